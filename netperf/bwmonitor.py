@@ -2,8 +2,11 @@
 # This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
 # See the file LICENSE for full license details.
 
-# This script runs a daemon which measures traffic on a network interface
-# and sends RX/TX bits-per-second readings to the Network Performance Monitor database
+# This script runs a daemon which measures traffic on one or more network interfaces
+# (bwmonitor.py -i <interface>[,<interface>...]) and sends RX/TX bits-per-second readings to the Network Performance Monitor database.
+# The interface counters can be sampled several times per second (bandwidth_monitor/sample_rate setting),
+# the samples are aggregated into one reading per second so that short bursts show up in the peak rates
+# without increasing the number of database rows.
 
 import sys
 import daemon
@@ -12,6 +15,8 @@ import time
 import getopt,sys
 import util
 import logging
+import posix_ipc
+from array import array
 from netperf_db import db_queue
 from netperf_settings import netperf_settings
 
@@ -21,55 +26,305 @@ logging.basicConfig(filename=NETPERF_SETTINGS.get_log_filename(), format=NETPERF
 bwmonitor_log = logging.getLogger('bwmonitor')
 bwmonitor_log.setLevel(NETPERF_SETTINGS.get_log_level())
 
-def bwmonitor(interface):
+class sample_ring:
+	# preallocated ring buffer of (rx_bps, tx_bps) samples. The samples of each reporting interval are
+	# aggregated in place, so sub-second sampling does not allocate memory or send a message per sample.
+	def __init__(self, capacity):
+		self.capacity = capacity
+		self.rx_bps = array("d", [0.0] * capacity)
+		self.tx_bps = array("d", [0.0] * capacity)
+		self.head = 0
+		self.count = 0
+
+	def add(self, rx_bps, tx_bps):
+		self.rx_bps[self.head] = rx_bps
+		self.tx_bps[self.head] = tx_bps
+		self.head = (self.head + 1) % self.capacity
+		# when the ring is full the oldest sample is overwritten
+		self.count = min(self.count + 1, self.capacity)
+
+	def aggregate(self):
+		# returns (sample count, rx_bps min, rx_bps max, tx_bps min, tx_bps max) of the samples added since
+		# the previous call, and empties the ring. Returns None if there are no samples.
+		if self.count == 0:
+			return None
+		start = (self.head - self.count) % self.capacity
+		if start + self.count <= self.capacity:
+			rx = self.rx_bps[start:start + self.count]
+			tx = self.tx_bps[start:start + self.count]
+		else:
+			rx = self.rx_bps[start:] + self.rx_bps[:self.head]
+			tx = self.tx_bps[start:] + self.tx_bps[:self.head]
+		result = (self.count, min(rx), max(rx), min(tx), max(tx))
+		self.count = 0
+		return result
+
+class sysfs_counters:
+	# reads the byte counters of a single interface from sysfs
+	def __init__(self, interface):
+		self.interface = interface
+		STATS_PATH="/sys/class/net/{}/statistics".format(interface)
+		try:
+			self.rx_bytes_file = open("{}/rx_bytes".format(STATS_PATH))
+		except:
+			sys.exit(2)
+		try:
+			self.tx_bytes_file = open("{}/tx_bytes".format(STATS_PATH))
+		except:
+			sys.exit(2)
+
+	def read(self):
+		# returns a dictionary mapping the interface name to its (rx_bytes, tx_bytes) counters
+		self.rx_bytes_file.seek(0)
+		rx_bytes = int(self.rx_bytes_file.read().strip())
+		self.tx_bytes_file.seek(0)
+		tx_bytes = int(self.tx_bytes_file.read().strip())
+		return { self.interface : (rx_bytes, tx_bytes) }
+
+class proc_net_dev_counters:
+	# reads the byte counters of several interfaces with a single read of /proc/net/dev into a reused buffer.
+	# /proc/net/dev lists the interfaces of the network namespace of the process, so all of the watched
+	# interfaces must be in the same namespace.
+	def __init__(self, interfaces):
+		self.interfaces = set(interfaces)
+		self.buffer = bytearray(16384)
+		try:
+			self.file = open("/proc/net/dev", "rb", buffering=0)
+		except:
+			sys.exit(2)
+		missing = self.interfaces - set(self.read())
+		if len(missing) > 0:
+			bwmonitor_log.error("Interfaces not found: {}".format(", ".join(sorted(missing))))
+			sys.exit(2)
+
+	def read(self):
+		# returns a dictionary mapping the name of each watched interface to its (rx_bytes, tx_bytes) counters
+		self.file.seek(0)
+		size = 0
+		while True:
+			if size == len(self.buffer):
+				self.buffer.extend(bytes(len(self.buffer)))
+			with memoryview(self.buffer) as view:
+				count = self.file.readinto(view[size:])
+			if not count:
+				break
+			size += count
+		counters = {}
+		# the first two lines are column headers. Each interface line is "<name>: <rx bytes> <rx packets> ...",
+		# with the transmit counters starting at the ninth field.
+		for line in self.buffer[:size].split(b"\n")[2:]:
+			(name, separator, fields) = line.partition(b":")
+			name = name.strip().decode()
+			if separator and name in self.interfaces:
+				fields = fields.split()
+				counters[name] = (int(fields[0]), int(fields[8]))
+		return counters
+
+class interface_meter:
+	# converts the byte counter samples of one interface into bandwidth readings, one per reporting interval.
+	# Sample times are monotonic clock readings in nanoseconds, so rates are not affected by wall clock steps.
+	def __init__(self, interface, sample_rate, max_counter):
+		self.interface = interface
+		self.max_counter = max_counter
+		# room for the samples of two intervals, in case sending a message is delayed
+		self.ring = sample_ring(2 * sample_rate)
+		self.sub_second = sample_rate > 1
+		self.last_rx_bytes = None
+		self.last_tx_bytes = None
+		self.last_time_ns = None
+		self.interval_start_ns = None
+		self.interval_rx_bytes = 0
+		self.interval_tx_bytes = 0
+
+	def add_sample(self, sample_time_ns, rx_bytes, tx_bytes):
+		if self.last_time_ns is not None:
+			rx_bytes_delta = rx_bytes - self.last_rx_bytes if rx_bytes >= self.last_rx_bytes else self.max_counter - self.last_rx_bytes + rx_bytes + 1
+			tx_bytes_delta = tx_bytes - self.last_tx_bytes if tx_bytes >= self.last_tx_bytes else self.max_counter - self.last_tx_bytes + tx_bytes + 1
+			self.interval_rx_bytes += rx_bytes_delta
+			self.interval_tx_bytes += tx_bytes_delta
+			time_delta = (sample_time_ns - self.last_time_ns) / 1e9
+			if time_delta > 0:
+				self.ring.add(float(rx_bytes_delta * 8) / time_delta, float(tx_bytes_delta * 8) / time_delta)
+		else:
+			self.interval_start_ns = sample_time_ns
+		self.last_time_ns = sample_time_ns
+		self.last_rx_bytes = rx_bytes
+		self.last_tx_bytes = tx_bytes
+
+	def reading(self, end_time_ns):
+		# returns the reading for the interval ending at end_time_ns and starts the next interval. Returns None
+		# if the interface has not been sampled during the interval.
+		if self.interval_start_ns is None or end_time_ns <= self.interval_start_ns:
+			return None
+		interval_time = (end_time_ns - self.interval_start_ns) / 1e9
+		reading = { "rx_bytes" : self.interval_rx_bytes, \
+				"tx_bytes" : self.interval_tx_bytes, \
+				"rx_bps" : float(self.interval_rx_bytes * 8) / interval_time, \
+				"tx_bps" : float(self.interval_tx_bytes * 8) / interval_time }
+		samples = self.ring.aggregate()
+		if self.sub_second and samples is not None:
+			(sample_count, rx_bps_min, rx_bps_max, tx_bps_min, tx_bps_max) = samples
+			reading.update({ "sample_count" : sample_count, \
+					"rx_bps_min" : rx_bps_min, \
+					"rx_bps_max" : rx_bps_max, \
+					"tx_bps_min" : tx_bps_min, \
+					"tx_bps_max" : tx_bps_max })
+		self.interval_start_ns = end_time_ns
+		self.interval_rx_bytes = 0
+		self.interval_tx_bytes = 0
+		return reading
+
+class tick_scheduler:
+	# absolute deadline scheduler on the monotonic clock: tick n is due at start + n * period, so the time
+	# spent sampling and sending messages does not accumulate as drift. Ticks whose deadline has passed by
+	# a whole period are skipped (and counted) rather than run back to back.
+	# The clock and sleep functions can be replaced by a simulated clock (see tools/simulate_bwmonitor.py).
+	def __init__(self, period_ns, clock = time.monotonic_ns, sleep = time.sleep):
+		self.period_ns = period_ns
+		self.clock = clock
+		self.sleep = sleep
+		self.start_ns = clock()
+		self.tick = 0
+
+	def deadline(self, tick):
+		return self.start_ns + tick * self.period_ns
+
+	def wait(self):
+		# waits until the next tick is due, returns the number of ticks that were missed
+		self.tick += 1
+		now = self.clock()
+		missed = 0
+		if now >= self.deadline(self.tick) + self.period_ns:
+			missed = (now - self.deadline(self.tick)) // self.period_ns
+			self.tick += missed
+		delay = self.deadline(self.tick) - now
+		if delay > 0:
+			self.sleep(delay / 1e9)
+		return missed
+
+class bandwidth_sampler:
+	# collects the counter samples of the watched interfaces, returns one message per second. The reporting
+	# intervals are aligned to the scheduler ticks (every <sample_rate> ticks), rates are computed from the
+	# monotonic sample times and the wall clock time is only used as the timestamp of the stored readings.
+	def __init__(self, client_id, interfaces, sample_rate, max_counter):
+		self.client_id = client_id
+		self.interfaces = interfaces
+		self.sample_rate = sample_rate
+		self.meters = [interface_meter(interface, sample_rate, max_counter) for interface in interfaces]
+		self.next_report_tick = None
+
+	def sample(self, tick, sample_time_ns, wall_time, interface_counters):
+		# records the counters read at scheduler tick <tick>. Returns the message for the interval ending
+		# with this sample, or None.
+		for meter in self.meters:
+			if meter.interface in interface_counters:
+				(rx_bytes, tx_bytes) = interface_counters[meter.interface]
+				meter.add_sample(sample_time_ns, rx_bytes, tx_bytes)
+		if self.next_report_tick is None:
+			self.next_report_tick = (tick // self.sample_rate + 1) * self.sample_rate
+			return None
+		if tick < self.next_report_tick:
+			return None
+		# after missed ticks, the interval ends with the first sample taken after its scheduled end
+		self.next_report_tick = (tick // self.sample_rate + 1) * self.sample_rate
+		if len(self.meters) == 1:
+			reading = self.meters[0].reading(sample_time_ns)
+			if reading is None:
+				return None
+			bw_data = { "type" : "bandwidth", \
+					"data" : {  "client_id" : self.client_id, \
+					"timestamp" : wall_time } }
+			bw_data["data"].update(reading)
+			return bw_data
+		readings = []
+		for meter in self.meters:
+			reading = meter.reading(sample_time_ns)
+			if reading is not None:
+				reading["interface"] = meter.interface
+				readings.append(reading)
+		if len(readings) == 0:
+			return None
+		return { "type" : "interface_bandwidth", \
+				"data" : {  "client_id" : self.client_id, \
+				"timestamp" : wall_time, \
+				"primary_interface" : self.interfaces[0], \
+				"interfaces" : readings } }
+
+def bwmonitor(interfaces, sample_rate = 1):
+	# samples the counters of the given interfaces <sample_rate> times per second and sends one message per
+	# second. rx_bps/tx_bps are the mean rates of the second; at sample rates above 1 Hz the readings also
+	# contain the number of samples and the minimum and maximum rate between consecutive samples.
+	# A single interface is read from sysfs and reported with a bandwidth message. Several interfaces are
+	# read together from /proc/net/dev and reported with one interface_bandwidth message per second; the
+	# first interface is the primary interface, its readings are also stored in the bandwidth table.
 	client_id = util.get_client_id()
 	os_word_size = 64 if sys.maxsize > 2**32 else 32
 	MAXUINT = (2 ** os_word_size) - 1
-	STATS_PATH="/sys/class/net/{}/statistics".format(interface)
-	try:
-		rx_bytes_file = open("{}/rx_bytes".format(STATS_PATH))
-	except:
-		sys.exit(2)
-	try:
-		tx_bytes_file = open("{}/tx_bytes".format(STATS_PATH))
-	except:
-		sys.exit(2)
-	last_rx_bytes = None
-	last_tx_bytes = None
-	last_time = None
-	dbq = db_queue()
+	if len(interfaces) == 1:
+		counters = sysfs_counters(interfaces[0])
+	else:
+		counters = proc_net_dev_counters(interfaces)
+	sampler = bandwidth_sampler(client_id, interfaces, sample_rate, MAXUINT)
+	scheduler = tick_scheduler(1000000000 // sample_rate)
+	# the readings of the last few minutes are also published to a shared memory ring (see bwring.py)
+	ring = None
+	ring_minutes = NETPERF_SETTINGS.get_bandwidth_monitor_ring_minutes()
+	if ring_minutes > 0:
+		from bwring import bandwidth_ring_writer
+		try:
+			ring = bandwidth_ring_writer(ring_minutes * 60)
+		except OSError as e:
+			bwmonitor_log.error("unable to create the shared memory bandwidth ring: {}".format(e))
+	sampling_loop(counters, sampler, scheduler, db_queue(), ring=ring)
+
+def ring_reading(bw_data):
+	# returns the reading of the primary interface of a bandwidth message in the format of the shared memory
+	# ring, None if the message does not contain it. At one sample per second the peak rates are the mean rates.
+	data = bw_data["data"]
+	reading = data
+	if bw_data["type"] == "interface_bandwidth":
+		reading = None
+		for r in data["interfaces"]:
+			if r["interface"] == data["primary_interface"]:
+				reading = r
+		if reading is None:
+			return None
+	return { "timestamp" : data["timestamp"], \
+		"rx_bytes" : reading["rx_bytes"], \
+		"tx_bytes" : reading["tx_bytes"], \
+		"rx_bps" : reading["rx_bps"], \
+		"tx_bps" : reading["tx_bps"], \
+		"rx_bps_max" : reading.get("rx_bps_max", reading["rx_bps"]), \
+		"tx_bps_max" : reading.get("tx_bps_max", reading["tx_bps"]) }
+
+def sampling_loop(counters, sampler, scheduler, dbq, wall_clock = time.time, ring = None):
+	# reads the counters at each scheduler tick, publishes the sampler's readings to the shared memory ring
+	# and sends them to the database queue
+	dropped_messages = 0
 	while True:
-		loop_start_time = time.time()
-		rx_bytes_file.seek(0)
-		rx_bytes = int(rx_bytes_file.read().strip())
-		tx_bytes_file.seek(0)
-		tx_bytes = int(tx_bytes_file.read().strip())
-		if last_time is not None:
-			rx_bytes_delta = rx_bytes - last_rx_bytes if rx_bytes >= last_rx_bytes else MAXUINT - last_rx_bytes + rx_bytes + 1
-			tx_bytes_delta = tx_bytes - last_tx_bytes if tx_bytes >= last_tx_bytes else MAXUINT - last_tx_bytes + tx_bytes + 1
-			time_delta = loop_start_time - last_time
-			rx_bps = float(rx_bytes_delta * 8) / time_delta
-			tx_bps = float(tx_bytes_delta * 8) / time_delta
-			bw_data = { "type" : "bandwidth", \
-						"data" : {  "client_id" : client_id, \
-						"timestamp" : loop_start_time, \
-						"rx_bytes" : rx_bytes_delta, \
-						"tx_bytes" : tx_bytes_delta, \
-						"rx_bps" : rx_bps, \
-						"tx_bps" : tx_bps}
-			}
-			dbq.write(bw_data)
-		last_time = loop_start_time
-		last_rx_bytes = rx_bytes
-		last_tx_bytes = tx_bytes
-
-		# sleep off remaining time
-		sleeptime = 1.0 - (time.time() - loop_start_time)
-		if (sleeptime > 0):
+		sample_time_ns = scheduler.clock()
+		wall_time = wall_clock()
+		bw_data = sampler.sample(scheduler.tick, sample_time_ns, wall_time, counters.read())
+		if bw_data is not None:
+			if ring is not None:
+				reading = ring_reading(bw_data)
+				if reading is not None:
+					ring.append(reading)
+			# never block the sampling loop on a full queue (e.g. while the database daemon is stopped),
+			# the reading is dropped instead
 			try:
-				time.sleep (sleeptime)
-			except:
-				pass
+				dbq.write(bw_data, timeout=0)
+				if dropped_messages > 0:
+					bwmonitor_log.warning("database queue available again, {} readings were dropped".format(dropped_messages))
+					dropped_messages = 0
+			except posix_ipc.BusyError:
+				if dropped_messages == 0:
+					bwmonitor_log.warning("database queue is full, dropping readings")
+				dropped_messages += 1
+		missed_ticks = scheduler.wait()
+		if missed_ticks > 0:
+			# the missed samples are also reflected in the sample_count of the reading
+			bwmonitor_log.warning("sampling stalled, {} ticks missed".format(missed_ticks))
 
 if __name__ == '__main__':
 	bwmonitor_log.debug("__main__")
@@ -85,11 +340,14 @@ if __name__ == '__main__':
 			bwmonitor_log.error(str(err))
 			sys.exit(2)
 
-	interface = None
+	interfaces = []
 	bwmonitor_log.debug("Processing argument list...")
 	for currentArgument, currentValue in arguments:
 		if currentArgument in ("-i", "--interface"):
-			interface = currentValue
+			# several interfaces can be given as a comma separated list or with repeated -i options
+			for interface in currentValue.split(","):
+				if interface != "" and interface not in interfaces:
+					interfaces.append(interface)
 		if currentArgument in ("-l", "--loglevel"):
 			loglevel = currentValue.lower
 			if loglevel == "debug":
@@ -102,15 +360,15 @@ if __name__ == '__main__':
 				bwmonitor_log.setLevel(logging.ERROR)
 			if loglevel == "critical":
 				bwmonitor_log.setLevel(logging.CRITICAL)
-	bwmonitor_log.debug("Watching interface: {}".format(interface))
-	if interface == None:
+	bwmonitor_log.debug("Watching interfaces: {}".format(", ".join(interfaces)))
+	if len(interfaces) == 0:
 		print ("Error: an interface is required.")
 		bwmonitor_log.error("An interface is required.")
 		sys.exit(2)
 
 	daemon_context = daemon.DaemonContext()
 	with daemon_context:
-		bwmonitor(interface)
+		bwmonitor(interfaces, NETPERF_SETTINGS.get_bandwidth_monitor_sample_rate())
 
 
 
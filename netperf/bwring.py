@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# Shared memory ring buffer of the most recent bandwidth monitor readings. The bandwidth monitor publishes
+# each reading of its (primary) interface to a memory mapped file under /dev/shm; readers map the same file
+# and get NumPy views of the recent readings without going through the database or the message queues.
+#
+# file layout: header (64 bytes), followed by the records, each one row of RING_COLUMNS stored as float64.
+#	header: magic, format version, capacity (records), number of columns, sequence counter, record count
+# Each record is written twice, at slot i and at slot i + capacity (with i = record number % capacity), so the
+# most recent n records are always the contiguous slots [h + capacity - n, h + capacity), h = record count %
+# capacity, and can be returned as a view without copying.
+#
+# The sequence counter works as a seqlock: the writer makes it odd before it modifies a record and even again
+# after the record count has been updated. A reader that sees the same even value before and after reading
+# the record count has a consistent view of the ring. The views returned to readers alias the shared memory:
+# a record is overwritten after <capacity> further readings, so a view of the last n records stays valid for
+# capacity - n seconds; snapshot returns checked copies instead.
+# A single writer (one bandwidth monitor process) is supported. The writer replaces the file when it starts,
+# readers notice the new file and map it again.
+
+import os
+import mmap
+import time
+import struct
+import numpy as np
+
+RING_FILENAME = "/dev/shm/netperf_bandwidth"
+RING_MAGIC = b"NPBWRING"
+RING_VERSION = 1
+RING_HEADER = struct.Struct("<8sIII")
+RING_HEADER_SIZE = 64
+RING_COUNTER = struct.Struct("<Q")
+RING_SEQUENCE_OFFSET = 32
+RING_COUNT_OFFSET = 40
+RING_COLUMNS = ["timestamp", "rx_bytes", "tx_bytes", "rx_bps", "tx_bps", "rx_bps_max", "tx_bps_max"]
+
+def ring_size(capacity):
+	return RING_HEADER_SIZE + 2 * capacity * len(RING_COLUMNS) * 8
+
+class bandwidth_ring_writer:
+	def __init__(self, capacity, filename = RING_FILENAME):
+		self.capacity = capacity
+		self.sequence = 0
+		self.count = 0
+		# the ring is built in a temporary file which then replaces the previous ring, so readers never map
+		# a partially initialised file
+		temp_filename = "{}.{}".format(filename, os.getpid())
+		fd = os.open(temp_filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+		try:
+			os.ftruncate(fd, ring_size(capacity))
+			self.mm = mmap.mmap(fd, ring_size(capacity))
+		finally:
+			os.close(fd)
+		RING_HEADER.pack_into(self.mm, 0, RING_MAGIC, RING_VERSION, capacity, len(RING_COLUMNS))
+		self.records = np.frombuffer(self.mm, dtype=np.float64, count=2 * capacity * len(RING_COLUMNS), \
+				offset=RING_HEADER_SIZE).reshape(2 * capacity, len(RING_COLUMNS))
+		os.rename(temp_filename, filename)
+
+	def append(self, reading):
+		# appends a reading (a dictionary with the RING_COLUMNS keys)
+		record = [reading[c] for c in RING_COLUMNS]
+		slot = self.count % self.capacity
+		self.sequence += 1
+		RING_COUNTER.pack_into(self.mm, RING_SEQUENCE_OFFSET, self.sequence)
+		self.records[slot] = record
+		self.records[slot + self.capacity] = record
+		self.count += 1
+		RING_COUNTER.pack_into(self.mm, RING_COUNT_OFFSET, self.count)
+		self.sequence += 1
+		RING_COUNTER.pack_into(self.mm, RING_SEQUENCE_OFFSET, self.sequence)
+
+class bandwidth_ring_reader:
+	def __init__(self, filename = RING_FILENAME):
+		self.filename = filename
+		self.inode = None
+		self.mm = None
+		self.records = None
+		self.capacity = 0
+
+	def map(self):
+		# maps the ring file, again if the writer has replaced it. Returns False if there is no valid ring.
+		try:
+			inode = os.stat(self.filename).st_ino
+		except OSError:
+			self.inode = None
+			self.records = None
+			return False
+		if inode == self.inode:
+			return self.records is not None
+		self.inode = inode
+		self.records = None
+		try:
+			fd = os.open(self.filename, os.O_RDONLY)
+			try:
+				size = os.fstat(fd).st_size
+				if size < RING_HEADER_SIZE:
+					return False
+				mm = mmap.mmap(fd, size, prot=mmap.PROT_READ)
+			finally:
+				os.close(fd)
+		except OSError:
+			return False
+		(magic, version, capacity, columns) = RING_HEADER.unpack_from(mm, 0)
+		if magic != RING_MAGIC or version != RING_VERSION or columns != len(RING_COLUMNS) or size < ring_size(capacity):
+			return False
+		self.mm = mm
+		self.capacity = capacity
+		self.records = np.frombuffer(mm, dtype=np.float64, count=2 * capacity * columns, \
+				offset=RING_HEADER_SIZE).reshape(2 * capacity, columns)
+		return True
+
+	def read(self, rows = None):
+		# returns (dictionary of column name -> NumPy view of the most recent <rows> readings (all readings in the
+		# ring if rows is None), oldest first, record count), or None if there is no ring or no consistent
+		# record count could be read
+		if not self.map():
+			return None
+		for attempt in range(1000):
+			sequence = RING_COUNTER.unpack_from(self.mm, RING_SEQUENCE_OFFSET)[0]
+			if sequence & 1:
+				# a reading is being written
+				time.sleep(0)
+				continue
+			count = RING_COUNTER.unpack_from(self.mm, RING_COUNT_OFFSET)[0]
+			if RING_COUNTER.unpack_from(self.mm, RING_SEQUENCE_OFFSET)[0] == sequence:
+				n = min(count, self.capacity)
+				if rows is not None:
+					n = min(n, max(int(rows), 0))
+				end = count % self.capacity + self.capacity
+				view = self.records[end - n:end]
+				return (dict([(c, view[:,i]) for (i, c) in enumerate(RING_COLUMNS)]), count)
+		# the sequence counter stays odd if the writer died while appending a reading
+		return None
+
+	def snapshot(self, rows = None):
+		# like read, but returns copies of the readings that are checked against the sequence counter, for
+		# readers that keep the arrays or that may be slower than the writer. Returns None if there is no ring
+		# or no consistent copy could be made.
+		if not self.map():
+			return None
+		for attempt in range(1000):
+			sequence = RING_COUNTER.unpack_from(self.mm, RING_SEQUENCE_OFFSET)[0]
+			if sequence & 1:
+				time.sleep(0)
+				continue
+			count = RING_COUNTER.unpack_from(self.mm, RING_COUNT_OFFSET)[0]
+			n = min(count, self.capacity)
+			if rows is not None:
+				n = min(n, max(int(rows), 0))
+			end = count % self.capacity + self.capacity
+			records = np.array(self.records[end - n:end])
+			if RING_COUNTER.unpack_from(self.mm, RING_SEQUENCE_OFFSET)[0] == sequence:
+				return (dict([(c, records[:,i]) for (i, c) in enumerate(RING_COLUMNS)]), count)
+		return None
+
+	def recent(self, seconds):
+		# returns a dictionary of column name -> NumPy view of the readings of the last <seconds> seconds,
+		# oldest first, or None if there is no ring (see read)
+		result = self.read()
+		if result is None:
+			return None
+		(columns, count) = result
+		first = np.searchsorted(columns["timestamp"], time.time() - seconds)
+		return dict([(c, v[first:]) for (c, v) in columns.items()])
@@ -231,6 +231,8 @@ for interface in network_interfaces:
 	os.system ("{} /usr/sbin/sshd -o PidFile={}/sshd-{}.pid".format(cmd_prefix,RUN_PATH,interface))
 	configure_log.info("Starting iperf3 server daemon in netowrk namespace {}".format(if_details['namespace']))
 	os.system("{} /usr/bin/iperf3 -D -s -i 1 --pidfile {}/iperf3-{}.pid > /tmp/{}_iperf3.log".format(cmd_prefix,RUN_PATH,interface,interface))
+	configure_log.info("Starting tcpprobe responder in network namespace {}".format(if_details['namespace']))
+	os.system("{} python3 /opt/netperf/tcpprobe.py -s -D -p {} --pidfile {}/tcpprobe-{}.pid".format(cmd_prefix,NETPERF_SETTINGS.get_local_tests_tcpprobe_port(),RUN_PATH,interface))
 	#os.system("/bin/sed -i " +"\"/" + if_details['alias'] + "/d\"" + " /etc/hosts")
 	os.system("/bin/sed -i \"/{}/d\" /etc/hosts".format(if_details['alias']))
 
@@ -20,12 +20,18 @@ from kombu import Queue
 # insert at 1, 0 is the script path (or '' in REPL)
 sys.path.insert(1, '/opt/netperf')
 
-from netperf_db import netperf_db,dashboard_queue
+from netperf_db import db_pool,dashboard_queue
+from bwring import bandwidth_ring_reader
 from netperf_settings import netperf_settings
 from time_bins import time_bins
 from util import fractional_hour
 
 SIO_NAMESPACE="/dashboard"
+# read-only database connections reused by the tasks of each worker process
+DB_POOL=db_pool()
+# recent bandwidth readings published by the bandwidth monitor in shared memory
+BANDWIDTH_RING=bandwidth_ring_reader()
+BANDWIDTH_USAGE_BIN_MINUTES=10
 MQ_HOST="localhost"
 MQ_VHOST="netperf"
 MQ_USER="netperf"
@@ -58,15 +64,58 @@ socketio = SocketIO(app, async_handlers=True, async_mode=async_mode, message_que
 thread = None
 thread_lock = Lock()
 
+def emit_ring_readings(ring, last_count):
+	# sends the readings published to the shared memory bandwidth ring since the ring's record count was
+	# <last_count> as bandwidth events, returns the current record count
+	result = ring.read()
+	if result is None:
+		return None
+	(readings, count) = result
+	if last_count is None or count < last_count:
+		# first poll, or the bandwidth monitor has been restarted
+		return count
+	new_readings = min(count - last_count, len(readings["timestamp"]))
+	now = time.time()
+	for i in range(len(readings["timestamp"]) - new_readings, len(readings["timestamp"])):
+		timestamp = float(readings["timestamp"][i])
+		# discard stale readings
+		if now - timestamp >= 1:
+			continue
+		bandwidth_data = { "timestamp" : timestamp, \
+				"rx_bytes" : int(readings["rx_bytes"][i]), \
+				"tx_bytes" : int(readings["tx_bytes"][i]), \
+				"rx_bps" : float(readings["rx_bps"][i]), \
+				"tx_bps" : float(readings["tx_bps"][i]) }
+		socketio.emit("bandwidth",bandwidth_data,namespace=SIO_NAMESPACE, broadcast=True)
+	return count
+
+def ring_bandwidth_rows(rows):
+	# returns the most recent <rows> bandwidth readings (newest first) from the shared memory ring, or None if
+	# the ring is not being updated by the bandwidth monitor
+	result = BANDWIDTH_RING.read(rows)
+	if result is None:
+		return None
+	readings = result[0]
+	if len(readings["timestamp"]) == 0 or time.time() - readings["timestamp"][-1] > 5:
+		return None
+	return [ { "timestamp" : t, "rx_bps" : rx_bps, "tx_bps" : tx_bps, "rx_bps_max" : rx_bps_max, "tx_bps_max" : tx_bps_max } \
+			for (t, rx_bps, tx_bps, rx_bps_max, tx_bps_max) in zip(readings["timestamp"][::-1].tolist(), \
+			readings["rx_bps"][::-1].tolist(), readings["tx_bps"][::-1].tolist(), \
+			readings["rx_bps_max"][::-1].tolist(), readings["tx_bps_max"][::-1].tolist()) ]
+
 def background_thread():
 	NETPERF_SETTINGS = netperf_settings()
-	db = netperf_db(NETPERF_SETTINGS.get_db_filename())
 	if NETPERF_SETTINGS.get_dashboard_enabled() == True:
 		dashboard_q = dashboard_queue(NETPERF_SETTINGS.get_dashboard_queue_name())
 	else:
 		dashboard_q = None
 		return
+	# when the bandwidth monitor publishes its readings in shared memory, the database daemon does not
+	# forward them to the dashboard queue
+	ring = bandwidth_ring_reader()
+	ring_count = None
 	while True:
+		ring_count = emit_ring_readings(ring, ring_count)
 		try:
 			(message, priority) = dashboard_q.read()
 		except:
@@ -76,11 +125,19 @@ def background_thread():
 		type = message.get("type",None)
 		data = message.get("data",None)
 		if type is not None and data is not None:
-			if type in {"bandwidth"}:
+			if type in {"bandwidth", "interface_bandwidth"}:
 				timestamp = data["timestamp"]
 				# discard stale bandwidth reading messages
 				if time.time() - timestamp >= 1:
 					continue
+			if type == "interface_bandwidth":
+				# a bandwidth monitor watching several interfaces: the primary interface readings are
+				# also sent as a bandwidth event
+				for reading in data.get("interfaces", []):
+					if reading.get("interface", None) == data.get("primary_interface", None):
+						bandwidth_data = dict(reading, client_id=data.get("client_id", None), timestamp=data["timestamp"])
+						del bandwidth_data["interface"]
+						socketio.emit("bandwidth",bandwidth_data,namespace=SIO_NAMESPACE, broadcast=True)
 			socketio.emit(type,data,namespace=SIO_NAMESPACE, broadcast=True)
 		else:
 			# type and/or data is None, skip this message
@@ -94,8 +151,14 @@ def connect():
 			thread = socketio.start_background_task(background_thread)
 
 def dbQuery(queryType, data = None):
-	NETPERF_SETTINGS = netperf_settings()
-	db = netperf_db(NETPERF_SETTINGS.get_db_filename())
+	db = DB_POOL.acquire()
+	try:
+		rowData = dbQueryRows(db, queryType, data)
+	finally:
+		DB_POOL.release(db)
+	return rowData
+
+def dbQueryRows(db, queryType, data):
 	queryDate = datetime.date.today()
 	if data is not None:
 		if "queryDateTimestamp" in data:
@@ -116,7 +179,7 @@ def dbQuery(queryType, data = None):
 					rowData = db.get_dns_data(queryDate)
 				else:
 					if queryType == 'bandwidth_usage':
-						rowData = db.get_bandwidth_data(queryDate)
+						rowData = db.get_bandwidth_rollup(queryDate, BANDWIDTH_USAGE_BIN_MINUTES)
 	return rowData
 
 @celery.task
@@ -141,26 +204,32 @@ def async_task(request_event = None, data = None, requester_sid = None):
 		response_data = {'settings': nps.settings_json}
 	elif request_event == 'get_bandwidth_data':
 		response_event = 'bandwidth_data'
-		nps = netperf_settings()
-		db = netperf_db(nps.get_db_filename())
-		if (data is not None) and ("minutes" in data):
-			response_data = db.get_bandwidth_data(minutes=data['minutes'])
-		else:
-			if (data is not None) and ("rows" in data):
-				response_data = db.get_bandwidth_data(rows=data["rows"])
-			else:
-				response_data = db.get_bandwidth_data(datetime.date.today())
+		if (data is not None) and ("rows" in data) and ("minutes" not in data):
+			# the most recent readings are read from shared memory when available
+			response_data = ring_bandwidth_rows(data["rows"])
+		if response_data is None:
+			db = DB_POOL.acquire()
+			try:
+				if (data is not None) and ("minutes" in data):
+					response_data = db.get_bandwidth_data(minutes=data['minutes'])
+				else:
+					if (data is not None) and ("rows" in data):
+						response_data = db.get_bandwidth_data(rows=data["rows"])
+					else:
+						response_data = db.get_bandwidth_data(datetime.date.today())
+			finally:
+				DB_POOL.release(db)
 	elif request_event == 'get_bandwidth_usage':
 		response_event = 'bandwidth_usage'
 		response_data = None
 		rows = dbQuery('bandwidth_usage',data)
+		averaged_data = None
 		if len(rows) > 0:
-			bin_width = 10
-			rx_tbins = time_bins(bin_width)
-			tx_tbins = time_bins(bin_width)
+			rx_tbins = time_bins(BANDWIDTH_USAGE_BIN_MINUTES)
+			tx_tbins = time_bins(BANDWIDTH_USAGE_BIN_MINUTES)
 			for r in rows:
-				rx_tbins.add_value(fractional_hour(r["timestamp"]),round(r["rx_bps"]/1e6))
-				tx_tbins.add_value(fractional_hour(r["timestamp"]),round(r["tx_bps"]/1e6))
+				rx_tbins.add_values(fractional_hour(r["timestamp"]),r["sample_count"],r["rx_bps_mean"]*r["sample_count"]/1e6)
+				tx_tbins.add_values(fractional_hour(r["timestamp"]),r["sample_count"],r["tx_bps_mean"]*r["sample_count"]/1e6)
 			averaged_data = {
 				'rx': [],
 				'tx': []
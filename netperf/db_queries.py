@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# SQL statements used by netperf_db. Every query is defined once, as a constant string that uses bound
+# parameters. Because the SQL text never changes, SQLite prepares each statement once per connection and
+# the sqlite3 module reuses the prepared statement from its cache on subsequent calls.
+# Tables are always referenced as main.<table>; in partitioned mode the statements are redirected to the
+# tables of an attached day partition by partition_sql.
+
+# tables that hold time series data (rows are deleted by the prune operation)
+TIMESERIES_TABLES = [ "isp_outages", "speedtest", "iperf3", "ping", "dns", "bandwidth", "data_usage", \
+			"bandwidth_1m", "bandwidth_10m", "bandwidth_1h", "bandwidth_chunks", "ping_chunks", "interface_bandwidth", \
+			"dns_servers" ]
+
+# bandwidth rollup tables maintained by the database writer: (table name, bucket width in seconds), coarsest first
+BANDWIDTH_ROLLUPS = [ ("bandwidth_1h", 3600), ("bandwidth_10m", 600), ("bandwidth_1m", 60) ]
+
+# tables whose rows can be packed into compressed chunks (see tschunk.py), one chunk per hour:
+# table -> (chunk table, key columns in addition to client_id, value columns)
+CHUNK_SOURCES = {
+	"bandwidth" : ("bandwidth_chunks", [], ["rx_bytes", "tx_bytes", "rx_bps", "tx_bps", "sample_count", "rx_bps_min", "rx_bps_max", "tx_bps_min", "tx_bps_max"]),
+	"ping" : ("ping_chunks", ["remote_host"], ["min", "avg", "max", "mdev", "packets_sent", "packets_received", "loss_pct", "jitter", \
+			"rtt_p50", "rtt_p90", "rtt_p99"])
+}
+# NULL values are stored as NaN. Chunks written before columns were added to a table have fewer columns, the
+# missing columns are read as NaN.
+CHUNK_SECONDS = 3600
+
+# latency under load columns of the speedtest table (see loadprobe.py): round trip time percentiles (ms) and
+# packet loss (%) of the idle, download and upload phases of the test
+SPEEDTEST_LATENCY_COLUMNS = ["{}_{}".format(phase, statistic) for phase in ("idle", "download", "upload") \
+		for statistic in ("latency_p50", "latency_p90", "latency_p99", "loss_pct")]
+
+# SQL statements used to insert one row of each message type
+INSERT_SQL = {
+	"isp_outage" : '''INSERT OR IGNORE INTO main.isp_outages(client_id,epoch_time)
+			VALUES(?,?);''',
+	"isp_outage_interval" : '''INSERT INTO main.isp_outage_intervals(client_id,epoch_time,end_time,ongoing,failed_rounds)
+			VALUES(?,?,?,?,?)
+			ON CONFLICT(client_id,epoch_time) DO UPDATE SET
+			end_time = max(end_time, excluded.end_time),
+			ongoing = min(ongoing, excluded.ongoing),
+			failed_rounds = max(coalesce(failed_rounds, 0), coalesce(excluded.failed_rounds, 0));''',
+	"ping" : '''INSERT OR IGNORE INTO main.ping(client_id,epoch_time,remote_host,min,avg,max,mdev,packets_sent,packets_received,loss_pct,jitter,rtt_p50,rtt_p90,rtt_p99)
+			VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?);''',
+	"iperf3" : '''INSERT OR IGNORE INTO main.iperf3(client_id,epoch_time,remote_host,rx_Mbps,tx_Mbps,retransmits,samples)
+			VALUES(?,?,?,?,?,?,?);''',
+	"speedtest" : '''INSERT OR IGNORE INTO main.speedtest(client_id,epoch_time,rx_Mbps,tx_Mbps,rx_bytes,tx_bytes,remote_host,url,ping,bwm_rx_Mbps,bwm_tx_Mbps,{})
+			VALUES(?,?,?,?,?,?,?,?,?,?,?,{});'''.format(",".join(SPEEDTEST_LATENCY_COLUMNS), ",".join(["?"] * len(SPEEDTEST_LATENCY_COLUMNS))),
+	"bandwidth" : '''INSERT OR IGNORE INTO main.bandwidth(client_id,epoch_time,rx_bytes,tx_bytes,rx_bps,tx_bps,sample_count,rx_bps_min,rx_bps_max,tx_bps_min,tx_bps_max)
+			VALUES(?,?,?,?,?,?,?,?,?,?,?);''',
+	"interface_bandwidth" : '''INSERT OR IGNORE INTO main.interface_bandwidth(client_id,epoch_time,interface,rx_bytes,tx_bytes,rx_bps,tx_bps,sample_count,rx_bps_min,rx_bps_max,tx_bps_min,tx_bps_max)
+			VALUES(?,?,?,?,?,?,?,?,?,?,?,?);''',
+	"dns" : '''INSERT OR IGNORE INTO main.dns(client_id,epoch_time,internal_dns_ok,internal_dns_query_time,internal_dns_failures,external_dns_ok,external_dns_query_time,external_dns_failures)
+			VALUES(?,?,?,?,?,?,?,?);''',
+	"dns_servers" : '''INSERT OR IGNORE INTO main.dns_servers(client_id,epoch_time,server,internal,ok,attempts,failures,rcode,query_time_us)
+			VALUES(?,?,?,?,?,?,?,?,?);''',
+	"data_usage" : '''INSERT OR IGNORE INTO main.data_usage(client_id,epoch_time,rxtx_bytes)
+			VALUES(?,?,?);''',
+	"data_usage_state" : '''INSERT OR REPLACE INTO main.data_usage_state(id,client_id,epoch_time,rxtx_bytes)
+			VALUES(0,?,?,?);'''
+}
+
+# rollup rows are merged into existing buckets: counts and sums are added, minimums and maximums are combined
+ROLLUP_COLUMNS = "client_id,epoch_time,sample_count,rx_bps_sum,rx_bps_min,rx_bps_max,rx_bps_sumsq,tx_bps_sum,tx_bps_min,tx_bps_max,tx_bps_sumsq"
+ROLLUP_MERGE_SQL = '''ON CONFLICT(client_id,epoch_time) DO UPDATE SET
+			sample_count = sample_count + excluded.sample_count,
+			rx_bps_sum = rx_bps_sum + excluded.rx_bps_sum,
+			rx_bps_min = min(rx_bps_min, excluded.rx_bps_min),
+			rx_bps_max = max(rx_bps_max, excluded.rx_bps_max),
+			rx_bps_sumsq = rx_bps_sumsq + excluded.rx_bps_sumsq,
+			tx_bps_sum = tx_bps_sum + excluded.tx_bps_sum,
+			tx_bps_min = min(tx_bps_min, excluded.tx_bps_min),
+			tx_bps_max = max(tx_bps_max, excluded.tx_bps_max),
+			tx_bps_sumsq = tx_bps_sumsq + excluded.tx_bps_sumsq'''
+for (table, bucket_seconds) in BANDWIDTH_ROLLUPS:
+	INSERT_SQL[table] = '''INSERT INTO main.{0}({1})
+			VALUES(?,?,?,?,?,?,?,?,?,?,?)
+			{2};'''.format(table, ROLLUP_COLUMNS, ROLLUP_MERGE_SQL)
+
+# the keys of the bandwidth rows stored in a time range, used to leave the rows of a batch that are already
+# stored out of the rollups. Parameters are (first time, last time).
+BANDWIDTH_KEYS_SQL = "SELECT client_id,epoch_time FROM main.bandwidth WHERE epoch_time >= ? AND epoch_time <= ?;"
+# the same for the rows of hours that have been packed into chunks: the chunks that start in the range
+BANDWIDTH_CHUNK_KEYS_SQL = "SELECT client_id,data FROM main.bandwidth_chunks WHERE epoch_time >= ? AND epoch_time <= ?;"
+
+# SELECT statements; result columns are aliased to the dictionary keys returned by netperf_db
+QUERIES = {
+	"isp_outages" : '''SELECT epoch_time AS timestamp FROM main.isp_outages
+			WHERE epoch_time >= ? AND epoch_time <= ?;''',
+	"isp_outage_intervals" : '''SELECT epoch_time AS start_time,end_time,ongoing,failed_rounds FROM main.isp_outage_intervals
+			WHERE end_time >= ? AND epoch_time <= ? ORDER BY epoch_time;''',
+	"speedtest" : '''SELECT epoch_time AS timestamp,rx_Mbps,tx_Mbps,rx_bytes,tx_bytes,ping,remote_host,url,bwm_rx_Mbps,bwm_tx_Mbps,{} FROM main.speedtest
+			WHERE epoch_time >= ? AND epoch_time <= ?;'''.format(",".join(SPEEDTEST_LATENCY_COLUMNS)),
+	"speedtest_data_usage" : '''SELECT COUNT(*) AS test_count, SUM(rx_bytes + tx_bytes) AS rxtx_bytes FROM main.speedtest
+			WHERE epoch_time >= ? AND epoch_time <= ?;''',
+	"data_usage" : '''SELECT rxtx_bytes FROM main.data_usage_state
+			WHERE id = 0;''',
+	"iperf3" : '''SELECT epoch_time AS timestamp,remote_host,rx_Mbps,tx_Mbps,retransmits FROM main.iperf3
+			WHERE epoch_time >= ? AND epoch_time <= ?;''',
+	"iperf3_interface" : '''SELECT epoch_time AS timestamp,rx_Mbps,tx_Mbps,retransmits FROM main.iperf3
+			WHERE remote_host = ? AND epoch_time >= ? AND epoch_time <= ?;''',
+	"iperf3_interface_samples" : '''SELECT epoch_time AS timestamp,samples FROM main.iperf3
+			WHERE remote_host = ? AND epoch_time >= ? AND epoch_time <= ? AND samples IS NOT NULL;''',
+	"iperf3_interfaces" : '''SELECT DISTINCT remote_host FROM main.iperf3
+			WHERE epoch_time >= ? AND epoch_time <= ?;''',
+	"ping_interface" : '''SELECT epoch_time AS timestamp,min,avg,max,mdev,packets_sent,packets_received,loss_pct,jitter,rtt_p50,rtt_p90,rtt_p99 FROM main.ping
+			WHERE remote_host = ? AND epoch_time >= ? AND epoch_time <= ?;''',
+	"ping_interface_outages" : '''SELECT epoch_time AS timestamp,min,avg,max,mdev,packets_sent,packets_received,loss_pct,jitter,rtt_p50,rtt_p90,rtt_p99 FROM main.ping
+			WHERE remote_host = ? AND epoch_time >= ? AND epoch_time <= ? AND (min = 0 OR max = 0);''',
+	"dns" : '''SELECT epoch_time AS timestamp,internal_dns_ok,internal_dns_query_time,internal_dns_failures,external_dns_ok,external_dns_query_time,external_dns_failures FROM main.dns
+			WHERE epoch_time >= ? AND epoch_time <= ?;''',
+	"dns_servers" : '''SELECT epoch_time AS timestamp,server,internal,ok,attempts,failures,rcode,query_time_us FROM main.dns_servers
+			WHERE epoch_time >= ? AND epoch_time <= ? ORDER BY epoch_time;''',
+	"last_bandwidth" : '''SELECT epoch_time AS timestamp,rx_bytes,tx_bytes,rx_bps,tx_bps,sample_count,rx_bps_min,rx_bps_max,tx_bps_min,tx_bps_max FROM main.bandwidth
+			ORDER BY epoch_time DESC LIMIT 1;''',
+	"bandwidth" : '''SELECT epoch_time AS timestamp,rx_bps,tx_bps,sample_count,rx_bps_min,rx_bps_max,tx_bps_min,tx_bps_max FROM main.bandwidth
+			WHERE epoch_time >= ? AND epoch_time <= ?;''',
+	"bandwidth_rows" : '''SELECT epoch_time AS timestamp,rx_bps,tx_bps,sample_count,rx_bps_min,rx_bps_max,tx_bps_min,tx_bps_max FROM main.bandwidth
+			ORDER BY epoch_time DESC LIMIT ?;''',
+	"interface_bandwidth" : '''SELECT epoch_time AS timestamp,rx_bytes,tx_bytes,rx_bps,tx_bps,sample_count,rx_bps_min,rx_bps_max,tx_bps_min,tx_bps_max FROM main.interface_bandwidth
+			WHERE interface = ? AND epoch_time >= ? AND epoch_time <= ? ORDER BY epoch_time;''',
+	"bandwidth_interfaces" : '''SELECT DISTINCT interface FROM main.interface_bandwidth
+			WHERE epoch_time >= ? AND epoch_time <= ?;'''
+}
+
+for (table, bucket_seconds) in BANDWIDTH_ROLLUPS:
+	QUERIES[table] = '''SELECT epoch_time AS timestamp,sample_count,rx_bps_sum,rx_bps_min,rx_bps_max,rx_bps_sumsq,tx_bps_sum,tx_bps_min,tx_bps_max,tx_bps_sumsq FROM main.{}
+			WHERE epoch_time >= ? AND epoch_time <= ? ORDER BY epoch_time;'''.format(table)
+
+# chunk queries: parameters are (first chunk start time, last chunk start time, start of the time range), the
+# decoded rows must be filtered by the caller. Chunks are read whole, so the first chunk start time of a
+# range is <start of range> - CHUNK_SECONDS.
+QUERIES["bandwidth_chunks"] = '''SELECT epoch_time AS timestamp,sample_count,data FROM main.bandwidth_chunks
+		WHERE epoch_time >= ? AND epoch_time <= ? AND end_time >= ? ORDER BY epoch_time;'''
+QUERIES["bandwidth_chunks_latest"] = '''SELECT epoch_time AS timestamp,sample_count,data FROM main.bandwidth_chunks
+		ORDER BY epoch_time DESC LIMIT ?;'''
+QUERIES["ping_interface_chunks"] = '''SELECT epoch_time AS timestamp,sample_count,data FROM main.ping_chunks
+		WHERE remote_host = ? AND epoch_time >= ? AND epoch_time <= ? AND end_time >= ? ORDER BY epoch_time;'''
+
+# statements used to pack the rows of one hour into chunks: the rows of the hour (key columns, epoch_time,
+# value columns), the data of an existing chunk for the same key and hour (rows that arrive late are merged
+# into it), and the deletion of the packed rows. The hour parameters are (start of hour, start of next hour).
+CHUNK_ROWS_SQL = {}
+CHUNK_DATA_SQL = {}
+CHUNK_DELETE_SQL = {}
+for (table, (chunk_table, key_columns, value_columns)) in CHUNK_SOURCES.items():
+	keys = ["client_id"] + key_columns
+	INSERT_SQL[chunk_table] = '''INSERT OR REPLACE INTO main.{0}({1},epoch_time,end_time,sample_count,data)
+			VALUES({2}?,?,?,?);'''.format(chunk_table, ",".join(keys), "?," * len(keys))
+	CHUNK_ROWS_SQL[table] = '''SELECT {1},epoch_time,{2} FROM main.{0}
+			WHERE epoch_time >= ? AND epoch_time < ? ORDER BY epoch_time;'''.format(table, ",".join(keys), ",".join(value_columns))
+	CHUNK_DATA_SQL[table] = '''SELECT data FROM main.{0}
+			WHERE {1} = ? AND epoch_time = ?;'''.format(chunk_table, " = ? AND ".join(keys))
+	CHUNK_DELETE_SQL[table] = "DELETE FROM main.{0} WHERE epoch_time >= ? AND epoch_time < ?;".format(table)
+
+# DELETE statements used to prune each time series table, deleting at most <limit> rows per statement:
+# parameters are (cutoff timestamp, limit)
+PRUNE_SQL = {}
+for table in TIMESERIES_TABLES:
+	PRUNE_SQL[table] = "DELETE FROM main.{0} WHERE rowid IN (SELECT rowid FROM main.{0} WHERE epoch_time < ? LIMIT ?);".format(table)
+
+# message types that are stored in the main database file in partitioned mode, all other rows are
+# stored in the partition file of the day given by their epoch_time
+UNPARTITIONED_TYPES = [ "data_usage_state", "isp_outage_interval" ]
+
+# outage intervals (stored in the main database file, also in partitioned mode) are pruned by their end time:
+# parameters are (cutoff timestamp)
+OUTAGE_INTERVALS_PRUNE_SQL = "DELETE FROM main.isp_outage_intervals WHERE end_time < ?;"
+
+# statements used to move the rows of a single-file database into day partitions: the oldest time in a
+# table, and the copy/delete pair that moves up to <limit> rows of one day. The copy statement is
+# formatted with the schema name of the partition. Parameters are (start of day, start of next day, limit).
+OLDEST_TIME_SQL = {}
+MIGRATE_COPY_SQL = {}
+MIGRATE_DELETE_SQL = {}
+for table in TIMESERIES_TABLES:
+	OLDEST_TIME_SQL[table] = "SELECT min(epoch_time) FROM main.{0};".format(table)
+	MIGRATE_COPY_SQL[table] = '''INSERT OR IGNORE INTO {{schema}}.{0} SELECT * FROM main.{0}
+			WHERE rowid IN (SELECT rowid FROM main.{0} WHERE epoch_time >= ? AND epoch_time < ? ORDER BY epoch_time LIMIT ?);'''.format(table)
+	MIGRATE_DELETE_SQL[table] = '''DELETE FROM main.{0}
+			WHERE rowid IN (SELECT rowid FROM main.{0} WHERE epoch_time >= ? AND epoch_time < ? ORDER BY epoch_time LIMIT ?);'''.format(table)
+# the rollup buckets of the main database are merged into the buckets the partition already has (rows written
+# to the partition while the main database was being moved)
+for (table, bucket_seconds) in BANDWIDTH_ROLLUPS:
+	MIGRATE_COPY_SQL[table] = '''INSERT INTO {{schema}}.{0}({1}) SELECT {1} FROM main.{0}
+			WHERE rowid IN (SELECT rowid FROM main.{0} WHERE epoch_time >= ? AND epoch_time < ? ORDER BY epoch_time LIMIT ?)
+			{2};'''.format(table, ROLLUP_COLUMNS, ROLLUP_MERGE_SQL)
+
+def partition_sql(sql, schema):
+	# returns the statement with its tables redirected to the attached database <schema>
+	return sql.replace("main.", schema + ".")
+
+# size of the per-connection prepared statement cache; large enough to hold every statement defined above
+STATEMENT_CACHE_SIZE = len(INSERT_SQL) + len(QUERIES) + len(PRUNE_SQL) + 3 * len(TIMESERIES_TABLES) + 3 * len(CHUNK_SOURCES) + 16
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# Asynchronous DNS probe: sends A record queries for a test name over UDP to the system resolver(s) and to a
+# list of external DNS servers, all servers concurrently, and measures the query time of each response in
+# microseconds. Each server is tried up to <attempts> times, a new socket and query ID is used for each attempt.
+# A server is considered to be working when it returns a NOERROR or NXDOMAIN response.
+#
+# The probe runs in the network namespace of the calling process. To probe from another namespace, run this
+# script in it (ip netns exec <namespace> dnsprobe.py), it prints the results as JSON:
+# usage: dnsprobe.py [-n <name>] [-e <server>[,<server>...]] [-a <attempts>] [-t <timeout seconds>] [-p <port>]
+
+import sys
+import json
+import time
+import random
+import struct
+import getopt
+import asyncio
+
+DNS_TEST_NAME = "www.example.com"
+DNS_QUERY_ATTEMPTS = 5
+DNS_QUERY_TIMEOUT = 2.0
+DNS_PORT = 53
+DNS_HEADER = struct.Struct("!HHHHHH")
+DNS_QTYPE_A = 1
+DNS_QCLASS_IN = 1
+DNS_FLAG_QR = 0x8000
+DNS_FLAG_RD = 0x0100
+DNS_RCODE_NOERROR = 0
+DNS_RCODE_NXDOMAIN = 3
+
+def system_nameservers(resolv_conf = "/etc/resolv.conf"):
+	# returns the name servers listed in resolv.conf (at most 3 are used by the resolver)
+	servers = []
+	try:
+		with open(resolv_conf, "r") as f:
+			for line in f:
+				fields = line.split()
+				if len(fields) >= 2 and fields[0] == "nameserver":
+					servers.append(fields[1])
+	except OSError:
+		pass
+	return servers[:3]
+
+def build_query(query_id, name, qtype = DNS_QTYPE_A):
+	# returns a standard query (recursion desired) for <name>
+	question = b"".join([bytes([len(label)]) + label.encode("ascii") for label in name.strip(".").split(".")]) + b"\x00"
+	return DNS_HEADER.pack(query_id, DNS_FLAG_RD, 1, 0, 0, 0) + question + struct.pack("!HH", qtype, DNS_QCLASS_IN)
+
+def parse_response(data, query):
+	# checks that <data> is the response to <query> (same ID and question), returns (rcode, answer count),
+	# or None if it is not
+	if len(data) < len(query) or data[:2] != query[:2]:
+		return None
+	(query_id, flags, qdcount, ancount, nscount, arcount) = DNS_HEADER.unpack_from(data, 0)
+	if not flags & DNS_FLAG_QR or qdcount != 1 or data[DNS_HEADER.size:len(query)].lower() != query[DNS_HEADER.size:].lower():
+		return None
+	return (flags & 0x000f, ancount)
+
+class dns_query_protocol(asyncio.DatagramProtocol):
+	# sends one query on a connected UDP socket and resolves a future with the first matching response
+	def __init__(self, query, response):
+		self.query = query
+		self.response = response
+		self.sent_time_ns = None
+
+	def connection_made(self, transport):
+		self.sent_time_ns = time.perf_counter_ns()
+		transport.sendto(self.query)
+
+	def datagram_received(self, data, addr):
+		received_time_ns = time.perf_counter_ns()
+		result = parse_response(data, self.query)
+		if result is not None and not self.response.done():
+			self.response.set_result(result + ((received_time_ns - self.sent_time_ns) // 1000,))
+
+	def error_received(self, exc):
+		# e.g. ICMP port unreachable
+		if not self.response.done():
+			self.response.set_exception(exc)
+
+async def query_server(server, name, timeout, port = DNS_PORT):
+	# sends a single query, returns (rcode, answer count, query time in microseconds). Raises
+	# asyncio.TimeoutError if there is no response within <timeout> seconds, OSError for network errors.
+	loop = asyncio.get_running_loop()
+	response = loop.create_future()
+	query = build_query(random.getrandbits(16), name)
+	(transport, protocol) = await loop.create_datagram_endpoint(lambda: dns_query_protocol(query, response), \
+			remote_addr=(server, port))
+	try:
+		return await asyncio.wait_for(response, timeout)
+	finally:
+		transport.close()
+
+async def probe_server(server, name = DNS_TEST_NAME, attempts = DNS_QUERY_ATTEMPTS, timeout = DNS_QUERY_TIMEOUT, port = DNS_PORT):
+	# queries a server until it responds or <attempts> queries have failed, returns a result dictionary:
+	# server, ok, attempts, failures, rcode and query_time_us (None if the server did not respond)
+	result = {"server" : server, "ok" : False, "attempts" : 0, "failures" : 0, "rcode" : None, "query_time_us" : None}
+	for attempt in range(attempts):
+		result["attempts"] += 1
+		try:
+			(rcode, answers, query_time_us) = await query_server(server, name, timeout, port)
+		except (asyncio.TimeoutError, OSError):
+			result["failures"] += 1
+			continue
+		result["rcode"] = rcode
+		result["query_time_us"] = query_time_us
+		if rcode in (DNS_RCODE_NOERROR, DNS_RCODE_NXDOMAIN):
+			result["ok"] = True
+			break
+		result["failures"] += 1
+	return result
+
+async def probe(external_servers, name = DNS_TEST_NAME, attempts = DNS_QUERY_ATTEMPTS, timeout = DNS_QUERY_TIMEOUT, \
+		port = DNS_PORT, internal_servers = None):
+	# probes the system resolver(s) and the external servers concurrently, returns a list of server results
+	# with an additional "internal" key (True for the system resolvers), internal servers first
+	if internal_servers is None:
+		internal_servers = system_nameservers()
+	servers = [(s, True) for s in internal_servers] + [(s, False) for s in external_servers]
+	results = await asyncio.gather(*[probe_server(s, name, attempts, timeout, port) for (s, internal) in servers])
+	for (result, (server, internal)) in zip(results, servers):
+		result["internal"] = internal
+	return list(results)
+
+def summarise(results, internal):
+	# combines the results of the internal or external servers in the way the servers would be tried one after
+	# the other: returns (ok, query time in ms of the first working server, failed queries before it)
+	failures = 0
+	for r in results:
+		if r["internal"] != internal:
+			continue
+		failures += r["failures"]
+		if r["ok"]:
+			return (True, int(round(r["query_time_us"] / 1000.0)), failures)
+	return (False, 0, failures)
+
+def main():
+	name = DNS_TEST_NAME
+	external_servers = []
+	attempts = DNS_QUERY_ATTEMPTS
+	timeout = DNS_QUERY_TIMEOUT
+	port = DNS_PORT
+	try:
+		options, remainder = getopt.getopt(sys.argv[1:], "n:e:a:t:p:", ["name=", "external=", "attempts=", "timeout=", "port="])
+	except getopt.error as err:
+		print(str(err))
+		sys.exit(2)
+	for opt, arg in options:
+		if opt in ("-n", "--name"):
+			name = arg
+		elif opt in ("-e", "--external"):
+			external_servers += [s for s in arg.split(",") if s != ""]
+		elif opt in ("-a", "--attempts"):
+			attempts = max(int(arg),1)
+		elif opt in ("-t", "--timeout"):
+			timeout = float(arg)
+		elif opt in ("-p", "--port"):
+			port = int(arg)
+	print(json.dumps(asyncio.run(probe(external_servers, name, attempts, timeout, port))))
+
+if __name__ == "__main__":
+	main()
@@ -2,46 +2,29 @@
 # This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
 # See the file LICENSE for full license details.
 
-import requests
-from xml.dom.minidom import parse, parseString
+# Prints the speedtest servers for the manual server selection (server_selection.sh), one server per line with
+# the fields of speedtest_servers.SERVER_ATTRIBUTES and the connect time in milliseconds, lowest connect time
+# first (see speedtest_servers.py). If no server accepts a connection the first servers of the list are printed.
+
 import sys
-import platform
+import asyncio
+import speedtest_servers
+from netperf_settings import netperf_settings
 
-SERVERLIST_URL="https://www.speedtest.net/speedtest-servers-static.php"
 OUTPUT_FIELD_SEPARATOR="||"
+MAX_SERVERS = 25
 
-ua_info = (
-        'Mozilla/5.0',
-        '(%s; U; %s; en-us)' % (platform.system(), platform.architecture()[0]),
-        'Python/%s' % platform.python_version(),
-        '(KHTML, like Gecko)',
-        'netperf/1.0'
-)
-
-USER_AGENT = ' '.join(ua_info)
-
-headers = {
-    'User-Agent': USER_AGENT
-}
-
+settings = netperf_settings()
 try:
-	response = requests.get(SERVERLIST_URL, headers=headers)
-except requests.exceptions.RequestException as e:
+	servers = speedtest_servers.fetch_server_list(settings.get_speedtest_server_list_url(), \
+			settings.get_speedtest_server_list_filename(), settings.get_speedtest_server_list_ttl())
+except (OSError, ValueError):
 	print ("Failed to retrieve server list.")
 	sys.exit(1)
-try:
-	dom = parseString(response.content)
-except:
-	print ("Failed to parse server list.")
-	sys.exit(1)
 
-serverList = dom.getElementsByTagName("server")
-serverAttributes = ["id","name","host","sponsor","country","cc","url","lat","lon"]
+ranked_servers = asyncio.run(speedtest_servers.rank_servers(servers, settings.get_speedtest_server_candidates(), MAX_SERVERS))
+if len(ranked_servers) == 0:
+	ranked_servers = [dict(s, latency_ms="") for s in servers[:MAX_SERVERS]]
 
-for server in serverList[:25]:
-	serverString=""
-	for a in serverAttributes:
-		serverString += str(server.getAttribute(a))
-		if a != serverAttributes[-1]:
-			serverString += OUTPUT_FIELD_SEPARATOR
-	print (serverString)
+for server in ranked_servers:
+	print (OUTPUT_FIELD_SEPARATOR.join([str(server[a]) for a in speedtest_servers.SERVER_ATTRIBUTES + ["latency_ms"]]))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# Latency under load probe: measures the round trip time to a host at short intervals while a speedtest is
+# running, and reads the byte counters of the network interfaces (all interfaces of the network namespace
+# except loopback) with each probe. Each probe is assigned to a phase of the test by the traffic of the
+# interval that follows it:
+#	download	received traffic above LOAD_THRESHOLD of its peak rate (and dominating the transmitted traffic)
+#	upload		transmitted traffic above LOAD_THRESHOLD of its peak rate
+#	idle		no significant traffic: before, between and after the transfers
+# The round trip time percentiles and the packet loss of each phase show the queueing delay the load adds
+# to the connection (bufferbloat). See pingprobe.py for the probe methods.
+#
+# The probe runs in the network namespace of the calling process. To probe from another namespace, run this
+# script in it (ip netns exec <namespace> loadprobe.py); it probes until its standard input is closed, then
+# prints the phase statistics as JSON:
+# usage: loadprobe.py [-i <interval seconds>] [-W <timeout seconds>] [-m <method>] [-p <tcp port>] <host>
+
+import os
+import sys
+import json
+import socket
+import getopt
+import asyncio
+import pingprobe
+
+LOAD_PHASES = ["idle", "download", "upload"]
+LOAD_PROBE_INTERVAL = 0.1
+LOAD_PROBE_TIMEOUT = 1.0
+LOAD_THRESHOLD = 0.2
+MIN_LOAD_BPS = 1e6
+
+def interface_counters(proc_net_dev = "/proc/net/dev"):
+	# returns the received and transmitted bytes of all interfaces except loopback
+	rx_bytes = 0
+	tx_bytes = 0
+	with open(proc_net_dev, "r") as f:
+		for line in f.readlines()[2:]:
+			(name, values) = line.split(":", 1)
+			if name.strip() == "lo":
+				continue
+			fields = values.split()
+			rx_bytes += int(fields[0])
+			tx_bytes += int(fields[8])
+	return (rx_bytes, tx_bytes)
+
+async def probe_under_load(remote_host, stop, interval = LOAD_PROBE_INTERVAL, timeout = LOAD_PROBE_TIMEOUT, method = "auto", \
+		port = pingprobe.TCP_PROBE_PORT, counters = interface_counters):
+	# probes the host every <interval> seconds until <stop> is set, returns a list of samples:
+	# (time in seconds since the first probe, round trip time in microseconds or None, rx bytes, tx bytes)
+	loop = asyncio.get_running_loop()
+	try:
+		addresses = await loop.getaddrinfo(remote_host, None, type=socket.SOCK_DGRAM)
+		(family, type, proto, canonname, sockaddr) = addresses[0]
+		(prober, method) = pingprobe.open_prober(sockaddr[0], family, method, port)
+	except (OSError, socket.gaierror):
+		await stop.wait()
+		return []
+	samples = []
+	probes = []
+	start = loop.time()
+	try:
+		while not stop.is_set():
+			(rx_bytes, tx_bytes) = counters()
+			samples.append((loop.time() - start, rx_bytes, tx_bytes))
+			probes.append(asyncio.ensure_future(prober.probe(len(probes) % 65536, timeout)))
+			try:
+				await asyncio.wait_for(stop.wait(), max(start + len(probes) * interval - loop.time(), 0))
+			except asyncio.TimeoutError:
+				pass
+		# the counters at the end of the last interval
+		(rx_bytes, tx_bytes) = counters()
+		samples.append((loop.time() - start, rx_bytes, tx_bytes))
+		rtts = await asyncio.gather(*probes)
+	finally:
+		prober.close()
+	return [(t, rtt, rx, tx) for ((t, rx, tx), rtt) in zip(samples, list(rtts) + [None])]
+
+def classify(samples, threshold = LOAD_THRESHOLD):
+	# returns the phase of each sample except the last one (which only closes the last interval)
+	rates = []
+	for i in range(len(samples) - 1):
+		elapsed = max(samples[i + 1][0] - samples[i][0], 1e-6)
+		rates.append(((samples[i + 1][2] - samples[i][2]) * 8 / elapsed, (samples[i + 1][3] - samples[i][3]) * 8 / elapsed))
+	peak_rx = max([r[0] for r in rates] + [MIN_LOAD_BPS])
+	peak_tx = max([r[1] for r in rates] + [MIN_LOAD_BPS])
+	phases = []
+	for (rx_bps, tx_bps) in rates:
+		download = rx_bps >= max(threshold * peak_rx, MIN_LOAD_BPS)
+		upload = tx_bps >= max(threshold * peak_tx, MIN_LOAD_BPS)
+		if download and (not upload or rx_bps / peak_rx >= tx_bps / peak_tx):
+			phases.append("download")
+		elif upload:
+			phases.append("upload")
+		else:
+			phases.append("idle")
+	return phases
+
+def phase_statistics(samples, phases):
+	# returns the round trip time percentiles (ms) and the packet loss (%) of each phase, as speedtest message
+	# fields (e.g. download_latency_p90, download_loss_pct); None for phases without probes
+	results = {}
+	for phase in LOAD_PHASES:
+		rtts = [samples[i][1] for i in range(len(phases)) if phases[i] == phase]
+		replies = sorted([r / 1000.0 for r in rtts if r is not None])
+		for p in (50, 90, 99):
+			results["{}_latency_p{}".format(phase, p)] = round(pingprobe.percentile(replies, p), 3) if len(replies) > 0 else None
+		results["{}_loss_pct".format(phase)] = round(100.0 * (len(rtts) - len(replies)) / len(rtts), 1) if len(rtts) > 0 else None
+	return results
+
+async def measure(remote_host, stop, interval = LOAD_PROBE_INTERVAL, timeout = LOAD_PROBE_TIMEOUT, method = "auto", \
+		port = pingprobe.TCP_PROBE_PORT):
+	# probes until <stop> is set, returns the phase statistics
+	samples = await probe_under_load(remote_host, stop, interval, timeout, method, port)
+	return phase_statistics(samples, classify(samples))
+
+async def measure_until_eof(remote_host, interval, timeout, method, port):
+	loop = asyncio.get_running_loop()
+	stop = asyncio.Event()
+	def stdin_readable():
+		if os.read(sys.stdin.fileno(), 4096) == b"":
+			loop.remove_reader(sys.stdin.fileno())
+			stop.set()
+	loop.add_reader(sys.stdin.fileno(), stdin_readable)
+	return await measure(remote_host, stop, interval, timeout, method, port)
+
+def main():
+	interval = LOAD_PROBE_INTERVAL
+	timeout = LOAD_PROBE_TIMEOUT
+	method = "auto"
+	port = pingprobe.TCP_PROBE_PORT
+	try:
+		options, remainder = getopt.getopt(sys.argv[1:], "i:W:m:p:", ["interval=", "timeout=", "method=", "port="])
+	except getopt.error as err:
+		print(str(err))
+		sys.exit(2)
+	for opt, arg in options:
+		if opt in ("-i", "--interval"):
+			interval = float(arg)
+		elif opt in ("-W", "--timeout"):
+			timeout = float(arg)
+		elif opt in ("-m", "--method"):
+			if arg not in pingprobe.PING_METHODS:
+				print("invalid method {}, valid methods: {}".format(arg, ", ".join(pingprobe.PING_METHODS)))
+				sys.exit(2)
+			method = arg
+		elif opt in ("-p", "--port"):
+			port = int(arg)
+	if len(remainder) != 1:
+		print("usage: {} [-i <interval seconds>] [-W <timeout seconds>] [-m <method>] [-p <tcp port>] <host>".format(sys.argv[0]))
+		sys.exit(2)
+	print(json.dumps(asyncio.run(measure_until_eof(remainder[0], interval, timeout, method, port))))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# Message encoding for the database write queue and the dashboard queue.
+#
+# The frequent message types (bandwidth, ping, iperf3, dns, speedtest) are sent in a compact binary format:
+#	format version (1 byte), type tag (1 byte), the numeric fields packed in a fixed struct layout, followed by
+#	the string fields, each prefixed with its length (2 bytes). Multi-byte values are little-endian.
+# A message type may have several layouts (e.g. bandwidth messages with and without sub-second sample statistics,
+# ping messages with and without the packet loss and round trip time percentiles, speedtest messages with and
+# without the latency under load), the layout whose fields match the message data exactly is used.
+# All other messages (e.g. prune, data_usage_reset, iperf3 messages with the per-interval samples of the built-in
+# throughput probe) are sent as JSON text. JSON messages always start with "{", which is never a valid format
+# version, so both formats can be mixed on the same queue.
+
+import json
+import struct
+
+MESSAGE_FORMAT_VERSION = 1
+
+# message layouts: (message type, type tag, fields). Field types: "d" float, "q" integer, "?" boolean, "s" string
+MESSAGE_LAYOUTS = [
+	("bandwidth", 1, [("client_id", "s"), ("timestamp", "d"), ("rx_bytes", "q"), ("tx_bytes", "q"), ("rx_bps", "d"), ("tx_bps", "d")]),
+	("bandwidth", 6, [("client_id", "s"), ("timestamp", "d"), ("rx_bytes", "q"), ("tx_bytes", "q"), ("rx_bps", "d"), ("tx_bps", "d"), \
+			("sample_count", "q"), ("rx_bps_min", "d"), ("rx_bps_max", "d"), ("tx_bps_min", "d"), ("tx_bps_max", "d")]),
+	("ping", 2, [("client_id", "s"), ("timestamp", "d"), ("remote_host", "s"), ("min", "d"), ("avg", "d"), ("max", "d"), ("mdev", "d")]),
+	("ping", 7, [("client_id", "s"), ("timestamp", "d"), ("remote_host", "s"), ("min", "d"), ("avg", "d"), ("max", "d"), ("mdev", "d"), \
+			("packets_sent", "q"), ("packets_received", "q"), ("loss_pct", "d"), ("jitter", "d"), ("rtt_p50", "d"), ("rtt_p90", "d"), ("rtt_p99", "d")]),
+	("iperf3", 3, [("client_id", "s"), ("timestamp", "d"), ("remote_host", "s"), ("rx_Mbps", "d"), ("tx_Mbps", "d"), ("retransmits", "q")]),
+	("dns", 4, [("client_id", "s"), ("timestamp", "d"), ("internal_dns_ok", "?"), ("internal_dns_query_time", "q"), ("internal_dns_failures", "q"), \
+			("external_dns_ok", "?"), ("external_dns_query_time", "q"), ("external_dns_failures", "q")]),
+	("speedtest", 5, [("client_id", "s"), ("timestamp", "d"), ("rx_Mbps", "d"), ("tx_Mbps", "d"), ("rx_bytes", "q"), ("tx_bytes", "q"), \
+			("remote_host", "s"), ("url", "s"), ("ping", "d"), ("bwm_rx_Mbps", "d"), ("bwm_tx_Mbps", "d")]),
+	("speedtest", 8, [("client_id", "s"), ("timestamp", "d"), ("rx_Mbps", "d"), ("tx_Mbps", "d"), ("rx_bytes", "q"), ("tx_bytes", "q"), \
+			("remote_host", "s"), ("url", "s"), ("ping", "d"), ("bwm_rx_Mbps", "d"), ("bwm_tx_Mbps", "d"), \
+			("idle_latency_p50", "d"), ("idle_latency_p90", "d"), ("idle_latency_p99", "d"), ("idle_loss_pct", "d"), \
+			("download_latency_p50", "d"), ("download_latency_p90", "d"), ("download_latency_p99", "d"), ("download_loss_pct", "d"), \
+			("upload_latency_p50", "d"), ("upload_latency_p90", "d"), ("upload_latency_p99", "d"), ("upload_loss_pct", "d")])
+]
+
+STRING_LENGTH = struct.Struct("<H")
+
+class message_layout:
+	# binary layout of one message type
+	def __init__(self, type, tag, fields):
+		self.type = type
+		self.tag = tag
+		self.field_names = frozenset([name for (name, code) in fields])
+		self.numeric_fields = [(name, code) for (name, code) in fields if code != "s"]
+		self.string_fields = [name for (name, code) in fields if code == "s"]
+		self.struct = struct.Struct("<BB" + "".join([code for (name, code) in self.numeric_fields]))
+
+	def encode(self, data):
+		values = [MESSAGE_FORMAT_VERSION, self.tag]
+		for (name, code) in self.numeric_fields:
+			values.append(field_value(data[name], code))
+		parts = [self.struct.pack(*values)]
+		for name in self.string_fields:
+			value = data[name]
+			if not isinstance(value, str):
+				raise TypeError("{} is not a string".format(name))
+			encoded = value.encode("utf-8")
+			parts.append(STRING_LENGTH.pack(len(encoded)))
+			parts.append(encoded)
+		return b"".join(parts)
+
+	def decode(self, message):
+		values = self.struct.unpack_from(message, 0)
+		data = {}
+		for i in range(len(self.numeric_fields)):
+			data[self.numeric_fields[i][0]] = values[i + 2]
+		offset = self.struct.size
+		for name in self.string_fields:
+			(length,) = STRING_LENGTH.unpack_from(message, offset)
+			offset += STRING_LENGTH.size
+			data[name] = message[offset:offset + length].decode("utf-8")
+			offset += length
+		return { "type" : self.type, "data" : data }
+
+def field_value(value, code):
+	# converts a message value to the type of its binary field. Values that cannot be converted exactly raise
+	# an exception, in which case the message is sent as JSON.
+	if code == "d":
+		if isinstance(value, bool):
+			raise TypeError("boolean value in a float field")
+		return float(value)
+	if code == "q":
+		if isinstance(value, float):
+			if not value.is_integer():
+				raise ValueError("non-integer value in an integer field")
+			return int(value)
+		if isinstance(value, bool):
+			raise TypeError("boolean value in an integer field")
+		return int(value)
+	if code == "?":
+		if not isinstance(value, bool):
+			raise TypeError("non-boolean value in a boolean field")
+		return value
+	raise ValueError("unknown field type {}".format(code))
+
+LAYOUTS_BY_TYPE = {}
+LAYOUTS_BY_TAG = {}
+for (type, tag, fields) in MESSAGE_LAYOUTS:
+	LAYOUTS_BY_TAG[tag] = message_layout(type, tag, fields)
+	LAYOUTS_BY_TYPE.setdefault(type, []).append(LAYOUTS_BY_TAG[tag])
+
+def encode_message(message, binary = True):
+	# encodes a message dictionary ({"type" : ..., "data" : {...}}), returns bytes (binary format) or a JSON string
+	if binary:
+		data = message.get("data", None)
+		for layout in LAYOUTS_BY_TYPE.get(message.get("type", None), []):
+			if not isinstance(data, dict) or layout.field_names != data.keys():
+				continue
+			try:
+				return layout.encode(data)
+			except (TypeError, ValueError, OverflowError, struct.error):
+				# values that do not fit the binary layout
+				break
+	return json.dumps(message)
+
+def decode_message(message):
+	# decodes a message in either format, returns the message dictionary. Raises ValueError for invalid messages.
+	if isinstance(message, str):
+		message = message.encode("utf-8")
+	if len(message) == 0:
+		raise ValueError("empty message")
+	if message[0] == MESSAGE_FORMAT_VERSION:
+		if len(message) < 2 or message[1] not in LAYOUTS_BY_TAG:
+			raise ValueError("unknown message type tag")
+		try:
+			return LAYOUTS_BY_TAG[message[1]].decode(message)
+		except (struct.error, UnicodeDecodeError) as e:
+			raise ValueError("invalid binary message: {}".format(e))
+	return json.loads(message)
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# Test agent: a long-running process that runs the network tests (see network_tests.py). The agent schedules
+# the tests itself, using the calendar expressions of the systemd timers that used to start a new test
+# process for each run (see netperf_settings.get_agent_schedules), and keeps the database queue, the settings
+# and the imported modules between runs. test_network.py hands tests to the agent through the agent queue.
+#
+# Each test type runs in its own thread, so a long test (e.g. isp) does not delay the others. Like a systemd
+# service that is still active when its timer elapses, a test that is still running when it is due again (or
+# is requested again) is not started a second time.
+# SIGHUP reloads the settings and schedules, SIGTERM stops the agent.
+#
+# Only the functions used by test_network.py to send requests are loaded when this module is imported, the
+# tests are imported when the agent starts.
+
+import os
+import json
+import time
+import signal
+import logging
+import threading
+import posix_ipc
+import util
+from datetime import datetime, timedelta
+
+AGENT_QUEUE = "/netperf.agent"
+AGENT_PIDFILE = "/run/netperf/netperf-agent.pid"
+TEST_TYPES = ["local", "isp", "dns", "internet_ping"]
+MAX_WAIT = 60.0
+
+# calendar expressions: [weekdays] [year-]month-day hour:minute[:second], e.g. "*-*-* *:0/10:00" or
+# "Mon..Fri *-*-* 8:30". Each field is *, a value, a range (a..b), a repetition (a/step, a..b/step, */step)
+# or a comma separated list of these. Shorthands as in systemd.
+CALENDAR_SHORTHANDS = {
+	"minutely" : "*-*-* *:*:00",
+	"hourly" : "*-*-* *:00:00",
+	"daily" : "*-*-* 00:00:00",
+	"weekly" : "Mon *-*-* 00:00:00",
+	"monthly" : "*-*-01 00:00:00",
+	"yearly" : "*-01-01 00:00:00",
+	"annually" : "*-01-01 00:00:00"
+}
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+def calendar_values(field, first, last, names = None):
+	# returns the sorted values (first..last) matched by a calendar expression field
+	def value(text):
+		if names is not None and text[:3].lower() in names:
+			return names.index(text[:3].lower())
+		return int(text)
+	values = set()
+	for part in field.split(","):
+		step = None
+		if "/" in part:
+			(part, step) = part.split("/", 1)
+			step = int(step)
+			if step < 1:
+				raise ValueError("invalid repetition in {}".format(field))
+		if part == "*":
+			(start, end) = (first, last)
+		elif ".." in part:
+			(start, end) = [value(v) for v in part.split("..", 1)]
+		else:
+			start = value(part)
+			end = last if step is not None else start
+		if start < first or end > last or start > end:
+			raise ValueError("value out of range in {}".format(field))
+		values.update(range(start, end + 1, step or 1))
+	return sorted(values)
+
+class calendar_event:
+	def __init__(self, expression):
+		self.expression = expression
+		expression = CALENDAR_SHORTHANDS.get(expression.strip().lower(), expression)
+		parts = expression.split()
+		weekdays = "*"
+		date_part = "*-*-*"
+		time_part = "00:00:00"
+		if len(parts) == 3:
+			(weekdays, date_part, time_part) = parts
+		elif len(parts) == 2 and ":" in parts[1]:
+			if "-" in parts[0]:
+				(date_part, time_part) = parts
+			else:
+				(weekdays, time_part) = parts
+		elif len(parts) == 2:
+			(weekdays, date_part) = parts
+		elif len(parts) == 1 and ":" in parts[0]:
+			time_part = parts[0]
+		elif len(parts) == 1:
+			date_part = parts[0]
+		else:
+			raise ValueError("invalid calendar expression: {}".format(self.expression))
+		date_fields = date_part.split("-")
+		if len(date_fields) == 2:
+			date_fields = ["*"] + date_fields
+		time_fields = time_part.split(":")
+		if len(time_fields) == 2:
+			time_fields.append("00")
+		if len(date_fields) != 3 or len(time_fields) != 3:
+			raise ValueError("invalid calendar expression: {}".format(self.expression))
+		self.weekdays = set(calendar_values(weekdays, 0, 6, WEEKDAYS))
+		self.years = None if date_fields[0] == "*" else set(calendar_values(date_fields[0], 1970, 2199))
+		self.months = set(calendar_values(date_fields[1], 1, 12))
+		self.days = set(calendar_values(date_fields[2], 1, 31))
+		self.hours = calendar_values(time_fields[0], 0, 23)
+		self.minutes = calendar_values(time_fields[1], 0, 59)
+		self.seconds = calendar_values(time_fields[2], 0, 59)
+
+	def matches_date(self, d):
+		return (self.years is None or d.year in self.years) and d.month in self.months and d.day in self.days \
+				and d.weekday() in self.weekdays
+
+	def first_time(self, hour, minute, second):
+		# returns the first (hour, minute, second) of the expression at or after the given time of day, or None
+		for h in self.hours:
+			if h < hour:
+				continue
+			for m in self.minutes:
+				if h == hour and m < minute:
+					continue
+				for s in self.seconds:
+					if h == hour and m == minute and s < second:
+						continue
+					return (h, m, s)
+		return None
+
+	def next_after(self, timestamp):
+		# returns the first time (local time, seconds since the epoch) of the expression after <timestamp>,
+		# None if there is none within the next 8 years
+		start = datetime.fromtimestamp(int(timestamp) + 1)
+		d = start.date()
+		for i in range(366 * 8):
+			if self.matches_date(d):
+				if d == start.date():
+					t = self.first_time(start.hour, start.minute, start.second)
+				else:
+					t = self.first_time(0, 0, 0)
+				if t is not None:
+					return time.mktime(datetime(d.year, d.month, d.day, *t).timetuple())
+			d += timedelta(days=1)
+		return None
+
+def agent_running():
+	# returns True if the agent process recorded in the pid file is running. If the agent runs as another
+	# user, the agent queue permissions decide whether requests can be sent.
+	return util.pidfile_running(AGENT_PIDFILE)
+
+def request_test(test_type):
+	# hands a test to the running agent, returns False if there is no agent to run it
+	if not agent_running():
+		return False
+	try:
+		queue = posix_ipc.MessageQueue(AGENT_QUEUE)
+	except (posix_ipc.ExistentialError, posix_ipc.PermissionsError):
+		return False
+	try:
+		queue.send(json.dumps({ "type" : "run_test", "data" : { "test" : test_type }}), 0)
+	except posix_ipc.BusyError:
+		# the agent is not reading its queue
+		return False
+	finally:
+		queue.close()
+	return True
+
+class test_agent:
+	def __init__(self, network_tests, dbq, settings, log):
+		self.network_tests = network_tests
+		self.dbq = dbq
+		self.log = log
+		self.running = {}
+		self.events = {}
+		self.next_run = {}
+		self.load_schedules(settings)
+
+	def load_schedules(self, settings):
+		self.events = {}
+		for (test_type, expression) in settings.get_agent_schedules().items():
+			if test_type not in TEST_TYPES:
+				self.log.error("unknown test type in agent schedules: {}".format(test_type))
+				continue
+			try:
+				self.events[test_type] = calendar_event(expression)
+			except ValueError as e:
+				self.log.error("invalid schedule for {} test: {}".format(test_type, e))
+		self.schedule(time.time())
+
+	def schedule(self, now):
+		# computes the next run of each scheduled test
+		self.next_run = {}
+		for (test_type, event) in self.events.items():
+			next_time = event.next_after(now)
+			if next_time is not None:
+				self.next_run[test_type] = next_time
+		for test_type in sorted(self.next_run, key=self.next_run.get):
+			self.log.debug("next {} test: {}".format(test_type, datetime.fromtimestamp(self.next_run[test_type])))
+
+	def start_test(self, test_type, reason):
+		thread = self.running.get(test_type, None)
+		if thread is not None and thread.is_alive():
+			self.log.info("{} test is still running, {} run skipped".format(test_type, reason))
+			return
+		self.log.debug("starting {} test ({})".format(test_type, reason))
+		thread = threading.Thread(target=self.run_test, args=(test_type,), name=test_type, daemon=True)
+		self.running[test_type] = thread
+		thread.start()
+
+	def run_test(self, test_type):
+		start_time = time.monotonic()
+		try:
+			self.network_tests.run_test(test_type, self.dbq)
+		except Exception:
+			self.log.exception("{} test failed".format(test_type))
+		self.log.debug("{} test completed in {:.1f} seconds".format(test_type, time.monotonic() - start_time))
+
+	def run_due(self, now):
+		# starts the tests that are due, returns the time until the next test is due (seconds)
+		for test_type in [t for (t, next_time) in self.next_run.items() if next_time <= now]:
+			self.start_test(test_type, "scheduled")
+			next_time = self.events[test_type].next_after(now)
+			if next_time is None:
+				del self.next_run[test_type]
+			else:
+				self.next_run[test_type] = next_time
+		if len(self.next_run) == 0:
+			return MAX_WAIT
+		return min(max(min(self.next_run.values()) - now, 0), MAX_WAIT)
+
+	def handle_request(self, message):
+		try:
+			request = json.loads(message)
+			test_type = request["data"]["test"]
+		except (ValueError, KeyError, TypeError):
+			self.log.error("invalid agent request: {}".format(message))
+			return
+		if request.get("type", None) != "run_test" or test_type not in TEST_TYPES:
+			self.log.error("invalid agent request: {}".format(message))
+			return
+		self.start_test(test_type, "requested")
+
+def main():
+	import network_tests
+	from netperf_db import db_queue
+	from netperf_settings import netperf_settings
+
+	settings = network_tests.NETPERF_SETTINGS
+	agent_log = logging.getLogger("netperf_agent")
+	agent_log.setLevel(settings.get_log_level())
+	if not settings.get_agent_enabled():
+		agent_log.info("test agent is disabled, the tests are run from systemd timers")
+		return
+	agent = test_agent(network_tests, db_queue(), settings, agent_log)
+
+	queue = posix_ipc.MessageQueue(AGENT_QUEUE, posix_ipc.O_CREAT)
+	# discard requests left in the queue by a previous agent
+	try:
+		while True:
+			queue.receive(0)
+	except posix_ipc.BusyError:
+		pass
+	with open(AGENT_PIDFILE, "w") as f:
+		f.write("{}\n".format(os.getpid()))
+
+	sigterm_h = util.sigterm_handler()
+	reload_requested = [False]
+	def sighup_handler(signal_number, frame):
+		reload_requested[0] = True
+	signal.signal(signal.SIGHUP, sighup_handler)
+	agent_log.info("test agent started, scheduled tests: {}".format(", ".join(sorted(agent.events.keys()))))
+
+	last_time = time.time()
+	while not sigterm_h.terminate:
+		now = time.time()
+		if reload_requested[0]:
+			reload_requested[0] = False
+			settings = netperf_settings()
+			network_tests.NETPERF_SETTINGS = settings
+			agent.load_schedules(settings)
+			agent_log.info("settings reloaded, scheduled tests: {}".format(", ".join(sorted(agent.events.keys()))))
+		elif now < last_time - 1.0:
+			# the clock was set back
+			agent.schedule(now)
+		last_time = now
+		wait_time = agent.run_due(now)
+		try:
+			(message, priority) = queue.receive(wait_time)
+		except (posix_ipc.BusyError, posix_ipc.SignalError):
+			continue
+		agent.handle_request(message)
+
+	try:
+		os.remove(AGENT_PIDFILE)
+	except OSError:
+		pass
+	queue.unlink()
+	queue.close()
+	running = [t for (t, thread) in agent.running.items() if thread.is_alive()]
+	if len(running) > 0:
+		agent_log.info("test agent stopped, tests interrupted: {}".format(", ".join(running)))
+	else:
+		agent_log.info("test agent stopped")
+
+if __name__ == "__main__":
+	main()
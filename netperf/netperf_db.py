@@ -5,6 +5,7 @@
 
 import datetime
 import time
+import math
 import sqlite3
 import json
 from sqlite3 import Error
@@ -13,7 +14,18 @@ import sys
 import util
 import logging
 import os
+import glob
+import threading
+from collections import OrderedDict
 from netperf_settings import netperf_settings
+from msgcodec import encode_message, decode_message
+from db_queries import INSERT_SQL, QUERIES, PRUNE_SQL, TIMESERIES_TABLES, BANDWIDTH_ROLLUPS, STATEMENT_CACHE_SIZE
+from db_queries import UNPARTITIONED_TYPES, OUTAGE_INTERVALS_PRUNE_SQL, OLDEST_TIME_SQL, MIGRATE_COPY_SQL, MIGRATE_DELETE_SQL, partition_sql
+from db_queries import SPEEDTEST_LATENCY_COLUMNS, BANDWIDTH_KEYS_SQL, BANDWIDTH_CHUNK_KEYS_SQL
+from db_queries import CHUNK_SOURCES, CHUNK_SECONDS, CHUNK_ROWS_SQL, CHUNK_DATA_SQL, CHUNK_DELETE_SQL
+
+# numpy and the chunk codec (tschunk) are imported by the functions that decode or encode chunks: the processes
+# that only send messages to the database queue (tests, bandwidth monitor) import this module but never use them.
 
 client_id = util.get_client_id()
 
@@ -22,6 +34,7 @@ NETPERF_SETTINGS = netperf_settings()
 DATA_PATH = NETPERF_SETTINGS.get_db_path()
 NETPERF_DB = NETPERF_SETTINGS.get_db_filename()
 DB_WRITE_QUEUE = NETPERF_SETTINGS.get_db_write_queue_name()
+BINARY_MESSAGES = NETPERF_SETTINGS.get_db_binary_messages()
 LOG_PATH = NETPERF_SETTINGS.get_log_path()
 LOG_FILE = NETPERF_SETTINGS.get_log_filename()
 
@@ -35,6 +48,11 @@ logging.basicConfig(filename=NETPERF_SETTINGS.get_log_filename(), format=NETPERF
 db_log = logging.getLogger("netperf_db")
 db_log.setLevel(NETPERF_SETTINGS.get_log_level())
 
+# value of PRAGMA auto_vacuum for incremental vacuum mode, and the number of pages freed per vacuum step (the
+# pragma frees one page per step of the statement, it is run to completion with executescript)
+AUTO_VACUUM_INCREMENTAL = 2
+VACUUM_PAGES_PER_STEP = 64
+
 def start_end_timestamps(query_date):
 	# given a datetime, return a tuple containing timestamps representing the earliest time
 	# on that day and the latest time on that day (corresponding to 00:00:00 and 23:59:59.99999...)
@@ -44,325 +62,971 @@ def start_end_timestamps(query_date):
 	end_timestamp = float(end_datetime.strftime('%s'))
 	return (start_timestamp,end_timestamp)
 
-def create_table(db_conn, create_table_sql):
+def day_timestamps(day):
+	# returns a tuple containing the timestamps of 00:00:00 on the given date and 00:00:00 on the following date
+	(start_timestamp, end_timestamp) = start_end_timestamps(day)
+	(next_timestamp, end_timestamp) = start_end_timestamps(day + datetime.timedelta(days=1))
+	return (start_timestamp, next_timestamp)
+
+def days_between(start_timestamp, end_timestamp):
+	# returns a list of the dates spanned by the given time range
+	day = datetime.date.fromtimestamp(start_timestamp)
+	last_day = datetime.date.fromtimestamp(end_timestamp)
+	days = []
+	while day <= last_day:
+		days.append(day)
+		day += datetime.timedelta(days=1)
+	return days
+
+def read_only_uri(filename):
+	# URI used to open a database file in read-only mode
+	import urllib.request
+	return "file:{}?mode=ro".format(urllib.request.pathname2url(os.path.abspath(filename)))
+
+def partition_schema(day):
+	# schema name of an attached day partition
+	return "p{}".format(day.strftime("%Y%m%d"))
+
+def decode_table_chunk(table, data):
+	# decodes a chunk of <table>, returns (timestamps, values) with one values column per chunk column of the
+	# table. Chunks written before columns were added to the table are padded with NaN.
+	import numpy as np
+	from tschunk import decode_chunk
+	(timestamps, values) = decode_chunk(data)
+	ncols = len(CHUNK_SOURCES[table][2])
+	if values.shape[1] < ncols:
+		values = np.hstack((values, np.full((len(timestamps), ncols - values.shape[1]), np.nan)))
+	return (timestamps, values)
+
+def chunk_results(table, timestamps, values, columns, integer_columns = ()):
+	# converts decoded chunk rows to result dictionaries containing the timestamp and the given columns,
+	# NaN values (NULL in the row format) are returned as None
+	value_columns = CHUNK_SOURCES[table][2]
+	column_values = [values[:,value_columns.index(c)].tolist() for c in columns]
+	results = []
+	for i, t in enumerate(timestamps.tolist()):
+		r = {"timestamp" : t}
+		for (c, v) in zip(columns, column_values):
+			if math.isnan(v[i]):
+				r[c] = None
+			elif c in integer_columns:
+				r[c] = int(v[i])
+			else:
+				r[c] = v[i]
+		results.append(r)
+	return results
+
+def encode_throughput_samples(samples):
+	# encodes the per-interval samples [time, rx_bps, tx_bps, retransmits] of a throughput test as a chunk, None
+	# values (the direction that was not measured in the interval) are stored as NaN
+	if not samples:
+		return None
+	from tschunk import encode_chunk
+	return encode_chunk([[float("nan") if v is None else v for v in s] for s in samples])
+
+def decode_throughput_samples(data):
+	# returns the rows of a chunk written by encode_throughput_samples as dictionaries, NaN values as None
+	from tschunk import decode_chunk
+	(timestamps, values) = decode_chunk(data)
+	results = []
+	for (t, (rx_bps, tx_bps, retransmits)) in zip(timestamps.tolist(), values.tolist()):
+		results.append({ "timestamp" : t, \
+			"rx_bps" : None if math.isnan(rx_bps) else rx_bps, \
+			"tx_bps" : None if math.isnan(tx_bps) else tx_bps, \
+			"retransmits" : None if math.isnan(retransmits) else int(retransmits) })
+	return results
+
+# Ordered schema migrations. Each entry is (version, description, [SQL statements]); the statements of each
+# pending migration are applied in a single transaction and the version is recorded in the schema_version table.
+# New schema changes must be appended to this list, existing entries must never be modified.
+SCHEMA_MIGRATIONS = [
+	(1, "create tables", [
+		""" CREATE TABLE IF NOT EXISTS isp_outages (
+			client_id text NOT NULL,
+			epoch_time real NOT NULL,
+			PRIMARY KEY (client_id,epoch_time)
+			); """,
+		""" CREATE TABLE IF NOT EXISTS speedtest (
+			client_id text NOT NULL,
+			epoch_time real NOT NULL,
+			rx_Mbps real NOT NULL,
+			tx_Mbps real NOT NULL,
+			rx_bytes integer NOT NULL,
+			tx_bytes integer NOT NULL,
+			remote_host text NOT NULL,
+			url text NOT NULL,
+			ping real,
+			bwm_rx_Mbps real NOT NULL,
+			bwm_tx_Mbps real NOT NULL,
+			PRIMARY KEY (client_id,epoch_time)
+			); """,
+		"""CREATE TABLE IF NOT EXISTS iperf3 (
+			client_id text NOT NULL,
+			epoch_time real NOT NULL,
+			remote_host text NOT NULL,
+			rx_Mbps real NOT NULL,
+			tx_Mbps real NOT NULL,
+			retransmits integer,
+			PRIMARY KEY (client_id,epoch_time)
+			);""",
+		"""CREATE TABLE IF NOT EXISTS ping (
+			client_id text NOT NULL,
+			epoch_time real NOT NULL,
+			remote_host text NOT NULL,
+			min real NOT NULL,
+			avg real NOT NULL,
+			max real NOT NULL,
+			mdev real NOT NULL,
+			PRIMARY KEY (client_id,epoch_time)
+			);""",
+		"""CREATE TABLE IF NOT EXISTS dns (
+			client_id text NOT NULL,
+			epoch_time real NOT NULL,
+			internal_dns_ok integer NOT NULL,
+			internal_dns_query_time integer NOT NULL,
+			internal_dns_failures integer NOT NULL,
+			external_dns_ok integer NOT NULL,
+			external_dns_query_time integer NOT NULL,
+			external_dns_failures integer NOT NULL,
+			PRIMARY KEY (client_id,epoch_time)
+			);""",
+		"""CREATE TABLE IF NOT EXISTS bandwidth (
+			client_id text NOT NULL,
+			epoch_time real NOT NULL,
+			rx_bytes integer NOT NULL,
+			tx_bytes integer NOT NULL,
+			rx_bps real NOT NULL,
+			tx_bps real NOT NULL,
+			PRIMARY KEY (client_id,epoch_time)
+			);""",
+		""" CREATE TABLE IF NOT EXISTS data_usage (
+			client_id text NOT NULL,
+			epoch_time real NOT NULL,
+			rxtx_bytes integer NOT NULL,
+			PRIMARY KEY (client_id,epoch_time)
+			); """
+	]),
+	(2, "time range and remote host indexes", [
+		"CREATE INDEX IF NOT EXISTS isp_outages_epoch_time ON isp_outages(epoch_time);",
+		"CREATE INDEX IF NOT EXISTS speedtest_epoch_time ON speedtest(epoch_time);",
+		"CREATE INDEX IF NOT EXISTS iperf3_epoch_time ON iperf3(epoch_time);",
+		"CREATE INDEX IF NOT EXISTS iperf3_remote_host_epoch_time ON iperf3(remote_host,epoch_time);",
+		"CREATE INDEX IF NOT EXISTS ping_epoch_time ON ping(epoch_time);",
+		"CREATE INDEX IF NOT EXISTS ping_remote_host_epoch_time ON ping(remote_host,epoch_time);",
+		"CREATE INDEX IF NOT EXISTS dns_epoch_time ON dns(epoch_time);",
+		"CREATE INDEX IF NOT EXISTS bandwidth_epoch_time ON bandwidth(epoch_time);",
+		"CREATE INDEX IF NOT EXISTS data_usage_epoch_time ON data_usage(epoch_time);"
+	]),
+	(3, "data usage state", [
+		"""CREATE TABLE IF NOT EXISTS data_usage_state (
+			id integer PRIMARY KEY CHECK (id = 0),
+			client_id text NOT NULL,
+			epoch_time real NOT NULL,
+			rxtx_bytes integer NOT NULL
+			);""",
+		"""INSERT OR IGNORE INTO data_usage_state(id,client_id,epoch_time,rxtx_bytes)
+			SELECT 0,client_id,epoch_time,rxtx_bytes FROM data_usage ORDER BY epoch_time DESC LIMIT 1;"""
+	]),
+	(4, "bandwidth rollup tables", [
+		"""CREATE TABLE IF NOT EXISTS bandwidth_1m (
+			client_id text NOT NULL,
+			epoch_time real NOT NULL,
+			sample_count integer NOT NULL,
+			rx_bps_sum real NOT NULL,
+			rx_bps_min real NOT NULL,
+			rx_bps_max real NOT NULL,
+			rx_bps_sumsq real NOT NULL,
+			tx_bps_sum real NOT NULL,
+			tx_bps_min real NOT NULL,
+			tx_bps_max real NOT NULL,
+			tx_bps_sumsq real NOT NULL,
+			PRIMARY KEY (client_id,epoch_time)
+			);""",
+		"CREATE INDEX IF NOT EXISTS bandwidth_1m_epoch_time ON bandwidth_1m(epoch_time);",
+		"""INSERT OR IGNORE INTO bandwidth_1m(client_id,epoch_time,sample_count,rx_bps_sum,rx_bps_min,rx_bps_max,rx_bps_sumsq,tx_bps_sum,tx_bps_min,tx_bps_max,tx_bps_sumsq)
+			SELECT client_id,CAST(epoch_time / 60 AS integer) * 60,COUNT(*),SUM(rx_bps),MIN(rx_bps),MAX(rx_bps),SUM(rx_bps * rx_bps),SUM(tx_bps),MIN(tx_bps),MAX(tx_bps),SUM(tx_bps * tx_bps)
+			FROM bandwidth GROUP BY client_id,CAST(epoch_time / 60 AS integer);""",
+		"""CREATE TABLE IF NOT EXISTS bandwidth_10m (
+			client_id text NOT NULL,
+			epoch_time real NOT NULL,
+			sample_count integer NOT NULL,
+			rx_bps_sum real NOT NULL,
+			rx_bps_min real NOT NULL,
+			rx_bps_max real NOT NULL,
+			rx_bps_sumsq real NOT NULL,
+			tx_bps_sum real NOT NULL,
+			tx_bps_min real NOT NULL,
+			tx_bps_max real NOT NULL,
+			tx_bps_sumsq real NOT NULL,
+			PRIMARY KEY (client_id,epoch_time)
+			);""",
+		"CREATE INDEX IF NOT EXISTS bandwidth_10m_epoch_time ON bandwidth_10m(epoch_time);",
+		"""INSERT OR IGNORE INTO bandwidth_10m(client_id,epoch_time,sample_count,rx_bps_sum,rx_bps_min,rx_bps_max,rx_bps_sumsq,tx_bps_sum,tx_bps_min,tx_bps_max,tx_bps_sumsq)
+			SELECT client_id,CAST(epoch_time / 600 AS integer) * 600,COUNT(*),SUM(rx_bps),MIN(rx_bps),MAX(rx_bps),SUM(rx_bps * rx_bps),SUM(tx_bps),MIN(tx_bps),MAX(tx_bps),SUM(tx_bps * tx_bps)
+			FROM bandwidth GROUP BY client_id,CAST(epoch_time / 600 AS integer);""",
+		"""CREATE TABLE IF NOT EXISTS bandwidth_1h (
+			client_id text NOT NULL,
+			epoch_time real NOT NULL,
+			sample_count integer NOT NULL,
+			rx_bps_sum real NOT NULL,
+			rx_bps_min real NOT NULL,
+			rx_bps_max real NOT NULL,
+			rx_bps_sumsq real NOT NULL,
+			tx_bps_sum real NOT NULL,
+			tx_bps_min real NOT NULL,
+			tx_bps_max real NOT NULL,
+			tx_bps_sumsq real NOT NULL,
+			PRIMARY KEY (client_id,epoch_time)
+			);""",
+		"CREATE INDEX IF NOT EXISTS bandwidth_1h_epoch_time ON bandwidth_1h(epoch_time);",
+		"""INSERT OR IGNORE INTO bandwidth_1h(client_id,epoch_time,sample_count,rx_bps_sum,rx_bps_min,rx_bps_max,rx_bps_sumsq,tx_bps_sum,tx_bps_min,tx_bps_max,tx_bps_sumsq)
+			SELECT client_id,CAST(epoch_time / 3600 AS integer) * 3600,COUNT(*),SUM(rx_bps),MIN(rx_bps),MAX(rx_bps),SUM(rx_bps * rx_bps),SUM(tx_bps),MIN(tx_bps),MAX(tx_bps),SUM(tx_bps * tx_bps)
+			FROM bandwidth GROUP BY client_id,CAST(epoch_time / 3600 AS integer);"""
+	]),
+	(5, "compressed time series chunks", [
+		"""CREATE TABLE IF NOT EXISTS bandwidth_chunks (
+			client_id text NOT NULL,
+			epoch_time real NOT NULL,
+			end_time real NOT NULL,
+			sample_count integer NOT NULL,
+			data blob NOT NULL,
+			PRIMARY KEY (client_id,epoch_time)
+			);""",
+		"CREATE INDEX IF NOT EXISTS bandwidth_chunks_epoch_time ON bandwidth_chunks(epoch_time);",
+		"""CREATE TABLE IF NOT EXISTS ping_chunks (
+			client_id text NOT NULL,
+			remote_host text NOT NULL,
+			epoch_time real NOT NULL,
+			end_time real NOT NULL,
+			sample_count integer NOT NULL,
+			data blob NOT NULL,
+			PRIMARY KEY (client_id,remote_host,epoch_time)
+			);""",
+		"CREATE INDEX IF NOT EXISTS ping_chunks_epoch_time ON ping_chunks(epoch_time);",
+		"CREATE INDEX IF NOT EXISTS ping_chunks_remote_host_epoch_time ON ping_chunks(remote_host,epoch_time);"
+	]),
+	(6, "bandwidth sub-second sample statistics", [
+		# NULL for rows recorded by the bandwidth monitor at one sample per second
+		"ALTER TABLE bandwidth ADD COLUMN sample_count integer;",
+		"ALTER TABLE bandwidth ADD COLUMN rx_bps_min real;",
+		"ALTER TABLE bandwidth ADD COLUMN rx_bps_max real;",
+		"ALTER TABLE bandwidth ADD COLUMN tx_bps_min real;",
+		"ALTER TABLE bandwidth ADD COLUMN tx_bps_max real;"
+	]),
+	(7, "per-interface bandwidth", [
+		"""CREATE TABLE IF NOT EXISTS interface_bandwidth (
+			client_id text NOT NULL,
+			epoch_time real NOT NULL,
+			interface text NOT NULL,
+			rx_bytes integer NOT NULL,
+			tx_bytes integer NOT NULL,
+			rx_bps real NOT NULL,
+			tx_bps real NOT NULL,
+			sample_count integer,
+			rx_bps_min real,
+			rx_bps_max real,
+			tx_bps_min real,
+			tx_bps_max real,
+			PRIMARY KEY (client_id,interface,epoch_time)
+			);""",
+		"CREATE INDEX IF NOT EXISTS interface_bandwidth_epoch_time ON interface_bandwidth(epoch_time);",
+		"CREATE INDEX IF NOT EXISTS interface_bandwidth_interface_epoch_time ON interface_bandwidth(interface,epoch_time);"
+	]),
+	(8, "per-server dns results", [
+		"""CREATE TABLE IF NOT EXISTS dns_servers (
+			client_id text NOT NULL,
+			epoch_time real NOT NULL,
+			server text NOT NULL,
+			internal integer NOT NULL,
+			ok integer NOT NULL,
+			attempts integer NOT NULL,
+			failures integer NOT NULL,
+			rcode integer,
+			query_time_us integer,
+			PRIMARY KEY (client_id,server,epoch_time)
+			);""",
+		"CREATE INDEX IF NOT EXISTS dns_servers_epoch_time ON dns_servers(epoch_time);"
+	]),
+	(9, "ping loss, jitter and percentiles", [
+		"ALTER TABLE ping ADD COLUMN packets_sent integer;",
+		"ALTER TABLE ping ADD COLUMN packets_received integer;",
+		"ALTER TABLE ping ADD COLUMN loss_pct real;",
+		"ALTER TABLE ping ADD COLUMN jitter real;",
+		"ALTER TABLE ping ADD COLUMN rtt_p50 real;",
+		"ALTER TABLE ping ADD COLUMN rtt_p90 real;",
+		"ALTER TABLE ping ADD COLUMN rtt_p99 real;"
+	]),
+	(10, "isp outage intervals", [
+		# outages detected by the outage monitor, end_time is the time of the last failed probe round while
+		# the outage is ongoing. Overlap queries (start <= range end and end >= range start) use the end_time
+		# index: only the outages that ended after the start of the range are scanned.
+		""" CREATE TABLE IF NOT EXISTS isp_outage_intervals (
+			client_id text NOT NULL,
+			epoch_time real NOT NULL,
+			end_time real NOT NULL,
+			ongoing integer NOT NULL,
+			failed_rounds integer,
+			PRIMARY KEY (client_id,epoch_time)
+			); """,
+		"CREATE INDEX IF NOT EXISTS isp_outage_intervals_end_time ON isp_outage_intervals(end_time,epoch_time);"
+	]),
+	(11, "speedtest latency under load", [
+		"ALTER TABLE speedtest ADD COLUMN idle_latency_p50 real;",
+		"ALTER TABLE speedtest ADD COLUMN idle_latency_p90 real;",
+		"ALTER TABLE speedtest ADD COLUMN idle_latency_p99 real;",
+		"ALTER TABLE speedtest ADD COLUMN idle_loss_pct real;",
+		"ALTER TABLE speedtest ADD COLUMN download_latency_p50 real;",
+		"ALTER TABLE speedtest ADD COLUMN download_latency_p90 real;",
+		"ALTER TABLE speedtest ADD COLUMN download_latency_p99 real;",
+		"ALTER TABLE speedtest ADD COLUMN download_loss_pct real;",
+		"ALTER TABLE speedtest ADD COLUMN upload_latency_p50 real;",
+		"ALTER TABLE speedtest ADD COLUMN upload_latency_p90 real;",
+		"ALTER TABLE speedtest ADD COLUMN upload_latency_p99 real;",
+		"ALTER TABLE speedtest ADD COLUMN upload_loss_pct real;"
+	]),
+	(12, "iperf3 throughput samples", [
+		# per-interval throughput of the built-in throughput probe (see tcpprobe.py), a chunk (see tschunk.py) of
+		# (time, rx_bps, tx_bps, retransmits) rows; NULL for iperf3 tests
+		"ALTER TABLE iperf3 ADD COLUMN samples blob;"
+	])
+]
+
+def schema_version(db_conn):
+	# returns the version of the most recent migration applied to the database, 0 for a new database
 	try:
-		c = db_conn.cursor()
-		c.execute(create_table_sql)
-	except Error as e:
-		print(e)
+		cur = db_conn.execute("SELECT max(version) FROM schema_version")
+		version = cur.fetchone()[0]
+		cur.close()
+	except Error:
+		version = None
+	if version is None:
+		version = 0
+	return version
+
+def apply_migrations(db_conn):
+	# applies any pending schema migrations, returns the resulting schema version
+	current_version = schema_version(db_conn)
+	pending = [m for m in SCHEMA_MIGRATIONS if m[0] > current_version]
+	if len(pending) == 0:
+		return current_version
+	cur = db_conn.cursor()
+	for (version, description, statements) in pending:
+		db_log.info("applying database migration {}: {}".format(version,description))
+		try:
+			# take the write lock before re-checking the version, another process may have applied the migration
+			cur.execute("BEGIN IMMEDIATE")
+			if schema_version(db_conn) >= version:
+				db_conn.commit()
+				current_version = version
+				continue
+			cur.execute("""CREATE TABLE IF NOT EXISTS schema_version (
+					version integer PRIMARY KEY,
+					applied_time real NOT NULL,
+					description text NOT NULL
+					);""")
+			for sql in statements:
+				cur.execute(sql)
+			cur.execute("INSERT INTO schema_version(version,applied_time,description) VALUES(?,?,?);", (version,time.time(),description))
+			db_conn.commit()
+		except Error as e:
+			db_conn.rollback()
+			db_log.error("database migration {} failed: {}".format(version,e))
+			break
+		current_version = version
+	cur.close()
+	return current_version
+
+def isp_outage_row(data):
+	return ( data["client_id"], \
+		data["timestamp"] )
+
+def isp_outage_interval_row(data):
+	return ( data["client_id"], \
+		data["timestamp"], \
+		data["end_time"], \
+		1 if data.get("ongoing",False) else 0, \
+		data.get("failed_rounds",None) )
+
+def ping_row(data):
+	return ( data["client_id"], \
+		data["timestamp"], \
+		data["remote_host"], \
+		data["min"], \
+		data["avg"], \
+		data["max"], \
+		data["mdev"], \
+		data.get("packets_sent", None), \
+		data.get("packets_received", None), \
+		data.get("loss_pct", None), \
+		data.get("jitter", None), \
+		data.get("rtt_p50", None), \
+		data.get("rtt_p90", None), \
+		data.get("rtt_p99", None) )
+
+def iperf3_row(data):
+	return ( data["client_id"], \
+		data["timestamp"], \
+		data["remote_host"], \
+		data["rx_Mbps"], \
+		data["tx_Mbps"], \
+		data["retransmits"], \
+		encode_throughput_samples(data.get("samples", None)) )
+
+def speedtest_row(data):
+	return ( data["client_id"], \
+		data["timestamp"], \
+		data["rx_Mbps"], \
+		data["tx_Mbps"], \
+		data["rx_bytes"], \
+		data["tx_bytes"], \
+		data["remote_host"], \
+		data["url"], \
+		data["ping"], \
+		data["bwm_rx_Mbps"], \
+		data["bwm_tx_Mbps"] ) + \
+		tuple([data.get(column, None) for column in SPEEDTEST_LATENCY_COLUMNS])
+
+def bandwidth_row(data):
+	# the sample statistics are only sent by the bandwidth monitor in sub-second sampling mode
+	return ( data["client_id"], \
+		data["timestamp"], \
+		data["rx_bytes"], \
+		data["tx_bytes"], \
+		data["rx_bps"], \
+		data["tx_bps"], \
+		data.get("sample_count", None), \
+		data.get("rx_bps_min", None), \
+		data.get("rx_bps_max", None), \
+		data.get("tx_bps_min", None), \
+		data.get("tx_bps_max", None) )
+
+def interface_bandwidth_rows(data):
+	# converts an interface_bandwidth message (the readings of several interfaces taken at the same time) into
+	# rows for each table; the readings of the primary interface are also stored in the bandwidth table
+	table_rows = {"interface_bandwidth" : []}
+	for reading in data["interfaces"]:
+		reading_data = dict(reading, client_id=data["client_id"], timestamp=data["timestamp"])
+		row = bandwidth_row(reading_data)
+		table_rows["interface_bandwidth"].append(row[:2] + (reading["interface"],) + row[2:])
+		if reading["interface"] == data.get("primary_interface", None):
+			table_rows["bandwidth"] = [row]
+	return table_rows
+
+def dns_row(data):
+	# map booleans to 1 = True, 0 = False
+	if data["internal_dns_ok"]:
+		idns_ok = 1
+	else:
+		idns_ok = 0
+	if data["external_dns_ok"]:
+		edns_ok = 1
+	else:
+		edns_ok = 0
+	return ( data["client_id"], \
+		data["timestamp"], \
+		idns_ok, \
+		data["internal_dns_query_time"], \
+		data["internal_dns_failures"], \
+		edns_ok, \
+		data["external_dns_query_time"], \
+		data["external_dns_failures"] )
+
+def dns_rows(data):
+	# converts a dns message into rows for each table; messages from the DNS probe also carry the results of
+	# each server that was queried
+	table_rows = {"dns" : [dns_row(data)]}
+	if "servers" in data:
+		table_rows["dns_servers"] = [( data["client_id"], \
+			data["timestamp"], \
+			r["server"], \
+			1 if r["internal"] else 0, \
+			1 if r["ok"] else 0, \
+			r["attempts"], \
+			r["failures"], \
+			r["rcode"], \
+			r["query_time_us"] ) for r in data["servers"]]
+	return table_rows
+
+def bandwidth_rollup_rows(bandwidth_rows):
+	# aggregates bandwidth rows into rollup rows for each rollup table; returns a dictionary that maps
+	# rollup table names to lists of rows (one per bucket) for the rollup inserts
+	col_client_id=0
+	col_time=1
+	col_rx_bps=4
+	col_tx_bps=5
+	col_rx_bps_min=7
+	col_rx_bps_max=8
+	col_tx_bps_min=9
+	col_tx_bps_max=10
+	rollup_rows = {}
+	for (table, bucket_seconds) in BANDWIDTH_ROLLUPS:
+		buckets = {}
+		for r in bandwidth_rows:
+			# the sample statistics columns may be missing from the end of a row, they are treated as None
+			if len(r) <= col_tx_bps_max:
+				r = tuple(r) + (None,) * (col_tx_bps_max + 1 - len(r))
+			rx_bps = float(r[col_rx_bps])
+			tx_bps = float(r[col_tx_bps])
+			# the minimum and maximum include the sub-second samples when the row has them
+			rx_bps_min = rx_bps if r[col_rx_bps_min] is None else float(r[col_rx_bps_min])
+			rx_bps_max = rx_bps if r[col_rx_bps_max] is None else float(r[col_rx_bps_max])
+			tx_bps_min = tx_bps if r[col_tx_bps_min] is None else float(r[col_tx_bps_min])
+			tx_bps_max = tx_bps if r[col_tx_bps_max] is None else float(r[col_tx_bps_max])
+			key = (r[col_client_id], int(r[col_time] // bucket_seconds) * bucket_seconds)
+			b = buckets.get(key, None)
+			if b is None:
+				buckets[key] = [1, rx_bps, rx_bps_min, rx_bps_max, rx_bps * rx_bps, tx_bps, tx_bps_min, tx_bps_max, tx_bps * tx_bps]
+			else:
+				b[0] += 1
+				b[1] += rx_bps
+				b[2] = min(b[2], rx_bps_min)
+				b[3] = max(b[3], rx_bps_max)
+				b[4] += rx_bps * rx_bps
+				b[5] += tx_bps
+				b[6] = min(b[6], tx_bps_min)
+				b[7] = max(b[7], tx_bps_max)
+				b[8] += tx_bps * tx_bps
+		rollup_rows[table] = [key + tuple(b) for (key, b) in buckets.items()]
+	return rollup_rows
+
+# functions that convert message data into row tuples, used for batched inserts
+ROW_BUILDERS = {
+	"isp_outage" : isp_outage_row,
+	"isp_outage_interval" : isp_outage_interval_row,
+	"ping" : ping_row,
+	"iperf3" : iperf3_row,
+	"speedtest" : speedtest_row,
+	"bandwidth" : bandwidth_row
+}
+
+# functions that convert message data into rows for several tables (a dictionary of message types to lists
+# of row tuples), used for batched inserts
+MULTI_ROW_BUILDERS = {
+	"interface_bandwidth" : interface_bandwidth_rows,
+	"dns" : dns_rows
+}
 
 class netperf_db:
-	def __init__(self,db_file):
+	def __init__(self,db_file,partitioned=None,read_only=False):
+		self.db_conn = None
+		# read-only mode: the database is opened with mode=ro and is never modified (no journal mode change,
+		# no schema migrations), so readers never take write locks. The database must already exist.
+		self.read_only = read_only
+		# running data usage total, loaded from the data_usage_state table on first use
+		self.rxtx_bytes = None
+		# pending incremental prune/vacuum work, see maintenance_step
+		self.prune_cutoff = None
+		self.prune_tables = []
+		self.vacuum_pending = False
+		# partitioned mode: time series rows are stored in one database file per day (<db name>_YYYYMMDD.db),
+		# attached to the connection on demand. The main database file holds the data usage state.
+		if partitioned is None:
+			partitioned = NETPERF_SETTINGS.get_db_partitioned()
+		self.partitioned = partitioned
+		self.max_partitions = NETPERF_SETTINGS.get_db_max_attached_partitions()
+		self.partition_prefix = "{}_".format(os.path.splitext(db_file)[0])
+		# attached partitions (date -> schema name), least recently used first
+		self.partitions = OrderedDict()
+		# True while the main database still holds time series rows (a single-file database that has
+		# not been fully moved into partitions), and the tables whose rows are still to be moved
+		self.legacy_rows = False
+		self.migrate_tables = []
+		# chunk storage: rows of completed hours are packed into compressed chunks. compact_days lists the
+		# databases still to be compacted (a partition date, or None for the main database), compacted_hour
+		# is the start of the hour in which compaction was last scheduled.
+		self.chunk_storage = NETPERF_SETTINGS.get_db_chunk_storage()
+		self.compact_days = []
+		self.compacted_hour = None
+		cache_size = STATEMENT_CACHE_SIZE
+		if self.partitioned:
+			cache_size = STATEMENT_CACHE_SIZE * (self.max_partitions + 1)
 		try:
-			self.db_conn = sqlite3.connect(db_file)
-			self.db_conn.execute("PRAGMA journal_mode=WAL")
+			if self.read_only:
+				# read-only connections may be reused by other threads (see db_pool)
+				self.db_conn = sqlite3.connect(read_only_uri(db_file), uri=True, cached_statements=cache_size, check_same_thread=False)
+			else:
+				self.db_conn = sqlite3.connect(db_file, cached_statements=cache_size)
+				self.db_conn.execute("PRAGMA journal_mode=WAL")
 		except Error as e:
 			print(e)
 
-		sql_create_isp_outage_table = """ CREATE TABLE IF NOT EXISTS isp_outages (
-										client_id text NOT NULL,
-										epoch_time real NOT NULL,
-										PRIMARY KEY (client_id,epoch_time)
-										); """
-
-		sql_create_speedtest_table = """ CREATE TABLE IF NOT EXISTS speedtest (
-										client_id text NOT NULL,
-										epoch_time real NOT NULL,
-										rx_Mbps real NOT NULL,
-										tx_Mbps real NOT NULL,
-										rx_bytes integer NOT NULL,
-										tx_bytes integer NOT NULL,
-										remote_host text NOT NULL,
-										url text NOT NULL,
-										ping real,
-										bwm_rx_Mbps real NOT NULL,
-										bwm_tx_Mbps real NOT NULL,
-										PRIMARY KEY (client_id,epoch_time)
-										); """
-
-		sql_create_iperf3_table = """CREATE TABLE IF NOT EXISTS iperf3 (
-										client_id text NOT NULL,
-										epoch_time real NOT NULL,
-										remote_host text NOT NULL,
-										rx_Mbps real NOT NULL,
-										tx_Mbps real NOT NULL,
-										retransmits integer,
-										PRIMARY KEY (client_id,epoch_time)
-										);"""
-
-		sql_create_ping_table = """CREATE TABLE IF NOT EXISTS ping (
-									client_id text NOT NULL,
-									epoch_time real NOT NULL,
-									remote_host text NOT NULL,
-									min real NOT NULL,
-									avg real NOT NULL,
-									max real NOT NULL,
-									mdev real NOT NULL,
-									PRIMARY KEY (client_id,epoch_time)
-									);"""
-
-
-		sql_create_dns_table = """CREATE TABLE IF NOT EXISTS dns (
-									client_id text NOT NULL,
-									epoch_time real NOT NULL,
-									internal_dns_ok integer NOT NULL,
-									internal_dns_query_time integer NOT NULL,
-									internal_dns_failures integer NOT NULL,
-									external_dns_ok integer NOT NULL,
-									external_dns_query_time integer NOT NULL,
-									external_dns_failures integer NOT NULL,
-									PRIMARY KEY (client_id,epoch_time)
-									);"""
-
-
-		sql_create_bandwidth_table = """CREATE TABLE IF NOT EXISTS bandwidth (
-										client_id text NOT NULL,
-										epoch_time real NOT NULL,
-										rx_bytes integer NOT NULL,
-										tx_bytes integer NOT NULL,
-										rx_bps real NOT NULL,
-										tx_bps real NOT NULL,
-										PRIMARY KEY (client_id,epoch_time)
-										);"""
-
-		sql_create_data_usage_table = """ CREATE TABLE IF NOT EXISTS data_usage (
-										client_id text NOT NULL,
-										epoch_time real NOT NULL,
-										rxtx_bytes integer NOT NULL,
-										PRIMARY KEY (client_id,epoch_time)
-										); """
-
 		if self.db_conn is not None:
-			create_table(self.db_conn, sql_create_isp_outage_table)
-			create_table(self.db_conn, sql_create_speedtest_table)
-			create_table(self.db_conn, sql_create_iperf3_table)
-			create_table(self.db_conn, sql_create_ping_table)
-			create_table(self.db_conn, sql_create_dns_table)
-			create_table(self.db_conn, sql_create_bandwidth_table)
-			create_table(self.db_conn, sql_create_data_usage_table)
+			if not self.read_only:
+				apply_migrations(self.db_conn)
+			if self.partitioned:
+				self.migrate_tables = [t for t in TIMESERIES_TABLES if self.oldest_time(t) is not None]
+				self.legacy_rows = len(self.migrate_tables) > 0
 		else:
 			print("Error! cannot create the database connection.")
 
-	def log_isp_outage(self, data):
-		client_id = data["client_id"]
-		timestamp = data["timestamp"]
-		sql = '''INSERT OR IGNORE INTO isp_outages(client_id,epoch_time)
-			VALUES(?,?);'''
+	def oldest_time(self, table_name, schema = "main"):
+		# returns the earliest epoch_time in a table, None if the table is empty
+		cur = self.db_conn.execute(partition_sql(OLDEST_TIME_SQL[table_name], schema))
+		oldest = cur.fetchone()[0]
+		cur.close()
+		return oldest
+
+	def partition_filename(self, day):
+		return "{}{}.db".format(self.partition_prefix, day.strftime("%Y%m%d"))
+
+	def partition_days(self):
+		# returns the dates of the existing partition files, oldest first
+		days = []
+		for filename in glob.glob("{}{}.db".format(glob.escape(self.partition_prefix), "[0-9]" * 8)):
+			try:
+				days.append(datetime.datetime.strptime(filename[len(self.partition_prefix):-3], "%Y%m%d").date())
+			except ValueError:
+				pass
+		return sorted(days)
+
+	def attach_partition(self, day, create = False):
+		# attaches the partition file of the given date, returns its schema name. Returns None if the partition
+		# does not exist (and create is False) or cannot be attached. When the maximum number of partitions
+		# is attached, the least recently used partition is detached.
+		if day in self.partitions:
+			self.partitions.move_to_end(day)
+			return self.partitions[day]
+		filename = self.partition_filename(day)
+		if not create and not os.path.exists(filename):
+			return None
+		schema = partition_schema(day)
+		try:
+			if self.read_only:
+				attach_filename = read_only_uri(filename)
+			else:
+				# the schema migrations refer to unqualified table names, so they are applied to the partition
+				# using a separate connection before it is attached
+				part_conn = sqlite3.connect(filename)
+				part_conn.execute("PRAGMA journal_mode=WAL")
+				apply_migrations(part_conn)
+				part_conn.close()
+				attach_filename = filename
+			while len(self.partitions) >= self.max_partitions:
+				self.detach_partition(next(iter(self.partitions)))
+			self.db_conn.commit()
+			self.db_conn.execute("ATTACH DATABASE ? AS {}".format(schema), (attach_filename,))
+		except Error as e:
+			db_log.error("unable to attach database partition {}: {}".format(filename,e))
+			return None
+		self.partitions[day] = schema
+		return schema
+
+	def detach_partition(self, day):
+		schema = self.partitions.pop(day, None)
+		if schema is not None:
+			self.db_conn.commit()
+			try:
+				self.db_conn.execute("DETACH DATABASE {}".format(schema))
+			except Error as e:
+				db_log.error("unable to detach database partition {}: {}".format(schema,e))
+
+	def drop_partition(self, day):
+		# detaches the partition of the given date and deletes its files
+		self.detach_partition(day)
+		filename = self.partition_filename(day)
+		db_log.info("removing database partition {}".format(filename))
+		for suffix in ("", "-wal", "-shm"):
+			if os.path.exists(filename + suffix):
+				os.remove(filename + suffix)
+
+	def insert_rows(self, table_rows):
+		# inserts rows into one or more tables using a single transaction (one commit, one fsync).
+		# table_rows is a dictionary mapping message types to lists of row tuples.
+		# The bandwidth rollup tables are updated in the same transaction as the bandwidth rows.
+		if not self.partitioned:
+			return self.write_rows([(type, "main", rows) for (type, rows) in table_rows.items()])
+		# partitioned mode: group the rows by the date of their epoch_time (column 1 of every row type)
+		day_rows = {}
+		for (type, rows) in table_rows.items():
+			if type in UNPARTITIONED_TYPES:
+				day_rows.setdefault(None, {}).setdefault(type, []).extend(rows)
+				continue
+			for row in rows:
+				day = datetime.date.fromtimestamp(row[1])
+				day_rows.setdefault(day, {}).setdefault(type, []).append(row)
+		statements = [(type, "main", rows) for (type, rows) in day_rows.pop(None, {}).items()]
+		days = sorted(day_rows)
+		lastrowid = None
+		# rows normally span one or two days; if they span more days than can be attached at the same
+		# time, each group of days is written in its own transaction
+		for i in range(0, max(len(days), 1), self.max_partitions):
+			for day in days[i:i + self.max_partitions]:
+				schema = self.attach_partition(day, create = True)
+				if schema is None:
+					db_log.error("discarding rows for {}".format(day))
+					continue
+				statements += [(type, schema, rows) for (type, rows) in day_rows[day].items()]
+			lastrowid = self.write_rows(statements)
+			statements = []
+		return lastrowid
+
+	def write_rows(self, statements):
+		# executes a list of (message type, schema, rows) in a single transaction; schema is "main" or the
+		# schema of an attached partition
 		cur = self.db_conn.cursor()
-		cur.execute(sql, (client_id, timestamp))
-		self.db_conn.commit()
+		try:
+			for (type, schema, rows) in statements:
+				if type == "bandwidth":
+					self.write_bandwidth_rows(cur, schema, rows)
+				else:
+					cur.executemany(partition_sql(INSERT_SQL[type], schema), rows)
+			self.db_conn.commit()
+		except Error as e:
+			# retry the rows one at a time so that a single bad row does not discard the whole batch
+			db_log.error("batch insert failed ({}), retrying rows individually".format(e))
+			self.db_conn.rollback()
+			for (type, schema, rows) in statements:
+				for row in rows:
+					try:
+						if type == "bandwidth":
+							self.write_bandwidth_rows(cur, schema, [row])
+						else:
+							cur.execute(partition_sql(INSERT_SQL[type], schema), row)
+					except Error as e:
+						db_log.error("unable to insert {} row {}: {}".format(type,row,e))
+			self.db_conn.commit()
 		cur.close()
 		return cur.lastrowid
 
+	def write_bandwidth_rows(self, cur, schema, rows):
+		# inserts bandwidth rows and adds them to the rollup tables (of the same database or partition). A row
+		# that is already stored (a message sent again) must not be counted in the rollups a second time: the
+		# keys stored in the time range of the rows are read with a single query, and only the rows not found
+		# (the first of the rows with the same key, as with INSERT OR IGNORE) are inserted and rolled up.
+		# The rows of hours that have been packed into chunks (see compact_hour) are no longer in the table,
+		# their keys are read from the chunks (with timestamps rounded to microseconds, as in the chunks).
+		if len(rows) == 0:
+			return
+		times = [row[1] for row in rows]
+		stored_keys = set(cur.execute(partition_sql(BANDWIDTH_KEYS_SQL, schema), (min(times), max(times))).fetchall())
+		chunks = cur.execute(partition_sql(BANDWIDTH_CHUNK_KEYS_SQL, schema), (min(times) - CHUNK_SECONDS, max(times))).fetchall()
+		chunk_keys = set()
+		if len(chunks) > 0:
+			import numpy as np
+			for (chunk_client_id, data) in chunks:
+				chunk_times = np.rint(decode_table_chunk("bandwidth", data)[0] * 1e6).astype(np.int64).tolist()
+				chunk_keys.update([(chunk_client_id, t) for t in chunk_times])
+		new_rows = []
+		for row in rows:
+			key = (row[0], row[1])
+			if key not in stored_keys and (len(chunk_keys) == 0 or (row[0], int(round(row[1] * 1e6))) not in chunk_keys):
+				stored_keys.add(key)
+				new_rows.append(row)
+		cur.executemany(partition_sql(INSERT_SQL["bandwidth"], schema), new_rows)
+		for (table, rollup_rows) in bandwidth_rollup_rows(new_rows).items():
+			cur.executemany(partition_sql(INSERT_SQL[table], schema), rollup_rows)
+
+	def log_batch(self, messages):
+		# writes a list of (type, data) messages. Rows are grouped by message type and inserted with one
+		# executemany per table inside a single transaction. Other message types (e.g. prune) are handled
+		# in order, after the rows received before them have been written.
+		table_rows = {}
+		for (type, data) in messages:
+			if type in ROW_BUILDERS:
+				try:
+					row = ROW_BUILDERS[type](data)
+				except (KeyError, TypeError):
+					db_log.error("invalid {} message data: {}".format(type,data))
+					continue
+				table_rows.setdefault(type,[]).append(row)
+			elif type in MULTI_ROW_BUILDERS:
+				try:
+					rows = MULTI_ROW_BUILDERS[type](data)
+				except (KeyError, TypeError):
+					db_log.error("invalid {} message data: {}".format(type,data))
+					continue
+				for (row_type, type_rows) in rows.items():
+					table_rows.setdefault(row_type,[]).extend(type_rows)
+			else:
+				if len(table_rows) > 0:
+					self.insert_rows(table_rows)
+					table_rows = {}
+				handler = self.message_handler(type)
+				if handler is None:
+					db_log.error("Invalid message type: {}".format(type))
+					continue
+				try:
+					handler(data)
+				except:
+					db_log.error("error occurred while writing to the database")
+		if len(table_rows) > 0:
+			self.insert_rows(table_rows)
+
+	def message_handler(self, type):
+		# returns the method used to process a single message of the given type
+		switcher = {
+			"bandwidth": self.log_bandwidth,
+			"interface_bandwidth": self.log_interface_bandwidth,
+			"speedtest": self.log_speedtest,
+			"ping": self.log_ping,
+			"iperf3": self.log_iperf3,
+			"dns": self.log_dns,
+			"isp_outage": self.log_isp_outage,
+			"isp_outage_interval": self.log_isp_outage_interval,
+			"data_usage": self.log_data_usage,
+			"prune": self.prune,
+			"data_usage_reset": self.data_usage_reset
+		}
+		return switcher.get(type, None)
+
+	def log_isp_outage(self, data):
+		return self.insert_rows({"isp_outage" : [isp_outage_row(data)]})
+
+	def log_isp_outage_interval(self, data):
+		return self.insert_rows({"isp_outage_interval" : [isp_outage_interval_row(data)]})
+
 	def log_pingtest(self, pingtest_results):
 		#logger.info("inserting ping results")
-		sql = '''INSERT OR IGNORE INTO ping(client_id,epoch_time,remote_host,min,avg,max,mdev)
-			VALUES(?,?,?,?,?,?,?);'''
-		cur = self.db_conn.cursor()
-		cur.execute(sql, pingtest_results)
-		self.db_conn.commit()
-		cur.close()
-		return cur.lastrowid
+		# ping test result tuples have no packet loss and round trip time percentile columns
+		return self.insert_rows({"ping" : [tuple(pingtest_results) + (None,) * 7]})
 
 	def log_ping(self,data):
-		row_data = (	data["client_id"], \
-				data["timestamp"], \
-				data["remote_host"], \
-				data["min"], \
-				data["avg"], \
-				data["max"], \
-				data["mdev"])
-		#print json.dumps(row_data)
-		sql = '''INSERT OR IGNORE INTO ping(client_id,epoch_time,remote_host,min,avg,max,mdev)
-			VALUES(?,?,?,?,?,?,?);'''
-		cur = self.db_conn.cursor()
-		cur.execute(sql, row_data)
-		self.db_conn.commit()
-		cur.close()
-		return cur.lastrowid
+		return self.insert_rows({"ping" : [ping_row(data)]})
 
 	def log_iperf3(self, data):
-		row_data = ( data["client_id"], \
-				data["timestamp"], \
-				data["remote_host"], \
-				data["rx_Mbps"], \
-				data["tx_Mbps"], \
-				data["retransmits"] )
-		sql = '''INSERT OR IGNORE INTO iperf3(client_id,epoch_time,remote_host,rx_Mbps,tx_Mbps,retransmits)
-			VALUES(?,?,?,?,?,?);'''
-		cur = self.db_conn.cursor()
-		cur.execute(sql, row_data)
-		self.db_conn.commit()
-		cur.close()
-		return cur.lastrowid
+		return self.insert_rows({"iperf3" : [iperf3_row(data)]})
 
 	def log_speedtest(self,data):
-		row_data = ( data["client_id"], \
-				data["timestamp"], \
-				data["rx_Mbps"], \
-				data["tx_Mbps"], \
-				data["rx_bytes"],\
-				data["tx_bytes"],\
-				data["remote_host"], \
-				data["url"], \
-				data["ping"], \
-				data["bwm_rx_Mbps"], \
-				data["bwm_tx_Mbps"] )
-		sql = '''INSERT OR IGNORE INTO speedtest(client_id,epoch_time,rx_Mbps,tx_Mbps,rx_bytes,tx_bytes,remote_host,url,ping,bwm_rx_Mbps,bwm_tx_Mbps)
-			VALUES(?,?,?,?,?,?,?,?,?,?,?);'''
-		cur = self.db_conn.cursor()
-		cur.execute(sql, row_data)
-		self.db_conn.commit()
-		cur.close()
-		return cur.lastrowid
+		return self.insert_rows({"speedtest" : [speedtest_row(data)]})
 
 	def log_bandwidth(self,data):
-		row_data = ( data["client_id"], \
-				 data["timestamp"], \
-				 data["rx_bytes"], \
-				 data["tx_bytes"], \
-				 data["rx_bps"], \
-				 data["tx_bps"])
-		sql = '''INSERT OR IGNORE INTO bandwidth(client_id,epoch_time,rx_bytes,tx_bytes,rx_bps,tx_bps)
-			VALUES(?,?,?,?,?,?);'''
-		cur = self.db_conn.cursor()
-		cur.execute(sql, row_data)
-		self.db_conn.commit()
-		cur.close()
-		return cur.lastrowid
+		return self.insert_rows({"bandwidth" : [bandwidth_row(data)]})
+
+	def log_interface_bandwidth(self,data):
+		return self.insert_rows(interface_bandwidth_rows(data))
 
 	def log_data_usage(self,data):
+		# adds the data usage to the running total. The total is kept in memory and in the single-row
+		# data_usage_state table, which is updated in the same transaction as the data_usage history row.
 		db_log.debug("start of log_data_usage")
-		cur = self.db_conn.cursor()
-		cur.execute("SELECT rxtx_bytes FROM data_usage where epoch_time = (select max(epoch_time) from data_usage)")
-		col_rxtx_bytes=0
-		query_results = cur.fetchall()
-		db_log.debug("length of query results: {}".format(len(query_results)))
-		if len(query_results) > 0:
-			current_rxtx_bytes = int(query_results[0][col_rxtx_bytes])
-		else:
-			current_rxtx_bytes = 0
-		new_rxtx_bytes = current_rxtx_bytes + int(data["rxtx_bytes"])
+		if self.rxtx_bytes is None:
+			self.rxtx_bytes = self.get_data_usage()["rxtx_bytes"]
+		new_rxtx_bytes = self.rxtx_bytes + int(data["rxtx_bytes"])
 		db_log.debug("new_rxtx_bytes: {}".format(new_rxtx_bytes))
 		row_data = ( data["client_id"], \
 					data["timestamp"], \
 					new_rxtx_bytes )
 		db_log.debug("row_data: {}".format(row_data))
-		sql = '''INSERT OR IGNORE INTO data_usage(client_id,epoch_time,rxtx_bytes)
-				VALUES(?,?,?);'''
-		cur.execute(sql, row_data)
-		self.db_conn.commit()
-		cur.close()
-		return cur.lastrowid
+		lastrowid = self.insert_rows({"data_usage" : [row_data], "data_usage_state" : [row_data]})
+		self.rxtx_bytes = new_rxtx_bytes
+		return lastrowid
 
 	def log_dns(self, dns_results):
-		# unpack dns_results tuple
-		client_id = dns_results["client_id"]
-		timestamp = dns_results["timestamp"]
-		internal_dns_ok = dns_results["internal_dns_ok"]
-		internal_dns_query_time = dns_results["internal_dns_query_time"]
-		internal_dns_failures = dns_results["internal_dns_failures"]
-		external_dns_ok = dns_results["external_dns_ok"]
-		external_dns_query_time = dns_results["external_dns_query_time"]
-		external_dns_failures = dns_results["external_dns_failures"]
-
-		# map booleans to 1 = True, 0 = False
-		if internal_dns_ok:
-			idns_ok = 1
-		else:
-			idns_ok = 0
+		return self.insert_rows(dns_rows(dns_results))
 
-		if external_dns_ok:
-			edns_ok = 1
-		else:
-			edns_ok = 0
-
-		repacked_dns_results = (client_id,
-								timestamp,
-								idns_ok,
-								internal_dns_query_time,
-								internal_dns_failures,
-								edns_ok,
-								external_dns_query_time,
-								external_dns_failures)
-
-		sql = '''INSERT OR IGNORE INTO dns(client_id,epoch_time,internal_dns_ok,internal_dns_query_time,internal_dns_failures,external_dns_ok,external_dns_query_time,external_dns_failures)
-				VALUES(?,?,?,?,?,?,?,?);'''
-		cur = self.db_conn.cursor()
-		cur.execute(sql, repacked_dns_results)
-		self.db_conn.commit()
+	def query(self, query_name, parameters = (), schema = "main"):
+		# runs one of the predefined queries, returns a list of dictionaries keyed by result column name
+		sql = QUERIES[query_name]
+		if schema != "main":
+			sql = partition_sql(sql, schema)
+		cur = self.db_conn.execute(sql, parameters)
+		columns = [d[0] for d in cur.description]
+		results = [dict(zip(columns, row)) for row in cur.fetchall()]
 		cur.close()
-		return cur.lastrowid
+		return results
+
+	def query_range(self, query_name, start_timestamp, end_timestamp, parameters):
+		# runs a query for the time range start_timestamp..end_timestamp. In partitioned mode the query is run
+		# against the partition of each date in the range (and the main database while it still holds rows).
+		if not self.partitioned:
+			return self.query(query_name, parameters)
+		results = []
+		if self.legacy_rows:
+			results += self.query(query_name, parameters)
+		for day in days_between(start_timestamp, end_timestamp):
+			schema = self.attach_partition(day)
+			if schema is not None:
+				results += self.query(query_name, parameters, schema)
+		return results
+
+	def query_latest(self, query_name, parameters, limit):
+		# runs a query that returns up to <limit> of the most recent rows, newest first. In partitioned mode
+		# the partitions are read from newest to oldest until enough rows have been found.
+		if not self.partitioned:
+			return self.query(query_name, parameters)
+		results = []
+		for day in reversed(self.partition_days()):
+			schema = self.attach_partition(day)
+			if schema is not None:
+				results += self.query(query_name, parameters, schema)
+			if len(results) >= limit:
+				return results[:limit]
+		if self.legacy_rows:
+			results += self.query(query_name, parameters)
+		return results[:limit]
+
+	def chunk_arrays(self, table, query_name, start_timestamp, end_timestamp, parameters):
+		# decodes the chunks returned by a chunk query, returns a tuple of arrays (timestamps, values) containing
+		# the rows within start_timestamp..end_timestamp sorted by time, with one values column per chunk column
+		import numpy as np
+		timestamps = [np.zeros(0)]
+		values = [np.zeros((0, len(CHUNK_SOURCES[table][2])))]
+		for chunk in self.query_range(query_name, start_timestamp - CHUNK_SECONDS, end_timestamp, parameters):
+			(t, v) = decode_table_chunk(table, chunk["data"])
+			timestamps.append(t)
+			values.append(v)
+		timestamps = np.concatenate(timestamps)
+		values = np.concatenate(values)
+		selected = (timestamps >= start_timestamp) & (timestamps <= end_timestamp)
+		order = np.argsort(timestamps[selected], kind="stable")
+		return (timestamps[selected][order], values[selected][order])
+
+	def latest_chunk_arrays(self, table, query_name, rows):
+		# decodes the most recent chunks until at least <rows> rows have been found, returns a tuple of arrays
+		# (timestamps, values) sorted by time, newest first
+		import numpy as np
+		timestamps = [np.zeros(0)]
+		values = [np.zeros((0, len(CHUNK_SOURCES[table][2])))]
+		found = 0
+		for chunk in self.query_latest(query_name, (rows,), rows):
+			(t, v) = decode_table_chunk(table, chunk["data"])
+			timestamps.append(t)
+			values.append(v)
+			found += len(t)
+			if found >= rows:
+				break
+		timestamps = np.concatenate(timestamps)
+		values = np.concatenate(values)
+		order = np.argsort(-timestamps, kind="stable")
+		return (timestamps[order], values[order])
 
 	def get_isp_outages(self, query_date):
+		# outage times of the day: the outages recorded by the network tests, and the start of each outage
+		# interval recorded by the outage monitor (the start of the day for outages that began the day before)
 		(start_timestamp,end_timestamp) = start_end_timestamps(query_date)
-		cur = self.db_conn.cursor()
-		cur.execute("SELECT * FROM isp_outages where epoch_time >= {} and epoch_time <= {}".format(start_timestamp,end_timestamp))
-		col_time=1
-		results=[]
-		for i in cur.fetchall():
-			results.append({"timestamp" : i[col_time]})
-		cur.close()
+		results = self.query_range("isp_outages", start_timestamp, end_timestamp, (start_timestamp,end_timestamp))
+		for r in self.get_isp_outage_intervals(query_date):
+			results.append({"timestamp" : max(r["start_time"], start_timestamp)})
+		return sorted(results, key=lambda r: r["timestamp"])
+
+	def get_isp_outage_intervals(self, query_date):
+		# outage intervals that overlap the day, not clipped to the day
+		(start_timestamp,end_timestamp) = start_end_timestamps(query_date)
+		results = self.query("isp_outage_intervals", (start_timestamp,end_timestamp))
+		for r in results:
+			r["ongoing"] = r["ongoing"] == 1
 		return results
 
 	def get_speedtest_data(self,query_date):
 		(start_timestamp,end_timestamp) = start_end_timestamps(query_date)
-		cur = self.db_conn.cursor()
-		cur.execute("SELECT * FROM speedtest where epoch_time >= {} and epoch_time <= {}".format(start_timestamp,end_timestamp))
-		col_time=1
-		col_rx_Mbps=2
-		col_tx_Mbps=3
-		col_rx_bytes=4
-		col_tx_bytes=5
-		col_remote_host=6
-		col_url=7
-		col_ping=8
-		col_bwm_rx_Mbps=9
-		col_bwm_tx_Mbps=10
-		results=[]
-		for i in cur.fetchall():
-			results.append({"timestamp" : i[col_time], \
-					"rx_Mbps" : i[col_rx_Mbps], \
-					"tx_Mbps" : i[col_tx_Mbps], \
-					"rx_bytes" : i[col_rx_bytes], \
-					"tx_bytes" : i[col_tx_bytes], \
-					"ping" : i[col_ping], \
-					"remote_host" : i[col_remote_host],\
-					"url" : i[col_url],\
-					"bwm_rx_Mbps" : i[col_bwm_rx_Mbps],\
-					"bwm_tx_Mbps" : i[col_bwm_tx_Mbps]})
-		cur.close()
-		return results
+		return self.query_range("speedtest", start_timestamp, end_timestamp, (start_timestamp,end_timestamp))
 
 	def get_speedtest_data_usage(self,query_date):
 		(start_timestamp,end_timestamp) = start_end_timestamps(query_date)
-		cur = self.db_conn.cursor()
-		cur.execute("SELECT COUNT(*) AS test_count, SUM(rx_bytes + tx_bytes) AS rxtx_bytes FROM speedtest where epoch_time >= {} and epoch_time <= {}".format(start_timestamp,end_timestamp))
-		col_test_count=0
-		col_rxtx_bytes=1
-		results=[]
-		query_results = cur.fetchall()
-		test_count = query_results[0][col_test_count]
-		if test_count == 0:
-			rxtx_bytes = 0
-		else:
-			rxtx_bytes = int(query_results[0][col_rxtx_bytes])
-		results.append({"test_count" : test_count, \
-				"rxtx_bytes" : rxtx_bytes})
-		cur.close()
-		return results
-
+		test_count = 0
+		rxtx_bytes = 0
+		for r in self.query_range("speedtest_data_usage", start_timestamp, end_timestamp, (start_timestamp,end_timestamp)):
+			if r["test_count"] > 0:
+				test_count += r["test_count"]
+				rxtx_bytes += int(r["rxtx_bytes"])
+		return [{"test_count" : test_count, "rxtx_bytes" : rxtx_bytes}]
 
 	def get_data_usage(self):
 		db_log.debug("start of get_data_usage")
-		cur = self.db_conn.cursor()
-		cur.execute("SELECT rxtx_bytes FROM data_usage where epoch_time = (select max(epoch_time) from data_usage)")
-		col_rxtx_bytes=0
-		query_results = cur.fetchall()
-		cur.close()
+		query_results = self.query("data_usage")
 		db_log.debug("length of query results: {}".format(len(query_results)))
 		if len(query_results) > 0:
-			rxtx_bytes = int(query_results[0][col_rxtx_bytes])
+			rxtx_bytes = int(query_results[0]["rxtx_bytes"])
 		else:
 			rxtx_bytes = int(0)
 		results={"rxtx_bytes" : rxtx_bytes}
@@ -370,175 +1034,175 @@ class netperf_db:
 
 	def get_iperf3_data(self,query_date):
 		(start_timestamp,end_timestamp) = start_end_timestamps(query_date)
-		cur = self.db_conn.cursor()
-		cur.execute("SELECT * FROM iperf3 where epoch_time >= {} and epoch_time <= {}".format(start_timestamp,end_timestamp))
-		col_time=1
-		col_remote_host=2
-		col_rx_Mbps=3
-		col_tx_Mbps=4
-		col_retransmits=5
-		results=[]
-		for i in cur.fetchall():
-			results.append({"timestamp" : i[col_time], \
-					"remote_host" : i[col_remote_host], \
-					"rx_Mbps" : i[col_rx_Mbps], \
-					"tx_Mbps" : i[col_tx_Mbps], \
-					"retransmits" : i[col_retransmits]})
-		cur.close()
-		return results
+		return self.query_range("iperf3", start_timestamp, end_timestamp, (start_timestamp,end_timestamp))
 
 	def get_ping_interface_data(self,query_date, interface, outage_only = False):
 		(start_timestamp,end_timestamp) = start_end_timestamps(query_date)
 		if outage_only:
-			query_str = "SELECT * FROM ping where (epoch_time >= {} AND epoch_time <= {}) AND remote_host LIKE \"{}\" AND (min = 0 OR max = 0)"
+			query_name = "ping_interface_outages"
 		else:
-			query_str = "SELECT * FROM ping where (epoch_time >= {} AND epoch_time <= {}) AND remote_host LIKE \"{}\""
-		cur = self.db_conn.cursor()
-		cur.execute(query_str.format(start_timestamp,end_timestamp,interface))
-		col_time=1
-		col_min=3
-		col_avg=4
-		col_max=5
-		col_mdev=6
-		results=[]
-		for i in cur.fetchall():
-			results.append({"timestamp" : i[col_time], \
-					"min" : i[col_min], \
-					"avg" : i[col_avg], \
-					"max" : i[col_max], \
-					"mdev" : i[col_mdev]})
-		cur.close()
+			query_name = "ping_interface"
+		results = self.query_range(query_name, start_timestamp, end_timestamp, (interface,start_timestamp,end_timestamp))
+		(timestamps, values) = self.chunk_arrays("ping", "ping_interface_chunks", start_timestamp, end_timestamp, \
+				(interface,start_timestamp - CHUNK_SECONDS,end_timestamp,start_timestamp))
+		if len(timestamps) > 0:
+			for r in chunk_results("ping", timestamps, values, CHUNK_SOURCES["ping"][2], ("packets_sent", "packets_received")):
+				if outage_only and r["min"] != 0 and r["max"] != 0:
+					continue
+				results.append(r)
+			results.sort(key=lambda r: r["timestamp"])
 		return results
 
 	def get_iperf3_interface_data(self,query_date, interface):
 		(start_timestamp,end_timestamp) = start_end_timestamps(query_date)
-		cur = self.db_conn.cursor()
-		cur.execute("SELECT * FROM iperf3 where epoch_time >= {} and epoch_time <= {} and remote_host LIKE \"{}\"".format(start_timestamp,end_timestamp,interface))
-		col_time=1
-		col_rx_Mbps=3
-		col_tx_Mbps=4
-		col_retransmits=5
-		results=[]
-		for i in cur.fetchall():
-			results.append({"timestamp" : i[col_time], \
-					"rx_Mbps" : i[col_rx_Mbps], \
-					"tx_Mbps" : i[col_tx_Mbps], \
-					"retransmits" : i[col_retransmits]})
-		cur.close()
+		return self.query_range("iperf3_interface", start_timestamp, end_timestamp, (interface,start_timestamp,end_timestamp))
+
+	def get_iperf3_interface_samples(self,query_date, interface):
+		# returns the per-interval throughput samples of the tests of an interface run with the built-in probe
+		# (see tcpprobe.py), each with the timestamp of its test (test_timestamp)
+		(start_timestamp,end_timestamp) = start_end_timestamps(query_date)
+		results = []
+		for r in self.query_range("iperf3_interface_samples", start_timestamp, end_timestamp, (interface,start_timestamp,end_timestamp)):
+			for sample in decode_throughput_samples(r["samples"]):
+				sample["test_timestamp"] = r["timestamp"]
+				results.append(sample)
+		results.sort(key=lambda r: r["timestamp"])
 		return results
 
 	def get_iperf3_interfaces(self,query_date):
-		start_datetime = datetime.datetime.combine(query_date,datetime.datetime.min.time())
-		end_datetime = datetime.datetime.combine(query_date,datetime.datetime.max.time())
-		start_epoch = float(start_datetime.strftime('%s'))
-		end_epoch = float(end_datetime.strftime('%s'))
-		cur = self.db_conn.cursor()
-		cur.execute("SELECT DISTINCT remote_host FROM iperf3 where epoch_time >= {} and epoch_time <= {}".format(start_epoch,end_epoch))
-		results=[]
-		for i in cur.fetchall():
-			results.append({"remote_host" : i[0]})
-		cur.close()
+		(start_timestamp,end_timestamp) = start_end_timestamps(query_date)
+		results = []
+		for r in self.query_range("iperf3_interfaces", start_timestamp, end_timestamp, (start_timestamp,end_timestamp)):
+			if r not in results:
+				results.append(r)
 		return results
 
 	def get_dns_data(self,query_date):
-		start_datetime = datetime.datetime.combine(query_date,datetime.datetime.min.time())
-		end_datetime = datetime.datetime.combine(query_date,datetime.datetime.max.time())
-		start_epoch = float(start_datetime.strftime('%s'))
-		end_epoch = float(end_datetime.strftime('%s'))
-		cur = self.db_conn.cursor()
-		cur.execute("SELECT * FROM dns where epoch_time >= {} and epoch_time <= {}".format(start_epoch,end_epoch))
-		col_time=1
-		col_idns_ok=2
-		col_internal_dns_query_time=3
-		col_internal_dns_failures=4
-		col_edns_ok=5
-		col_external_dns_query_time=6
-		col_external_dns_failures=7
-		results=[]
-		for i in cur.fetchall():
+		(start_timestamp,end_timestamp) = start_end_timestamps(query_date)
+		results = self.query_range("dns", start_timestamp, end_timestamp, (start_timestamp,end_timestamp))
+		for r in results:
 			# map integer values to booleans
-			if i[col_idns_ok] == 1:
-				internal_dns_ok = True
-			else:
-				internal_dns_ok = False
-			if i[col_edns_ok] == 1:
-				external_dns_ok = True
-			else:
-				external_dns_ok = False
-
-			results.append({"timestamp" : i[col_time], \
-						"internal_dns_ok" : internal_dns_ok, \
-						"internal_dns_query_time" : i[col_internal_dns_query_time], \
-						"internal_dns_failures" : i[col_internal_dns_failures], \
-						"external_dns_ok" : external_dns_ok, \
-						"external_dns_query_time" : i[col_external_dns_query_time], \
-						"external_dns_failures" : i[col_external_dns_failures]})
-		cur.close()
+			r["internal_dns_ok"] = (r["internal_dns_ok"] == 1)
+			r["external_dns_ok"] = (r["external_dns_ok"] == 1)
 		return results
 
-	def get_last_bandwidth(self):
-		cur = self.db_conn.cursor()
-		cur.execute("SELECT * FROM bandwidth ORDER BY epoch_time DESC LIMIT 1")
-		col_time=1
-		col_rx_bytes=2
-		col_tx_bytes=3
-		col_rx_bps=4
-		col_tx_bps=5
-		results=None
-		for i in cur.fetchall():
-			results = {"timestamp" : i[col_time], \
-				   "rx_bytes" : i[col_rx_bytes], \
-				   "tx_bytes" : i[col_tx_bytes], \
-				   "rx_bps" : i[col_rx_bps], \
-				   "tx_bps" : i[col_tx_bps]}
-			break
-		cur.close()
+	def get_dns_server_data(self,query_date):
+		# returns the results of each DNS server queried by the name resolution tests on the given date
+		(start_timestamp,end_timestamp) = start_end_timestamps(query_date)
+		results = self.query_range("dns_servers", start_timestamp, end_timestamp, (start_timestamp,end_timestamp))
+		for r in results:
+			r["internal"] = (r["internal"] == 1)
+			r["ok"] = (r["ok"] == 1)
 		return results
 
-	def get_bandwidth_data(self,query_date = datetime.date.today(),minutes=0, rows=0):
-		# returns all bandwidth usage rows for the given date.
+	def get_last_bandwidth(self):
+		results = self.query_latest("last_bandwidth", (), 1)
+		if len(results) > 0:
+			return results[0]
+		(timestamps, values) = self.latest_chunk_arrays("bandwidth", "bandwidth_chunks_latest", 1)
+		if len(timestamps) > 0:
+			return chunk_results("bandwidth", timestamps[:1], values[:1], CHUNK_SOURCES["bandwidth"][2], \
+					("rx_bytes", "tx_bytes", "sample_count"))[0]
+		return None
+
+	def get_bandwidth_data(self,query_date = None,minutes=0, rows=0):
+		# returns all bandwidth usage rows for the given date (default today).
 		# if minutes is supplied as an argument, returns all rows within the past <minutes> minutes.
 		# if rows is supplied as an argument, returns the most recent <rows> rows of data.
+		# rows recorded in sub-second sampling mode also contain the sample count and the minimum/maximum
+		# sample rates of each interval, these are None for rows recorded at one sample per second.
+		if query_date is None:
+			query_date = datetime.date.today()
 		(start_timestamp,end_timestamp) = start_end_timestamps(query_date)
 		minutes = int(minutes)
+		rows = int(rows)
 		if query_date == datetime.date.today():
 			if minutes > 0:
 				start_timestamp = time.time() - 60*minutes
-		cur = self.db_conn.cursor()
+		# rows that have been packed into chunks are merged with the uncompressed rows
+		columns = ["rx_bps", "tx_bps", "sample_count", "rx_bps_min", "rx_bps_max", "tx_bps_min", "tx_bps_max"]
 		if rows > 0:
-			query = "SELECT * FROM bandwidth ORDER BY epoch_time DESC LIMIT {};".format(rows)
-		else:
-			query = "SELECT * FROM bandwidth where epoch_time >= {} and epoch_time <= {}".format(start_timestamp,end_timestamp)
-		cur.execute(query)
-		col_time=1
-		col_rx_bytes=2
-		col_tx_bytes=3
-		col_rx_bps=4
-		col_tx_bps=5
-		results=[]
-		for i in cur.fetchall():
-			results.append({"timestamp" : i[col_time], \
-					"rx_bps" : i[col_rx_bps], \
-					"tx_bps" : i[col_tx_bps]})
-		cur.close()
+			results = self.query_latest("bandwidth_rows", (rows,), rows)
+			if len(results) < rows:
+				(timestamps, values) = self.latest_chunk_arrays("bandwidth", "bandwidth_chunks_latest", rows - len(results))
+				if len(timestamps) > 0:
+					results += chunk_results("bandwidth", timestamps, values, columns, ("sample_count",))
+					results.sort(key=lambda r: r["timestamp"], reverse=True)
+					results = results[:rows]
+			return results
+		results = self.query_range("bandwidth", start_timestamp, end_timestamp, (start_timestamp,end_timestamp))
+		(timestamps, values) = self.chunk_arrays("bandwidth", "bandwidth_chunks", start_timestamp, end_timestamp, \
+				(start_timestamp - CHUNK_SECONDS,end_timestamp,start_timestamp))
+		if len(timestamps) > 0:
+			results += chunk_results("bandwidth", timestamps, values, columns, ("sample_count",))
+			results.sort(key=lambda r: r["timestamp"])
 		return results
 
+	def get_interface_bandwidth_data(self, query_date, interface):
+		# returns the bandwidth readings of one interface for the given date, recorded by a bandwidth monitor
+		# that watches several interfaces
+		(start_timestamp,end_timestamp) = start_end_timestamps(query_date)
+		return self.query_range("interface_bandwidth", start_timestamp, end_timestamp, (interface,start_timestamp,end_timestamp))
 
-	def get_isp_outage_data(self,query_date = datetime.date.today()):
+	def get_bandwidth_interfaces(self, query_date):
 		(start_timestamp,end_timestamp) = start_end_timestamps(query_date)
-		cur = self.db_conn.cursor()
-		query = "SELECT * FROM isp_outages where epoch_time >= {} and epoch_time <= {};".format(start_timestamp,end_timestamp)
-		cur.execute(query)
-		col_time=1
-		results=[]
-		for i in cur.fetchall():
-			results.append({"timestamp" : i[col_time]})
-		cur.close()
+		results = []
+		for r in self.query_range("bandwidth_interfaces", start_timestamp, end_timestamp, (start_timestamp,end_timestamp)):
+			if r not in results:
+				results.append(r)
+		return results
+
+	def get_bandwidth_rollup(self, query_date, bin_minutes):
+		# returns bandwidth statistics for the given date in bins of <bin_minutes> minutes, read from the
+		# coarsest rollup table whose buckets fit evenly into the bins. Each result contains the bin start
+		# timestamp, the sample count, and the mean, minimum, maximum and standard deviation of rx_bps and tx_bps.
+		(start_timestamp,end_timestamp) = start_end_timestamps(query_date)
+		bin_seconds = int(bin_minutes * 60)
+		rollup_table = None
+		for (table, bucket_seconds) in BANDWIDTH_ROLLUPS:
+			# buckets must also line up with local midnight (not the case for hourly buckets in some time zones)
+			if bin_seconds % bucket_seconds == 0 and start_timestamp % bucket_seconds == 0:
+				rollup_table = table
+				break
+		if rollup_table is None:
+			db_log.error("no bandwidth rollup table matches a bin width of {} minutes".format(bin_minutes))
+			return []
+		bins = {}
+		for r in self.query_range(rollup_table, start_timestamp, end_timestamp, (start_timestamp,end_timestamp)):
+			bin_start = start_timestamp + ((r["timestamp"] - start_timestamp) // bin_seconds) * bin_seconds
+			current_bin = bins.get(bin_start, None)
+			if current_bin is None:
+				current_bin = {"timestamp" : bin_start, "sample_count" : 0, \
+						"rx_bps_sum" : 0.0, "rx_bps_min" : r["rx_bps_min"], "rx_bps_max" : r["rx_bps_max"], "rx_bps_sumsq" : 0.0, \
+						"tx_bps_sum" : 0.0, "tx_bps_min" : r["tx_bps_min"], "tx_bps_max" : r["tx_bps_max"], "tx_bps_sumsq" : 0.0}
+				bins[bin_start] = current_bin
+			current_bin["sample_count"] += r["sample_count"]
+			for d in ("rx", "tx"):
+				current_bin[d + "_bps_sum"] += r[d + "_bps_sum"]
+				current_bin[d + "_bps_sumsq"] += r[d + "_bps_sumsq"]
+				current_bin[d + "_bps_min"] = min(current_bin[d + "_bps_min"], r[d + "_bps_min"])
+				current_bin[d + "_bps_max"] = max(current_bin[d + "_bps_max"], r[d + "_bps_max"])
+		results = []
+		for b in [bins[t] for t in sorted(bins)]:
+			n = b["sample_count"]
+			result = {"timestamp" : b["timestamp"], "sample_count" : n}
+			for d in ("rx", "tx"):
+				mean = b[d + "_bps_sum"] / n
+				result[d + "_bps_mean"] = mean
+				result[d + "_bps_min"] = b[d + "_bps_min"]
+				result[d + "_bps_max"] = b[d + "_bps_max"]
+				result[d + "_bps_stdev"] = math.sqrt(max(b[d + "_bps_sumsq"] / n - mean * mean, 0.0))
+			results.append(result)
 		return results
 
+	def get_isp_outage_data(self,query_date = None):
+		if query_date is None:
+			query_date = datetime.date.today()
+		return self.get_isp_outages(query_date)
 
 	def prune(self,data):
-		# deletes all rows (in all tables) with an epoch_time <= latest time on given date
+		# schedules deletion of all rows (in all tables) with an epoch_time <= latest time on given date.
+		# The rows are deleted in small chunks by maintenance_step, so that pruning does not block the write queue.
 		timestamp = data.get("timestamp",None)
 		if timestamp is not None:
 			prune_date = datetime.datetime.fromtimestamp(timestamp)
@@ -546,29 +1210,182 @@ class netperf_db:
 			db_log.error("prune: invalid timestamp")
 			return
 		(start_timestamp, end_timestamp) = start_end_timestamps(prune_date)
-		cur = self.db_conn.cursor()
+		# the outage intervals are kept in the main database file, outages that ended before the cutoff are
+		# deleted at once (there are few of them)
+		try:
+			self.db_conn.execute(OUTAGE_INTERVALS_PRUNE_SQL, (end_timestamp,))
+			self.db_conn.commit()
+		except Error as e:
+			self.db_conn.rollback()
+			db_log.error("unable to prune outage intervals: {}".format(e))
+		if self.partitioned:
+			# partitions are removed immediately, the main database is pruned only if it still holds rows
+			for day in self.partition_days():
+				if day <= prune_date.date():
+					self.drop_partition(day)
+			if not self.legacy_rows:
+				return
 		db_log.info("pruning database rows")
-		cur.execute("SELECT NAME FROM sqlite_master where type = 'table'")
-		for t in cur.fetchall():
-			table_name = t[0]
-			cur.execute("SELECT COUNT(*) AS CNTREC FROM pragma_table_info('{}') WHERE name='epoch_time'".format(table_name))
-			if cur.fetchall()[0] != 0:
-				cur.execute("DELETE FROM {} WHERE epoch_time < {}".format(table_name, end_timestamp))
-		# compact the database file
-		cur.execute("PRAGMA wal_checkpoint(TRUNCATE)")
-		cur.execute("VACUUM")
+		if self.prune_cutoff is None or end_timestamp > self.prune_cutoff:
+			self.prune_cutoff = end_timestamp
+		self.prune_tables = list(TIMESERIES_TABLES)
+
+	def maintenance_pending(self):
+		self.schedule_compaction()
+		return (self.prune_cutoff is not None) or (len(self.migrate_tables) > 0) or (len(self.compact_days) > 0) or self.vacuum_pending
+
+	def schedule_compaction(self):
+		# in chunk storage mode, schedules packing of the rows of each completed hour into chunks
+		if not self.chunk_storage:
+			return
+		current_hour = int(time.time() // CHUNK_SECONDS) * CHUNK_SECONDS
+		if current_hour == self.compacted_hour:
+			return
+		if not self.partitioned:
+			days = [None]
+		elif self.compacted_hour is None:
+			days = self.partition_days()
+		else:
+			days = days_between(self.compacted_hour - CHUNK_SECONDS, current_hour - 1)
+		self.compacted_hour = current_hour
+		for day in days:
+			if day not in self.compact_days:
+				self.compact_days.append(day)
+
+	def compact_hour(self, schema, table):
+		# packs the rows of the oldest completed hour of <table> (in database <schema>) into chunks, one chunk
+		# per client (and remote host). Returns False if the table has no rows older than the current hour.
+		import numpy as np
+		from tschunk import encode_chunk
+		current_hour = int(time.time() // CHUNK_SECONDS) * CHUNK_SECONDS
+		oldest_time = self.oldest_time(table, schema)
+		if oldest_time is None or oldest_time >= current_hour:
+			return False
+		hour = int(oldest_time // CHUNK_SECONDS) * CHUNK_SECONDS
+		(chunk_table, key_columns, value_columns) = CHUNK_SOURCES[table]
+		key_count = 1 + len(key_columns)
+		cur = self.db_conn.cursor()
+		try:
+			groups = {}
+			for row in cur.execute(partition_sql(CHUNK_ROWS_SQL[table], schema), (hour, hour + CHUNK_SECONDS)).fetchall():
+				groups.setdefault(row[:key_count], []).append(row[key_count:])
+			chunk_rows = []
+			for (key, rows) in groups.items():
+				# rows that arrived after the hour was compacted are merged into the existing chunk
+				existing = cur.execute(partition_sql(CHUNK_DATA_SQL[table], schema), key + (hour,)).fetchone()
+				if existing is not None:
+					(timestamps, values) = decode_table_chunk(table, existing[0])
+					# the rows of the hour have been deleted from the table, so a row sent again is not ignored by
+					# the insert: the rows whose timestamp is already in the chunk are left out
+					chunk_times = set(np.rint(timestamps * 1e6).astype(np.int64).tolist())
+					rows = [r for r in rows if int(round(r[0] * 1e6)) not in chunk_times]
+					rows = sorted([tuple(r) for r in np.column_stack((timestamps, values)).tolist()] + rows, key=lambda r: r[0])
+				chunk_rows.append(key + (hour, rows[-1][0], len(rows), encode_chunk(rows)))
+			cur.executemany(partition_sql(INSERT_SQL[chunk_table], schema), chunk_rows)
+			cur.execute(partition_sql(CHUNK_DELETE_SQL[table], schema), (hour, hour + CHUNK_SECONDS))
+			self.db_conn.commit()
+		except Error as e:
+			self.db_conn.rollback()
+			db_log.error("unable to compact {} rows: {}".format(table,e))
+			cur.close()
+			return False
 		cur.close()
-		self.db_conn.commit()
+		return True
 
+	def maintenance_step(self, time_budget, chunk_size = 2000):
+		# performs pending prune deletes and incremental vacuum steps for up to <time_budget> seconds
+		deadline = time.monotonic() + time_budget
+		cur = self.db_conn.cursor()
+		while self.prune_cutoff is not None and time.monotonic() < deadline:
+			table_name = self.prune_tables[0]
+			cur.execute(PRUNE_SQL[table_name], (self.prune_cutoff, chunk_size))
+			deleted_rows = cur.rowcount
+			self.db_conn.commit()
+			if deleted_rows < chunk_size:
+				self.prune_tables.pop(0)
+				if len(self.prune_tables) == 0:
+					db_log.info("database rows pruned")
+					self.prune_cutoff = None
+					self.vacuum_pending = self.incremental_vacuum_enabled()
+		while self.prune_cutoff is None and len(self.migrate_tables) > 0 and time.monotonic() < deadline:
+			# move the rows of a single-file database into day partitions, oldest rows first
+			table_name = self.migrate_tables[0]
+			oldest_time = self.oldest_time(table_name)
+			if oldest_time is None:
+				self.migrate_tables.pop(0)
+				if len(self.migrate_tables) == 0:
+					db_log.info("database rows moved to partitions")
+					self.legacy_rows = False
+					self.vacuum_pending = self.incremental_vacuum_enabled()
+					# check all partitions for rows to compact
+					self.compacted_hour = None
+				continue
+			day = datetime.date.fromtimestamp(oldest_time)
+			schema = self.attach_partition(day, create = True)
+			if schema is None:
+				# the remaining rows stay in (and are still read from) the main database
+				db_log.error("unable to move database rows to partitions")
+				self.migrate_tables = []
+				break
+			(start_timestamp, next_timestamp) = day_timestamps(day)
+			cur.execute(MIGRATE_COPY_SQL[table_name].format(schema = schema), (start_timestamp, next_timestamp, chunk_size))
+			cur.execute(MIGRATE_DELETE_SQL[table_name], (start_timestamp, next_timestamp, chunk_size))
+			self.db_conn.commit()
+		while self.prune_cutoff is None and len(self.migrate_tables) == 0 and len(self.compact_days) > 0 and time.monotonic() < deadline:
+			# pack the rows of completed hours into chunks, one hour of one table per iteration
+			day = self.compact_days[0]
+			if day is None:
+				schema = "main"
+			else:
+				schema = self.attach_partition(day)
+			if schema is None or not (self.compact_hour(schema, "bandwidth") or self.compact_hour(schema, "ping")):
+				self.compact_days.pop(0)
+		while self.vacuum_pending and time.monotonic() < deadline:
+			# release free pages to the file system a few at a time (requires auto_vacuum=INCREMENTAL)
+			free_pages = cur.execute("PRAGMA freelist_count").fetchone()[0]
+			if free_pages > 0:
+				self.db_conn.executescript("PRAGMA incremental_vacuum({});".format(VACUUM_PAGES_PER_STEP))
+			remaining_pages = cur.execute("PRAGMA freelist_count").fetchone()[0]
+			if remaining_pages == 0 or remaining_pages >= free_pages:
+				# done, or no page could be freed. Move the vacuumed pages from the write-ahead log into the
+				# database file and truncate the log.
+				cur.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+				self.vacuum_pending = False
+				if remaining_pages == 0:
+					db_log.info("database free pages reclaimed")
+				else:
+					db_log.error("unable to reclaim {} free database pages".format(remaining_pages))
+		cur.close()
 
-	def data_usage_reset(self,data):
-		# resets data usage to zero
-		timestamp = time.time()
+	def incremental_vacuum_enabled(self):
+		# True if free pages can be reclaimed by incremental vacuum steps (see enable_incremental_vacuum)
+		return self.db_conn.execute("PRAGMA auto_vacuum").fetchone()[0] == AUTO_VACUUM_INCREMENTAL
+
+	def enable_incremental_vacuum(self):
+		# switches the database to auto_vacuum=INCREMENTAL so that free pages can be reclaimed in small steps.
+		# Converting an existing database requires a one-time full VACUUM; if it fails (e.g. the database is busy
+		# or the disk is full) the database is used without incremental vacuum, and conversion is retried at
+		# the next start.
+		if self.incremental_vacuum_enabled():
+			return
+		db_log.info("enabling incremental vacuum")
 		cur = self.db_conn.cursor()
-		query = "INSERT INTO data_usage (client_id,epoch_time,rxtx_bytes) VALUES('{}','{}','{}')".format(client_id,timestamp,str(0));
-		cur.execute(query)
+		try:
+			cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+			cur.execute("VACUUM")
+		except Error as e:
+			db_log.error("unable to enable incremental vacuum: {}".format(e))
 		cur.close()
-		self.db_conn.commit()
+		if not self.incremental_vacuum_enabled():
+			self.vacuum_pending = False
+
+	def data_usage_reset(self,data):
+		# resets data usage to zero
+		row_data = ( client_id, \
+				time.time(), \
+				0 )
+		self.insert_rows({"data_usage" : [row_data], "data_usage_state" : [row_data]})
+		self.rxtx_bytes = 0
 
 	def close(self):
 		try:
@@ -577,6 +1394,36 @@ class netperf_db:
 		except:
 			pass
 
+class db_pool():
+	# pool of read-only netperf_db instances, reused across requests (e.g. the tasks run by a dashboard worker).
+	# Connections are never shared with forked child processes: the pool is emptied when it is used in a
+	# process other than the one that created the connections.
+	def __init__(self, db_file = None, max_idle = 4):
+		if db_file is None:
+			db_file = NETPERF_DB
+		self.db_file = db_file
+		self.max_idle = max_idle
+		self.idle = []
+		self.pid = os.getpid()
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		with self.lock:
+			if self.pid != os.getpid():
+				# the connections belong to the parent process, leave them alone
+				self.idle = []
+				self.pid = os.getpid()
+			if len(self.idle) > 0:
+				return self.idle.pop()
+		return netperf_db(self.db_file, read_only = True)
+
+	def release(self, db):
+		with self.lock:
+			if db.db_conn is not None and self.pid == os.getpid() and len(self.idle) < self.max_idle:
+				self.idle.append(db)
+				return
+		db.close()
+
 class db_queue():
 	queue = None
 	def __init__(self):
@@ -585,13 +1432,20 @@ class db_queue():
 		except:
 			self.queue = posix_ipc.MessageQueue(DB_WRITE_QUEUE)
 
-	def write(self,json_object):
-		self.queue.send(json.dumps(json_object))
+	def write(self,json_object,timeout=None):
+		# blocks while the queue is full. If a timeout (seconds) is given, posix_ipc.BusyError is raised when
+		# the message cannot be sent in time; a timeout of 0 never blocks.
+		self.queue.send(encode_message(json_object, BINARY_MESSAGES), timeout)
 
-	def read(self):
-		( message, priority ) = self.queue.receive()
+	def read_raw(self,timeout=None):
+		# blocks until a message is available, returns the encoded message. If a timeout (seconds) is given,
+		# posix_ipc.BusyError is raised when no message arrives in time; a timeout of 0 returns immediately.
+		return self.queue.receive(timeout)
+
+	def read(self,timeout=None):
+		( message, priority ) = self.read_raw(timeout)
 		try:
-			json_data = json.loads(message)
+			json_data = decode_message(message)
 		except:
 			json_data = None
 			db_log.error("received invalid message: {}".format(str(message)))
@@ -607,12 +1461,16 @@ class dashboard_queue():
 			db_log.error("unable to open/create the dashboard message queue")
 			pass
 	def write(self,json_object):
-		self.queue.send(json.dumps(json_object))
+		self.queue.send(encode_message(json_object, BINARY_MESSAGES))
+
+	def write_raw(self,message):
+		# forwards a message that has already been encoded
+		self.queue.send(message)
 
 	def read(self):
 		( message, priority ) = self.queue.receive()
 		try:
-			json_data = json.loads(message)
+			json_data = decode_message(message)
 		except:
 			json_data = None
 			db_log.error("received invalid message: {}".format(str(message)))
@@ -629,46 +1487,80 @@ if __name__ == '__main__':
 		dashboard_q = dashboard_queue(DASHBOARD_QUEUE)
 	else:
 		dashboard_q = None
+	# the dashboard reads live bandwidth readings from the bandwidth monitor's shared memory ring when it is
+	# enabled, these messages are not forwarded
+	if NETPERF_SETTINGS.get_bandwidth_monitor_ring_minutes() > 0:
+		dashboard_skip_types = {"bandwidth", "interface_bandwidth"}
+	else:
+		dashboard_skip_types = set()
 	sigterm_h = util.sigterm_handler()
+	batch_writes = NETPERF_SETTINGS.get_db_batch_writes()
+	max_batch_size = NETPERF_SETTINGS.get_db_max_batch_size()
+	flush_delay = NETPERF_SETTINGS.get_db_flush_delay()
+	prune_chunk_size = NETPERF_SETTINGS.get_db_prune_chunk_size()
+	maintenance_time_budget = NETPERF_SETTINGS.get_db_maintenance_time_budget()
+	db.enable_incremental_vacuum()
 
-	def invalid(data):
-		db_log.error("Invalid message type: {}".format(data.get("type",None)))
+	def receive(timeout=None):
+		# read a message from the queue and forward it to the dashboard, returns (type, data) or None
+		raw_message, priority = dbq.read_raw(timeout)
+		try:
+			message = decode_message(raw_message)
+		except:
+			message = None
+		db_log.debug(message)
+		if message is None:
+			db_log.error("received invalid message: {}".format(str(raw_message)))
+			return None
+		type = message.get("type",None)
+		data = message.get("data",None)
+		db_log.debug("received message type: {} data: {}".format(type,json.dumps(data)))
+		if dashboard_q is not None and type not in dashboard_skip_types:
+			try:
+				# the dashboard understands the same message formats, forward the message without re-encoding it
+				dashboard_q.write_raw(raw_message)
+			except:
+				#queue is full
+				db_log.debug("dashboard message queue is full.")
+		return (type, data)
 
-	def function_map(type):
-		switcher = {
-			"bandwidth": db.log_bandwidth,
-			"speedtest": db.log_speedtest,
-			"ping": db.log_ping,
-			"iperf3": db.log_iperf3,
-			"dns": db.log_dns,
-			"isp_outage": db.log_isp_outage,
-			"data_usage": db.log_data_usage,
-			"prune": db.prune,
-			"data_usage_reset": db.data_usage_reset
-		}
-		return switcher.get(type, invalid)
+	def read_batch():
+		# wait for a message, then collect the messages that arrive within the flush delay, followed by
+		# any that are already waiting in the queue, up to the maximum batch size.
+		batch = []
+		message = receive()
+		if message is not None:
+			batch.append(message)
+		deadline = time.monotonic() + flush_delay
+		while len(batch) < max_batch_size and not sigterm_h.terminate:
+			try:
+				message = receive(max(deadline - time.monotonic(), 0))
+			except posix_ipc.BusyError:
+				break
+			if message is not None:
+				batch.append(message)
+		return batch
 
 	while not sigterm_h.terminate:
-		message, priority = dbq.read()
-		db_log.debug(message)
-		if message is not None:
-			type = message.get("type",None)
-			db_log.debug("message type is: {}".format(type))
-			data = message.get("data",None)
-			db_log.debug("received message type: {} data: {}".format(type,json.dumps(data)))
-			if dashboard_q is not None:
-				try:
-					dashboard_q.write(message)
-				except:
-					#queue is full
-					db_log.debug("dashboard message queue is full.")
-		else:
-			type = "undefined"
-			data = {"error" : "unable to parse json object"}
-			db_log.error("received undefined message")
+		if db.maintenance_pending() and dbq.queue.current_messages == 0:
+			# the queue is idle, use the gap to perform a step of pending prune/vacuum work
+			db.maintenance_step(maintenance_time_budget, prune_chunk_size)
+			continue
+		if batch_writes:
+			batch = read_batch()
+			db_log.debug("writing batch of {} messages".format(len(batch)))
+			db.log_batch(batch)
+			continue
+		message = receive()
+		if message is None:
+			continue
+		(type, data) = message
+		handler = db.message_handler(type)
+		if handler is None:
+			db_log.error("Invalid message type: {}".format(type))
 			continue
 		try:
-			function_map(type)(data)
+			handler(data)
 		except:
 			db_log.error("error occurred while writing to the database")
 	db.close()
@@ -8,15 +8,9 @@ import time
 import sys
 import os
 from subprocess import check_output,Popen,STDOUT,PIPE
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
-import matplotlib.dates as md
-import numpy as np
 import re
 import util
-from netperf_db import netperf_db
+from netperf_db import netperf_db, start_end_timestamps
 from netperf_settings import netperf_settings
 import pprint
 import logging
@@ -88,6 +82,14 @@ def main():
 
 	report_log.info("Generating network performance report for date {}".format(query_date.strftime("%Y-%m-%d")))
 
+	# matplotlib and numpy take most of the start up time of this script, they are only imported once
+	# a report is actually generated
+	import matplotlib
+	matplotlib.use('Agg')
+	import matplotlib.pyplot as plt
+	import matplotlib.ticker as ticker
+	import numpy as np
+
 	report_keyvals.add("main/client_id", CLIENT_ID)
 	report_keyvals.add("main/query_date", query_date.strftime("%Y-%m-%d"))
 	report_keyvals.add("main/graphics_path", TMP_PATH)
@@ -95,6 +97,7 @@ def main():
 	db = netperf_db(NETPERF_DB)
 
 	isp_outage_rows = db.get_isp_outages(query_date)
+	isp_outage_intervals = db.get_isp_outage_intervals(query_date)
 
 	rows = db.get_speedtest_data(query_date)
 	if len(rows) == 0:
@@ -162,6 +165,16 @@ def main():
 
 	isp_outages["y_values"] = np.zeros_like(isp_outages["times"])
 
+	# outage intervals recorded by the outage monitor, clipped to the reporting day
+	(day_start, day_end) = start_end_timestamps(query_date)
+	isp_outages["spans"] = []
+	isp_outages["seconds"] = 0
+	for r in isp_outage_intervals:
+		start = 0.0 if r["start_time"] <= day_start else util.fractional_hour(r["start_time"])
+		end = 24.0 if r["end_time"] >= day_end else util.fractional_hour(r["end_time"])
+		isp_outages["spans"].append((start, end))
+		isp_outages["seconds"] += min(r["end_time"], day_end) - max(r["start_time"], day_start)
+
 	report_keyvals.add("main/isp_outages", str(len(isp_outage_rows)))
 
 	speedtest_data["outages"]["y_values"] = np.zeros_like(speedtest_data["outages"]["times"])
@@ -201,6 +214,12 @@ def main():
 		#	axes["rx_tx"].axvline(i,color="xkcd:red",linewidth=0.5)
 		linesum = linesum + lines["isp_outages"]
 		legend_columns = 2
+		# shade the duration of each outage interval (at least one minute wide, to remain visible)
+		for (start, end) in isp_outages["spans"]:
+			span = axes["rx_tx"].axvspan(start, max(end, start + 1.0/60), color="xkcd:red", alpha=0.2, linewidth=0, zorder=0, \
+					label="Internet outage duration")
+		if len(isp_outages["spans"]) > 0:
+			linesum = linesum + [span]
 	else:
 		legend_columns = 3
 
@@ -211,6 +230,8 @@ def main():
 
 	if len(isp_outages["times"]) > 0:
 		speedtest_data["outages"]["info"] = "One or more times during the reporting day an Internet outage was recorded."
+		if len(isp_outages["spans"]) > 0:
+			speedtest_data["outages"]["info"] += " The outages detected by the outage monitor lasted {:.1f} minutes in total.".format(isp_outages["seconds"] / 60.0)
 	else:
 		speedtest_data["outages"]["info"] = "No Internet outages were recorded during the reporting day."
 	report_keyvals.add("main/outage_info", speedtest_data["outages"]["info"])
@@ -227,31 +248,57 @@ def main():
 		speedtest_data["table_tex"] += "{} & {} & {} & {} & {}\\\\\n".format(datetime.fromtimestamp(r["timestamp"]).strftime("%H:%M"),r["rx_Mbps"],r["tx_Mbps"],r["ping"],r["remote_host"])
 	report_keyvals.add("main/speedtest_table_data", speedtest_data["table_tex"])
 
-	rows = db.get_bandwidth_data(query_date)
+	# latency under load: median latency of each speedtest phase, with whiskers up to the 99th percentile
+	latency_rows = [r for r in rows if r["idle_latency_p50"] is not None or r["download_latency_p50"] is not None \
+			or r["upload_latency_p50"] is not None]
+	if len(latency_rows) > 0:
+		report_log.debug("Generating latency under load chart.")
+		fig, ax = plt.subplots()
+		ax.set_title("Latency under load for {}".format(query_date.strftime("%Y-%m-%d")))
+		ax.set_xlabel('Time of day (24 hour clock)')
+		ax.set_ylabel('Latency (ms)')
+		phase_styles = [("idle", "Idle", "xkcd:grey", -0.08), ("download", "During download", "xkcd:blue", 0.0), \
+				("upload", "During upload", "xkcd:green", 0.08)]
+		for (phase, label, color, offset) in phase_styles:
+			times = []
+			p50 = []
+			p99 = []
+			for r in latency_rows:
+				if r["{}_latency_p50".format(phase)] is None:
+					continue
+				times.append(util.fractional_hour(r["timestamp"]) + offset)
+				p50.append(r["{}_latency_p50".format(phase)])
+				p99.append(r["{}_latency_p99".format(phase)] - r["{}_latency_p50".format(phase)])
+			if len(times) > 0:
+				ax.errorbar(times, p50, yerr=[[0] * len(times), p99], color=color, marker="o", markersize=3, \
+						linestyle="None", capsize=2, label=label)
+		fig.subplots_adjust(bottom=0.2)
+		ax.set_xlim(0,24)
+		ax.set_xticks(np.arange(0,24,1))
+		ax.set_ylim(bottom=0)
+		ax.legend(loc='upper center', bbox_to_anchor=(0.5, -0.15), shadow=True, ncol=3)
+		chart_filename = "latency_chart.pdf"
+		report_keyvals.add("latency/chart_filename", chart_filename)
+		fig.savefig("{}/{}".format(TMP_PATH,chart_filename),format='pdf', bbox_inches='tight')
+		plt.cla()
+		for phase in ("idle", "download", "upload"):
+			values = [r["{}_latency_p90".format(phase)] for r in latency_rows if r["{}_latency_p90".format(phase)] is not None]
+			report_keyvals.add("latency/{}_p90_avg".format(phase), str(round(sum(values) / len(values), 2)) if len(values) > 0 else "--")
+		report_keyvals.add("latency/readings", "True")
+	else:
+		report_keyvals.add("latency/readings", "False")
+
+	bin_width = 10
+	rows = db.get_bandwidth_rollup(query_date, bin_width)
 
 	if len(rows) > 0:
 		report_log.debug("Generating bandwidth usage chart.")
-		bin_width = 10
 		report_keyvals.add("bwmonitor/bin_width", str(bin_width))
 		rx_tbins = time_bins(bin_width)
 		tx_tbins = time_bins(bin_width)
-		bandwidth_data = {}
-		bandwidth_data["times"] = {}
-		bandwidth_data["times"]["raw"] = []
-		bandwidth_data["rx"] = {}
-		bandwidth_data["rx"]["bps"] = []
-		bandwidth_data["rx"]["Mbps"] = []
-		bandwidth_data["tx"] = {}
-		bandwidth_data["tx"]["bps"] = []
-		bandwidth_data["tx"]["Mbps"] = []
 		for r in rows:
-			rx_tbins.add_value(util.fractional_hour(r["timestamp"]),round(r["rx_bps"]/1e6))
-			tx_tbins.add_value(util.fractional_hour(r["timestamp"]),round(r["tx_bps"]/1e6))
-			bandwidth_data["times"]["raw"].append(util.fractional_hour(r["timestamp"]))
-			bandwidth_data["rx"]["bps"].append(r["rx_bps"])
-			bandwidth_data["rx"]["Mbps"].append(round(r["rx_bps"]/1e6,2))
-			bandwidth_data["tx"]["bps"].append(r["tx_bps"])
-			bandwidth_data["tx"]["Mbps"].append(round(r["tx_bps"]/1e6,2))
+			rx_tbins.add_values(util.fractional_hour(r["timestamp"]),r["sample_count"],r["rx_bps_mean"]*r["sample_count"]/1e6)
+			tx_tbins.add_values(util.fractional_hour(r["timestamp"]),r["sample_count"],r["tx_bps_mean"]*r["sample_count"]/1e6)
 
 		axes = {}
 		fig, axes["times"] = plt.subplots()
@@ -421,6 +468,20 @@ def main():
 		axes["rx_tx"].set_xlim(0,24)
 		axes["rx_tx"].set_xticks(np.arange(0,24,1))
 		linesum = lines["rx"] + lines["tx"]
+		# the lowest interval rates of the tests run with the built-in throughput probe (see tcpprobe.py) show
+		# the dips that the average rates of a test hide
+		lowest_Mbps = {}
+		for sample in db.get_iperf3_interface_samples(query_date,iperf3_data["remote_host"]):
+			lowest = lowest_Mbps.setdefault(sample["test_timestamp"], {"rx" : None, "tx" : None})
+			for direction in ("rx","tx"):
+				bps = sample["{}_bps".format(direction)]
+				if bps is not None and (lowest[direction] is None or bps/1e6 < lowest[direction]):
+					lowest[direction] = bps/1e6
+		if len(lowest_Mbps) > 0:
+			lowest_times = [util.fractional_hour(t) for t in lowest_Mbps]
+			lines["rx_lowest"] = axes["rx_tx"].plot(lowest_times,[l["rx"] for l in lowest_Mbps.values()],color="xkcd:blue",marker="v",linestyle="None",markersize=3,label='Lowest interval receive (Mbps)')
+			lines["tx_lowest"] = axes["rx_tx"].plot(lowest_times,[l["tx"] for l in lowest_Mbps.values()],color="xkcd:green",marker="v",linestyle="None",markersize=3,label='Lowest interval transmit (Mbps)')
+			linesum = linesum + lines["rx_lowest"] + lines["tx_lowest"]
 		if np.count_nonzero(iperf3_data["retransmits"]["raw"]) > 0:
 			axes["retransmits"] = axes["rx_tx"].twinx()
 			color = "m"
@@ -193,18 +193,358 @@ class netperf_settings:
 		self.save_settings()
 
 	def get_speedtest_server_id(self):
+		# the configured server, or with ranked server selection the first server of the ranked shortlist
 		if "speedtest" in self.settings_json:
 			server_id = self.settings_json["speedtest"].get("server_id", None)
 		else:
 			server_id = None
+		if server_id is None and self.get_speedtest_server_selection() == "ranked":
+			import speedtest_servers
+			server_id = speedtest_servers.best_server_id(self.get_speedtest_shortlist_filename())
 		return server_id
 
+	def get_speedtest_server_selection(self):
+		# manual: the configured server_id, ranked: the server with the lowest connect time (see speedtest_servers.py),
+		# client: the speedtest client chooses. speedtest-cli does not reliably use a given server and the native
+		# client uses its own endpoints, with these the ranked selection is not used.
+		selection = "ranked"
+		if "speedtest" in self.settings_json:
+			if self.settings_json["speedtest"].get("server_id", None) is not None:
+				return "manual"
+			selection = self.settings_json["speedtest"].get("server_selection",selection)
+		if selection != "ranked" or self.get_speedtest_client() in ("speedtest-cli", "native"):
+			selection = "client"
+		return selection
+
+	def get_speedtest_server_list_url(self):
+		url = "https://www.speedtest.net/speedtest-servers-static.php"
+		if "speedtest" in self.settings_json:
+			url = self.settings_json["speedtest"].get("server_list_url",url)
+		return url
+
+	def get_speedtest_server_list_ttl(self):
+		# seconds the cached server list is used before it is refreshed
+		ttl = 86400
+		if "speedtest" in self.settings_json:
+			ttl = int(self.settings_json["speedtest"].get("server_list_ttl",ttl))
+		return min(max(ttl,3600),30*86400)
+
+	def get_speedtest_ranking_interval(self):
+		# seconds between the rankings of the speedtest servers
+		interval = 21600
+		if "speedtest" in self.settings_json:
+			interval = int(self.settings_json["speedtest"].get("ranking_interval",interval))
+		return min(max(interval,600),7*86400)
+
+	def get_speedtest_server_candidates(self):
+		# number of servers from the top of the server list that are ranked
+		candidates = 25
+		if "speedtest" in self.settings_json:
+			candidates = int(self.settings_json["speedtest"].get("server_candidates",candidates))
+		return min(max(candidates,1),100)
+
+	def get_speedtest_server_list_filename(self):
+		if "data_root" in self.settings_json:
+			return "{}/{}/speedtest_server_list.json".format(self.settings_json["data_root"].rstrip("/"),util.get_client_id())
+		else:
+			return None
+
+	def get_speedtest_shortlist_filename(self):
+		if "data_root" in self.settings_json:
+			return "{}/{}/speedtest_servers.json".format(self.settings_json["data_root"].rstrip("/"),util.get_client_id())
+		else:
+			return None
+
+	def get_speedtest_latency_probe(self):
+		# measure the latency under load (idle, download and upload phases) during each speedtest, see loadprobe.py
+		enabled = True
+		if "speedtest" in self.settings_json:
+			enabled = self.settings_json["speedtest"].get("latency_probe",True)
+		return enabled
+
+	def get_speedtest_latency_target(self):
+		# host probed during the speedtest, any host beyond the Internet connection's bottleneck will do
+		target = "8.8.8.8"
+		if "speedtest" in self.settings_json:
+			target = self.settings_json["speedtest"].get("latency_target",target)
+		return target
+
+	def get_speedtest_latency_interval(self):
+		# seconds between the latency probes sent during the speedtest
+		interval = 0.1
+		if "speedtest" in self.settings_json:
+			interval = float(self.settings_json["speedtest"].get("latency_interval",interval))
+		return min(max(interval,0.02),1.0)
+
+	def get_speedtest_native_download_url(self):
+		# HTTP URL the native speedtest client downloads from (see throughput.py), None if not configured
+		url = None
+		if "speedtest" in self.settings_json:
+			url = self.settings_json["speedtest"].get("native_download_url",None)
+		return url if url != "" else None
+
+	def get_speedtest_native_upload_url(self):
+		# HTTP URL the native speedtest client uploads to, None if not configured
+		url = None
+		if "speedtest" in self.settings_json:
+			url = self.settings_json["speedtest"].get("native_upload_url",None)
+		return url if url != "" else None
+
+	def get_speedtest_native_connections(self):
+		# parallel connections of each phase of the native speedtest
+		connections = 4
+		if "speedtest" in self.settings_json:
+			connections = int(self.settings_json["speedtest"].get("native_connections",connections))
+		return min(max(connections,1),16)
+
+	def get_speedtest_native_duration(self):
+		# maximum seconds of each phase (download, upload) of the native speedtest
+		duration = 10
+		if "speedtest" in self.settings_json:
+			duration = int(self.settings_json["speedtest"].get("native_duration",duration))
+		return min(max(duration,2),60)
+
+	def get_speedtest_native_max_MB(self):
+		# maximum payload of each phase of the native speedtest in MB, a phase ends when it is reached.
+		# 0: no limit, the phases last native_duration seconds.
+		max_MB = 100
+		if "speedtest" in self.settings_json:
+			max_MB = int(self.settings_json["speedtest"].get("native_max_MB",max_MB))
+		return min(max(max_MB,0),10000)
+
 	def get_bandwidth_monitor_enabled(self):
 		bwm_enabled=False
 		if "bandwidth_monitor" in self.settings_json:
 			bwm_enabled=self.settings_json["bandwidth_monitor"].get("enabled",False)
 		return bwm_enabled
 
+	def get_bandwidth_monitor_sample_rate(self):
+		# interface counter samples per second. At rates above 1 Hz the samples of each second are aggregated
+		# by the bandwidth monitor, which records the mean, minimum and maximum rate and the sample count.
+		sample_rate = 1
+		if "bandwidth_monitor" in self.settings_json:
+			sample_rate = int(self.settings_json["bandwidth_monitor"].get("sample_rate",sample_rate))
+		return min(max(sample_rate,1),50)
+
+	def get_bandwidth_monitor_ring_minutes(self):
+		# minutes of bandwidth readings kept in the shared memory ring (/dev/shm) for the dashboard and the
+		# speedtest; 0 disables the ring
+		ring_minutes = 10
+		if "bandwidth_monitor" in self.settings_json:
+			ring_minutes = int(self.settings_json["bandwidth_monitor"].get("ring_minutes",ring_minutes))
+		return min(max(ring_minutes,0),1440)
+
+	def get_local_tests_concurrent(self):
+		# run the local network tests of all interfaces concurrently (see network_tests.py)
+		concurrent = True
+		if "local_tests" in self.settings_json:
+			concurrent = self.settings_json["local_tests"].get("concurrent",True)
+		return concurrent
+
+	def get_local_tests_max_concurrent_iperf3(self):
+		# maximum number of local iperf3 tests run at the same time
+		max_concurrent = 1
+		if "local_tests" in self.settings_json:
+			max_concurrent = int(self.settings_json["local_tests"].get("max_concurrent_iperf3",max_concurrent))
+		return max(max_concurrent,1)
+
+	def get_local_tests_throughput_probe(self):
+		# the program that measures the throughput of the local network interfaces: iperf3, or tcpprobe (the
+		# built-in probe, see tcpprobe.py), which also records the throughput of each interval of the test
+		probe = "iperf3"
+		if "local_tests" in self.settings_json:
+			probe = self.settings_json["local_tests"].get("throughput_probe",probe)
+		if probe not in ("iperf3","tcpprobe"):
+			probe = "iperf3"
+		return probe
+
+	def get_local_tests_tcpprobe_streams(self):
+		# parallel TCP connections of a tcpprobe test
+		streams = 1
+		if "local_tests" in self.settings_json:
+			streams = int(self.settings_json["local_tests"].get("tcpprobe_streams",streams))
+		return min(max(streams,1),16)
+
+	def get_local_tests_tcpprobe_duration(self):
+		# seconds of each direction (download, then upload) of a tcpprobe test
+		duration = 5
+		if "local_tests" in self.settings_json:
+			duration = float(self.settings_json["local_tests"].get("tcpprobe_duration",duration))
+		return min(max(duration,1),60)
+
+	def get_local_tests_tcpprobe_interval(self):
+		# seconds between the throughput samples of a tcpprobe test
+		interval = 0.5
+		if "local_tests" in self.settings_json:
+			interval = float(self.settings_json["local_tests"].get("tcpprobe_interval",interval))
+		return min(max(interval,0.1),5)
+
+	def get_local_tests_tcpprobe_port(self):
+		# TCP port of the tcpprobe responders of the interfaces
+		port = 5202
+		if "local_tests" in self.settings_json:
+			port = int(self.settings_json["local_tests"].get("tcpprobe_port",port))
+		return port
+
+	def get_agent_enabled(self):
+		# run the network tests in the test agent (netperf_agent.py) instead of from systemd timers
+		enabled = True
+		if "agent" in self.settings_json:
+			enabled = self.settings_json["agent"].get("enabled",True)
+		return enabled
+
+	def get_agent_schedules(self):
+		# calendar expressions (systemd OnCalendar syntax) of the tests run by the test agent. Tests without
+		# a schedule are only run on request (test_network.py <test>).
+		schedules = { "internet_ping" : "*-*-* *:*:45", \
+				"dns" : "*-*-* *:0/10:00", \
+				"local" : "*-*-* *:0/10:00", \
+				"isp" : "*-*-* *:5,35:00" }
+		if "agent" in self.settings_json:
+			schedules.update(self.settings_json["agent"].get("schedules",{}))
+		return dict([(test, schedule) for (test, schedule) in schedules.items() if schedule not in (None, "")])
+
+	def get_ping_count(self):
+		# number of probes sent to each host by the latency tests (see pingprobe.py)
+		count = 10
+		if "ping" in self.settings_json:
+			count = int(self.settings_json["ping"].get("count",count))
+		return min(max(count,1),100)
+
+	def get_ping_interval(self):
+		# seconds between the probes sent to a host
+		interval = 0.2
+		if "ping" in self.settings_json:
+			interval = float(self.settings_json["ping"].get("interval",interval))
+		return min(max(interval,0.01),10.0)
+
+	def get_ping_timeout(self):
+		# seconds to wait for the reply to a probe
+		timeout = 2.0
+		if "ping" in self.settings_json:
+			timeout = float(self.settings_json["ping"].get("timeout",timeout))
+		return min(max(timeout,0.1),30.0)
+
+	def get_ping_method(self):
+		# probe method: auto, icmp, udp or tcp
+		method = "auto"
+		if "ping" in self.settings_json:
+			method = self.settings_json["ping"].get("method",method)
+		if method not in ("auto", "icmp", "udp", "tcp"):
+			method = "auto"
+		return method
+
+	def get_ping_tcp_port(self):
+		# port used by the tcp probe method (also the fallback when ICMP sockets are not permitted)
+		port = 53
+		if "ping" in self.settings_json:
+			port = int(self.settings_json["ping"].get("tcp_port",port))
+		return min(max(port,1),65535)
+
+	def get_outage_monitor_enabled(self):
+		# probe the Internet continuously (see outage_monitor.py) and record outages as time intervals
+		enabled = True
+		if "outage_monitor" in self.settings_json:
+			enabled = self.settings_json["outage_monitor"].get("enabled",True)
+		return enabled
+
+	def get_outage_monitor_targets(self):
+		# hosts probed by the outage monitor, ideally operated by different providers
+		targets = ["8.8.8.8", "1.1.1.1", "9.9.9.9"]
+		if "outage_monitor" in self.settings_json:
+			targets = self.settings_json["outage_monitor"].get("targets",targets)
+		return [t for t in targets if t not in (None, "")]
+
+	def get_outage_monitor_interval(self):
+		# seconds between the probe rounds of the outage monitor (one probe per target per round)
+		interval = 1.0
+		if "outage_monitor" in self.settings_json:
+			interval = float(self.settings_json["outage_monitor"].get("interval",interval))
+		return min(max(interval,0.2),60.0)
+
+	def get_outage_monitor_timeout(self):
+		# seconds to wait for the reply to a probe, at most the probe interval
+		timeout = 1.0
+		if "outage_monitor" in self.settings_json:
+			timeout = float(self.settings_json["outage_monitor"].get("timeout",timeout))
+		return min(max(timeout,0.1),self.get_outage_monitor_interval())
+
+	def get_outage_monitor_quorum(self):
+		# number of targets that must fail to reply for a probe round to count as failed, 0 for a majority
+		quorum = 0
+		if "outage_monitor" in self.settings_json:
+			quorum = int(self.settings_json["outage_monitor"].get("quorum",quorum))
+		return max(quorum,0)
+
+	def get_outage_monitor_confirm_rounds(self):
+		# consecutive failed (successful) probe rounds needed to start (end) an outage
+		rounds = 3
+		if "outage_monitor" in self.settings_json:
+			rounds = int(self.settings_json["outage_monitor"].get("confirm_rounds",rounds))
+		return min(max(rounds,1),60)
+
+	def get_db_batch_writes(self):
+		batch_writes = True
+		if "database" in self.settings_json:
+			batch_writes = self.settings_json["database"].get("batch_writes",True)
+		return batch_writes
+
+	def get_db_max_batch_size(self):
+		max_batch_size = 500
+		if "database" in self.settings_json:
+			max_batch_size = int(self.settings_json["database"].get("max_batch_size",max_batch_size))
+		return max(max_batch_size,1)
+
+	def get_db_flush_delay(self):
+		# maximum time (seconds) the database daemon waits for more messages before writing a batch
+		flush_delay = 2.0
+		if "database" in self.settings_json:
+			flush_delay = float(self.settings_json["database"].get("flush_delay",flush_delay))
+		return max(flush_delay,0.0)
+
+	def get_db_prune_chunk_size(self):
+		# maximum number of rows deleted by each step of an incremental prune
+		prune_chunk_size = 2000
+		if "database" in self.settings_json:
+			prune_chunk_size = int(self.settings_json["database"].get("prune_chunk_size",prune_chunk_size))
+		return max(prune_chunk_size,1)
+
+	def get_db_maintenance_time_budget(self):
+		# maximum time (seconds) spent on each prune/vacuum step while the write queue is idle
+		time_budget = 0.2
+		if "database" in self.settings_json:
+			time_budget = float(self.settings_json["database"].get("maintenance_time_budget",time_budget))
+		return max(time_budget,0.01)
+
+	def get_db_partitioned(self):
+		# store each day's rows in a separate database file
+		partitioned = False
+		if "database" in self.settings_json:
+			partitioned = self.settings_json["database"].get("partitioned",False)
+		return partitioned
+
+	def get_db_max_attached_partitions(self):
+		# maximum number of day partitions attached to a database connection at the same time
+		# (sqlite supports at most 10 attached databases per connection)
+		max_attached = 8
+		if "database" in self.settings_json:
+			max_attached = int(self.settings_json["database"].get("max_attached_partitions",max_attached))
+		return min(max(max_attached,1),10)
+
+	def get_db_binary_messages(self):
+		# send the frequent message types to the database queue in the binary format (see msgcodec.py)
+		binary_messages = True
+		if "database" in self.settings_json:
+			binary_messages = self.settings_json["database"].get("binary_messages",True)
+		return binary_messages
+
+	def get_db_chunk_storage(self):
+		# pack bandwidth and ping rows older than the current hour into compressed chunks
+		chunk_storage = False
+		if "database" in self.settings_json:
+			chunk_storage = self.settings_json["database"].get("chunk_storage",False)
+		return chunk_storage
+
 def main():
 	log_levels = set(['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'])
 	ns = netperf_settings()
@@ -249,6 +589,8 @@ def main():
 			print (ns.get_speedtest_client())
 		elif setting == "bwmonitor_enabled":
 			print (ns.get_bandwidth_monitor_enabled())
+		elif setting == "agent_enabled":
+			print (ns.get_agent_enabled())
 
 	if action == "set":
 		if setting == "data_usage_quota_GB":
@@ -308,8 +650,10 @@ def main():
 				ns.set_speedtest_client("ookla")
 			elif value.lower() == "speedtest-cli":
 				ns.set_speedtest_client("speedtest-cli")
+			elif value.lower() == "native":
+				ns.set_speedtest_client("native")
 			else:
-				print ("speedtest_client value must be 'speedtest-cli' or 'ookla'")
+				print ("speedtest_client value must be 'speedtest-cli', 'ookla' or 'native'")
 		elif setting == "speedtest_server_id":
 			if value != "":
 				ns.set_speedtest_server_id(value)
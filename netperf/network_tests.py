@@ -0,0 +1,594 @@
+#!/usr/bin/env python3
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# The network tests. They are run by the test agent (netperf_agent.py), or by test_network.py when the agent
+# is not running.
+
+import os
+import json
+import shlex
+import asyncio
+from datetime import datetime
+from subprocess import check_output,Popen,STDOUT,DEVNULL,PIPE
+import sys
+import util
+import dnsprobe
+import pingprobe
+import loadprobe
+import tcpprobe
+import outage_monitor
+import nshelper
+import speedtest_servers
+import time
+from netperf_db import netperf_db,db_queue
+from netperf_settings import netperf_settings
+import logging
+
+client_id = util.get_client_id()
+
+NETPERF_SETTINGS = netperf_settings()
+
+logging.basicConfig(filename=NETPERF_SETTINGS.get_log_filename(), format=NETPERF_SETTINGS.get_logger_format())
+test_log = logging.getLogger("test_network")
+test_log.setLevel(NETPERF_SETTINGS.get_log_level())
+
+def default_nns(nns):
+	if nns in (None, "root"):
+		return True
+	else:
+		return False
+
+def log_isp_outage(client_id,timestamp,dbq):
+	# outages detected by the tests are only recorded while the outage monitor is not running, the monitor
+	# records them as intervals (see outage_monitor.py)
+	if outage_monitor.monitor_running():
+		return
+	outage_data = {"type": "isp_outage",\
+			"data" : { \
+				"client_id" : client_id, \
+				"timestamp" : timestamp} \
+			}
+	dbq.write(outage_data)
+
+def pingtest(test_exec_namespace,remote_host,dbq):
+	ping_result = asyncio.run(ping_hosts(test_exec_namespace,[remote_host]))[0]
+	db_data = ping_message(ping_result)
+	dbq.write(db_data)
+	p_results = db_data["data"]
+	return (client_id,p_results["timestamp"],remote_host,p_results["min"],p_results["avg"],p_results["max"],p_results["mdev"])
+
+def local_iperf3_command(remote_host):
+	return "iperf3 --connect-timeout 5000 -c {} --json".format(remote_host)
+
+def iperf3_message(returncode, json_str, remote_host):
+	# returns the iperf3 database message for the output of an iperf3 test
+	rx_Mbps = 0
+	tx_Mbps = 0
+	retransmits = 0
+	if returncode == 0:
+		test_log.info("Successful iperf3 test.")
+		# successful iperf3 test
+		iperf3_json=json.loads(json_str)
+		tx_Mbps=round(float(iperf3_json['end']['sum_sent']['bits_per_second'])/1e6,2)
+		rx_Mbps=round(float(iperf3_json['end']['sum_received']['bits_per_second'])/1e6,2)
+		retransmits=iperf3_json['end']['sum_sent']['retransmits']
+	else:
+		# iperf3 test failed
+		test_log.info("iperf3 test failed.")
+	return throughput_message(remote_host, rx_Mbps, tx_Mbps, retransmits)
+
+def tcpprobe_message(result, remote_host):
+	# returns the iperf3 database message for the result of a built-in throughput probe (see tcpprobe.py), which
+	# includes the throughput of each interval of the test
+	if result is None or not tcpprobe.succeeded(result):
+		test_log.info("tcpprobe test failed{}".format(": " + "; ".join(result["errors"]) if result is not None else "."))
+		return throughput_message(remote_host, 0, 0, 0)
+	test_log.info("Successful tcpprobe test.")
+	return throughput_message(remote_host, round(result["rx_bps"]/1e6,2), round(result["tx_bps"]/1e6,2), \
+			result["retransmits"] or 0, result["samples"])
+
+def throughput_message(remote_host, rx_Mbps, tx_Mbps, retransmits, samples = None):
+	ip3_results = {	"client_id" : client_id, \
+			"timestamp" : time.time(), \
+			"remote_host" : remote_host, \
+			"rx_Mbps" : rx_Mbps, \
+			"tx_Mbps" : tx_Mbps, \
+			"retransmits" : retransmits}
+	if samples:
+		ip3_results["samples"] = samples
+	return {	"type" : "iperf3", \
+			"data" : ip3_results}
+
+def ping_message(ping_result):
+	# returns the ping database message for the result of a latency probe (see pingprobe.py)
+	return { "type" : "ping",\
+		    "data" : { \
+				"client_id" : client_id, \
+				"timestamp" : time.time(), \
+				"remote_host" : ping_result["remote_host"], \
+				"min" : ping_result["min"], \
+				"avg" : ping_result["avg"], \
+				"max" : ping_result["max"], \
+				"mdev" : ping_result["mdev"], \
+				"packets_sent" : ping_result["packets_sent"], \
+				"packets_received" : ping_result["packets_received"], \
+				"loss_pct" : ping_result["loss_pct"], \
+				"jitter" : ping_result["jitter"], \
+				"rtt_p50" : ping_result["rtt_p50"], \
+				"rtt_p90" : ping_result["rtt_p90"], \
+				"rtt_p99" : ping_result["rtt_p99"]} \
+		  }
+
+async def namespace_probe(test_exec_namespace, probe_type, data):
+	# runs a probe in the test namespace with the namespace helper (see nshelper.py), returns None if the
+	# helper is not available
+	try:
+		return await nshelper.probe(test_exec_namespace, probe_type, data)
+	except (OSError, EOFError) as e:
+		test_log.debug("namespace helper not available ({}), using sudo ip netns exec".format(e))
+		return None
+
+async def ping_hosts(test_exec_namespace, remote_hosts):
+	# measures the latency and packet loss to the remote hosts, all hosts concurrently. In another network
+	# namespace the probe runs in the namespace helper, or as a single process in that namespace.
+	count = NETPERF_SETTINGS.get_ping_count()
+	interval = NETPERF_SETTINGS.get_ping_interval()
+	timeout = NETPERF_SETTINGS.get_ping_timeout()
+	method = NETPERF_SETTINGS.get_ping_method()
+	tcp_port = NETPERF_SETTINGS.get_ping_tcp_port()
+	if default_nns(test_exec_namespace):
+		return await pingprobe.ping_hosts(remote_hosts, count, interval, timeout, method, tcp_port)
+	ping_results = await namespace_probe(test_exec_namespace, "ping", { "hosts" : remote_hosts, "count" : count, \
+			"interval" : interval, "timeout" : timeout, "method" : method, "port" : tcp_port })
+	if ping_results is not None:
+		return ping_results
+	cmd = "sudo ip netns exec {} {} -c {} -i {} -W {} -m {} -p {} {}".format(test_exec_namespace, \
+			os.path.join(os.path.dirname(os.path.abspath(__file__)), "pingprobe.py"), \
+			count, interval, timeout, method, tcp_port, " ".join(remote_hosts))
+	ps = await asyncio.create_subprocess_shell(cmd,stdout=PIPE,stderr=DEVNULL)
+	output = (await ps.communicate())[0]
+	try:
+		return json.loads(output)
+	except ValueError:
+		test_log.error("latency probe failed in namespace {}".format(test_exec_namespace))
+		return [pingprobe.ping_statistics(h, None, [None] * count) for h in remote_hosts]
+
+async def local_throughput_test(test_exec_namespace, remote_host):
+	# measures the throughput to an interface with iperf3 or the built-in probe (see tcpprobe.py), returns the
+	# iperf3 database message. In another network namespace the built-in probe runs in the namespace helper, or
+	# as a process in that namespace.
+	if NETPERF_SETTINGS.get_local_tests_throughput_probe() != "tcpprobe":
+		(returncode, json_str) = await run_command(test_exec_namespace, local_iperf3_command(remote_host))
+		return iperf3_message(returncode, json_str, remote_host)
+	streams = NETPERF_SETTINGS.get_local_tests_tcpprobe_streams()
+	duration = NETPERF_SETTINGS.get_local_tests_tcpprobe_duration()
+	interval = NETPERF_SETTINGS.get_local_tests_tcpprobe_interval()
+	port = NETPERF_SETTINGS.get_local_tests_tcpprobe_port()
+	if default_nns(test_exec_namespace):
+		return tcpprobe_message(await tcpprobe.measure(remote_host, streams, duration, interval, port), remote_host)
+	result = await namespace_probe(test_exec_namespace, "tcp", { "host" : remote_host, "streams" : streams, \
+			"duration" : duration, "interval" : interval, "port" : port })
+	if result is None:
+		cmd = "sudo ip netns exec {} {} -p {} -P {} -t {} -i {} {}".format(test_exec_namespace, \
+				os.path.join(os.path.dirname(os.path.abspath(__file__)), "tcpprobe.py"), \
+				port, streams, duration, interval, remote_host)
+		ps = await asyncio.create_subprocess_shell(cmd,stdout=PIPE,stderr=DEVNULL)
+		output = (await ps.communicate())[0]
+		try:
+			result = json.loads(output)
+		except ValueError:
+			test_log.error("tcpprobe failed in namespace {}".format(test_exec_namespace))
+	return tcpprobe_message(result, remote_host)
+
+def test_local_network(test_exec_namespace, remote_host, dbq):
+	test_log.info("Testing interface {}".format(remote_host))
+
+	# Perform local network speed / ping tests
+	dbq.write(asyncio.run(local_throughput_test(test_exec_namespace, remote_host)))
+
+	ping_result = asyncio.run(ping_hosts(test_exec_namespace,[remote_host]))[0]
+	dbq.write(ping_message(ping_result))
+
+async def run_command(test_exec_namespace, cmd, stderr = True):
+	# runs a shell command in the test namespace without blocking the event loop, returns (return code, output).
+	# The output includes the standard error of the command if <stderr> is True. In another network namespace
+	# the command is run by the namespace helper (see nshelper.py), or with sudo ip netns exec when the helper
+	# is not available.
+	if not default_nns(test_exec_namespace):
+		try:
+			return await nshelper.run_command(test_exec_namespace, cmd, stderr)
+		except OSError as e:
+			test_log.debug("namespace helper not available ({}), using sudo ip netns exec".format(e))
+			cmd = "sudo ip netns exec {} {}".format(test_exec_namespace, cmd)
+		except EOFError:
+			# the command may have run, it is not repeated
+			test_log.error("namespace helper stopped while running: {}".format(cmd))
+			return (-1, b"")
+	ps = await asyncio.create_subprocess_shell(cmd,stdout=PIPE,stderr=STDOUT if stderr else DEVNULL)
+	output = (await ps.communicate())[0]
+	return (ps.returncode, output)
+
+async def test_local_networks(test_exec_namespace, remote_hosts, dbq, max_concurrent_iperf3 = 1):
+	# tests all of the local network interfaces. The ping tests of all interfaces run in parallel, followed by
+	# the throughput tests (iperf3 or tcpprobe), at most <max_concurrent_iperf3> at a time so that they do not
+	# compete for bandwidth (the ping tests are run first so that the latency is not measured while a throughput
+	# test loads the network).
+	# Returns the total time taken in seconds.
+	start_time = time.monotonic()
+	test_log.info("Testing latency of interfaces {}".format(", ".join(remote_hosts)))
+	for ping_result in await ping_hosts(test_exec_namespace, remote_hosts):
+		dbq.write(ping_message(ping_result))
+
+	iperf3_slots = asyncio.Semaphore(max_concurrent_iperf3)
+	async def iperf3_test(remote_host):
+		async with iperf3_slots:
+			test_log.info("Testing interface {}".format(remote_host))
+			message = await local_throughput_test(test_exec_namespace, remote_host)
+		dbq.write(message)
+	await asyncio.gather(*[iperf3_test(h) for h in remote_hosts])
+	elapsed_time = time.monotonic() - start_time
+	test_log.info("Local network tests of {} interfaces completed in {:.1f} seconds".format(len(remote_hosts),elapsed_time))
+	return elapsed_time
+
+async def namespace_load_probe(test_exec_namespace, target, interval, timeout, method, tcp_port, stop):
+	# measures the latency under load in another network namespace until <stop> is set, returns None if the
+	# probe failed. The probe runs in the namespace helper, or as a process in that namespace which stops
+	# when its standard input is closed.
+	try:
+		connection = await nshelper.connect()
+	except OSError as e:
+		test_log.debug("namespace helper not available ({}), using sudo ip netns exec".format(e))
+		connection = None
+	if connection is not None:
+		try:
+			return (await nshelper.request(connection, test_exec_namespace, "load", { "host" : target, \
+					"interval" : interval, "timeout" : timeout, "method" : method, "port" : tcp_port }, stop))[1]
+		except (OSError, EOFError) as e:
+			test_log.error("latency under load probe failed in namespace {}: {}".format(test_exec_namespace, e))
+			return None
+	probe_cmd = "sudo ip netns exec {} {} -i {} -W {} -m {} -p {} {}".format(test_exec_namespace, \
+			os.path.join(os.path.dirname(os.path.abspath(__file__)), "loadprobe.py"), \
+			interval, timeout, method, tcp_port, target)
+	probe_ps = await asyncio.create_subprocess_shell(probe_cmd,stdin=PIPE,stdout=PIPE,stderr=DEVNULL)
+	await stop.wait()
+	probe_output = (await probe_ps.communicate(b""))[0]
+	try:
+		return json.loads(probe_output)
+	except ValueError:
+		test_log.error("latency under load probe failed in namespace {}".format(test_exec_namespace))
+		return None
+
+async def speedtest_under_load(test_exec_namespace, cmd):
+	# runs the speedtest command while the latency under load is measured (see loadprobe.py), returns
+	# (return code, speedtest output, latency statistics of the test phases)
+	target = NETPERF_SETTINGS.get_speedtest_latency_target()
+	interval = NETPERF_SETTINGS.get_speedtest_latency_interval()
+	timeout = NETPERF_SETTINGS.get_ping_timeout()
+	method = NETPERF_SETTINGS.get_ping_method()
+	tcp_port = NETPERF_SETTINGS.get_ping_tcp_port()
+	stop = asyncio.Event()
+	if default_nns(test_exec_namespace):
+		probe = asyncio.ensure_future(loadprobe.measure(target, stop, interval, timeout, method, tcp_port))
+	else:
+		probe = asyncio.ensure_future(namespace_load_probe(test_exec_namespace, target, interval, timeout, method, tcp_port, stop))
+	# one second of idle probes before the test starts
+	await asyncio.sleep(1.0)
+	(returncode, output) = await run_command(test_exec_namespace, cmd, False)
+	stop.set()
+	latency = await probe
+	return (returncode, output, latency)
+
+def update_speedtest_servers(test_exec_namespace):
+	# ranks the speedtest servers again (see speedtest_servers.py) when the shortlist is older than the ranking
+	# interval. The servers are ranked from the test namespace, a failed ranking keeps the previous shortlist.
+	shortlist_filename = NETPERF_SETTINGS.get_speedtest_shortlist_filename()
+	if shortlist_filename is None:
+		return
+	(timestamp, shortlist) = speedtest_servers.load_shortlist(shortlist_filename)
+	if timestamp is not None and 0 <= time.time() - timestamp < NETPERF_SETTINGS.get_speedtest_ranking_interval():
+		return
+	url = NETPERF_SETTINGS.get_speedtest_server_list_url()
+	cache_filename = NETPERF_SETTINGS.get_speedtest_server_list_filename()
+	ttl = NETPERF_SETTINGS.get_speedtest_server_list_ttl()
+	candidates = NETPERF_SETTINGS.get_speedtest_server_candidates()
+	test_log.info("Ranking speedtest servers...")
+	if default_nns(test_exec_namespace):
+		try:
+			servers = speedtest_servers.fetch_server_list(url, cache_filename, ttl)
+		except (OSError, ValueError) as e:
+			test_log.error("Failed to retrieve the speedtest server list: {}".format(e))
+			return
+		shortlist = asyncio.run(speedtest_servers.rank_servers(servers, candidates))
+	else:
+		cmd = "{} -u {} -t {} -n {}".format(os.path.join(os.path.dirname(os.path.abspath(__file__)), "speedtest_servers.py"), \
+				url, ttl, candidates)
+		if cache_filename is not None:
+			cmd += " -c {}".format(cache_filename)
+		(returncode, output) = asyncio.run(run_command(test_exec_namespace, cmd, False))
+		try:
+			shortlist = json.loads(output)
+		except ValueError:
+			test_log.error("Speedtest server ranking failed in namespace {}".format(test_exec_namespace))
+			return
+	if len(shortlist) == 0:
+		test_log.warning("No speedtest server accepted a connection, the server ranking is unchanged.")
+		return
+	speedtest_servers.save_shortlist(shortlist_filename, shortlist)
+	test_log.info("Speedtest servers ranked, best server: {} {} ({} ms)".format(shortlist[0]["id"], shortlist[0]["sponsor"], \
+			shortlist[0]["latency_ms"]))
+
+def test_isp(test_exec_namespace,dbq):
+	speedtest_client = NETPERF_SETTINGS.get_speedtest_client()
+	if NETPERF_SETTINGS.get_speedtest_server_selection() == "ranked":
+		update_speedtest_servers(test_exec_namespace)
+	speedtest_server_id = NETPERF_SETTINGS.get_speedtest_server_id()
+	bwmonitor_enabled = NETPERF_SETTINGS.get_bandwidth_monitor_enabled()
+	test_log.info("Testing Internet speed...")
+	if bwmonitor_enabled == True:
+		test_log.info("Bandwidth monitor is enabled")
+	else:
+		test_log.info("Bandwidth monitor is disabled")
+	if speedtest_client == "speedtest-cli":
+		# open source client
+		if speedtest_server_id is not None:
+			speedtest_server_opt = "--server {}".format(speedtest_server_id)
+		else:
+			speedtest_server_opt = ""
+		cmd = "/usr/local/bin/speedtest-cli --json {}".format(speedtest_server_opt)
+	elif speedtest_client == "native":
+		# built-in HTTP throughput test against the configured endpoints, run as a command so that it can run
+		# in the test namespace (see throughput.py)
+		download_url = NETPERF_SETTINGS.get_speedtest_native_download_url()
+		upload_url = NETPERF_SETTINGS.get_speedtest_native_upload_url()
+		if download_url is None or upload_url is None:
+			# a configuration error, not a failed test: no speedtest result is recorded
+			test_log.error("The native speedtest client requires the speedtest native_download_url and native_upload_url settings")
+			return
+		cmd = "{} -d {} -u {} -c {} -t {} -b {}".format(os.path.join(os.path.dirname(os.path.abspath(__file__)), "throughput.py"), \
+				shlex.quote(download_url), shlex.quote(upload_url), NETPERF_SETTINGS.get_speedtest_native_connections(), \
+				NETPERF_SETTINGS.get_speedtest_native_duration(), NETPERF_SETTINGS.get_speedtest_native_max_MB() * 1000000)
+	else:
+		# Ookla client
+		if speedtest_server_id is not None:
+			speedtest_server_opt = "--server-id={}".format(speedtest_server_id)
+		else:
+			speedtest_server_opt = ""
+		cmd = "/usr/bin/speedtest --accept-license --format=json {}".format(speedtest_server_opt)
+	print (cmd)
+	latency = None
+	if NETPERF_SETTINGS.get_speedtest_latency_probe():
+		(returncode, json_str, latency) = asyncio.run(speedtest_under_load(test_exec_namespace, cmd))
+	else:
+		(returncode, json_str) = asyncio.run(run_command(test_exec_namespace, cmd, False))
+	bwm_rx_Mbps = 0.0
+	bwm_tx_Mbps = 0.0
+	if returncode == 0:
+		test_log.info("Successful speedtest.")
+		# successful speedtest
+		speedtest_json=json.loads(json_str)
+		if speedtest_client == "speedtest-cli":
+			# open source client JSON format
+			rx_Mbps=round(float(speedtest_json['download'])/1e6,2)
+			tx_Mbps=round(float(speedtest_json['upload'])/1e6,2)
+			rx_bytes=speedtest_json['bytes_received']
+			tx_bytes=speedtest_json['bytes_sent']
+			ping = round(speedtest_json['ping'],2)
+			remote_host=speedtest_json['server']['host']
+			url=speedtest_json['server']['url']
+		elif speedtest_client == "native":
+			# native client JSON format, the rates and bytes are measured on the wire
+			rx_Mbps=round(float(speedtest_json['download']['bps'])/1e6,2)
+			tx_Mbps=round(float(speedtest_json['upload']['bps'])/1e6,2)
+			rx_bytes=speedtest_json['rx_bytes']
+			tx_bytes=speedtest_json['tx_bytes']
+			ping = round(speedtest_json['ping'],2)
+			remote_host=speedtest_json['server']['host']
+			url=speedtest_json['server']['url']
+		else:
+			# Ookla client JSON format
+			rx_bytes=speedtest_json['download']['bytes']
+			rx_elapsed_seconds = float(speedtest_json['download']['elapsed'])/1e3
+			rx_Mbps = round(float(rx_bytes) * 8.0  / rx_elapsed_seconds / 1e6,2)
+			tx_bytes=speedtest_json['upload']['bytes']
+			tx_elapsed_seconds = float(speedtest_json['upload']['elapsed'])/1e3
+			tx_Mbps = round(float(tx_bytes) * 8.0  / tx_elapsed_seconds / 1e6,2)
+			ping = round(speedtest_json['ping']['latency'],2)
+			remote_host=speedtest_json['server']['host']
+			url='n/a'
+		bwm_ring = None
+		if bwmonitor_enabled:
+			# peak rates of the last minute, read from the bandwidth monitor's shared memory ring when it is
+			# being updated, otherwise from the database (bwring imports numpy, only needed here)
+			from bwring import bandwidth_ring_reader
+			bwm_ring = bandwidth_ring_reader().recent(60)
+			if bwm_ring is not None and (len(bwm_ring["timestamp"]) == 0 or time.time() - bwm_ring["timestamp"][-1] > 5):
+				bwm_ring = None
+		if bwm_ring is not None:
+			bwm_rx_Mbps = round(float(bwm_ring["rx_bps_max"].max())/1e6,2)
+			bwm_tx_Mbps = round(float(bwm_ring["tx_bps_max"].max())/1e6,2)
+		elif bwmonitor_enabled:
+			db_filename = NETPERF_SETTINGS.get_db_filename()
+			db = netperf_db(db_filename)
+			bwm_data = db.get_bandwidth_data(minutes=1)
+			for d in bwm_data:
+				# use the peak sub-second rates when the bandwidth monitor records them
+				rx_bps = d["rx_bps"] if d.get("rx_bps_max", None) is None else d["rx_bps_max"]
+				tx_bps = d["tx_bps"] if d.get("tx_bps_max", None) is None else d["tx_bps_max"]
+				rxMbps = round(rx_bps/1e6,2)
+				txMbps = round(tx_bps/1e6,2)
+				if rxMbps > bwm_rx_Mbps:
+					bwm_rx_Mbps = rxMbps
+				if txMbps > bwm_tx_Mbps:
+					bwm_tx_Mbps = txMbps
+		speedtest_results=(client_id,time.time(),rx_Mbps,tx_Mbps,rx_bytes,tx_bytes,remote_host,url,ping)
+		test_status = True
+	else:
+		test_log.info("Speedtest failed.")
+		# speedtest failed
+		speedtest_results=(client_id,time.time(),0,0,"n/a","n/a",0)
+		rx_Mbps = 0
+		tx_Mbps = 0
+		rx_bytes = 0
+		tx_bytes = 0
+		rx_bytes = 0
+		tx_bytes = 0
+		ping = 0
+		remote_host = "n/a"
+		url = "n/a"
+		test_status = False
+	st_data = { "type" : "speedtest", \
+		    "data" : {  "client_id" : client_id, \
+				"timestamp" : time.time(), \
+				"rx_Mbps" : rx_Mbps, \
+				"tx_Mbps" : tx_Mbps, \
+				"rx_bytes" : rx_bytes, \
+				"tx_bytes" : tx_bytes, \
+				"remote_host" : remote_host, \
+				"url" : url, \
+				"ping" : ping, \
+				"bwm_rx_Mbps" : bwm_rx_Mbps, \
+				"bwm_tx_Mbps" : bwm_tx_Mbps }
+                          }
+	if test_status and latency is not None:
+		test_log.info("Latency under load (p90): idle {} ms, download {} ms, upload {} ms".format(latency["idle_latency_p90"], \
+				latency["download_latency_p90"], latency["upload_latency_p90"]))
+		st_data["data"].update(latency)
+	dbq.write(st_data)
+	if NETPERF_SETTINGS.get_speedtest_enforce_quota() == True:
+		# send data usage info to the database for data usage quota enforcement
+		data_usage = { "type" : "data_usage", \
+				"data" : { "client_id" : client_id, \
+					   "timestamp" : time.time(), \
+					   "rxtx_bytes" : int(rx_bytes) + int(tx_bytes)}
+				}
+		dbq.write(data_usage)
+
+	return test_status
+
+def test_name_resolution(test_exec_namespace,dbq):
+	test_log.info("Testing name resolution...")
+	EXTERNAL_DNS_SERVERS=['8.8.8.8','8.8.4.4','1.1.1.1','9.9.9.9']
+	# the system resolver(s) and the external DNS servers are queried concurrently by the DNS probe; in another
+	# network namespace the probe runs in the namespace helper or as a single process in that namespace, both
+	# use the namespace's resolv.conf
+	print ("Testing local and external DNS...")
+	if default_nns(test_exec_namespace):
+		dns_servers = asyncio.run(dnsprobe.probe(EXTERNAL_DNS_SERVERS))
+	else:
+		dns_servers = asyncio.run(namespace_probe(test_exec_namespace, "dns", { "external_servers" : EXTERNAL_DNS_SERVERS }))
+	if dns_servers is None:
+		cmd = "sudo ip netns exec {} {} -e {}".format(test_exec_namespace, \
+				os.path.join(os.path.dirname(os.path.abspath(__file__)), "dnsprobe.py"), ",".join(EXTERNAL_DNS_SERVERS))
+		ps = Popen(cmd,shell=True,stdout=PIPE,stderr=DEVNULL)
+		cmd_output = ps.communicate()[0]
+		try:
+			dns_servers = json.loads(cmd_output)
+		except ValueError:
+			test_log.error("DNS probe failed in namespace {}".format(test_exec_namespace))
+			dns_servers = []
+	for r in dns_servers:
+		if r["ok"]:
+			test_log.info("{} DNS {} ok, query time {} us.".format("Internal" if r["internal"] else "External", r["server"], r["query_time_us"]))
+		else:
+			test_log.info("{} DNS {} failure.".format("Internal" if r["internal"] else "External", r["server"]))
+	(internal_dns_ok, internal_dns_query_time, internal_dns_failures) = dnsprobe.summarise(dns_servers, True)
+	(external_dns_ok, external_dns_query_time, external_dns_failures) = dnsprobe.summarise(dns_servers, False)
+	dns_data = { "type" : "dns", \
+		     "data" : { \
+				"client_id" : client_id, \
+				"timestamp" : time.time(), \
+				"internal_dns_ok" : internal_dns_ok, \
+				"internal_dns_query_time" : internal_dns_query_time, \
+				"internal_dns_failures" : internal_dns_failures, \
+				"external_dns_ok" : external_dns_ok, \
+				"external_dns_query_time" : external_dns_query_time, \
+				"external_dns_failures" : external_dns_failures, \
+				"servers" : dns_servers
+				} \
+		    }
+	dbq.write(dns_data)
+
+	if internal_dns_ok == False or external_dns_ok == False:
+		return False
+	else:
+		return True
+
+def run_test(test_type,dbq):
+	# runs a test: local, isp, dns or internet_ping (see netperf_agent.TEST_TYPES), results are written to dbq
+	with open("/opt/netperf/config/interfaces.json","r") as config_file:
+		interface_info = json.load(config_file)
+		test_exec_namespace = interface_info["test_exec_namespace"]
+		if test_type == 'local':
+			interfaces = interface_info["interfaces"]
+			remote_hosts = [interfaces[i]["alias"] for i in interfaces if interfaces[i]["namespace"] != test_exec_namespace]
+			if NETPERF_SETTINGS.get_local_tests_concurrent():
+				elapsed_time = asyncio.run(test_local_networks(test_exec_namespace, remote_hosts, dbq, \
+						NETPERF_SETTINGS.get_local_tests_max_concurrent_iperf3()))
+				print ("Local network tests completed in {:.1f} seconds".format(elapsed_time))
+			else:
+				for remote_host in remote_hosts:
+					test_local_network(test_exec_namespace, remote_host, dbq)
+		else:
+			if test_type == 'isp':
+				db_filename = NETPERF_SETTINGS.get_db_filename()
+				db = netperf_db(db_filename)
+				enforce_quota = NETPERF_SETTINGS.get_speedtest_enforce_quota()
+				data_usage_quota_GB = NETPERF_SETTINGS.get_data_usage_quota_GB()
+				data_usage_GB = float(db.get_data_usage()["rxtx_bytes"])/float(1e9)
+				test_log.info("data usage GB: {:0.2f}".format(data_usage_GB))
+				if enforce_quota == True:
+					st_data_usage = db.get_speedtest_data_usage(datetime.today())
+					test_count = st_data_usage[0]["test_count"]
+					if test_count > 0:
+						rxtx_GB = float(st_data_usage[0]["rxtx_bytes"])/float(1e9)
+						avg_rxtx_GB = float(rxtx_GB)/float(test_count)
+					else:
+						rxtx_GB = float(0)
+						avg_rxtx_GB = float(0)
+					if (data_usage_GB + avg_rxtx_GB) > data_usage_quota_GB:
+						quota_reached = True
+					else:
+						quota_reached = False
+				db.close()
+
+				if not (enforce_quota == True and quota_reached == True):
+					test_ok = test_isp(test_exec_namespace,dbq)
+					if not test_ok:
+						# speedtest failed, test for an Internet outage outage
+						ping_results = pingtest(test_exec_namespace,"8.8.8.8",dbq)
+						(client_id,timestamp,remote_host,min,avg,max,mdev) = ping_results
+						if min == 0 or max == 0:
+							# log an outage
+							log_isp_outage(client_id,timestamp,dbq)
+				else:
+					test_log.error("Data usage quota has been reached, speedtest was cancelled. Data usage quota: {:0.2f} Data usage since last reset: {:0.2} GB, average data usage per test: {:0.2f} GB".format(data_usage_quota_GB,data_usage_GB,avg_rxtx_GB))
+			else:
+				if test_type == 'dns':
+					dns_ok = test_name_resolution(test_exec_namespace,dbq)
+					if not dns_ok:
+						# dns lookup failures, test for an Internet outage
+						ping_results = pingtest(test_exec_namespace,"8.8.8.8",dbq)
+						(client_id,timestamp,remote_host,min,avg,max,mdev) = ping_results
+						if min == 0 or max == 0:
+							# log an outage
+							log_isp_outage(client_id,timestamp,dbq)
+				else:
+					if test_type == 'internet_ping':
+						ping_results = pingtest(test_exec_namespace,"8.8.8.8",dbq)
+						(client_id,timestamp,remote_host,min,avg,max,mdev) = ping_results
+						message = {     "type" : "ping", \
+								"data" : { 	"client_id" : client_id, \
+										"timestamp" : timestamp, \
+										"remote_host" : remote_host, \
+										"min" : min, \
+										"avg" : avg, \
+										"max" : max, \
+										"mdev" : mdev}}
+						#dbq.write(message)
+
+						if min == 0 or max == 0:
+							test_log.info("Internet outage detected.")
+							log_isp_outage(client_id,timestamp,dbq)
+					else:
+						raise ValueError("unknown test type: {}".format(test_type))
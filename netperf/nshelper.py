@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# Namespace helper: a long-running root process that enters the test network namespace (test_exec_namespace in
+# interfaces.json) once, then runs the probes and commands of the network tests for the test processes. This
+# replaces a sudo ip netns exec (a sudo/PAM round trip and usually a new Python process) per probe. Like
+# ip netns exec, the helper bind mounts the files in /etc/netns/<namespace> over those in /etc (e.g. resolv.conf)
+# and mounts the sysfs of the network namespace, in a mount namespace of its own.
+#
+# Each request is a connection to the helper's Unix socket (NSHELPER_SOCKET, owned by the owner of its
+# directory). Requests and replies are lines of JSON: { "type" : <type>, "data" : {...} }, each request names
+# the namespace it expects the helper to run in. Request types:
+#	ping	latency probe (pingprobe.ping_hosts), reply: result
+#	dns	DNS probe (dnsprobe.probe), reply: result
+#	load	latency under load probe (loadprobe.measure), probes until the client shuts down its side of the
+#		connection, reply: result
+#	tcp	TCP throughput probe (tcpprobe.measure), reply: result
+#	exec	shell command, replies: output (streamed while the command runs), then exit (return code)
+# Requests that cannot be run (e.g. for another namespace) are answered with an error.
+# usage: nshelper.py [-s <socket>] [<namespace>]
+
+import os
+import sys
+import json
+import ctypes
+import signal
+import getopt
+import asyncio
+import logging
+
+NSHELPER_SOCKET = "/run/netperf/nshelper.sock"
+NSHELPER_PIDFILE = "/run/netperf/netperf-nshelper.pid"
+REQUEST_TYPES = ["ping", "dns", "load", "tcp", "exec"]
+# an output message must fit in a stream reader line (64 KiB), JSON escapes each non-ASCII byte in 6 characters
+OUTPUT_CHUNK_SIZE = 8192
+
+CLONE_NEWNS = 0x00020000
+CLONE_NEWNET = 0x40000000
+MS_BIND = 0x1000
+MS_REC = 0x4000
+MS_SLAVE = 0x80000
+MNT_DETACH = 2
+
+def encode_message(message_type, data):
+	return (json.dumps({ "type" : message_type, "data" : data }) + "\n").encode()
+
+# client
+
+async def connect(socket_path = NSHELPER_SOCKET):
+	# returns a connection to the helper, raises OSError if the helper is not running
+	return await asyncio.open_unix_connection(socket_path)
+
+async def request(connection, namespace, request_type, data, stop = None):
+	# sends a request on a connection returned by connect() and closes it, returns (output, result). For
+	# load requests the probe runs until <stop> is set. Raises ConnectionError if the helper cannot run the
+	# request and EOFError if the connection was lost while it was running.
+	(reader, writer) = connection
+	try:
+		writer.write(encode_message(request_type, dict(data, namespace=namespace)))
+		await writer.drain()
+		if stop is not None:
+			await stop.wait()
+		writer.write_eof()
+		output = []
+		while True:
+			line = await reader.readline()
+			if line == b"":
+				raise EOFError("the namespace helper closed the connection")
+			reply = json.loads(line)
+			if reply["type"] == "output":
+				output.append(reply["data"].encode("latin-1"))
+			elif reply["type"] == "error":
+				raise ConnectionError(reply["data"])
+			else:
+				return (b"".join(output), reply["data"])
+	finally:
+		writer.close()
+
+async def probe(namespace, probe_type, data, stop = None):
+	# runs a ping, dns, tcp or load probe in the helper, returns the probe result
+	return (await request(await connect(), namespace, probe_type, data, stop))[1]
+
+async def run_command(namespace, cmd, stderr = True):
+	# runs a shell command in the helper, returns (return code, output). The command's standard error is
+	# included in the output if <stderr> is True, discarded otherwise.
+	(output, returncode) = await request(await connect(), namespace, "exec", { "cmd" : cmd, "stderr" : stderr })
+	return (returncode, output)
+
+# helper
+
+def enter_namespace(namespace):
+	# enters a network namespace created by ip netns add, in the same way as ip netns exec. Must be called
+	# before the process starts any threads.
+	libc = ctypes.CDLL(None, use_errno=True)
+	def check(result, operation):
+		if result != 0:
+			errno = ctypes.get_errno()
+			raise OSError(errno, "{}: {}".format(operation, os.strerror(errno)))
+	fd = os.open("/run/netns/{}".format(namespace), os.O_RDONLY)
+	try:
+		check(libc.setns(fd, CLONE_NEWNET), "setns")
+	finally:
+		os.close(fd)
+	check(libc.unshare(CLONE_NEWNS), "unshare")
+	# the mounts below must not propagate to the other mount namespaces
+	check(libc.mount(b"none", b"/", None, MS_SLAVE | MS_REC, None), "mount")
+	if libc.umount2(b"/sys", MNT_DETACH) == 0:
+		check(libc.mount(namespace.encode(), b"/sys", b"sysfs", 0, None), "mount /sys")
+	etc_path = "/etc/netns/{}".format(namespace)
+	if os.path.isdir(etc_path):
+		for name in os.listdir(etc_path):
+			check(libc.mount(os.path.join(etc_path, name).encode(), os.path.join("/etc", name).encode(), b"none", \
+					MS_BIND, None), "bind mount {}".format(name))
+
+class namespace_helper:
+	def __init__(self, namespace, log):
+		self.namespace = namespace
+		self.log = log
+
+	async def handle(self, reader, writer):
+		try:
+			try:
+				message = json.loads(await reader.readline())
+				(request_type, data) = (message["type"], message["data"])
+				namespace = data["namespace"]
+			except (ValueError, KeyError, TypeError):
+				writer.write(encode_message("error", "invalid request"))
+				return
+			if namespace != self.namespace:
+				writer.write(encode_message("error", "the helper runs in namespace {}".format(self.namespace)))
+				return
+			if request_type not in REQUEST_TYPES:
+				writer.write(encode_message("error", "unknown request type {}".format(request_type)))
+				return
+			try:
+				if request_type == "exec":
+					returncode = await self.run_command(data, writer)
+					writer.write(encode_message("exit", returncode))
+				else:
+					writer.write(encode_message("result", await self.run_probe(request_type, data, reader)))
+			except (KeyError, TypeError, ValueError) as e:
+				writer.write(encode_message("error", "invalid {} request: {}".format(request_type, e)))
+			await writer.drain()
+		except (ConnectionError, asyncio.IncompleteReadError):
+			self.log.debug("request connection lost")
+		finally:
+			writer.close()
+
+	async def run_probe(self, probe_type, data, reader):
+		# the probe modules are imported when they are first used
+		if probe_type == "ping":
+			import pingprobe
+			return await pingprobe.ping_hosts(data["hosts"], data["count"], data["interval"], data["timeout"], \
+					data["method"], data["port"])
+		if probe_type == "dns":
+			import dnsprobe
+			return await dnsprobe.probe(data["external_servers"])
+		if probe_type == "tcp":
+			import tcpprobe
+			return await tcpprobe.measure(data["host"], data["streams"], data["duration"], data["interval"], data["port"])
+		import loadprobe
+		# the load probe stops when the client shuts down its side of the connection
+		stop = asyncio.Event()
+		async def wait_for_eof():
+			await reader.read()
+			stop.set()
+		eof = asyncio.ensure_future(wait_for_eof())
+		try:
+			return await loadprobe.measure(data["host"], stop, data["interval"], data["timeout"], data["method"], data["port"])
+		finally:
+			eof.cancel()
+
+	async def run_command(self, data, writer):
+		# streams the output of the command to the client, the command is killed if the client goes away
+		ps = await asyncio.create_subprocess_shell(data["cmd"], stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, \
+				stderr=asyncio.subprocess.STDOUT if data.get("stderr", True) else asyncio.subprocess.DEVNULL)
+		try:
+			while True:
+				chunk = await ps.stdout.read(OUTPUT_CHUNK_SIZE)
+				if chunk == b"":
+					break
+				writer.write(encode_message("output", chunk.decode("latin-1")))
+				await writer.drain()
+			return await ps.wait()
+		finally:
+			if ps.returncode is None:
+				ps.kill()
+				await ps.wait()
+
+async def serve(helper, socket_path, log, stop):
+	if os.path.exists(socket_path):
+		os.remove(socket_path)
+	server = await asyncio.start_unix_server(helper.handle, socket_path)
+	# only the owner of the socket directory (the netperf user) and root can send requests
+	directory = os.stat(os.path.dirname(socket_path))
+	os.chown(socket_path, directory.st_uid, directory.st_gid)
+	os.chmod(socket_path, 0o660)
+	log.info("namespace helper started in namespace {}".format(helper.namespace))
+	await stop.wait()
+	server.close()
+	await server.wait_closed()
+	os.remove(socket_path)
+
+def main():
+	socket_path = NSHELPER_SOCKET
+	try:
+		options, remainder = getopt.getopt(sys.argv[1:], "s:", ["socket="])
+	except getopt.error as err:
+		print(str(err))
+		sys.exit(2)
+	for opt, arg in options:
+		if opt in ("-s", "--socket"):
+			socket_path = arg
+	if len(remainder) > 1:
+		print("usage: {} [-s <socket>] [<namespace>]".format(sys.argv[0]))
+		sys.exit(2)
+
+	from netperf_settings import netperf_settings
+	settings = netperf_settings()
+	logging.basicConfig(filename=settings.get_log_filename(), format=settings.get_logger_format())
+	helper_log = logging.getLogger("nshelper")
+	helper_log.setLevel(settings.get_log_level())
+	if len(remainder) == 1:
+		namespace = remainder[0]
+	else:
+		with open("/opt/netperf/config/interfaces.json","r") as config_file:
+			namespace = json.load(config_file).get("test_exec_namespace", None)
+	if namespace in (None, "root"):
+		helper_log.info("the tests run in the default namespace, the namespace helper is not needed")
+		return
+	if os.geteuid() != 0:
+		helper_log.error("the namespace helper must be run as root")
+		sys.exit(1)
+	try:
+		enter_namespace(namespace)
+	except OSError as e:
+		helper_log.error("unable to enter namespace {}: {}".format(namespace, e))
+		sys.exit(1)
+
+	write_pidfile = socket_path == NSHELPER_SOCKET
+	if write_pidfile:
+		with open(NSHELPER_PIDFILE, "w") as f:
+			f.write("{}\n".format(os.getpid()))
+	async def run():
+		stop = asyncio.Event()
+		loop = asyncio.get_running_loop()
+		loop.add_signal_handler(signal.SIGTERM, stop.set)
+		loop.add_signal_handler(signal.SIGINT, stop.set)
+		await serve(namespace_helper(namespace, helper_log), socket_path, helper_log, stop)
+	try:
+		asyncio.run(run())
+	finally:
+		if write_pidfile:
+			try:
+				os.remove(NSHELPER_PIDFILE)
+			except OSError:
+				pass
+	helper_log.info("namespace helper stopped")
+
+if __name__ == "__main__":
+	main()
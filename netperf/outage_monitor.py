@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# Outage monitor: probes several Internet hosts continuously (one probe per target per round, one round per
+# second by default, see pingprobe.py for the probe methods) and records Internet outages as time intervals.
+#
+# Consensus: a round fails when at least <quorum> targets do not reply (by default a majority of the targets),
+# so a single unreachable or rate limiting target is not taken for an outage. An outage starts after
+# <confirm_rounds> consecutive failed rounds and ends after <confirm_rounds> consecutive successful rounds.
+# The outage interval runs from the first failed round to the first successful round of the recovery; while
+# the outage is ongoing, the interval (end time = last failed round) is updated once per minute. When the
+# monitor stops during an outage, the interval is closed at the last failed round.
+#
+# The outage intervals are sent to the database queue as isp_outage_interval messages. The probes are sent
+# from the test namespace (test_exec_namespace in interfaces.json), like the network tests; with -n they are
+# sent from the namespace the monitor is started in.
+# usage: outage_monitor.py [-n]
+
+import os
+import sys
+import time
+import json
+import signal
+import socket
+import getopt
+import asyncio
+import logging
+import posix_ipc
+import util
+import pingprobe
+
+OUTAGE_MONITOR_PIDFILE = "/run/netperf/netperf-outage-monitor.pid"
+UPDATE_INTERVAL = 60.0
+
+def monitor_running():
+	# returns True if the outage monitor is running
+	return util.pidfile_running(OUTAGE_MONITOR_PIDFILE)
+
+class outage_detector:
+	# turns the probe results of each round into outage interval messages
+	def __init__(self, client_id, target_count, quorum = 0, confirm_rounds = 3):
+		self.client_id = client_id
+		if quorum <= 0:
+			quorum = target_count // 2 + 1
+		self.quorum = min(max(quorum, 1), target_count)
+		self.confirm_rounds = confirm_rounds
+		self.failed_start = None
+		self.failed_rounds = 0
+		self.recovery_start = None
+		self.recovered_rounds = 0
+		self.outage = None
+		self.last_update = None
+
+	def message(self, ongoing):
+		return { "type" : "isp_outage_interval", \
+			"data" : { "client_id" : self.client_id, \
+				"timestamp" : self.outage["start"], \
+				"end_time" : self.outage["end"], \
+				"ongoing" : ongoing, \
+				"failed_rounds" : self.outage["failed_rounds"] } }
+
+	def round(self, timestamp, replies):
+		# processes the results of a round (True for each target that replied), returns a list of messages
+		failed = replies.count(False) >= self.quorum
+		messages = []
+		if self.outage is None:
+			if not failed:
+				self.failed_rounds = 0
+				return messages
+			if self.failed_rounds == 0:
+				self.failed_start = timestamp
+			self.failed_rounds += 1
+			if self.failed_rounds >= self.confirm_rounds:
+				self.outage = {"start" : self.failed_start, "end" : timestamp, "failed_rounds" : self.failed_rounds}
+				self.recovered_rounds = 0
+				self.last_update = timestamp
+				messages.append(self.message(True))
+			return messages
+		if failed:
+			self.outage["end"] = timestamp
+			self.outage["failed_rounds"] += 1
+			self.recovered_rounds = 0
+			if timestamp - self.last_update >= UPDATE_INTERVAL:
+				self.last_update = timestamp
+				messages.append(self.message(True))
+			return messages
+		if self.recovered_rounds == 0:
+			self.recovery_start = timestamp
+		self.recovered_rounds += 1
+		if self.recovered_rounds >= self.confirm_rounds:
+			self.outage["end"] = self.recovery_start
+			messages.append(self.message(False))
+			self.outage = None
+			self.failed_rounds = 0
+		return messages
+
+	def close(self):
+		# ends an ongoing outage at its last failed round, returns a list of messages
+		if self.outage is None:
+			return []
+		messages = [self.message(False)]
+		self.outage = None
+		return messages
+
+class target_prober:
+	# probes a target with a prober that is kept open between rounds. The prober is opened in the first round
+	# in which the target can be resolved.
+	def __init__(self, target, method, port):
+		self.target = target
+		self.method = method
+		self.port = port
+		self.prober = None
+
+	async def probe(self, sequence, timeout):
+		# returns True if the target replied
+		if self.prober is None:
+			loop = asyncio.get_running_loop()
+			try:
+				addresses = await asyncio.wait_for(loop.getaddrinfo(self.target, None, type=socket.SOCK_DGRAM), timeout)
+				(family, type, proto, canonname, sockaddr) = addresses[0]
+				(self.prober, method) = pingprobe.open_prober(sockaddr[0], family, self.method, self.port)
+			except (OSError, asyncio.TimeoutError):
+				return False
+		return await self.prober.probe(sequence % 65536, timeout) is not None
+
+	def close(self):
+		if self.prober is not None:
+			self.prober.close()
+			self.prober = None
+
+async def monitor(probers, detector, dbq, interval, timeout, log, stop):
+	# runs probe rounds every <interval> seconds until <stop> is set. Messages that cannot be sent because
+	# the database queue is full are kept and sent after a later round.
+	loop = asyncio.get_running_loop()
+	pending = []
+	outage_start = None
+	sequence = 0
+	next_round = loop.time()
+	while not stop.is_set():
+		round_time = time.time()
+		replies = await asyncio.gather(*[p.probe(sequence, timeout) for p in probers])
+		sequence += 1
+		for message in detector.round(round_time, list(replies)):
+			if message["data"]["ongoing"] and message["data"]["timestamp"] != outage_start:
+				outage_start = message["data"]["timestamp"]
+				log.info("Internet outage detected.")
+			elif not message["data"]["ongoing"]:
+				log.info("Internet outage ended, duration {:.0f} seconds.".format(message["data"]["end_time"] - message["data"]["timestamp"]))
+			pending.append(message)
+		pending = send_messages(dbq, pending)
+		next_round += interval
+		if next_round < loop.time():
+			# rounds were missed (e.g. the system was suspended), the schedule restarts from now
+			next_round = loop.time()
+		try:
+			await asyncio.wait_for(stop.wait(), next_round - loop.time())
+		except asyncio.TimeoutError:
+			pass
+	for p in probers:
+		p.close()
+	send_messages(dbq, pending + detector.close())
+
+def send_messages(dbq, messages):
+	# never blocks on a full queue, returns the messages that were not sent
+	for i in range(len(messages)):
+		try:
+			dbq.write(messages[i], timeout=0)
+		except posix_ipc.BusyError:
+			return messages[i:]
+	return []
+
+def main():
+	in_namespace = False
+	try:
+		options, remainder = getopt.getopt(sys.argv[1:], "n", ["in-namespace"])
+	except getopt.error as err:
+		print(str(err))
+		sys.exit(2)
+	for opt, arg in options:
+		if opt in ("-n", "--in-namespace"):
+			in_namespace = True
+
+	from netperf_db import db_queue
+	from netperf_settings import netperf_settings
+	settings = netperf_settings()
+	logging.basicConfig(filename=settings.get_log_filename(), format=settings.get_logger_format())
+	monitor_log = logging.getLogger("outage_monitor")
+	monitor_log.setLevel(settings.get_log_level())
+	if not settings.get_outage_monitor_enabled():
+		monitor_log.info("outage monitor is disabled")
+		return
+	targets = settings.get_outage_monitor_targets()
+	if len(targets) == 0:
+		monitor_log.error("no outage monitor targets configured")
+		sys.exit(1)
+
+	if not in_namespace:
+		with open("/opt/netperf/config/interfaces.json","r") as config_file:
+			test_exec_namespace = json.load(config_file).get("test_exec_namespace", None)
+		if test_exec_namespace not in (None, "root"):
+			# continue in the test namespace
+			script = os.path.abspath(__file__)
+			os.execvp("sudo", ["sudo", "ip", "netns", "exec", test_exec_namespace, sys.executable, script, "--in-namespace"])
+
+	detector = outage_detector(util.get_client_id(), len(targets), settings.get_outage_monitor_quorum(), \
+			settings.get_outage_monitor_confirm_rounds())
+	probers = [target_prober(t, settings.get_ping_method(), settings.get_ping_tcp_port()) for t in targets]
+	with open(OUTAGE_MONITOR_PIDFILE, "w") as f:
+		f.write("{}\n".format(os.getpid()))
+	monitor_log.info("outage monitor started, targets: {}, quorum: {}".format(", ".join(targets), detector.quorum))
+
+	async def run():
+		stop = asyncio.Event()
+		asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+		await monitor(probers, detector, db_queue(), settings.get_outage_monitor_interval(), \
+				settings.get_outage_monitor_timeout(), monitor_log, stop)
+	try:
+		asyncio.run(run())
+	finally:
+		try:
+			os.remove(OUTAGE_MONITOR_PIDFILE)
+		except OSError:
+			pass
+	monitor_log.info("outage monitor stopped")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# Latency and packet loss probe: sends <count> probes at a fixed interval to each target host, all hosts
+# concurrently, and records the round trip time of each probe. Probe methods:
+#	icmp	ICMP echo requests on an unprivileged ICMP datagram socket (allowed for the groups listed in
+#		net.ipv4.ping_group_range), or on a raw socket if that is not permitted (requires root / CAP_NET_RAW)
+#	udp	UDP datagrams to an unused port; the ICMP port unreachable error is the reply
+#	tcp	TCP connections to a port; an accepted or a refused connection (SYN/ACK or RST) is the reply
+#	auto	icmp, falling back to tcp if ICMP sockets cannot be opened
+# The results contain the ping statistics (min/avg/max/mdev, in ms), the 50th, 90th and 99th percentile of the
+# round trip times, the jitter (mean difference between the round trip times of consecutive replies) and the
+# packet loss. If no reply is received the statistics are 0, like the results of a failed ping test.
+#
+# The probe runs in the network namespace of the calling process. To probe from another namespace, run this
+# script in it (ip netns exec <namespace> pingprobe.py), it prints the results as JSON:
+# usage: pingprobe.py [-c <count>] [-i <interval seconds>] [-W <timeout seconds>] [-m <method>] [-p <tcp port>] <host> [<host>...]
+
+import sys
+import json
+import math
+import time
+import random
+import struct
+import socket
+import getopt
+import asyncio
+
+PING_METHODS = ["auto", "icmp", "udp", "tcp"]
+PING_COUNT = 10
+PING_INTERVAL = 0.2
+PING_TIMEOUT = 2.0
+TCP_PROBE_PORT = 53
+UDP_PROBE_PORT = 33434
+ICMP_HEADER = struct.Struct("!BBHHH")
+ICMP_ECHO_REQUEST = {socket.AF_INET : 8, socket.AF_INET6 : 128}
+ICMP_ECHO_REPLY = {socket.AF_INET : 0, socket.AF_INET6 : 129}
+ICMP_PROTOCOL = {socket.AF_INET : socket.IPPROTO_ICMP, socket.AF_INET6 : socket.IPPROTO_ICMPV6}
+ICMP_PAYLOAD = bytes(range(48))
+
+def icmp_checksum(data):
+	if len(data) % 2:
+		data += b"\x00"
+	total = sum(struct.unpack("!{}H".format(len(data) // 2), data))
+	total = (total >> 16) + (total & 0xffff)
+	total += total >> 16
+	return ~total & 0xffff
+
+class icmp_prober:
+	# ICMP echo requests. On a datagram socket the kernel sets the identifier and only delivers the replies
+	# to this socket's requests; a raw socket receives all ICMP packets, which are matched by identifier.
+	def __init__(self, address, family, raw):
+		self.address = address
+		self.family = family
+		self.raw = raw
+		self.identifier = random.getrandbits(16)
+		self.sock = socket.socket(family, socket.SOCK_RAW if raw else socket.SOCK_DGRAM, ICMP_PROTOCOL[family])
+		self.sock.setblocking(False)
+		self.pending = {}
+		self.loop = asyncio.get_running_loop()
+		self.loop.add_reader(self.sock.fileno(), self.receive)
+
+	def receive(self):
+		while True:
+			try:
+				(data, addr) = self.sock.recvfrom(2048)
+			except (BlockingIOError, InterruptedError):
+				return
+			except OSError:
+				continue
+			received_time_ns = time.perf_counter_ns()
+			if self.raw and self.family == socket.AF_INET:
+				# raw IPv4 sockets return the IP header
+				data = data[(data[0] & 0x0f) * 4:]
+			if len(data) < ICMP_HEADER.size:
+				continue
+			(type, code, checksum, identifier, sequence) = ICMP_HEADER.unpack_from(data, 0)
+			if type != ICMP_ECHO_REPLY[self.family]:
+				continue
+			if self.raw and (identifier != self.identifier or addr[0] != self.address):
+				continue
+			probe = self.pending.get(sequence, None)
+			if probe is not None and not probe[0].done():
+				probe[0].set_result((received_time_ns - probe[1]) // 1000)
+
+	async def probe(self, sequence, timeout):
+		# returns the round trip time in microseconds, None if there was no reply
+		header = ICMP_HEADER.pack(ICMP_ECHO_REQUEST[self.family], 0, 0, self.identifier, sequence)
+		packet = ICMP_HEADER.pack(ICMP_ECHO_REQUEST[self.family], 0, icmp_checksum(header + ICMP_PAYLOAD), \
+				self.identifier, sequence) + ICMP_PAYLOAD
+		reply = self.loop.create_future()
+		self.pending[sequence] = (reply, time.perf_counter_ns())
+		try:
+			self.sock.sendto(packet, (self.address, 0))
+			return await asyncio.wait_for(reply, timeout)
+		except (asyncio.TimeoutError, OSError):
+			return None
+		finally:
+			del self.pending[sequence]
+
+	def close(self):
+		self.loop.remove_reader(self.sock.fileno())
+		self.sock.close()
+
+class udp_probe_protocol(asyncio.DatagramProtocol):
+	def __init__(self, reply):
+		self.reply = reply
+
+	def datagram_received(self, data, addr):
+		if not self.reply.done():
+			self.reply.set_result(time.perf_counter_ns())
+
+	def error_received(self, exc):
+		# ICMP port unreachable, reported on the connected socket
+		if isinstance(exc, ConnectionRefusedError) and not self.reply.done():
+			self.reply.set_result(time.perf_counter_ns())
+
+class udp_prober:
+	# UDP datagrams to an unused port, one socket per probe
+	def __init__(self, address, port = UDP_PROBE_PORT):
+		self.address = address
+		self.port = port
+
+	async def probe(self, sequence, timeout):
+		loop = asyncio.get_running_loop()
+		reply = loop.create_future()
+		try:
+			(transport, protocol) = await loop.create_datagram_endpoint(lambda: udp_probe_protocol(reply), \
+					remote_addr=(self.address, self.port + sequence % 64))
+		except OSError:
+			return None
+		try:
+			sent_time_ns = time.perf_counter_ns()
+			transport.sendto(ICMP_PAYLOAD)
+			return (await asyncio.wait_for(reply, timeout) - sent_time_ns) // 1000
+		except (asyncio.TimeoutError, OSError):
+			return None
+		finally:
+			transport.close()
+
+	def close(self):
+		pass
+
+class tcp_prober:
+	# TCP connections, the connection is reset as soon as it is established
+	def __init__(self, address, port = TCP_PROBE_PORT):
+		self.address = address
+		self.port = port
+
+	async def probe(self, sequence, timeout):
+		sent_time_ns = time.perf_counter_ns()
+		try:
+			(reader, writer) = await asyncio.wait_for(asyncio.open_connection(self.address, self.port), timeout)
+		except ConnectionRefusedError:
+			return (time.perf_counter_ns() - sent_time_ns) // 1000
+		except (asyncio.TimeoutError, OSError):
+			return None
+		rtt_us = (time.perf_counter_ns() - sent_time_ns) // 1000
+		writer.transport.abort()
+		return rtt_us
+
+	def close(self):
+		pass
+
+def open_prober(address, family, method, port = TCP_PROBE_PORT):
+	# returns (prober, method used). Raises PermissionError if ICMP sockets cannot be opened for method icmp.
+	if method in ("auto", "icmp"):
+		for raw in (False, True):
+			try:
+				return (icmp_prober(address, family, raw), "icmp")
+			except PermissionError:
+				pass
+		if method == "icmp":
+			raise PermissionError("unable to open an ICMP socket")
+	if method == "udp":
+		return (udp_prober(address), "udp")
+	return (tcp_prober(address, port), "tcp")
+
+def percentile(sorted_values, p):
+	# percentile with linear interpolation between the closest ranks
+	position = (len(sorted_values) - 1) * p / 100.0
+	lower = int(math.floor(position))
+	upper = min(lower + 1, len(sorted_values) - 1)
+	return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+def ping_statistics(remote_host, method, rtts):
+	# returns the result dictionary for the round trip times (microseconds, None for lost probes) of a host
+	replies = [r / 1000.0 for r in rtts if r is not None]
+	result = {"remote_host" : remote_host, "method" : method, "packets_sent" : len(rtts), "packets_received" : len(replies), \
+			"loss_pct" : 100.0, "min" : 0, "avg" : 0, "max" : 0, "mdev" : 0, "jitter" : 0, "rtt_p50" : 0, "rtt_p90" : 0, "rtt_p99" : 0}
+	if len(replies) == 0:
+		return result
+	ordered = sorted(replies)
+	avg = sum(replies) / len(replies)
+	if len(replies) > 1:
+		jitter = sum([abs(b - a) for (a, b) in zip(replies, replies[1:])]) / (len(replies) - 1)
+	else:
+		jitter = 0.0
+	result.update({ "loss_pct" : round(100.0 * (len(rtts) - len(replies)) / len(rtts), 1), \
+			"min" : round(ordered[0], 3), \
+			"avg" : round(avg, 3), \
+			"max" : round(ordered[-1], 3), \
+			"mdev" : round(math.sqrt(max(sum([r * r for r in replies]) / len(replies) - avg * avg, 0.0)), 3), \
+			"jitter" : round(jitter, 3), \
+			"rtt_p50" : round(percentile(ordered, 50), 3), \
+			"rtt_p90" : round(percentile(ordered, 90), 3), \
+			"rtt_p99" : round(percentile(ordered, 99), 3) })
+	return result
+
+async def ping(remote_host, count = PING_COUNT, interval = PING_INTERVAL, timeout = PING_TIMEOUT, method = "auto", port = TCP_PROBE_PORT):
+	# probes a single host, returns its result dictionary (see ping_statistics)
+	loop = asyncio.get_running_loop()
+	try:
+		addresses = await loop.getaddrinfo(remote_host, None, type=socket.SOCK_DGRAM)
+		(family, type, proto, canonname, sockaddr) = addresses[0]
+		(prober, method) = open_prober(sockaddr[0], family, method, port)
+	except (OSError, socket.gaierror):
+		return ping_statistics(remote_host, None, [None] * count)
+	try:
+		start = loop.time()
+		probes = []
+		for sequence in range(count):
+			# the probes are sent on a fixed schedule, replies are awaited concurrently
+			await asyncio.sleep(max(start + sequence * interval - loop.time(), 0))
+			probes.append(asyncio.ensure_future(prober.probe(sequence, timeout)))
+		rtts = await asyncio.gather(*probes)
+	finally:
+		prober.close()
+	return ping_statistics(remote_host, method, rtts)
+
+async def ping_hosts(remote_hosts, count = PING_COUNT, interval = PING_INTERVAL, timeout = PING_TIMEOUT, method = "auto", port = TCP_PROBE_PORT):
+	# probes several hosts concurrently, returns a list of result dictionaries in the order of <remote_hosts>
+	return list(await asyncio.gather(*[ping(h, count, interval, timeout, method, port) for h in remote_hosts]))
+
+def main():
+	count = PING_COUNT
+	interval = PING_INTERVAL
+	timeout = PING_TIMEOUT
+	method = "auto"
+	port = TCP_PROBE_PORT
+	try:
+		options, remote_hosts = getopt.getopt(sys.argv[1:], "c:i:W:m:p:", ["count=", "interval=", "timeout=", "method=", "port="])
+	except getopt.error as err:
+		print(str(err))
+		sys.exit(2)
+	for opt, arg in options:
+		if opt in ("-c", "--count"):
+			count = max(int(arg),1)
+		elif opt in ("-i", "--interval"):
+			interval = float(arg)
+		elif opt in ("-W", "--timeout"):
+			timeout = float(arg)
+		elif opt in ("-m", "--method"):
+			if arg not in PING_METHODS:
+				print("invalid method {}, valid methods: {}".format(arg, ", ".join(PING_METHODS)))
+				sys.exit(2)
+			method = arg
+		elif opt in ("-p", "--port"):
+			port = int(arg)
+	print(json.dumps(asyncio.run(ping_hosts(remote_hosts, count, interval, timeout, method, port))))
+
+if __name__ == "__main__":
+	main()
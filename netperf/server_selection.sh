@@ -14,7 +14,7 @@ INPUT_FIELD_SEPARATOR='\\|\\|'
 speedtestClient=$( python3 /opt/netperf/netperf_settings.py --get speedtest_client )
 if [[ "$speedtestClient" == "ookla" ]]; then
 	serverSelectionMethod=$( whiptail --title "$TITLE" --menu "Internet speed test server selection method:" 0 0 2 \
-		Automatic: "let the speedtest client choose servers automatically" \
+		Automatic: "use the server with the lowest latency, ranked automatically" \
 		Manual: "choose a specific server for performing speed tests" \
 		3>&1 1>&2 2>&3 )
 
@@ -42,7 +42,7 @@ if [[ "$speedtestClient" == "ookla" ]]; then
 			while read line
 			do
 				id=$(echo "$line" | awk -F "$INPUT_FIELD_SEPARATOR" '{printf $1}')
-				details=$(echo "$line" | awk  -F "$INPUT_FIELD_SEPARATOR" '{printf $2 " " $3}')
+				details=$(echo "$line" | awk  -F "$INPUT_FIELD_SEPARATOR" '{printf $2 " " $3; if ($10 != "") printf " (" $10 " ms)"}')
 				menuItems+=("$id" "$details")
 				serverDetails["$id"]="$details"
 			done <<< $serverList
@@ -64,10 +64,10 @@ if [[ "$speedtestClient" == "ookla" ]]; then
 			whiptail --title "$TITLE" --msgbox "Manual server selection failed.\nThe speed test server will be chosen automatically." 0 0
 		fi
 	else
-		whiptail --title "$TITLE" --msgbox "The speedtest client will choose a server automatically." 0 0
+		whiptail --title "$TITLE" --msgbox "The speed test server with the lowest latency will be chosen automatically." 0 0
 	fi
 else
-	# speedtest-cli is being used, default to automatic server selection
+	# speedtest-cli or the native client is being used, default to automatic server selection
 	serverId="None"
 fi
 
@@ -80,5 +80,5 @@ sudo python3 /opt/netperf/netperf_settings.py --set speedtest_server_id --value
 if [[ "$serverId" != "None" ]]; then
 	echo "Speed test server ID set to $serverId"
 else
-	echo "Speed test server will be selected automatically by the client."
+	echo "Speed test server will be selected automatically."
 fi
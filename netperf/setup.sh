@@ -213,6 +213,9 @@ if [[ "$OS_ID" == "centos" || "$OS_ID" == "fedora" ]]; then
 		# allow iperf3 connections
 		printf "Opening port 5201/tcp for iperf3 connections...\n"
 		firewall-cmd --zone="$default_zone" --permanent --add-port=5201/tcp
+		# allow connections to the built-in throughput probe responder (tcpprobe.py)
+		printf "Opening port 5202/tcp for tcpprobe connections...\n"
+		firewall-cmd --zone="$default_zone" --permanent --add-port=5202/tcp
 		# allow RabbitMQ connections
 		printf "Opening ports for RabbitMQ message broker connections...\n"
 		firewall-cmd --zone="$default_zone" --permanent --add-port=4369/tcp
@@ -273,6 +276,24 @@ cp /opt/netperf/config/systemd/netperf-db.service /etc/systemd/system
 systemctl daemon-reload
 systemctl enable netperf-db
 
+# copy the test agent systemd unit file and enable the service
+printf "Installing systemd unit file for the test agent...\n"
+cp /opt/netperf/config/systemd/netperf-agent.service /etc/systemd/system
+systemctl daemon-reload
+systemctl enable netperf-agent
+
+# copy the outage monitor systemd unit file and enable the service
+printf "Installing systemd unit file for the outage monitor...\n"
+cp /opt/netperf/config/systemd/netperf-outage-monitor.service /etc/systemd/system
+systemctl daemon-reload
+systemctl enable netperf-outage-monitor
+
+# copy the namespace helper systemd unit file and enable the service
+printf "Installing systemd unit file for the namespace helper...\n"
+cp /opt/netperf/config/systemd/netperf-nshelper.service /etc/systemd/system
+systemctl daemon-reload
+systemctl enable netperf-nshelper
+
 # copy the interface configuration systemd unit file
 printf "Installing systemd unit file for the interface configuration script...\n"
 cp /opt/netperf/config/systemd/netperf-interfaces.service /etc/systemd/system
@@ -306,10 +327,12 @@ if [[ "$OS_ID" == "centos" || "$OS_ID" == "fedora" ]]; then
 	fi
 fi
 
-# detect which speedtest client is installed:
+# detect which speedtest client is installed, the native client (throughput.py) is kept when it is configured:
 speedtest_cli_installed=$( pip_package_installed speedtest-cli )
 ookla_installed=$( os_package_installed speedtest )
-if [[ "$speedtest_cli_installed" == true ]]; then
+if [[ "$( python3 "$CONFIG_APP" --get speedtest_client )" == "native" ]]; then
+	speedtest_client="native"
+elif [[ "$speedtest_cli_installed" == true ]]; then
 	speedtest_client="speedtest-cli"
 elif [[ "$ookla_installed" == true ]] || [[ $(command -v /usr/bin/speedtest) ]]; then
 	speedtest_client="ookla"
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# Speedtest server selection. The speedtest.net server list is parsed while it is downloaded (the XML document
+# is not built in memory) and cached in a file. The cached list is used for <ttl> seconds, then refreshed with a
+# conditional request (ETag / Last-Modified), so an unchanged list is not downloaded again. When the list cannot
+# be refreshed the cached list is used, however old.
+#
+# The servers are ranked by network distance: the TCP connect time to the first <candidates> servers of the list
+# (which is ordered by distance from the client's location) is measured, all servers concurrently, each server
+# <attempts> times. The servers that accepted a connection, ordered by their lowest connect time, form the ranked
+# shortlist, which is saved to a file; the speedtest uses the first server of the shortlist (see
+# netperf_settings.get_speedtest_server_id).
+#
+# The connect times are measured from the network namespace of the calling process. To rank the servers from
+# another namespace, run this script in it; it prints the shortlist as JSON:
+# usage: speedtest_servers.py [-u <url>] [-c <cache file>] [-t <ttl seconds>] [-n <candidates>] [-s <shortlist size>]
+
+import os
+import sys
+import json
+import time
+import socket
+import getopt
+import asyncio
+import platform
+import urllib.error
+import urllib.request
+from xml.etree import ElementTree
+
+SERVER_LIST_URL = "https://www.speedtest.net/speedtest-servers-static.php"
+SERVER_ATTRIBUTES = ["id","name","host","sponsor","country","cc","url","lat","lon"]
+SERVER_LIST_TTL = 86400
+SERVER_LIST_TIMEOUT = 10.0
+SERVER_PORT = 8080
+CANDIDATES = 25
+SHORTLIST_SIZE = 5
+CONNECT_ATTEMPTS = 3
+CONNECT_TIMEOUT = 2.0
+
+USER_AGENT = " ".join([
+	"Mozilla/5.0",
+	"({}; U; {}; en-us)".format(platform.system(), platform.architecture()[0]),
+	"Python/{}".format(platform.python_version()),
+	"(KHTML, like Gecko)",
+	"netperf/1.0"
+])
+
+def parse_server_list(stream):
+	# returns the servers of a server list read from a file object, each server a dict of SERVER_ATTRIBUTES.
+	# Raises ValueError if the list cannot be parsed.
+	servers = []
+	try:
+		for (event, element) in ElementTree.iterparse(stream, events=("end",)):
+			if element.tag == "server":
+				servers.append({ a : element.get(a, "") for a in SERVER_ATTRIBUTES })
+			element.clear()
+	except ElementTree.ParseError as e:
+		raise ValueError("invalid server list: {}".format(e))
+	return servers
+
+def write_json(filename, data):
+	# replaces the file atomically, readers never see a partly written file
+	temp_filename = "{}.{}.tmp".format(filename, os.getpid())
+	with open(temp_filename, "w") as f:
+		json.dump(data, f)
+	os.replace(temp_filename, filename)
+
+def read_json(filename):
+	# returns None if the file does not exist or cannot be read
+	if filename is None:
+		return None
+	try:
+		with open(filename, "r") as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return None
+
+def fetch_server_list(url = SERVER_LIST_URL, cache_file = None, ttl = SERVER_LIST_TTL, timeout = SERVER_LIST_TIMEOUT):
+	# returns the server list, from the cache file when it was fetched less than <ttl> seconds ago. Raises OSError
+	# or ValueError if the list can neither be downloaded nor read from the cache.
+	cache = read_json(cache_file)
+	if cache is not None and (cache.get("url", None) != url or "servers" not in cache):
+		cache = None
+	now = time.time()
+	if cache is not None and 0 <= now - cache["fetched"] < ttl:
+		return cache["servers"]
+	headers = { "User-Agent" : USER_AGENT }
+	if cache is not None:
+		if cache.get("etag", None) is not None:
+			headers["If-None-Match"] = cache["etag"]
+		if cache.get("last_modified", None) is not None:
+			headers["If-Modified-Since"] = cache["last_modified"]
+	try:
+		with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout) as response:
+			servers = parse_server_list(response)
+			if len(servers) == 0:
+				raise ValueError("the server list is empty")
+			cache = { "url" : url, \
+				"fetched" : now, \
+				"etag" : response.headers.get("ETag", None), \
+				"last_modified" : response.headers.get("Last-Modified", None), \
+				"servers" : servers }
+	except urllib.error.HTTPError as e:
+		if cache is None:
+			raise
+		if e.code != 304:
+			return cache["servers"]
+		# not modified, the cached list is used for another <ttl> seconds
+		cache["fetched"] = now
+	except (OSError, ValueError):
+		if cache is None:
+			raise
+		return cache["servers"]
+	if cache_file is not None:
+		try:
+			write_json(cache_file, cache)
+		except OSError:
+			pass
+	return cache["servers"]
+
+def server_address(server):
+	# returns (host, port) of a server's host attribute (host:port)
+	(host, separator, port) = server["host"].rpartition(":")
+	if separator == "" or not port.isdigit():
+		return (server["host"], SERVER_PORT)
+	return (host.strip("[]"), int(port))
+
+async def connect_time(server, attempts = CONNECT_ATTEMPTS, timeout = CONNECT_TIMEOUT):
+	# returns the lowest TCP connect time to the server in milliseconds, None if no connection was accepted.
+	# The name is resolved once, so the connect times do not include the name resolution.
+	loop = asyncio.get_running_loop()
+	(host, port) = server_address(server)
+	try:
+		addresses = await asyncio.wait_for(loop.getaddrinfo(host, port, type=socket.SOCK_STREAM), timeout)
+	except (OSError, asyncio.TimeoutError):
+		return None
+	(family, type, proto, canonname, sockaddr) = addresses[0]
+	times = []
+	for i in range(attempts):
+		start = time.perf_counter()
+		try:
+			(reader, writer) = await asyncio.wait_for(asyncio.open_connection(sockaddr[0], sockaddr[1]), timeout)
+		except (OSError, asyncio.TimeoutError):
+			continue
+		times.append(time.perf_counter() - start)
+		writer.transport.abort()
+	if len(times) == 0:
+		return None
+	return round(min(times) * 1e3, 3)
+
+async def rank_servers(servers, candidates = CANDIDATES, shortlist_size = SHORTLIST_SIZE, attempts = CONNECT_ATTEMPTS, \
+		timeout = CONNECT_TIMEOUT):
+	# returns the shortlist: the candidate servers that accepted a connection ordered by connect time, each with
+	# an additional latency_ms key. With a shortlist size of 0 all of these servers are returned.
+	candidate_servers = servers[:candidates]
+	latencies = await asyncio.gather(*[connect_time(s, attempts, timeout) for s in candidate_servers])
+	ranked = sorted([dict(s, latency_ms=l) for (s, l) in zip(candidate_servers, latencies) if l is not None], \
+			key=lambda s: s["latency_ms"])
+	if shortlist_size > 0:
+		return ranked[:shortlist_size]
+	return ranked
+
+def save_shortlist(filename, shortlist, timestamp = None):
+	write_json(filename, { "timestamp" : time.time() if timestamp is None else timestamp, "servers" : shortlist })
+
+def load_shortlist(filename):
+	# returns (time the shortlist was ranked, shortlist), (None, []) if there is no shortlist
+	shortlist = read_json(filename)
+	if shortlist is None or "timestamp" not in shortlist:
+		return (None, [])
+	return (shortlist["timestamp"], shortlist.get("servers", []))
+
+def best_server_id(filename):
+	# returns the id of the first server of the shortlist, None if there is no shortlist
+	(timestamp, shortlist) = load_shortlist(filename)
+	if len(shortlist) == 0:
+		return None
+	return shortlist[0]["id"]
+
+def main():
+	url = SERVER_LIST_URL
+	cache_file = None
+	ttl = SERVER_LIST_TTL
+	candidates = CANDIDATES
+	shortlist_size = SHORTLIST_SIZE
+	try:
+		options, remainder = getopt.getopt(sys.argv[1:], "u:c:t:n:s:", ["url=", "cache=", "ttl=", "candidates=", "shortlist="])
+	except getopt.error as err:
+		print(str(err))
+		sys.exit(2)
+	for opt, arg in options:
+		if opt in ("-u", "--url"):
+			url = arg
+		elif opt in ("-c", "--cache"):
+			cache_file = arg
+		elif opt in ("-t", "--ttl"):
+			ttl = float(arg)
+		elif opt in ("-n", "--candidates"):
+			candidates = max(int(arg),1)
+		elif opt in ("-s", "--shortlist"):
+			shortlist_size = max(int(arg),0)
+	try:
+		servers = fetch_server_list(url, cache_file, ttl)
+	except (OSError, ValueError) as e:
+		print("Failed to retrieve server list: {}".format(e), file=sys.stderr)
+		sys.exit(1)
+	print(json.dumps(asyncio.run(rank_servers(servers, candidates, shortlist_size))))
+
+if __name__ == "__main__":
+	main()
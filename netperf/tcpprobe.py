@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# TCP throughput probe for the local network tests, a built-in alternative to iperf3: measures the throughput to
+# a responder (this script in server mode, started for each interface by configure_interfaces.py) over <streams>
+# parallel TCP connections, first receiving from the responder (download), then sending to it (upload), each
+# direction for <duration> seconds. The throughput is sampled every <interval> seconds, so the dips during a test
+# are kept with its average rates (stored with the iperf3 row, see netperf_db.py).
+#
+# Each connection starts with a request (REQUEST_FORMAT: magic, version, direction, duration in milliseconds).
+# For a download the responder sends until the client closes the connection, for an upload it receives and
+# discards until the client closes it; in both directions the responder gives up on its own after the requested
+# duration (at most MAX_DURATION seconds) and REQUEST_GRACE seconds. Data is sent from a single buffer of random
+# data and received into a buffer per connection that is allocated once.
+#
+# The received throughput is counted by the client as it reads. The transmitted throughput is the data
+# acknowledged by the responder (tcpi_bytes_acked of TCP_INFO) rather than the data written into the socket
+# buffers, and the retransmits are the segments the client retransmitted during the upload, as iperf3 reports
+# them. The interface counters are not used, so the probe also measures over loopback.
+#
+# The probe runs in the network namespace of the calling process. To test from another namespace, run this
+# script in it; it prints the results as JSON and exits with 1 if the test failed:
+# usage: tcpprobe.py [-p <port>] [-P <streams>] [-t <duration seconds>] [-i <interval seconds>] <host>
+# The responder listens on all addresses of its network namespace unless an address is given:
+# usage: tcpprobe.py -s [-B <address>] [-p <port>] [-D] [--pidfile <file>]
+
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import getopt
+import asyncio
+
+TCPPROBE_PORT = 5202
+STREAMS = 1
+DURATION = 5.0
+INTERVAL = 0.5
+MAX_STREAMS = 16
+MAX_DURATION = 60.0
+MIN_INTERVAL = 0.05
+# samples per direction at most, the interval is lengthened for long tests: the samples are sent to the database
+# with the test results, in a single message of the database queue (8 KiB by default)
+MAX_SAMPLES = 60
+CONNECT_TIMEOUT = 5.0
+REQUEST_TIMEOUT = 5.0
+REQUEST_GRACE = 2.0
+MAX_CONNECTIONS = 64
+RECEIVE_BUFFER_SIZE = 262144
+SEND_BUFFER_SIZE = 1048576
+YIELD_INTERVAL = 0.005
+
+REQUEST_MAGIC = b"NPTP"
+REQUEST_VERSION = 1
+REQUEST_FORMAT = "!4sBBHI"
+REQUEST_SIZE = struct.calcsize(REQUEST_FORMAT)
+DIRECTIONS = { "download" : 1, "upload" : 2 }
+
+# struct tcp_info (linux/tcp.h): tcpi_total_retrans (__u32) and tcpi_bytes_acked (__u64, Linux 4.1 and later)
+TCPI_TOTAL_RETRANS_OFFSET = 100
+TCPI_BYTES_ACKED_OFFSET = 120
+TCP_INFO_SIZE = 128
+
+def abort(sock):
+	# closes a connection with a reset: the data left in the socket buffers is discarded rather than sent after
+	# the end of the phase, where it would load the link during the next test
+	try:
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+	except OSError:
+		pass
+	sock.close()
+
+def tcp_info(sock):
+	# returns (bytes acknowledged by the peer, segments retransmitted) of a connection, None if the kernel does
+	# not report them
+	try:
+		info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_SIZE)
+	except (OSError, AttributeError):
+		return None
+	if len(info) < TCP_INFO_SIZE:
+		return None
+	return (struct.unpack_from("=Q", info, TCPI_BYTES_ACKED_OFFSET)[0], struct.unpack_from("=I", info, TCPI_TOTAL_RETRANS_OFFSET)[0])
+
+class stream:
+	# a connection of a test phase and the bytes received (download) or written (upload) on it
+	def __init__(self, sock):
+		self.sock = sock
+		self.bytes = 0
+
+	def counters(self, direction):
+		# returns (bytes transferred, segments retransmitted). The bytes written are counted for an upload only
+		# when TCP_INFO is not available; the retransmits are None for a download.
+		if direction == "download":
+			return (self.bytes, None)
+		info = tcp_info(self.sock)
+		if info is None:
+			return (self.bytes, None)
+		return info
+
+class transfer:
+	# the state of a test phase shared by its streams
+	def __init__(self, direction, streams):
+		self.direction = direction
+		self.streams = streams
+		self.complete = False
+		self.loop = asyncio.get_running_loop()
+		self.yield_time = 0.0
+
+	def counters(self):
+		# returns the (bytes, retransmits) of all streams, retransmits is None if no stream reports them
+		bytes_transferred = 0
+		retransmits = None
+		for s in self.streams:
+			(count, retransmitted) = s.counters(self.direction)
+			bytes_transferred += count
+			if retransmitted is not None:
+				retransmits = (retransmits or 0) + retransmitted
+		return (bytes_transferred, retransmits)
+
+	async def yield_to_others(self):
+		# the socket calls complete without suspending while data can be transferred, which on a fast link (or
+		# loopback) would keep the other streams and the sampling from running. A stream lets the others run at
+		# least every YIELD_INTERVAL seconds (not after each call, which would add to the CPU time per byte).
+		if self.loop.time() >= self.yield_time:
+			await asyncio.sleep(0)
+			self.yield_time = self.loop.time() + YIELD_INTERVAL
+
+async def download_stream(phase, s, buffer):
+	# receives into <buffer> until the phase ends
+	loop = asyncio.get_running_loop()
+	while not phase.complete:
+		count = await loop.sock_recv_into(s.sock, buffer)
+		if count == 0:
+			raise ConnectionError("the responder closed the connection")
+		s.bytes += count
+		await phase.yield_to_others()
+
+async def upload_stream(phase, s, buffer):
+	# sends <buffer> until the phase ends
+	loop = asyncio.get_running_loop()
+	with memoryview(buffer) as view:
+		while not phase.complete:
+			await loop.sock_sendall(s.sock, view)
+			s.bytes += len(view)
+			await phase.yield_to_others()
+
+STREAM_FUNCTIONS = { "download" : download_stream, "upload" : upload_stream }
+
+async def connect(sockaddr, family, request):
+	# returns a non-blocking socket connected to <sockaddr> that has sent <request>
+	loop = asyncio.get_running_loop()
+	sock = socket.socket(family, socket.SOCK_STREAM)
+	sock.setblocking(False)
+	try:
+		await asyncio.wait_for(loop.sock_connect(sock, sockaddr), CONNECT_TIMEOUT)
+		await loop.sock_sendall(sock, request)
+	except:
+		sock.close()
+		raise
+	return sock
+
+async def run_phase(direction, sockaddr, family, streams, duration, interval, buffers):
+	# runs the download or the upload phase, returns (bytes, retransmits, elapsed seconds, samples, errors). The
+	# samples are (time, bytes, retransmits) of all streams, taken every <interval> seconds.
+	loop = asyncio.get_running_loop()
+	request = struct.pack(REQUEST_FORMAT, REQUEST_MAGIC, REQUEST_VERSION, DIRECTIONS[direction], 0, int(duration * 1e3))
+	connections = await asyncio.gather(*[connect(sockaddr, family, request) for i in range(streams)], return_exceptions=True)
+	errors = sorted(set([str(c) or type(c).__name__ for c in connections if isinstance(c, BaseException)]))
+	phase = transfer(direction, [stream(c) for c in connections if not isinstance(c, BaseException)])
+	if len(phase.streams) < streams:
+		for s in phase.streams:
+			abort(s.sock)
+		return (0, None, 0.0, [], errors)
+	function = STREAM_FUNCTIONS[direction]
+	tasks = [asyncio.ensure_future(function(phase, s, buffers[i % len(buffers)])) for (i, s) in enumerate(phase.streams)]
+	start = loop.time()
+	samples = [(time.time(),) + phase.counters()]
+	try:
+		pending = set(tasks)
+		while len(pending) > 0:
+			sample_time = min(start + len(samples) * interval, start + duration)
+			if sample_time > loop.time():
+				(done, pending) = await asyncio.wait(pending, timeout=sample_time - loop.time())
+			samples.append((time.time(),) + phase.counters())
+			if sample_time >= start + duration:
+				break
+	finally:
+		# the last sample is taken before the streams are stopped
+		elapsed = loop.time() - start
+		phase.complete = True
+		for task in tasks:
+			task.cancel()
+		results = await asyncio.gather(*tasks, return_exceptions=True)
+		for s in phase.streams:
+			abort(s.sock)
+	errors += sorted(set([str(r) or type(r).__name__ for r in results \
+			if isinstance(r, Exception) and not isinstance(r, asyncio.CancelledError)]))
+	bytes_transferred = samples[-1][1] - samples[0][1]
+	retransmits = samples[-1][2] - samples[0][2] if None not in (samples[0][2], samples[-1][2]) else None
+	return (bytes_transferred, retransmits, elapsed, samples, errors)
+
+def interval_samples(direction, samples):
+	# returns the rows [time, rx_bps, tx_bps, retransmits] of the intervals between the samples of a phase, the
+	# values of the other direction are None
+	rows = []
+	for ((start_time, start_bytes, start_retransmits), (end_time, end_bytes, end_retransmits)) in zip(samples, samples[1:]):
+		if end_time <= start_time:
+			continue
+		bps = round((end_bytes - start_bytes) * 8.0 / (end_time - start_time), 1)
+		retransmits = end_retransmits - start_retransmits if None not in (start_retransmits, end_retransmits) else None
+		if direction == "download":
+			rows.append([round(end_time, 3), bps, None, None])
+		else:
+			rows.append([round(end_time, 3), None, bps, retransmits])
+	return rows
+
+async def measure(host, streams = STREAMS, duration = DURATION, interval = INTERVAL, port = TCPPROBE_PORT):
+	# runs the download phase, then the upload phase, returns the results: the rates in bits per second, the bytes
+	# and the upload retransmits of the test, and the per-interval samples (see interval_samples). The test failed
+	# if a direction transferred no data, its errors are listed.
+	loop = asyncio.get_running_loop()
+	streams = min(max(int(streams), 1), MAX_STREAMS)
+	duration = min(max(float(duration), MIN_INTERVAL), MAX_DURATION)
+	interval = min(max(float(interval), MIN_INTERVAL, duration / MAX_SAMPLES), duration)
+	results = { "remote_host" : host, \
+		"streams" : streams, \
+		"duration" : duration, \
+		"interval" : interval, \
+		"rx_bps" : 0.0, \
+		"tx_bps" : 0.0, \
+		"rx_bytes" : 0, \
+		"tx_bytes" : 0, \
+		"retransmits" : None, \
+		"samples" : [], \
+		"errors" : [] }
+	try:
+		addresses = await asyncio.wait_for(loop.getaddrinfo(host, port, type=socket.SOCK_STREAM), CONNECT_TIMEOUT)
+	except (OSError, asyncio.TimeoutError) as e:
+		results["errors"].append(str(e) or type(e).__name__)
+		return results
+	(family, socket_type, proto, canonname, sockaddr) = addresses[0]
+	receive_buffers = [bytearray(RECEIVE_BUFFER_SIZE) for i in range(streams)]
+	send_buffer = bytearray(os.urandom(SEND_BUFFER_SIZE))
+	for (direction, buffers, prefix) in (("download", receive_buffers, "rx"), ("upload", [send_buffer], "tx")):
+		(bytes_transferred, retransmits, elapsed, samples, errors) = \
+				await run_phase(direction, sockaddr, family, streams, duration, interval, buffers)
+		results[prefix + "_bytes"] = bytes_transferred
+		results[prefix + "_bps"] = round(bytes_transferred * 8.0 / elapsed, 1) if elapsed > 0 else 0.0
+		results["samples"] += interval_samples(direction, samples)
+		results["errors"] += ["{}: {}".format(direction, e) for e in errors]
+		if direction == "upload":
+			results["retransmits"] = retransmits
+	return results
+
+def succeeded(results):
+	return results["rx_bytes"] > 0 and results["tx_bytes"] > 0
+
+# responder
+
+class responder:
+	def __init__(self):
+		self.send_buffer = bytearray(os.urandom(SEND_BUFFER_SIZE))
+		self.connections = set()
+
+	async def send(self, sock):
+		loop = asyncio.get_running_loop()
+		yield_time = 0.0
+		with memoryview(self.send_buffer) as view:
+			while True:
+				await loop.sock_sendall(sock, view)
+				if loop.time() >= yield_time:
+					await asyncio.sleep(0)
+					yield_time = loop.time() + YIELD_INTERVAL
+
+	async def receive(self, sock):
+		loop = asyncio.get_running_loop()
+		buffer = bytearray(RECEIVE_BUFFER_SIZE)
+		yield_time = 0.0
+		while await loop.sock_recv_into(sock, buffer) > 0:
+			if loop.time() >= yield_time:
+				await asyncio.sleep(0)
+				yield_time = loop.time() + YIELD_INTERVAL
+
+	async def handle(self, sock):
+		loop = asyncio.get_running_loop()
+		try:
+			request = bytearray()
+			while len(request) < REQUEST_SIZE:
+				data = await asyncio.wait_for(loop.sock_recv(sock, REQUEST_SIZE - len(request)), REQUEST_TIMEOUT)
+				if data == b"":
+					return
+				request += data
+			(magic, version, direction, reserved, duration_ms) = struct.unpack(REQUEST_FORMAT, request)
+			if magic != REQUEST_MAGIC or version != REQUEST_VERSION:
+				return
+			# the client ends the transfer by closing the connection
+			timeout = min(duration_ms / 1e3, MAX_DURATION) + REQUEST_GRACE
+			if direction == DIRECTIONS["download"]:
+				await asyncio.wait_for(self.send(sock), timeout)
+			elif direction == DIRECTIONS["upload"]:
+				await asyncio.wait_for(self.receive(sock), timeout)
+		except (OSError, asyncio.TimeoutError):
+			pass
+		finally:
+			abort(sock)
+
+	async def serve(self, address = "", port = TCPPROBE_PORT, stop = None):
+		# accepts connections until <stop> is set (forever if it is None), at most MAX_CONNECTIONS at a time
+		loop = asyncio.get_running_loop()
+		if address == "" and socket.has_dualstack_ipv6():
+			listener = socket.create_server(("", port), family=socket.AF_INET6, backlog=MAX_CONNECTIONS, dualstack_ipv6=True)
+		else:
+			listener = socket.create_server((address, port), backlog=MAX_CONNECTIONS)
+		listener.setblocking(False)
+		stopped = asyncio.ensure_future(stop.wait() if stop is not None else asyncio.Future())
+		try:
+			while True:
+				accepted = asyncio.ensure_future(loop.sock_accept(listener))
+				await asyncio.wait([accepted, stopped], return_when=asyncio.FIRST_COMPLETED)
+				if not accepted.done():
+					accepted.cancel()
+					break
+				(sock, peer) = accepted.result()
+				if len(self.connections) >= MAX_CONNECTIONS:
+					abort(sock)
+					continue
+				sock.setblocking(False)
+				task = asyncio.ensure_future(self.handle(sock))
+				self.connections.add(task)
+				task.add_done_callback(self.connections.discard)
+		finally:
+			stopped.cancel()
+			for task in list(self.connections):
+				task.cancel()
+			await asyncio.gather(*self.connections, return_exceptions=True)
+			listener.close()
+
+def write_pidfile(pidfile):
+	if pidfile is not None:
+		with open(pidfile, "w") as f:
+			f.write("{}\n".format(os.getpid()))
+
+def main():
+	port = TCPPROBE_PORT
+	streams = STREAMS
+	duration = DURATION
+	interval = INTERVAL
+	server = False
+	address = ""
+	daemonize = False
+	pidfile = None
+	try:
+		options, remainder = getopt.getopt(sys.argv[1:], "p:P:t:i:sB:D", ["port=", "parallel=", "time=", "interval=", \
+				"server", "bind=", "daemon", "pidfile="])
+	except getopt.error as err:
+		print(str(err))
+		sys.exit(2)
+	for opt, arg in options:
+		if opt in ("-p", "--port"):
+			port = int(arg)
+		elif opt in ("-P", "--parallel"):
+			streams = int(arg)
+		elif opt in ("-t", "--time"):
+			duration = float(arg)
+		elif opt in ("-i", "--interval"):
+			interval = float(arg)
+		elif opt in ("-s", "--server"):
+			server = True
+		elif opt in ("-B", "--bind"):
+			address = arg
+		elif opt in ("-D", "--daemon"):
+			daemonize = True
+		elif opt == "--pidfile":
+			pidfile = os.path.abspath(arg)
+	if server:
+		if daemonize:
+			import daemon
+			# detached even when the standard input is a socket, which the daemon module takes for a start by inetd
+			with daemon.DaemonContext(detach_process=True):
+				write_pidfile(pidfile)
+				asyncio.run(responder().serve(address, port))
+		else:
+			write_pidfile(pidfile)
+			asyncio.run(responder().serve(address, port))
+		return
+	if len(remainder) != 1:
+		print("usage: {} [-p <port>] [-P <streams>] [-t <duration seconds>] [-i <interval seconds>] <host>".format(sys.argv[0]))
+		print("       {} -s [-B <address>] [-p <port>] [-D] [--pidfile <file>]".format(sys.argv[0]))
+		sys.exit(2)
+	results = asyncio.run(measure(remainder[0], streams, duration, interval, port))
+	print(json.dumps(results))
+	if not succeeded(results):
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# Native throughput test (speedtest client "native"): downloads from an HTTP endpoint over <connections> parallel
+# TCP connections, then uploads to an HTTP endpoint over as many connections. Each phase ends after <duration>
+# seconds or when <max_bytes> of payload have been transferred, whichever comes first, which bounds the data
+# volume of a test (see the data usage quota). The data a download has received but not read yet counts against
+# the budget (it has crossed the link already), and the connections are reset when a phase ends, so that the
+# server stops sending at once and no data left in the send buffers goes out after it. A connection whose request
+# completes before the end of the phase starts another request.
+#
+# Every connection receives into a buffer of its own that is allocated once, and all connections send from a
+# single buffer of random data (random, so that no compression on the path can shrink it). The requests are
+# plain HTTP/1.0: a response ends when the server closes the connection, so the body needs no decoding and goes
+# from the socket straight into the buffer. TLS is not supported, on a small device it would measure the
+# encryption rather than the connection.
+#
+# The throughput is measured on the wire, like the bandwidth monitor measures it: the byte counters of the
+# network interfaces (all interfaces of the network namespace except loopback) are sampled during each phase.
+# The rate of a phase leaves out its first WARMUP seconds (TCP slow start) and includes the protocol overhead.
+# The data volume of the test is the difference of the counters at its start and end.
+#
+# The test runs in the network namespace of the calling process. To test from another namespace, run this
+# script in it; it prints the results as JSON and exits with 1 if the test failed:
+# usage: throughput.py -d <download url> -u <upload url> [-c <connections>] [-t <duration seconds>]
+#	[-b <max bytes per phase>]
+
+import os
+import sys
+import json
+import time
+import socket
+import fcntl
+import struct
+import getopt
+import asyncio
+import termios
+import urllib.parse
+
+CONNECTIONS = 4
+DURATION = 10.0
+MAX_BYTES = 100000000
+WARMUP = 1.0
+SAMPLE_INTERVAL = 0.1
+RESOLVE_TIMEOUT = 5.0
+RECEIVE_BUFFER_SIZE = 262144
+SEND_BUFFER_SIZE = 1048576
+UPLOAD_REQUEST_SIZE = 25000000
+MAX_HEADER_SIZE = 16384
+YIELD_INTERVAL = 0.005
+UNREAD_INTERVAL = 0.002
+USER_AGENT = "netperf/1.0"
+
+os_word_size = 64 if sys.maxsize > 2**32 else 32
+MAXUINT = (2 ** os_word_size) - 1
+
+class interface_counters:
+	# reads the byte counters of all interfaces except loopback with a single read of /proc/net/dev into a
+	# reused buffer (as the bandwidth monitor does)
+	def __init__(self, proc_net_dev = "/proc/net/dev"):
+		self.buffer = bytearray(16384)
+		self.file = open(proc_net_dev, "rb", buffering=0)
+
+	def read(self):
+		# returns a dictionary mapping the interface name to its (rx_bytes, tx_bytes) counters
+		self.file.seek(0)
+		size = 0
+		while True:
+			if size == len(self.buffer):
+				self.buffer.extend(bytes(len(self.buffer)))
+			with memoryview(self.buffer) as view:
+				count = self.file.readinto(view[size:])
+			if not count:
+				break
+			size += count
+		counters = {}
+		for line in self.buffer[:size].split(b"\n")[2:]:
+			(name, separator, fields) = line.partition(b":")
+			name = name.strip().decode()
+			if separator and name != "lo":
+				fields = fields.split()
+				counters[name] = (int(fields[0]), int(fields[8]))
+		return counters
+
+	def close(self):
+		self.file.close()
+
+def counter_difference(start, end):
+	# returns the (rx_bytes, tx_bytes) transferred between two readings of interface_counters, counters that
+	# wrapped around are corrected. Interfaces that are not in both readings are left out.
+	rx_bytes = 0
+	tx_bytes = 0
+	for (name, (rx_end, tx_end)) in end.items():
+		if name in start:
+			(rx_start, tx_start) = start[name]
+			rx_bytes += rx_end - rx_start if rx_end >= rx_start else MAXUINT - rx_start + rx_end + 1
+			tx_bytes += tx_end - tx_start if tx_end >= tx_start else MAXUINT - tx_start + tx_end + 1
+	return (rx_bytes, tx_bytes)
+
+def abort(sock):
+	# closes a connection with a reset: the data left in the socket buffers is discarded rather than received or
+	# sent after the end of the phase
+	try:
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+	except OSError:
+		pass
+	sock.close()
+
+def parse_url(url):
+	# returns (host, port, request target) of an http URL, raises ValueError for other URLs
+	parts = urllib.parse.urlsplit(url)
+	if parts.scheme != "http" or parts.hostname is None:
+		raise ValueError("not an http URL: {}".format(url))
+	target = parts.path if parts.path != "" else "/"
+	if parts.query != "":
+		target += "?" + parts.query
+	return (parts.hostname, parts.port if parts.port is not None else 80, target)
+
+def parse_response_header(header):
+	# returns the length of the header of an HTTP response (including the blank line that ends it), None if the
+	# header is incomplete. Raises ValueError if the response is not successful.
+	end = header.find(b"\r\n\r\n")
+	if end < 0:
+		if len(header) > MAX_HEADER_SIZE:
+			raise ValueError("invalid HTTP response")
+		return None
+	status_line = bytes(header[:header.find(b"\r\n")]).split(None, 2)
+	if len(status_line) < 2 or not status_line[0].startswith(b"HTTP/") or not status_line[1].startswith(b"2"):
+		raise ValueError("HTTP response: {}".format(bytes(header[:header.find(b"\r\n")]).decode("latin-1")))
+	return end + 4
+
+class transfer:
+	# the state of a test phase shared by its connections: the payload bytes transferred, the byte budget and
+	# the lowest connect time
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.payload_bytes = 0
+		self.reserved_bytes = 0
+		self.connect_time = None
+		self.complete = asyncio.Event()
+		self.loop = asyncio.get_running_loop()
+		self.yield_time = 0.0
+		# the data received but not read yet by each download connection, and its total
+		self.unread_bytes = {}
+		self.unread_total = 0
+		self.unread_time = 0.0
+
+	def add(self, count):
+		# counts payload bytes. The download ends as soon as the budget is received, the upload when the requests
+		# the budget allows (see reserve) have been answered, i.e. all of the payload has reached the server.
+		self.payload_bytes += count
+		return self.max_bytes > 0 and self.payload_bytes + self.unread_total >= self.max_bytes
+
+	def add_unread(self, sock):
+		# updates the data waiting in the receive buffers of the download connections, returns True when the
+		# budget is reached. On a fast link the receive buffers hold megabytes, which would be received on top
+		# of the budget if only the data read was counted. The buffer of <sock> is queried at each call, those
+		# of the other connections (which fill theirs while this one reads) at most every UNREAD_INTERVAL
+		# seconds, so that a read costs one ioctl rather than one per connection.
+		if self.max_bytes <= 0:
+			return False
+		sockets = [sock]
+		if self.loop.time() >= self.unread_time:
+			sockets = list(self.unread_bytes.keys() | {sock})
+			self.unread_time = self.loop.time() + UNREAD_INTERVAL
+		for s in sockets:
+			try:
+				count = struct.unpack("i", fcntl.ioctl(s.fileno(), termios.FIONREAD, b"\0\0\0\0"))[0]
+			except OSError:
+				continue
+			self.unread_total += count - self.unread_bytes.get(s, 0)
+			self.unread_bytes[s] = count
+		return self.add(0)
+
+	def close(self, sock):
+		# resets the connection when the phase is complete (see abort), closes it otherwise
+		self.unread_total -= self.unread_bytes.pop(sock, 0)
+		if self.complete.is_set():
+			abort(sock)
+		else:
+			sock.close()
+
+	def reserve(self, count):
+		# returns the size of the next upload request, at most <count> bytes of the remaining budget
+		if self.max_bytes > 0:
+			count = min(count, self.max_bytes - self.reserved_bytes)
+		self.reserved_bytes += count
+		return count
+
+	async def yield_to_others(self):
+		# the socket calls complete without suspending while data can be transferred, which on a fast link would
+		# keep the other connections and the counter sampling from running. A connection lets the others run
+		# at least every YIELD_INTERVAL seconds (not after each call, which would add to the CPU time per byte).
+		if self.loop.time() >= self.yield_time:
+			await asyncio.sleep(0)
+			self.yield_time = self.loop.time() + YIELD_INTERVAL
+
+	async def connect(self, sockaddr, family):
+		# returns a non-blocking socket connected to <sockaddr>. The connect has no timeout of its own, the end of
+		# the phase cancels it (asyncio.wait_for can lose that cancellation when the connect completes with it).
+		sock = socket.socket(family, socket.SOCK_STREAM)
+		sock.setblocking(False)
+		try:
+			start = time.perf_counter()
+			await self.loop.sock_connect(sock, sockaddr)
+			elapsed = time.perf_counter() - start
+		except:
+			sock.close()
+			raise
+		if self.connect_time is None or elapsed < self.connect_time:
+			self.connect_time = elapsed
+		return sock
+
+async def download_connection(phase, sockaddr, family, request, buffer):
+	# requests the download URL until the phase ends, the responses are received into <buffer> and discarded
+	loop = asyncio.get_running_loop()
+	with memoryview(buffer) as view:
+		while not phase.complete.is_set():
+			sock = await phase.connect(sockaddr, family)
+			try:
+				phase.add_unread(sock)
+				await loop.sock_sendall(sock, request)
+				header = bytearray()
+				body_bytes = 0
+				while True:
+					count = await loop.sock_recv_into(sock, buffer)
+					if count == 0:
+						break
+					if header is not None:
+						header += view[:count]
+						header_size = parse_response_header(header)
+						if header_size is None:
+							continue
+						count = len(header) - header_size
+						header = None
+					body_bytes += count
+					if phase.add(count) or phase.add_unread(sock):
+						phase.complete.set()
+					if phase.complete.is_set():
+						return
+					await phase.yield_to_others()
+				if header is not None:
+					raise ValueError("incomplete HTTP response")
+				if body_bytes == 0:
+					raise ValueError("empty HTTP response")
+			finally:
+				phase.close(sock)
+
+async def upload_connection(phase, sockaddr, family, request, buffer):
+	# posts request bodies sent from <buffer> to the upload URL until the phase ends
+	loop = asyncio.get_running_loop()
+	with memoryview(buffer) as view:
+		while not phase.complete.is_set():
+			size = phase.reserve(UPLOAD_REQUEST_SIZE)
+			if size <= 0:
+				break
+			sock = await phase.connect(sockaddr, family)
+			try:
+				await loop.sock_sendall(sock, request + "Content-Length: {}\r\n\r\n".format(size).encode())
+				sent = 0
+				while sent < size:
+					count = min(len(buffer), size - sent)
+					await loop.sock_sendall(sock, view[:count])
+					sent += count
+					phase.add(count)
+					if phase.complete.is_set():
+						return
+					await phase.yield_to_others()
+				header = bytearray()
+				while parse_response_header(header) is None:
+					response = await loop.sock_recv(sock, MAX_HEADER_SIZE)
+					if response == b"":
+						raise ValueError("incomplete HTTP response")
+					header += response
+			finally:
+				phase.close(sock)
+
+async def sample_counters(counters, samples, stop, interval = SAMPLE_INTERVAL):
+	# appends (time, counters) to <samples> every <interval> seconds until <stop> is set, and once more then
+	loop = asyncio.get_running_loop()
+	start = loop.time()
+	while True:
+		samples.append((loop.time(), counters.read()))
+		if stop.is_set():
+			return
+		try:
+			await asyncio.wait_for(stop.wait(), max(start + len(samples) * interval - loop.time(), 0))
+		except asyncio.TimeoutError:
+			pass
+
+def phase_rate(samples, direction, warmup = WARMUP):
+	# returns the rate in bits per second of the samples of a phase, without its first <warmup> seconds.
+	# direction is 0 for received and 1 for transmitted bytes.
+	(start_time, start) = samples[0]
+	(end_time, end) = samples[-1]
+	if end_time - start_time > 2 * warmup:
+		(start_time, start) = next((t, c) for (t, c) in samples if t - samples[0][0] >= warmup)
+	if end_time <= start_time:
+		return 0.0
+	return counter_difference(start, end)[direction] * 8.0 / (end_time - start_time)
+
+def download_request(host, port, target):
+	return "GET {} HTTP/1.0\r\nHost: {}:{}\r\nUser-Agent: {}\r\nAccept-Encoding: identity\r\nCache-Control: no-cache\r\n\r\n" \
+			.format(target, host, port, USER_AGENT).encode()
+
+def upload_request(host, port, target):
+	# the header without the content length, which is added for each request
+	return "POST {} HTTP/1.0\r\nHost: {}:{}\r\nUser-Agent: {}\r\nContent-Type: application/octet-stream\r\n" \
+			.format(target, host, port, USER_AGENT).encode()
+
+PHASES = { "download" : (download_connection, download_request, 0), \
+	"upload" : (upload_connection, upload_request, 1) }
+
+async def run_phase(phase_name, url, connections, duration, max_bytes, counters, buffers):
+	# runs the download or the upload phase, returns a dictionary of its results
+	(connection, make_request, direction) = PHASES[phase_name]
+	loop = asyncio.get_running_loop()
+	(host, port, target) = parse_url(url)
+	addresses = await asyncio.wait_for(loop.getaddrinfo(host, port, type=socket.SOCK_STREAM), RESOLVE_TIMEOUT)
+	(family, socket_type, proto, canonname, sockaddr) = addresses[0]
+	phase = transfer(max_bytes)
+	request = make_request(host, port, target)
+	samples = []
+	stop = asyncio.Event()
+	sampler = asyncio.ensure_future(sample_counters(counters, samples, stop))
+	tasks = [asyncio.ensure_future(connection(phase, sockaddr, family, request, buffers[i % len(buffers)])) \
+			for i in range(connections)]
+	complete = asyncio.ensure_future(phase.complete.wait())
+	start = loop.time()
+	try:
+		pending = set(tasks)
+		while len(pending) > 0 and not phase.complete.is_set():
+			remaining = start + duration - loop.time()
+			if remaining <= 0:
+				break
+			(done, pending) = await asyncio.wait(pending | {complete}, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+			pending.discard(complete)
+	finally:
+		# the last sample is taken before the connections are closed, the data still arriving then is only
+		# included in the data volume of the test
+		elapsed = loop.time() - start
+		stop.set()
+		await sampler
+		phase.complete.set()
+		complete.cancel()
+		for task in tasks:
+			task.cancel()
+		results = await asyncio.gather(*tasks, return_exceptions=True)
+	errors = sorted(set([str(r) or type(r).__name__ for r in results \
+			if isinstance(r, Exception) and not isinstance(r, asyncio.CancelledError)]))
+	return { "bps" : round(phase_rate(samples, direction), 1), \
+		"bytes" : counter_difference(samples[0][1], samples[-1][1])[direction], \
+		"payload_bytes" : phase.payload_bytes, \
+		"payload_bps" : round(phase.payload_bytes * 8.0 / elapsed, 1) if elapsed > 0 else 0.0, \
+		"elapsed" : round(elapsed, 3), \
+		"connect_ms" : round(phase.connect_time * 1e3, 3) if phase.connect_time is not None else None, \
+		"errors" : errors, \
+		"host" : host, \
+		"url" : url }
+
+async def measure(download_url, upload_url, connections = CONNECTIONS, duration = DURATION, max_bytes = MAX_BYTES):
+	# runs the download phase, then the upload phase, returns the results: the rate (bps, on the wire), bytes
+	# on the wire and payload bytes of each phase, the lowest connect time in ms (ping), the bytes received and
+	# transmitted during the whole test and the download server. A phase failed if no payload was transferred,
+	# its errors are listed.
+	counters = interface_counters()
+	try:
+		start = counters.read()
+		receive_buffers = [bytearray(RECEIVE_BUFFER_SIZE) for i in range(connections)]
+		download = await run_phase("download", download_url, connections, duration, max_bytes, counters, receive_buffers)
+		del receive_buffers
+		send_buffer = bytearray(os.urandom(SEND_BUFFER_SIZE))
+		upload = await run_phase("upload", upload_url, connections, duration, max_bytes, counters, [send_buffer])
+		(rx_bytes, tx_bytes) = counter_difference(start, counters.read())
+	finally:
+		counters.close()
+	connect_times = [p["connect_ms"] for p in (download, upload) if p["connect_ms"] is not None]
+	return { "download" : download, \
+		"upload" : upload, \
+		"ping" : min(connect_times) if len(connect_times) > 0 else None, \
+		"rx_bytes" : rx_bytes, \
+		"tx_bytes" : tx_bytes, \
+		"server" : { "host" : download["host"], "url" : download_url } }
+
+def succeeded(results):
+	return results["download"]["payload_bytes"] > 0 and results["upload"]["payload_bytes"] > 0
+
+def main():
+	download_url = None
+	upload_url = None
+	connections = CONNECTIONS
+	duration = DURATION
+	max_bytes = MAX_BYTES
+	try:
+		options, remainder = getopt.getopt(sys.argv[1:], "d:u:c:t:b:", ["download=", "upload=", "connections=", "duration=", "bytes="])
+	except getopt.error as err:
+		print(str(err))
+		sys.exit(2)
+	for opt, arg in options:
+		if opt in ("-d", "--download"):
+			download_url = arg
+		elif opt in ("-u", "--upload"):
+			upload_url = arg
+		elif opt in ("-c", "--connections"):
+			connections = max(int(arg),1)
+		elif opt in ("-t", "--duration"):
+			duration = max(float(arg),1.0)
+		elif opt in ("-b", "--bytes"):
+			max_bytes = max(int(arg),0)
+	if not download_url or not upload_url:
+		print("usage: {} -d <download url> -u <upload url> [-c <connections>] [-t <duration seconds>] [-b <max bytes per phase>]" \
+				.format(sys.argv[0]))
+		sys.exit(2)
+	try:
+		results = asyncio.run(measure(download_url, upload_url, connections, duration, max_bytes))
+	except (OSError, ValueError, asyncio.TimeoutError) as e:
+		print("Throughput test failed: {}".format(str(e) or type(e).__name__), file=sys.stderr)
+		sys.exit(1)
+	print(json.dumps(results))
+	if not succeeded(results):
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
@@ -8,15 +8,22 @@ DAY_MINUTES=24*60
 
 class bin:
 	def __init__(self,fractional_hour):
-		self.values=[]
+		self.total = 0
+		self.count = 0
 		self.time = fractional_hour
 
 	def add_value(self,value):
-		self.values.append(value)
+		self.total += value
+		self.count += 1
+
+	def add_values(self,count,total):
+		# adds pre-aggregated values, e.g. the sample count and sum from a bandwidth rollup row
+		self.total += total
+		self.count += count
 
 	def mean(self):
-		if len(self.values) > 0:
-			m = sum(self.values) / len(self.values)
+		if self.count > 0:
+			m = self.total / self.count
 		else:
 			m = 0
 		return m
@@ -38,6 +45,10 @@ class time_bins:
 		b = int(math.floor(fractional_hour / self.bin_width))
 		self.bins[b].add_value(value)
 
+	def add_values(self, fractional_hour, count, total):
+		b = int(math.floor(fractional_hour / self.bin_width))
+		self.bins[b].add_values(count, total)
+
 	def get_times(self):
 		times = []
 		for b in self.bins:
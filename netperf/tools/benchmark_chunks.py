@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# Benchmark comparing the row format of the bandwidth table with compressed chunk storage (tschunk.py).
+# Two temporary databases are filled with the same synthetic 1 Hz bandwidth monitor data (jittered sample
+# times, mostly idle traffic with bursts), the rows of the second database are then packed into hourly chunks.
+# Both databases also hold the bandwidth rollup tables. The benchmark reports the database sizes, the
+# compression ratio, and the time taken to read a day of bandwidth data with get_bandwidth_data from each database.
+#
+# usage: benchmark_chunks.py [-d <days>] [-r <repetitions>] [-k]
+#        -k keeps the temporary database files for inspection
+
+import os
+import sys
+import time
+import getopt
+import random
+import sqlite3
+import datetime
+import tempfile
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from netperf_db import netperf_db, start_end_timestamps
+from tschunk import decode_chunk
+
+CLIENT_ID = "benchmark"
+
+def bandwidth_rows(start_timestamp, seconds):
+	# synthetic bandwidth monitor rows, computed the same way as bwmonitor.py (1 Hz sampling, without the
+	# sub-second sample statistics)
+	rows = []
+	last_time = start_timestamp
+	rx_rate = 2e4
+	for s in range(1, seconds):
+		sample_time = start_timestamp + s + random.uniform(0, 0.004)
+		if random.random() < 0.002:
+			# start or end of a burst of traffic
+			rx_rate = random.choice([2e4, 2e6, 1.2e7])
+		rx_bytes = max(0, int(random.gauss(rx_rate, rx_rate / 10)))
+		tx_bytes = int(rx_bytes / random.uniform(10, 30))
+		time_delta = sample_time - last_time
+		rows.append((CLIENT_ID, sample_time, rx_bytes, tx_bytes, float(rx_bytes * 8) / time_delta, float(tx_bytes * 8) / time_delta) + (None,) * 5)
+		last_time = sample_time
+	return rows
+
+def database_size(db_filename):
+	# size of the database after a VACUUM (the vacuumed pages may still be in the write-ahead log)
+	db_conn = sqlite3.connect(db_filename)
+	db_conn.execute("VACUUM")
+	size = db_conn.execute("PRAGMA page_count").fetchone()[0] * db_conn.execute("PRAGMA page_size").fetchone()[0]
+	db_conn.close()
+	return size
+
+def timed(function, repetitions):
+	start = time.perf_counter()
+	for r in range(repetitions):
+		function()
+	return (time.perf_counter() - start) / repetitions
+
+def main():
+	days = 1
+	repetitions = 3
+	keep_db = False
+	try:
+		options, remainder = getopt.getopt(sys.argv[1:], "d:r:k", ["days=", "repetitions=", "keep"])
+	except getopt.error as err:
+		print(str(err))
+		sys.exit(2)
+	for opt, arg in options:
+		if opt in ("-d", "--days"):
+			days = max(int(arg),1)
+		elif opt in ("-r", "--repetitions"):
+			repetitions = max(int(arg),1)
+		elif opt in ("-k", "--keep"):
+			keep_db = True
+
+	first_day = datetime.date.today() - datetime.timedelta(days=days)
+	start_timestamp = start_end_timestamps(first_day)[0]
+	rows = bandwidth_rows(start_timestamp, days * 86400)
+	db_filenames = []
+	dbs = []
+	for name in ("rows", "chunks"):
+		(fd, db_filename) = tempfile.mkstemp(suffix="-{}.db".format(name))
+		os.close(fd)
+		db_filenames.append(db_filename)
+		db = netperf_db(db_filename, partitioned = False)
+		db.insert_rows({"bandwidth" : list(rows)})
+		dbs.append(db)
+	print("Created benchmark databases with {} bandwidth samples ({} days)".format(len(rows), days))
+
+	# pack the rows of the second database into chunks
+	(row_db, chunk_db) = dbs
+	chunk_db.chunk_storage = True
+	start = time.perf_counter()
+	while chunk_db.maintenance_pending():
+		chunk_db.maintenance_step(1.0)
+	print("Compaction time: {:.2f} s".format(time.perf_counter() - start))
+	chunk_count, chunk_bytes = chunk_db.db_conn.execute("SELECT COUNT(*), SUM(length(data)) FROM bandwidth_chunks").fetchone()
+	# chunk payload size compared to the size of the values stored in the row format (2 x 8 byte integers,
+	# 3 x 8 byte reals, client id text)
+	print("Chunks: {}, payload {} bytes, {:.2f} bytes/sample (row values: {} bytes/sample)".format(chunk_count, chunk_bytes, \
+			chunk_bytes / len(rows), 5 * 8 + len(CLIENT_ID)))
+
+	sizes = [database_size(f) for f in db_filenames]
+	print("{:<24} {:>14} {:>14} {:>8}".format("", "rows", "chunks", "ratio"))
+	print("{:<24} {:>14} {:>14} {:>7.2f}x".format("database size (bytes)", sizes[0], sizes[1], sizes[0] / sizes[1]))
+
+	dates = [first_day + datetime.timedelta(days=d) for d in range(days)]
+	row_time = timed(lambda: [row_db.get_bandwidth_data(d) for d in dates], repetitions) / days
+	chunk_time = timed(lambda: [chunk_db.get_bandwidth_data(d) for d in dates], repetitions) / days
+	print("{:<24} {:>14.1f} {:>14.1f} {:>7.2f}x".format("daily query (ms)", row_time * 1e3, chunk_time * 1e3, row_time / chunk_time))
+	chunks = [r[0] for r in chunk_db.db_conn.execute("SELECT data FROM bandwidth_chunks").fetchall()]
+	decode_time = timed(lambda: [decode_chunk(c) for c in chunks], repetitions)
+	print("Decoding to NumPy arrays: {:.1f} ms per day".format(decode_time * 1e3 / days))
+
+	for (db, db_filename) in zip(dbs, db_filenames):
+		db.close()
+		if keep_db:
+			print("Benchmark database kept: {}".format(db_filename))
+		else:
+			for suffix in ("", "-wal", "-shm"):
+				if os.path.exists(db_filename + suffix):
+					os.remove(db_filename + suffix)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# Micro-benchmark comparing the legacy string-formatted query path with the parameterized query layer
+# (db_queries.py) used by netperf_db. A temporary database is filled with one week of synthetic data
+# (1 Hz bandwidth samples, per-minute ping results, iperf3/dns/speedtest results every 10 minutes), then
+# each query is run repeatedly for every day of the week using both query paths.
+#
+# usage: benchmark_db_queries.py [-r <repetitions>] [-k]
+#        -k keeps the temporary database file for inspection
+
+import os
+import sys
+import time
+import getopt
+import random
+import sqlite3
+import datetime
+import tempfile
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from netperf_db import netperf_db, start_end_timestamps
+from db_queries import SPEEDTEST_LATENCY_COLUMNS
+
+INTERFACES = ["wlan0", "wlan1", "eth1", "eth2"]
+CLIENT_ID = "benchmark"
+DAYS = 7
+
+def populate(db, start_timestamp):
+	# fill the database with DAYS days of synthetic data, one day per transaction. The columns added to the
+	# tables since (sample statistics, ping percentiles, iperf3 samples, speedtest latencies) are left empty.
+	for day in range(DAYS):
+		day_start = start_timestamp + day * 86400
+		rows = {"bandwidth": [], "ping": [], "iperf3": [], "dns": [], "speedtest": []}
+		for s in range(86400):
+			t = day_start + s
+			rows["bandwidth"].append((CLIENT_ID, t, 1000, 500, random.uniform(0,1e8), random.uniform(0,1e7)) + (None,) * 5)
+			if s % 60 == 0:
+				rows["ping"].append((CLIENT_ID, t + 0.1, "8.8.8.8", 10.0, 12.0, 15.0, 1.0) + (None,) * 7)
+			if s % 600 == 0:
+				for i in range(len(INTERFACES)):
+					rows["iperf3"].append((CLIENT_ID, t + i, INTERFACES[i], 90.0, 80.0, 0, None))
+					rows["ping"].append((CLIENT_ID, t + 0.2 + i, INTERFACES[i], 1.0, 2.0, 3.0, 0.5) + (None,) * 7)
+				rows["dns"].append((CLIENT_ID, t, 1, 12, 0, 1, 20, 0))
+				rows["speedtest"].append((CLIENT_ID, t, 100.0, 10.0, 1e8, 1e7, "host", "url", 12.0, 100.0, 10.0) + (None,) * len(SPEEDTEST_LATENCY_COLUMNS))
+		db.insert_rows(rows)
+
+def legacy_queries(db_conn, query_date):
+	# the string-formatted queries (and row to dictionary conversions) used by netperf_db before the
+	# parameterized query layer was introduced
+	(start_timestamp,end_timestamp) = start_end_timestamps(query_date)
+	cur = db_conn.cursor()
+	cur.execute("SELECT * FROM speedtest where epoch_time >= {} and epoch_time <= {}".format(start_timestamp,end_timestamp))
+	results = [{"timestamp" : i[1], "rx_Mbps" : i[2], "tx_Mbps" : i[3], "rx_bytes" : i[4], "tx_bytes" : i[5], "ping" : i[8], \
+			"remote_host" : i[6], "url" : i[7], "bwm_rx_Mbps" : i[9], "bwm_tx_Mbps" : i[10]} for i in cur.fetchall()]
+	cur.execute("SELECT * FROM dns where epoch_time >= {} and epoch_time <= {}".format(start_timestamp,end_timestamp))
+	results = [{"timestamp" : i[1], "internal_dns_ok" : i[2] == 1, "internal_dns_query_time" : i[3], "internal_dns_failures" : i[4], \
+			"external_dns_ok" : i[5] == 1, "external_dns_query_time" : i[6], "external_dns_failures" : i[7]} for i in cur.fetchall()]
+	for interface in INTERFACES:
+		cur.execute("SELECT * FROM ping where (epoch_time >= {} AND epoch_time <= {}) AND remote_host LIKE \"{}\"".format(start_timestamp,end_timestamp,interface))
+		results = [{"timestamp" : i[1], "min" : i[3], "avg" : i[4], "max" : i[5], "mdev" : i[6]} for i in cur.fetchall()]
+		cur.execute("SELECT * FROM iperf3 where epoch_time >= {} and epoch_time <= {} and remote_host LIKE \"{}\"".format(start_timestamp,end_timestamp,interface))
+		results = [{"timestamp" : i[1], "rx_Mbps" : i[3], "tx_Mbps" : i[4], "retransmits" : i[5]} for i in cur.fetchall()]
+	cur.execute("SELECT * FROM bandwidth where epoch_time >= {} and epoch_time <= {}".format(start_timestamp,end_timestamp))
+	results = [{"timestamp" : i[1], "rx_bps" : i[4], "tx_bps" : i[5]} for i in cur.fetchall()]
+	cur.close()
+
+def layer_queries(db, query_date):
+	db.get_speedtest_data(query_date)
+	db.get_dns_data(query_date)
+	for interface in INTERFACES:
+		db.get_ping_interface_data(query_date, interface)
+		db.get_iperf3_interface_data(query_date, interface)
+	db.get_bandwidth_data(query_date)
+
+def legacy_small_queries(db_conn, query_date):
+	# the short per-interface lookups where statement preparation dominates the run time
+	(start_timestamp,end_timestamp) = start_end_timestamps(query_date)
+	cur = db_conn.cursor()
+	for interface in INTERFACES:
+		cur.execute("SELECT * FROM ping where (epoch_time >= {} AND epoch_time <= {}) AND remote_host LIKE \"{}\" AND (min = 0 OR max = 0)".format(start_timestamp,end_timestamp,interface))
+		results = [{"timestamp" : i[1], "min" : i[3], "avg" : i[4], "max" : i[5], "mdev" : i[6]} for i in cur.fetchall()]
+	cur.close()
+
+def layer_small_queries(db, query_date):
+	for interface in INTERFACES:
+		db.get_ping_interface_data(query_date, interface, outage_only = True)
+
+def timed(function, repetitions, dates):
+	start = time.perf_counter()
+	for r in range(repetitions):
+		for d in dates:
+			function(d)
+	return (time.perf_counter() - start) / (repetitions * len(dates))
+
+def main():
+	repetitions = 5
+	keep_db = False
+	try:
+		options, remainder = getopt.getopt(sys.argv[1:], "r:k", ["repetitions=", "keep"])
+	except getopt.error as err:
+		print(str(err))
+		sys.exit(2)
+	for opt, arg in options:
+		if opt in ("-r", "--repetitions"):
+			repetitions = max(int(arg),1)
+		elif opt in ("-k", "--keep"):
+			keep_db = True
+
+	(fd, db_filename) = tempfile.mkstemp(suffix=".db")
+	os.close(fd)
+	first_day = datetime.date.today() - datetime.timedelta(days=DAYS)
+	dates = [first_day + datetime.timedelta(days=d) for d in range(DAYS)]
+	print("Creating benchmark database {} ({} days of data)...".format(db_filename, DAYS))
+	db = netperf_db(db_filename)
+	populate(db, start_end_timestamps(first_day)[0])
+	legacy_conn = sqlite3.connect(db_filename)
+
+	print("{:<32} {:>14} {:>14} {:>8}".format("Query set", "legacy (ms)", "layer (ms)", "speedup"))
+	benchmarks = [
+		("daily report queries", lambda d: legacy_queries(legacy_conn, d), lambda d: layer_queries(db, d), repetitions),
+		("interface outage lookups", lambda d: legacy_small_queries(legacy_conn, d), lambda d: layer_small_queries(db, d), repetitions * 100)
+	]
+	for (name, legacy, layer, n) in benchmarks:
+		legacy_time = timed(legacy, n, dates)
+		layer_time = timed(layer, n, dates)
+		print("{:<32} {:>14.3f} {:>14.3f} {:>7.2f}x".format(name, legacy_time * 1e3, layer_time * 1e3, legacy_time / layer_time))
+
+	legacy_conn.close()
+	db.close()
+	if keep_db:
+		print("Benchmark database kept: {}".format(db_filename))
+	else:
+		for suffix in ("", "-wal", "-shm"):
+			if os.path.exists(db_filename + suffix):
+				os.remove(db_filename + suffix)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# Benchmark of the per-probe overhead of the two ways the network tests run probes in the test namespace:
+#	sudo		sudo ip netns exec <namespace> <command>, a new process (and for the probes a new Python
+#			interpreter) for each probe
+#	helper		a request to the namespace helper (nshelper.py), which runs in the namespace already
+# Two operations are measured: an empty command (true), which shows the cost of entering the namespace, and a
+# single latency probe to the namespace's loopback address, as run by the tests (pingprobe.py). The benchmark
+# starts its own helper on a temporary socket. Without a namespace argument, the test namespace from
+# interfaces.json is used, or a temporary namespace is created. Must be run as root; when sudo is not installed
+# the sudo path is measured without sudo, which leaves out the sudo/PAM round trip.
+#
+# usage: benchmark_nshelper.py [-r <repetitions>] [<namespace>]
+
+import os
+import sys
+import json
+import time
+import shutil
+import getopt
+import asyncio
+import tempfile
+import statistics
+import subprocess
+
+NETPERF_PATH = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(1, NETPERF_PATH)
+
+import nshelper
+
+PING_ARGS = { "hosts" : ["127.0.0.1"], "count" : 1, "interval" : 0.0, "timeout" : 1.0, "method" : "auto", "port" : 53 }
+
+async def sudo_command(prefix, cmd):
+	ps = await asyncio.create_subprocess_shell("{} {}".format(prefix, cmd), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+	output = (await ps.communicate())[0]
+	if ps.returncode != 0:
+		raise RuntimeError("{} {} failed".format(prefix, cmd))
+	return output
+
+async def helper_request(socket_path, namespace, request_type, data):
+	return await nshelper.request(await nshelper.connect(socket_path), namespace, request_type, data)
+
+async def timed(operation, repetitions):
+	# returns the times of the repetitions in milliseconds, after one warm up run
+	await operation()
+	times = []
+	for i in range(repetitions):
+		start = time.perf_counter()
+		await operation()
+		times.append((time.perf_counter() - start) * 1e3)
+	return times
+
+async def run_benchmarks(namespace, socket_path, prefix, repetitions):
+	ping_cmd = "{} {} -c 1 -i 0 -W 1.0 127.0.0.1".format(sys.executable, os.path.join(NETPERF_PATH, "pingprobe.py"))
+	benchmarks = [
+		("empty command", lambda: sudo_command(prefix, "true"), \
+				lambda: helper_request(socket_path, namespace, "exec", { "cmd" : "true" })),
+		("latency probe", lambda: sudo_command(prefix, ping_cmd), \
+				lambda: helper_request(socket_path, namespace, "ping", PING_ARGS))
+	]
+	# both paths must measure the same thing
+	sudo_result = json.loads(await sudo_command(prefix, ping_cmd))[0]
+	helper_result = (await helper_request(socket_path, namespace, "ping", PING_ARGS))[1][0]
+	if sudo_result["packets_received"] != 1 or helper_result["packets_received"] != 1:
+		raise RuntimeError("the latency probe got no reply in namespace {}".format(namespace))
+
+	print("{:<16} {:>20} {:>20} {:>8}".format("Operation", "sudo median/min (ms)", "helper median/min (ms)", "speedup"))
+	for (name, sudo_operation, helper_operation) in benchmarks:
+		sudo_times = await timed(sudo_operation, repetitions)
+		helper_times = await timed(helper_operation, repetitions)
+		print("{:<16} {:>11.2f} / {:>6.2f} {:>13.2f} / {:>6.2f} {:>7.1f}x".format(name, statistics.median(sudo_times), \
+				min(sudo_times), statistics.median(helper_times), min(helper_times), \
+				statistics.median(sudo_times) / statistics.median(helper_times)))
+
+def wait_for_socket(socket_path, helper_ps, timeout = 10.0):
+	deadline = time.monotonic() + timeout
+	while not os.path.exists(socket_path):
+		if helper_ps.poll() is not None or time.monotonic() > deadline:
+			raise RuntimeError("the namespace helper did not start")
+		time.sleep(0.05)
+
+def main():
+	repetitions = 20
+	try:
+		options, remainder = getopt.getopt(sys.argv[1:], "r:", ["repetitions="])
+	except getopt.error as err:
+		print(str(err))
+		sys.exit(2)
+	for opt, arg in options:
+		if opt in ("-r", "--repetitions"):
+			repetitions = max(int(arg),1)
+	if len(remainder) > 1:
+		print("usage: {} [-r <repetitions>] [<namespace>]".format(sys.argv[0]))
+		sys.exit(2)
+	if os.geteuid() != 0:
+		print("The benchmark must be run as root.")
+		sys.exit(1)
+
+	namespace = remainder[0] if len(remainder) == 1 else None
+	if namespace is None and os.path.exists("/opt/netperf/config/interfaces.json"):
+		with open("/opt/netperf/config/interfaces.json","r") as config_file:
+			namespace = json.load(config_file).get("test_exec_namespace", None)
+	temporary_namespace = namespace in (None, "root")
+	if temporary_namespace:
+		namespace = "nsbench{}".format(os.getpid())
+		subprocess.run(["ip", "netns", "add", namespace], check=True)
+		subprocess.run(["ip", "netns", "exec", namespace, "ip", "link", "set", "lo", "up"], check=True)
+	prefix = "ip netns exec {}".format(namespace)
+	if shutil.which("sudo") is not None:
+		prefix = "sudo " + prefix
+	else:
+		print("sudo is not installed, the sudo path is measured without sudo.")
+	print("Namespace: {}{}, {} repetitions".format(namespace, " (temporary)" if temporary_namespace else "", repetitions))
+
+	socket_dir = tempfile.mkdtemp()
+	socket_path = os.path.join(socket_dir, "nshelper.sock")
+	helper_ps = subprocess.Popen([sys.executable, os.path.join(NETPERF_PATH, "nshelper.py"), "-s", socket_path, namespace])
+	try:
+		wait_for_socket(socket_path, helper_ps)
+		asyncio.run(run_benchmarks(namespace, socket_path, prefix, repetitions))
+	finally:
+		helper_ps.terminate()
+		helper_ps.wait()
+		shutil.rmtree(socket_dir)
+		if temporary_namespace:
+			subprocess.run(["ip", "netns", "delete", namespace])
+
+if __name__ == "__main__":
+	main()
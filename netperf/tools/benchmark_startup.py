@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# Start up benchmark for the entry points (scripts started by systemd, cron jobs, the shell scripts and other
+# processes). Each entry point is started in a new interpreter, the wall time until the interpreter exits and
+# its peak resident set size are measured, and the heavy modules that were loaded (numpy, matplotlib, ...) are
+# listed. The peak RSS is read by the child (VmHWM): ru_maxrss would include the memory of the benchmark process
+# the child was forked from. An entry point is measured as follows:
+#	- scripts with a main guard are imported, i.e. their module level code runs but main() does not
+#	- scripts without a main guard (e.g. prune_db.py, which sends a message when it runs) only execute their
+#	  top level import statements
+#	- commands (e.g. netperf_settings.py --get, used by the shell scripts) are run as they are
+# Interpreter start up alone is measured as the baseline. The times depend on the page cache: the first
+# repetition usually reads the modules from disk, the median and the minimum of the repetitions are reported.
+#
+# The results can be saved (-s) and later compared against (-c): an entry point whose minimum start up time or
+# peak RSS grew by more than the threshold (-t, percent) is reported as a regression and the exit code is 1.
+#
+# usage: benchmark_startup.py [-r <repetitions>] [-s <results file>] [-c <results file>] [-t <threshold %>]
+
+import os
+import sys
+import ast
+import json
+import time
+import getopt
+import statistics
+import subprocess
+
+NETPERF_PATH = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# (name, script path relative to NETPERF_PATH, command line arguments or None to import the script)
+ENTRY_POINTS = [
+	("test_network.py", "test_network.py", None),
+	("network_tests.py", "network_tests.py", None),
+	("netperf_agent.py", "netperf_agent.py", None),
+	("netperf_db.py", "netperf_db.py", None),
+	("bwmonitor.py", "bwmonitor.py", None),
+	("outage_monitor.py", "outage_monitor.py", None),
+	("nshelper.py", "nshelper.py", None),
+	("speedtest_servers.py", "speedtest_servers.py", None),
+	("throughput.py", "throughput.py", None),
+	("tcpprobe.py", "tcpprobe.py", None),
+	("netperf_report.py", "netperf_report.py", None),
+	("prune_db.py", "prune_db.py", None),
+	("reset_data_usage.py", "reset_data_usage.py", None),
+	("configure_interfaces.py", "configure_interfaces.py", None),
+	("dnsprobe.py", "dnsprobe.py", None),
+	("pingprobe.py", "pingprobe.py", None),
+	("netperf_settings.py --get", "netperf_settings.py", ["--get", "username"]),
+	("dashboard.py", "dashboard/application/dashboard.py", None)
+]
+HEAVY_MODULES = ["numpy", "matplotlib", "sqlite3", "asyncio", "urllib.request", "daemon", "flask"]
+NOISE_FLOOR = 0.01
+DEFAULT_THRESHOLD = 25.0
+REPORT_MARKER = "#startup:"
+
+def has_main_guard(tree):
+	for node in tree.body:
+		if isinstance(node, ast.If) and isinstance(node.test, ast.Compare) and isinstance(node.test.left, ast.Name) \
+				and node.test.left.id == "__name__":
+			return True
+	return False
+
+def report_code():
+	# code printing the module count, the heavy modules loaded and the peak RSS of the child
+	return "import sys, json\n" \
+			"hwm = [int(l.split()[1]) for l in open('/proc/self/status') if l.startswith('VmHWM:')]\n" \
+			"print({!r} + json.dumps({{'modules' : len(sys.modules), 'heavy' : [m for m in {!r} if m in sys.modules], " \
+			"'rss_kb' : hwm[0] if hwm else None}}), flush=True)\n".format(REPORT_MARKER, HEAVY_MODULES)
+
+def child_code(script, arguments):
+	# returns the code run by the child interpreter for an entry point, and the directory to run it in
+	if script is None:
+		return (report_code(), NETPERF_PATH)
+	path = os.path.join(NETPERF_PATH, script)
+	directory = os.path.dirname(path)
+	if arguments is not None:
+		# the command runs as a script, the report is printed when it exits
+		code = "import sys, runpy\nsys.argv = {!r}\ntry:\n\trunpy.run_path({!r}, run_name='__main__')\nfinally:\n{}" \
+				.format([path] + arguments, path, "".join(["\t" + l + "\n" for l in report_code().splitlines()]))
+		return ("import sys\nsys.path.insert(0, {!r})\n{}".format(directory, code), directory)
+	with open(path, "r") as f:
+		tree = ast.parse(f.read(), path)
+	if has_main_guard(tree):
+		code = "import {}".format(os.path.splitext(os.path.basename(path))[0])
+	else:
+		imports = [node for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))]
+		code = ast.unparse(ast.Module(body=imports, type_ignores=[]))
+	return ("import sys\nsys.path.insert(0, {!r})\n{}\n{}".format(directory, code, report_code()), directory)
+
+def run_once(argv, directory):
+	# runs a child interpreter, returns (exit code, wall time in seconds, stdout)
+	start = time.perf_counter()
+	process = subprocess.run(argv, cwd=directory, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL)
+	elapsed = time.perf_counter() - start
+	return (process.returncode, elapsed, process.stdout.decode(errors="replace"))
+
+def measure(name, script, arguments, repetitions):
+	(code, directory) = child_code(script, arguments)
+	argv = [sys.executable, "-c", code]
+	times = []
+	rss = []
+	result = {"name" : name, "ok" : True, "modules" : None, "heavy" : []}
+	for i in range(repetitions):
+		(exit_code, elapsed, output) = run_once(argv, directory)
+		reports = [json.loads(l[len(REPORT_MARKER):]) for l in output.splitlines() if l.startswith(REPORT_MARKER)]
+		if exit_code != 0 or len(reports) == 0:
+			result["ok"] = False
+			break
+		times.append(elapsed)
+		rss.append(reports[-1]["rss_kb"] or 0)
+		result["modules"] = reports[-1]["modules"]
+		result["heavy"] = reports[-1]["heavy"]
+	if result["ok"]:
+		result["time"] = statistics.median(times)
+		result["time_min"] = min(times)
+		result["rss_kb"] = max(rss)
+	return result
+
+def compare(results, baseline, threshold):
+	# returns the names of the entry points that regressed against the baseline results
+	regressions = []
+	previous = dict([(r["name"], r) for r in baseline if r["ok"]])
+	for r in results:
+		p = previous.get(r["name"], None)
+		if p is None or not r["ok"]:
+			continue
+		reasons = []
+		if r["time_min"] - p["time_min"] > NOISE_FLOOR and r["time_min"] > p["time_min"] * (1 + threshold / 100.0):
+			reasons.append("time {:.0f} -> {:.0f} ms".format(p["time_min"] * 1000, r["time_min"] * 1000))
+		if r["rss_kb"] > p["rss_kb"] * (1 + threshold / 100.0):
+			reasons.append("RSS {} -> {} kB".format(p["rss_kb"], r["rss_kb"]))
+		for m in r["heavy"]:
+			if m not in p["heavy"]:
+				reasons.append("{} now loaded".format(m))
+		if len(reasons) > 0:
+			regressions.append("{}: {}".format(r["name"], ", ".join(reasons)))
+	return regressions
+
+def main():
+	repetitions = 5
+	save_file = None
+	compare_file = None
+	threshold = DEFAULT_THRESHOLD
+	try:
+		options, remainder = getopt.getopt(sys.argv[1:], "r:s:c:t:", ["repetitions=", "save=", "compare=", "threshold="])
+	except getopt.error as err:
+		print(str(err))
+		sys.exit(2)
+	for opt, arg in options:
+		if opt in ("-r", "--repetitions"):
+			repetitions = max(int(arg),1)
+		elif opt in ("-s", "--save"):
+			save_file = arg
+		elif opt in ("-c", "--compare"):
+			compare_file = arg
+		elif opt in ("-t", "--threshold"):
+			threshold = float(arg)
+
+	results = []
+	print("{:<28} {:>10} {:>10} {:>10} {:>8}  {}".format("entry point", "median ms", "min ms", "peak RSS", "modules", "heavy modules"))
+	for (name, script, arguments) in [("python (baseline)", None, None)] + ENTRY_POINTS:
+		r = measure(name, script, arguments, repetitions)
+		results.append(r)
+		if r["ok"]:
+			print("{:<28} {:>10.1f} {:>10.1f} {:>7} kB {:>8}  {}".format(name, r["time"] * 1000, r["time_min"] * 1000, r["rss_kb"], \
+					"" if r["modules"] is None else r["modules"], ", ".join(r["heavy"])))
+		else:
+			print("{:<28} {:>10}".format(name, "failed"))
+
+	if save_file is not None:
+		with open(save_file, "w") as f:
+			json.dump(results, f, indent=4)
+	if compare_file is not None:
+		with open(compare_file, "r") as f:
+			regressions = compare(results, json.load(f), threshold)
+		for regression in regressions:
+			print("REGRESSION {}".format(regression))
+		print("{} regressions (threshold {}%)".format(len(regressions), threshold))
+		if len(regressions) > 0:
+			sys.exit(1)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# Checks and benchmark of the built-in throughput probe (tcpprobe.py). The protocol checks run over loopback
+# against a responder started with the command line, as configure_interfaces.py starts it (in the foreground and
+# as a daemon). As root, the rate checks then run over a veth pair to a responder in a temporary network
+# namespace, with both ends of the pair shaped to a known rate by tc (tbf): the rates of the test must match the
+# shaped rate, and a rate drop in the middle of the download must show in its interval samples.
+#
+# The benchmark compares the rate and the CPU time per GB of the probe with iperf3 over loopback, when iperf3 is
+# installed. Loopback is not a real link: the rates show the cost of the programs, not of a network.
+#
+# usage: benchmark_tcpprobe.py [-t <duration seconds>]
+
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import shutil
+import getopt
+import asyncio
+import tempfile
+import threading
+import subprocess
+
+NETPERF_PATH = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(1, NETPERF_PATH)
+
+import tcpprobe
+from harness import check, summary
+
+LOOPBACK_ADDRESS = "127.0.0.1"
+LOOPBACK_PORT = 5292
+CLIENT_ADDRESS = "10.202.0.1"
+SERVER_ADDRESS = "10.202.0.2"
+SHAPED_RATE_MBIT = 100
+DIP_RATE_MBIT = 20
+TCPPROBE = os.path.join(NETPERF_PATH, "tcpprobe.py")
+
+def wait_for_responder(address, port, ps = None, timeout = 10.0):
+	deadline = time.monotonic() + timeout
+	while True:
+		try:
+			socket.create_connection((address, port), timeout=1.0).close()
+			return
+		except OSError:
+			if (ps is not None and ps.poll() is not None) or time.monotonic() > deadline:
+				raise RuntimeError("the responder did not start")
+			time.sleep(0.1)
+
+def median(values):
+	values = sorted(values)
+	return values[len(values) // 2]
+
+def run_loopback_checks(duration):
+	results = []
+	interval = 0.25
+
+	r = asyncio.run(tcpprobe.measure(LOOPBACK_ADDRESS, 1, duration, interval, LOOPBACK_PORT))
+	check(results, "loopback: test succeeded", tcpprobe.succeeded(r) and len(r["errors"]) == 0, r["errors"])
+	expected = int(round(duration / interval))
+	rx_samples = [s for s in r["samples"] if s[1] is not None]
+	tx_samples = [s for s in r["samples"] if s[2] is not None]
+	check(results, "samples: one per interval in each direction", abs(len(rx_samples) - expected) <= 1 and abs(len(tx_samples) - expected) <= 1, \
+			"{} / {}, expected {}".format(len(rx_samples), len(tx_samples), expected))
+	check(results, "samples: in time order, download first", [s[0] for s in r["samples"]] == sorted([s[0] for s in r["samples"]]) \
+			and r["samples"].index(tx_samples[0]) == len(rx_samples))
+	check(results, "samples: one direction per row", all(s[2] is None and s[3] is None for s in rx_samples) \
+			and all(s[1] is None and s[3] is not None for s in tx_samples))
+	for (name, samples, column, bps) in (("download", rx_samples, 1, r["rx_bps"]), ("upload", tx_samples, 2, r["tx_bps"])):
+		mean = sum([s[column] for s in samples]) / len(samples)
+		check(results, "samples: {} intervals average to the test rate".format(name), 0.9 * bps < mean < 1.1 * bps, \
+				"{:.0f} / {:.0f} Mbps".format(mean / 1e6, bps / 1e6))
+	check(results, "retransmits: counted for the upload", isinstance(r["retransmits"], int), r["retransmits"])
+	check(results, "bytes: consistent with the rates", r["rx_bytes"] > 0 and abs(r["rx_bytes"] * 8.0 / duration - r["rx_bps"]) < 0.1 * r["rx_bps"], \
+			"{} bytes".format(r["rx_bytes"]))
+
+	r = asyncio.run(tcpprobe.measure(LOOPBACK_ADDRESS, 4, 1.0, interval, LOOPBACK_PORT))
+	check(results, "streams: 4 parallel streams", tcpprobe.succeeded(r) and r["streams"] == 4 and len(r["errors"]) == 0, r["errors"])
+	r = asyncio.run(tcpprobe.measure(LOOPBACK_ADDRESS, 1, 3.0, 0.01, LOOPBACK_PORT))
+	check(results, "samples: at most MAX_SAMPLES per direction", len(r["samples"]) <= 2 * tcpprobe.MAX_SAMPLES + 2, \
+			"{} samples, interval {:.3f} s".format(len(r["samples"]), r["interval"]))
+
+	# failures
+	start = time.monotonic()
+	r = asyncio.run(tcpprobe.measure(LOOPBACK_ADDRESS, 2, 1.0, interval, LOOPBACK_PORT + 1))
+	check(results, "failure: refused connection fails the test", not tcpprobe.succeeded(r) and len(r["errors"]) > 0 \
+			and time.monotonic() - start < 2.0, r["errors"])
+	r = asyncio.run(tcpprobe.measure("host.invalid", 1, 1.0, interval, LOOPBACK_PORT))
+	check(results, "failure: unknown host fails the test", not tcpprobe.succeeded(r) and len(r["errors"]) > 0, r["errors"])
+	with socket.create_connection((LOOPBACK_ADDRESS, LOOPBACK_PORT), timeout=5.0) as sock:
+		sock.sendall(b"GET / HTTP/1.0\r\n\r\n")
+		try:
+			closed = sock.recv(1024) == b""
+		except ConnectionResetError:
+			closed = True
+	check(results, "responder: invalid request is closed", closed)
+	# a client that reads but never closes: the responder stops after the requested duration and the grace time
+	with socket.create_connection((LOOPBACK_ADDRESS, LOOPBACK_PORT), timeout=10.0) as sock:
+		start = time.monotonic()
+		sock.sendall(struct.pack(tcpprobe.REQUEST_FORMAT, tcpprobe.REQUEST_MAGIC, tcpprobe.REQUEST_VERSION, \
+				tcpprobe.DIRECTIONS["download"], 0, 500))
+		try:
+			while sock.recv(1048576) != b"":
+				pass
+		except ConnectionResetError:
+			pass
+		elapsed = time.monotonic() - start
+	check(results, "responder: stops after the duration and grace time", 0.5 <= elapsed < 0.5 + tcpprobe.REQUEST_GRACE + 1.0, \
+			"{:.1f} s".format(elapsed))
+
+	# the command line, as run by the network tests
+	ps = subprocess.run([sys.executable, TCPPROBE, "-p", str(LOOPBACK_PORT), "-P", "2", "-t", "1", "-i", "0.5", LOOPBACK_ADDRESS], \
+			stdout=subprocess.PIPE)
+	cli = json.loads(ps.stdout) if ps.returncode == 0 else None
+	check(results, "command line: JSON results", cli is not None and cli["streams"] == 2 and len(cli["samples"]) == 4, ps.returncode)
+	ps = subprocess.run([sys.executable, TCPPROBE, "-p", str(LOOPBACK_PORT + 1), "-t", "1", LOOPBACK_ADDRESS], stdout=subprocess.PIPE)
+	check(results, "command line: failed test exits with 1", ps.returncode == 1, ps.returncode)
+
+	# the responder as a daemon
+	pidfile = os.path.join(tempfile.mkdtemp(), "tcpprobe.pid")
+	ps = subprocess.run([sys.executable, TCPPROBE, "-s", "-D", "-B", LOOPBACK_ADDRESS, "-p", str(LOOPBACK_PORT + 2), "--pidfile", pidfile])
+	try:
+		wait_for_responder(LOOPBACK_ADDRESS, LOOPBACK_PORT + 2)
+		with open(pidfile, "r") as f:
+			pid = int(f.read())
+		r = asyncio.run(tcpprobe.measure(LOOPBACK_ADDRESS, 1, 1.0, interval, LOOPBACK_PORT + 2))
+		check(results, "daemon: responder detaches and serves tests", ps.returncode == 0 and tcpprobe.succeeded(r), pid)
+		os.kill(pid, 15)
+	except (OSError, ValueError, RuntimeError) as e:
+		check(results, "daemon: responder detaches and serves tests", False, e)
+	return results
+
+def shape(namespace, link, rate_mbit, action = "add"):
+	cmd = ["tc", "qdisc", action, "dev", link, "root", "tbf", "rate", "{}mbit".format(rate_mbit), "burst", "32kbit", "latency", "50ms"]
+	if namespace is not None:
+		cmd = ["ip", "netns", "exec", namespace] + cmd
+	subprocess.run(cmd, check=True)
+
+def run_veth_checks(namespace, client_link, server_link, duration):
+	results = []
+	r = asyncio.run(tcpprobe.measure(SERVER_ADDRESS, 2, duration, 0.5))
+	check(results, "veth: test succeeded", tcpprobe.succeeded(r) and len(r["errors"]) == 0, r["errors"])
+	for (name, bps) in (("download", r["rx_bps"]), ("upload", r["tx_bps"])):
+		check(results, "veth: {} rate matches the shaped rate".format(name), 0.85 * SHAPED_RATE_MBIT < bps / 1e6 < 1.1 * SHAPED_RATE_MBIT, \
+				"{:.1f} Mbps, shaped to {}".format(bps / 1e6, SHAPED_RATE_MBIT))
+
+	# the download is shaped to a lower rate for one second in the middle of the test
+	timers = [threading.Timer(duration / 2 - 0.5, shape, (namespace, server_link, DIP_RATE_MBIT, "change")), \
+		threading.Timer(duration / 2 + 0.5, shape, (namespace, server_link, SHAPED_RATE_MBIT, "change"))]
+	for timer in timers:
+		timer.start()
+	r = asyncio.run(tcpprobe.measure(SERVER_ADDRESS, 1, duration, 0.25))
+	for timer in timers:
+		timer.join()
+	rx_samples = [s[1] / 1e6 for s in r["samples"] if s[1] is not None]
+	check(results, "veth: the rate drop shows in the interval samples", min(rx_samples) < 0.5 * median(rx_samples) \
+			and r["rx_bps"] / 1e6 > 0.5 * median(rx_samples), "lowest {:.1f}, median {:.1f}, average {:.1f} Mbps".format( \
+			min(rx_samples), median(rx_samples), r["rx_bps"] / 1e6))
+	return results
+
+def veth_checks(duration):
+	# runs the veth checks against a responder in a temporary network namespace
+	namespace = "nstcpp{}".format(os.getpid())
+	client_link = "vtcpp{}".format(os.getpid() % 100000)
+	server_link = client_link + "s"
+	subprocess.run(["ip", "netns", "add", namespace], check=True)
+	responder_ps = None
+	try:
+		for cmd in (["ip", "link", "add", client_link, "type", "veth", "peer", "name", server_link], \
+				["ip", "link", "set", server_link, "netns", namespace], \
+				["ip", "addr", "add", CLIENT_ADDRESS + "/30", "dev", client_link], \
+				["ip", "link", "set", client_link, "up"], \
+				["ip", "netns", "exec", namespace, "ip", "addr", "add", SERVER_ADDRESS + "/30", "dev", server_link], \
+				["ip", "netns", "exec", namespace, "ip", "link", "set", server_link, "up"], \
+				["ip", "netns", "exec", namespace, "ip", "link", "set", "lo", "up"]):
+			subprocess.run(cmd, check=True)
+		shape(None, client_link, SHAPED_RATE_MBIT)
+		shape(namespace, server_link, SHAPED_RATE_MBIT)
+		# the responder listens on all addresses of its namespace, as configure_interfaces.py starts it
+		responder_ps = subprocess.Popen(["ip", "netns", "exec", namespace, sys.executable, TCPPROBE, "-s"])
+		wait_for_responder(SERVER_ADDRESS, tcpprobe.TCPPROBE_PORT, responder_ps)
+		return run_veth_checks(namespace, client_link, server_link, duration)
+	finally:
+		if responder_ps is not None:
+			responder_ps.terminate()
+			responder_ps.wait()
+		subprocess.run(["ip", "link", "delete", client_link], stderr=subprocess.DEVNULL)
+		subprocess.run(["ip", "netns", "delete", namespace])
+
+def timed(operation):
+	# returns (result, CPU seconds) of the operation, including its child processes
+	cpu_start = time.process_time()
+	children_start = os.times()
+	result = operation()
+	children_end = os.times()
+	return (result, time.process_time() - cpu_start + (children_end.children_user - children_start.children_user) \
+			+ (children_end.children_system - children_start.children_system))
+
+def iperf3_test(duration, streams):
+	ps = subprocess.run(["iperf3", "-c", LOOPBACK_ADDRESS, "-t", str(duration), "-P", str(streams), "--json"], stdout=subprocess.PIPE)
+	end = json.loads(ps.stdout)["end"]
+	return (end["sum_received"]["bits_per_second"], end["sum_received"]["bytes"])
+
+def run_benchmark(duration):
+	# the client's CPU time; the responder (and the iperf3 server) run in other processes
+	print("")
+	print("{:<28} {:>12} {:>14}".format("Client (loopback, upload)", "Mbps", "CPU s per GB"))
+	for streams in (1, 4):
+		(r, cpu) = timed(lambda: asyncio.run(tcpprobe.run_phase("upload", (LOOPBACK_ADDRESS, LOOPBACK_PORT), socket.AF_INET, \
+				streams, duration, 0.5, [bytearray(os.urandom(tcpprobe.SEND_BUFFER_SIZE))])))
+		(bytes_transferred, retransmits, elapsed, samples, errors) = r
+		print("{:<28} {:>12.0f} {:>14.3f}".format("tcpprobe, {} stream{}".format(streams, "s" if streams > 1 else ""), \
+				bytes_transferred * 8.0 / elapsed / 1e6, cpu / (bytes_transferred / 1e9)))
+	if shutil.which("iperf3") is None:
+		print("iperf3 is not installed, no comparison")
+		return
+	server_ps = subprocess.Popen(["iperf3", "-s", "-B", LOOPBACK_ADDRESS], stdout=subprocess.DEVNULL)
+	try:
+		wait_for_responder(LOOPBACK_ADDRESS, 5201, server_ps)
+		for streams in (1, 4):
+			((bps, received), cpu) = timed(lambda: iperf3_test(duration, streams))
+			print("{:<28} {:>12.0f} {:>14.3f}".format("iperf3, {} stream{}".format(streams, "s" if streams > 1 else ""), \
+					bps / 1e6, cpu / (received / 1e9)))
+	finally:
+		server_ps.terminate()
+		server_ps.wait()
+
+def main():
+	duration = 3.0
+	try:
+		options, remainder = getopt.getopt(sys.argv[1:], "t:", ["duration="])
+	except getopt.error as err:
+		print(str(err))
+		sys.exit(2)
+	for opt, arg in options:
+		if opt in ("-t", "--duration"):
+			duration = max(float(arg),2.0)
+
+	responder_ps = subprocess.Popen([sys.executable, TCPPROBE, "-s", "-B", LOOPBACK_ADDRESS, "-p", str(LOOPBACK_PORT)])
+	try:
+		wait_for_responder(LOOPBACK_ADDRESS, LOOPBACK_PORT, responder_ps)
+		results = run_loopback_checks(duration)
+		if os.geteuid() == 0 and shutil.which("tc") is not None:
+			results += veth_checks(duration)
+		else:
+			print("The veth checks need root and tc, skipped.")
+		passed = summary(results)
+		run_benchmark(duration)
+	finally:
+		responder_ps.terminate()
+		responder_ps.wait()
+	if not passed:
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
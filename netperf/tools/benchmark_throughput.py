@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# Checks and benchmark of the native throughput test (throughput.py) against a local HTTP server. The server runs
+# in a temporary network namespace connected by a veth pair, so that the test traffic crosses an interface
+# whose counters the test samples (loopback traffic is not counted). The server:
+#	GET /download		a body of <size> bytes (query parameter size, default 1 GB)
+#	GET /missing		404
+#	POST /upload		reads and discards the body
+#	GET /stats		JSON: the upload bytes received and the download requests served since the last
+#				stats request
+#
+# The checks cover the byte budget, the wire measurement (counters versus payload), the results of the upload
+# as seen by the server and the failures (HTTP error, no server). The benchmark then compares the rate and the
+# CPU time per GB of the native test with a download by urllib.request, which allocates a new bytes object for
+# each read. The veth pair is not a real link: the rates show the cost of the clients, not of a network.
+#
+# Must be run as root.
+# usage: benchmark_throughput.py [-t <duration seconds>]
+
+import os
+import sys
+import json
+import time
+import getopt
+import asyncio
+import subprocess
+import urllib.request
+
+NETPERF_PATH = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(1, NETPERF_PATH)
+
+import throughput
+from harness import check, summary
+
+CLIENT_ADDRESS = "10.201.0.1"
+SERVER_ADDRESS = "10.201.0.2"
+SERVER_PORT = 8080
+CHUNK_SIZE = 262144
+
+def serve(address, port):
+	# the HTTP server, run in the server namespace by --serve
+	import socketserver
+	import http.server
+	import urllib.parse
+	chunk = bytes(os.urandom(CHUNK_SIZE))
+	uploaded = [0]
+	downloads = [0]
+	class handler(http.server.BaseHTTPRequestHandler):
+		def do_GET(self):
+			url = urllib.parse.urlsplit(self.path)
+			if url.path == "/stats":
+				body = json.dumps({ "uploaded" : uploaded[0], "downloads" : downloads[0] }).encode()
+				uploaded[0] = 0
+				downloads[0] = 0
+			elif url.path == "/download":
+				size = int(urllib.parse.parse_qs(url.query).get("size", ["1000000000"])[0])
+				downloads[0] += 1
+				self.send_response(200)
+				self.send_header("Content-Length", str(size))
+				self.end_headers()
+				try:
+					while size > 0:
+						count = min(size, len(chunk))
+						self.wfile.write(chunk[:count] if count < len(chunk) else chunk)
+						size -= count
+				except OSError:
+					pass
+				return
+			else:
+				self.send_error(404)
+				return
+			self.send_response(200)
+			self.send_header("Content-Length", str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def do_POST(self):
+			if urllib.parse.urlsplit(self.path).path != "/upload":
+				self.send_error(404)
+				return
+			size = int(self.headers.get("Content-Length", "0"))
+			buffer = bytearray(CHUNK_SIZE)
+			while size > 0:
+				# the client resets its connections at the end of a phase
+				try:
+					with memoryview(buffer) as view:
+						count = self.rfile.readinto(view[:min(size, len(buffer))])
+				except OSError:
+					return
+				if not count:
+					return
+				uploaded[0] += count
+				size -= count
+			self.send_response(200)
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+
+		def log_message(self, format, *args):
+			pass
+	socketserver.ThreadingTCPServer.allow_reuse_address = True
+	socketserver.ThreadingTCPServer.daemon_threads = True
+	with socketserver.ThreadingTCPServer((address, port), handler) as server:
+		server.serve_forever()
+
+def server_stats():
+	with urllib.request.urlopen("http://{}:{}/stats".format(SERVER_ADDRESS, SERVER_PORT), timeout=5) as response:
+		return json.load(response)
+
+def urllib_download(url, duration):
+	# downloads with urllib.request for <duration> seconds, returns (payload bytes, elapsed seconds)
+	received = 0
+	start = time.monotonic()
+	with urllib.request.urlopen(url, timeout=5) as response:
+		while time.monotonic() - start < duration:
+			data = response.read(CHUNK_SIZE)
+			if not data:
+				break
+			received += len(data)
+	return (received, time.monotonic() - start)
+
+def timed(operation):
+	# returns (result, CPU seconds) of the operation
+	cpu_start = time.process_time()
+	result = operation()
+	return (result, time.process_time() - cpu_start)
+
+def run_checks(duration):
+	results = []
+	url = "http://{}:{}".format(SERVER_ADDRESS, SERVER_PORT)
+	server_stats()
+
+	# byte budget: both phases stop at the budget, well before the duration
+	budget = 20000000
+	start = time.monotonic()
+	r = asyncio.run(throughput.measure(url + "/download", url + "/upload", 4, 30.0, budget))
+	elapsed = time.monotonic() - start
+	check(results, "budget: test succeeded", throughput.succeeded(r), json.dumps(r["download"]["errors"] + r["upload"]["errors"]))
+	check(results, "budget: stops before the duration", elapsed < 20.0, "{:.1f} s".format(elapsed))
+	# the data received but not read yet counts against the budget, the payload read may be less than the budget
+	check(results, "budget: download payload within budget", 0 < r["download"]["payload_bytes"] <= budget + 4 * throughput.RECEIVE_BUFFER_SIZE, \
+			r["download"]["payload_bytes"])
+	# the connections are reset at the budget; what arrives until then depends on the rate (tens of Gbps here)
+	check(results, "budget: download stops near the budget on the wire", r["download"]["bytes"] < 1.5 * budget, \
+			"{:.2f} x budget".format(r["download"]["bytes"] / budget))
+	check(results, "budget: upload payload equals budget", r["upload"]["payload_bytes"] == budget, r["upload"]["payload_bytes"])
+	uploaded = server_stats()["uploaded"]
+	check(results, "budget: server received the upload", uploaded == budget, uploaded)
+	check(results, "wire: download bytes include the protocol overhead", r["download"]["bytes"] >= r["download"]["payload_bytes"], \
+			"{} >= {}".format(r["download"]["bytes"], r["download"]["payload_bytes"]))
+	check(results, "wire: upload bytes include the protocol overhead", r["upload"]["bytes"] >= r["upload"]["payload_bytes"], \
+			"{} >= {}".format(r["upload"]["bytes"], r["upload"]["payload_bytes"]))
+	check(results, "wire: test volume covers both phases", r["rx_bytes"] >= r["download"]["bytes"] and r["tx_bytes"] >= r["upload"]["bytes"], \
+			"rx {} tx {}".format(r["rx_bytes"], r["tx_bytes"]))
+	# at the end of the download the receive buffers of the connections may hold data not read yet
+	with open("/proc/sys/net/ipv4/tcp_rmem", "r") as f:
+		max_receive_buffer = int(f.read().split()[2])
+	check(results, "wire: overhead is plausible", r["download"]["bytes"] < 1.1 * r["download"]["payload_bytes"] + 4 * max_receive_buffer, \
+			"{:.3f}".format(r["download"]["bytes"] / r["download"]["payload_bytes"]))
+	check(results, "ping: connect time measured", r["ping"] is not None and r["ping"] > 0, r["ping"])
+	check(results, "server: download host and url", r["server"] == { "host" : SERVER_ADDRESS, "url" : url + "/download" }, r["server"])
+
+	# duration: unlimited budget, the phases last the duration
+	r = asyncio.run(throughput.measure(url + "/download", url + "/upload", 2, duration, 0))
+	check(results, "duration: test succeeded", throughput.succeeded(r))
+	for phase in ("download", "upload"):
+		check(results, "duration: {} lasts the duration".format(phase), duration <= r[phase]["elapsed"] < duration + 1.0, \
+				r[phase]["elapsed"])
+		check(results, "duration: {} wire rate close to payload rate".format(phase), \
+				0.8 * r[phase]["payload_bps"] < r[phase]["bps"] < 1.3 * r[phase]["payload_bps"], \
+				"{:.0f} / {:.0f} Mbps".format(r[phase]["bps"] / 1e6, r[phase]["payload_bps"] / 1e6))
+	server_stats()
+
+	# short responses: each connection makes several requests
+	r = asyncio.run(throughput.measure(url + "/download?size=1000000", url + "/upload", 2, 2.0, 30000000))
+	downloads = server_stats()["downloads"]
+	check(results, "requests: short responses are repeated", throughput.succeeded(r) and len(r["download"]["errors"]) == 0 \
+			and downloads >= 30, "{} requests".format(downloads))
+
+	# failures
+	r = asyncio.run(throughput.measure(url + "/missing", url + "/upload", 2, 2.0, 1000000))
+	check(results, "failure: HTTP error fails the download", not throughput.succeeded(r) and r["download"]["payload_bytes"] == 0 \
+			and "404" in " ".join(r["download"]["errors"]), r["download"]["errors"])
+	server_stats()
+	r = asyncio.run(throughput.measure("http://{}:{}/download".format(SERVER_ADDRESS, SERVER_PORT + 1), url + "/upload", 2, 2.0, 1000000))
+	check(results, "failure: refused connection fails the download", not throughput.succeeded(r) and len(r["download"]["errors"]) > 0, \
+			r["download"]["errors"])
+	server_stats()
+	try:
+		asyncio.run(throughput.measure("https://{}/download".format(SERVER_ADDRESS), url + "/upload", 1, 2.0, 1000000))
+		check(results, "failure: https is rejected", False)
+	except ValueError as e:
+		check(results, "failure: https is rejected", True, e)
+
+	# the command line, as run by the network tests
+	ps = subprocess.run([sys.executable, os.path.join(NETPERF_PATH, "throughput.py"), "-d", url + "/download", "-u", url + "/upload", \
+			"-c", "2", "-t", "2", "-b", "5000000"], stdout=subprocess.PIPE)
+	cli = json.loads(ps.stdout) if ps.returncode == 0 else None
+	check(results, "command line: JSON results", cli is not None and cli["upload"]["payload_bytes"] == 5000000, ps.returncode)
+	server_stats()
+	ps = subprocess.run([sys.executable, os.path.join(NETPERF_PATH, "throughput.py"), "-d", url + "/missing", "-u", url + "/upload", \
+			"-c", "1", "-t", "2"], stdout=subprocess.PIPE)
+	check(results, "command line: failed test exits with 1", ps.returncode == 1, ps.returncode)
+	server_stats()
+	return results
+
+def native_download(url, connections, duration):
+	# runs the download phase of the native test alone
+	counters = throughput.interface_counters()
+	try:
+		return asyncio.run(throughput.run_phase("download", url, connections, duration, 0, counters, \
+				[bytearray(throughput.RECEIVE_BUFFER_SIZE) for i in range(connections)]))
+	finally:
+		counters.close()
+
+def run_benchmark(duration):
+	url = "http://{}:{}".format(SERVER_ADDRESS, SERVER_PORT)
+	print("")
+	print("{:<28} {:>12} {:>12} {:>14}".format("Download client", "Mbps (wire)", "Mbps (data)", "CPU s per GB"))
+	for connections in (1, 4):
+		(r, cpu) = timed(lambda: native_download(url + "/download", connections, duration))
+		print("{:<28} {:>12.0f} {:>12.0f} {:>14.3f}".format("native, {} connection{}".format(connections, "s" if connections > 1 else ""), \
+				r["bps"] / 1e6, r["payload_bps"] / 1e6, cpu / (r["payload_bytes"] / 1e9)))
+	((received, elapsed), cpu) = timed(lambda: urllib_download(url + "/download", duration))
+	print("{:<28} {:>12} {:>12.0f} {:>14.3f}".format("urllib.request, 1 connection", "--", received * 8.0 / elapsed / 1e6, \
+			cpu / (received / 1e9)))
+
+def main():
+	duration = 3.0
+	try:
+		options, remainder = getopt.getopt(sys.argv[1:], "t:", ["duration=", "serve="])
+	except getopt.error as err:
+		print(str(err))
+		sys.exit(2)
+	for opt, arg in options:
+		if opt in ("-t", "--duration"):
+			duration = max(float(arg),1.0)
+		elif opt == "--serve":
+			serve(arg, SERVER_PORT)
+			return
+	if os.geteuid() != 0:
+		print("The benchmark must be run as root.")
+		sys.exit(1)
+
+	namespace = "nstput{}".format(os.getpid())
+	client_link = "vtput{}".format(os.getpid() % 100000)
+	server_link = client_link + "s"
+	subprocess.run(["ip", "netns", "add", namespace], check=True)
+	server_ps = None
+	try:
+		for cmd in (["ip", "link", "add", client_link, "type", "veth", "peer", "name", server_link], \
+				["ip", "link", "set", server_link, "netns", namespace], \
+				["ip", "addr", "add", CLIENT_ADDRESS + "/30", "dev", client_link], \
+				["ip", "link", "set", client_link, "up"], \
+				["ip", "netns", "exec", namespace, "ip", "addr", "add", SERVER_ADDRESS + "/30", "dev", server_link], \
+				["ip", "netns", "exec", namespace, "ip", "link", "set", server_link, "up"], \
+				["ip", "netns", "exec", namespace, "ip", "link", "set", "lo", "up"]):
+			subprocess.run(cmd, check=True)
+		server_ps = subprocess.Popen(["ip", "netns", "exec", namespace, sys.executable, os.path.abspath(__file__), "--serve", SERVER_ADDRESS])
+		deadline = time.monotonic() + 10.0
+		while True:
+			try:
+				server_stats()
+				break
+			except OSError:
+				if server_ps.poll() is not None or time.monotonic() > deadline:
+					raise RuntimeError("the HTTP server did not start")
+				time.sleep(0.1)
+		results = run_checks(duration)
+		passed = summary(results)
+		run_benchmark(duration)
+	finally:
+		if server_ps is not None:
+			server_ps.terminate()
+			server_ps.wait()
+		subprocess.run(["ip", "link", "delete", client_link], stderr=subprocess.DEVNULL)
+		subprocess.run(["ip", "netns", "delete", namespace])
+	if not passed:
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
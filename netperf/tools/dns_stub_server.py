@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# Test harness for the DNS probe (dnsprobe.py). Runs stub DNS servers on loopback addresses (127.0.0.x), each
+# with a fixed behaviour, and checks the probe results against them:
+#	- a server that answers immediately, and one that answers after a delay (query time measurement)
+#	- NXDOMAIN (counts as working) and SERVFAIL (counts as failing) responses
+#	- a server that drops the first queries (retries with a new socket and query ID)
+#	- a silent server (per-query timeout, all attempts fail)
+#	- a server that first sends a response with the wrong query ID (must be ignored)
+#	- all servers probed concurrently: the probe takes as long as the slowest server, not the sum
+#	- the dnsprobe.py command line (as run in another network namespace)
+# With -s the stub servers are only started (until interrupted), e.g. for manual tests with dig.
+#
+# usage: dns_stub_server.py [-p <port>] [-s]
+
+import os
+import sys
+import time
+import json
+import struct
+import getopt
+import asyncio
+import subprocess
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import dnsprobe
+from harness import check, exit_status
+
+STUB_PORT = 5353
+STUB_ADDRESS = "192.0.2.1"
+
+# stub servers: address -> (behaviour, parameter)
+STUB_SERVERS = {
+	"127.0.0.2" : ("answer", 0),
+	"127.0.0.3" : ("answer", 0.2),
+	"127.0.0.4" : ("rcode", dnsprobe.DNS_RCODE_NXDOMAIN),
+	"127.0.0.5" : ("rcode", 2),
+	"127.0.0.6" : ("drop", 2),
+	"127.0.0.7" : ("silent", None),
+	"127.0.0.8" : ("wrong_id", 0.05)
+}
+
+def stub_response(query, rcode, answer):
+	# returns the response to a query: the query header with the QR and RA flags and the rcode set, the question,
+	# and an A record answer (name compressed as a pointer to the question)
+	(query_id, flags, qdcount, ancount, nscount, arcount) = dnsprobe.DNS_HEADER.unpack_from(query, 0)
+	flags = (flags & 0x7900) | dnsprobe.DNS_FLAG_QR | 0x0080 | rcode
+	question = query[dnsprobe.DNS_HEADER.size:]
+	if answer:
+		record = struct.pack("!HHHIH", 0xc000 | dnsprobe.DNS_HEADER.size, dnsprobe.DNS_QTYPE_A, dnsprobe.DNS_QCLASS_IN, 300, 4) + \
+				bytes(int(b) for b in STUB_ADDRESS.split("."))
+		return dnsprobe.DNS_HEADER.pack(query_id, flags, 1, 1, 0, 0) + question + record
+	return dnsprobe.DNS_HEADER.pack(query_id, flags, 1, 0, 0, 0) + question
+
+class stub_server(asyncio.DatagramProtocol):
+	def __init__(self, behaviour, parameter):
+		self.behaviour = behaviour
+		self.parameter = parameter
+		self.queries = 0
+		self.transport = None
+
+	def connection_made(self, transport):
+		self.transport = transport
+
+	def datagram_received(self, data, addr):
+		self.queries += 1
+		loop = asyncio.get_running_loop()
+		if self.behaviour == "answer":
+			loop.call_later(self.parameter, self.transport.sendto, stub_response(data, 0, True), addr)
+		elif self.behaviour == "rcode":
+			self.transport.sendto(stub_response(data, self.parameter, False), addr)
+		elif self.behaviour == "drop":
+			if self.queries > self.parameter:
+				self.transport.sendto(stub_response(data, 0, True), addr)
+		elif self.behaviour == "wrong_id":
+			spoofed = bytes([data[0] ^ 0xff]) + data[1:]
+			self.transport.sendto(stub_response(spoofed, 0, True), addr)
+			loop.call_later(self.parameter, self.transport.sendto, stub_response(data, 0, True), addr)
+
+async def start_servers(port):
+	loop = asyncio.get_running_loop()
+	servers = {}
+	for (address, (behaviour, parameter)) in STUB_SERVERS.items():
+		(transport, protocol) = await loop.create_datagram_endpoint(lambda: stub_server(behaviour, parameter), \
+				local_addr=(address, port))
+		servers[address] = protocol
+	return servers
+
+async def run_checks(port):
+	results = []
+	servers = await start_servers(port)
+	attempts = 3
+	timeout = 0.5
+	start = time.perf_counter()
+	probe_results = await dnsprobe.probe(list(STUB_SERVERS.keys()), attempts=attempts, timeout=timeout, port=port, \
+			internal_servers=[])
+	elapsed = time.perf_counter() - start
+	r = dict([(p["server"], p) for p in probe_results])
+
+	check(results, "answer: ok on the first attempt", r["127.0.0.2"]["ok"] and r["127.0.0.2"]["attempts"] == 1, r["127.0.0.2"])
+	check(results, "answer: query time measured", 0 < r["127.0.0.2"]["query_time_us"] < 50000, r["127.0.0.2"]["query_time_us"])
+	check(results, "delayed answer: query time of 200 ms", 195000 <= r["127.0.0.3"]["query_time_us"] < 300000, r["127.0.0.3"]["query_time_us"])
+	check(results, "NXDOMAIN: server working", r["127.0.0.4"]["ok"] and r["127.0.0.4"]["rcode"] == dnsprobe.DNS_RCODE_NXDOMAIN, r["127.0.0.4"])
+	check(results, "SERVFAIL: server failing on every attempt", not r["127.0.0.5"]["ok"] and r["127.0.0.5"]["failures"] == attempts \
+			and r["127.0.0.5"]["rcode"] == 2, r["127.0.0.5"])
+	check(results, "dropped queries: ok after retries", r["127.0.0.6"]["ok"] and r["127.0.0.6"]["attempts"] == 3 \
+			and r["127.0.0.6"]["failures"] == 2, r["127.0.0.6"])
+	check(results, "silent server: all attempts time out", not r["127.0.0.7"]["ok"] and r["127.0.0.7"]["failures"] == attempts \
+			and r["127.0.0.7"]["query_time_us"] is None, r["127.0.0.7"])
+	check(results, "silent server: one query per attempt", servers["127.0.0.7"].queries == attempts, servers["127.0.0.7"].queries)
+	check(results, "wrong query ID: response ignored", r["127.0.0.8"]["ok"] and r["127.0.0.8"]["query_time_us"] >= 45000, r["127.0.0.8"])
+	# the silent server determines the duration: attempts * timeout
+	check(results, "servers probed concurrently", elapsed < attempts * timeout + 0.3, "{:.2f} s".format(elapsed))
+
+	# summary fields of the dns message: the servers are combined as if they had been tried one after the other
+	for p in probe_results:
+		p["internal"] = p["server"] in ("127.0.0.5", "127.0.0.7", "127.0.0.8")
+	(ok, query_time, failures) = dnsprobe.summarise(probe_results, True)
+	check(results, "summary: first working server after failing ones", ok and 45 <= query_time < 150 and failures == 2 * attempts, \
+			(ok, query_time, failures))
+	(ok, query_time, failures) = dnsprobe.summarise([p for p in probe_results if p["server"] in ("127.0.0.5", "127.0.0.7")], True)
+	check(results, "summary: no working server", not ok and query_time == 0 and failures == 2 * attempts, (ok, query_time, failures))
+
+	# the command line, as run in another network namespace
+	script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dnsprobe.py")
+	process = await asyncio.create_subprocess_exec(sys.executable, script, "-e", "127.0.0.2,127.0.0.4", "-p", str(port), \
+			"-a", "1", "-t", "1", stdout=subprocess.PIPE)
+	(output, errors) = await process.communicate()
+	try:
+		cli_results = [p for p in json.loads(output) if not p["internal"]]
+	except ValueError:
+		cli_results = []
+	check(results, "command line: JSON results", [p["server"] for p in cli_results] == ["127.0.0.2", "127.0.0.4"] \
+			and all([p["ok"] for p in cli_results]), output)
+	return results
+
+async def serve(port):
+	await start_servers(port)
+	print("stub DNS servers on port {}:".format(port))
+	for (address, (behaviour, parameter)) in STUB_SERVERS.items():
+		print("    {} {} {}".format(address, behaviour, parameter))
+	await asyncio.Event().wait()
+
+def main():
+	port = STUB_PORT
+	serve_only = False
+	try:
+		options, remainder = getopt.getopt(sys.argv[1:], "p:s", ["port=", "serve"])
+	except getopt.error as err:
+		print(str(err))
+		sys.exit(2)
+	for opt, arg in options:
+		if opt in ("-p", "--port"):
+			port = int(arg)
+		elif opt in ("-s", "--serve"):
+			serve_only = True
+	if serve_only:
+		try:
+			asyncio.run(serve(port))
+		except KeyboardInterrupt:
+			pass
+		return
+	results = asyncio.run(run_checks(port))
+	exit_status(results)
+
+if __name__ == "__main__":
+	main()
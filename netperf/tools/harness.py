@@ -0,0 +1,23 @@
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# Check helpers shared by the test harnesses in this directory: each check prints a PASS/FAIL line and adds its
+# result to a list, the summary prints the number of checks passed.
+
+import sys
+
+def check(results, name, condition, detail = ""):
+	# records and prints the result of a check, followed by <detail> if the check failed
+	condition = bool(condition)
+	results.append(condition)
+	print("{:<60} {}{}".format(name, "PASS" if condition else "FAIL", "" if condition or detail == "" else " ({})".format(detail)))
+
+def summary(results):
+	# prints the number of checks passed, returns True if all of them passed
+	print("{} of {} checks passed".format(results.count(True), len(results)))
+	return all(results)
+
+def exit_status(results):
+	# prints the summary and exits with status 1 if a check failed
+	if not summary(results):
+		sys.exit(1)
@@ -4,7 +4,8 @@
 
 # This script is used to manage the scheduled tasks, including network performance tests, database pruning,
 # and report generation. The tasks are scheduled via systemd timers, each timer triggers a corresponding
-# service unit file.
+# service unit file. When the test agent is enabled (see netperf_agent.py) it schedules the network tests,
+# and only the database pruning and report generation timers are used.
 
 username=$(/opt/netperf/netperf_settings.py --get username)
 
@@ -21,7 +22,14 @@ supported commands:
 	reload   reloads the timer configuration files (used for applying changes made to the task schedules)
 	install  installs timers by creating links in /etc/systemd/user to the files in /opt/netperf/config/systemd/tasks"
 
-TASKS=( netperf-test-isp netperf-test-local netperf-test-dns netperf-test-ping netperf-prune-db netperf-report )
+TEST_TASKS=( netperf-test-isp netperf-test-local netperf-test-dns netperf-test-ping )
+agent_enabled=$(/opt/netperf/netperf_settings.py --get agent_enabled)
+if [[ "$agent_enabled" == "True" ]]; then
+	# the network tests are scheduled by the test agent (netperf-agent.service), their timers are not used
+	TASKS=( netperf-prune-db netperf-report )
+else
+	TASKS=( "${TEST_TASKS[@]}" netperf-prune-db netperf-report )
+fi
 SOURCE_DIR="/opt/netperf/config/systemd/tasks"
 TARGET_DIR="/etc/systemd/user"
 uid=$(id -u "$username")
@@ -77,6 +85,15 @@ if [[ "$command" =~ ("start"|"stop") ]]; then
 	done
 fi
 
+if [[ "$agent_enabled" == "True" && "$command" =~ ("start"|"reload") ]]; then
+	# disable the test timers of an installation that ran the tests from timers, and apply schedule changes
+	for timer in "${TEST_TASKS[@]}"; do
+		eval "${cmd_prefix} systemctl --user disable ${timer}.timer > /dev/null 2> /dev/null"
+		eval "${cmd_prefix} systemctl --user stop ${timer}.timer > /dev/null 2> /dev/null"
+	done
+	systemctl reload netperf-agent > /dev/null 2> /dev/null
+fi
+
 if [[ "$command" == "install" ]]; then
 	for task in "${TASKS[@]}"; do
 		source_unit_file="$SOURCE_DIR/${task}.service"
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# Test harness for the bandwidth monitor sampling loop (bwmonitor.py). The loop is run against a simulated
+# clock: the monotonic clock only advances when the loop sleeps or when a scenario adds processing delays, and
+# the wall clock can be stepped (as by NTP) independently of it. The interface counters are generated from
+# known traffic rates, so the readings can be checked exactly. Scenarios:
+#	- constant rate at 1 Hz and at 10 Hz sampling
+#	- counter wrap-around (32 bit counters)
+#	- wall clock steps backwards and forwards
+#	- a stalled queue write, causing missed ticks
+#	- a full database queue (readings are dropped, the sampling cadence is kept)
+#	- a short traffic burst, which must show up in the peak rate of the 10 Hz readings
+#	- no drift of the tick deadlines over a long run with varying processing time
+#	- the shared memory ring (bwring.py): readers, and a writer that dies while appending a reading
+#
+# usage: simulate_bwmonitor.py [-v]
+#        -v prints each reading
+
+import os
+import sys
+import getopt
+import random
+import tempfile
+import posix_ipc
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bwmonitor import bandwidth_sampler, tick_scheduler, sampling_loop
+from bwring import bandwidth_ring_writer, bandwidth_ring_reader, RING_COLUMNS, RING_COUNTER, RING_SEQUENCE_OFFSET
+from harness import check, exit_status
+
+NS = 1000000000
+MAXUINT32 = 2 ** 32 - 1
+VERBOSE = False
+
+class simulation_end(Exception):
+	pass
+
+class simulated_clock:
+	# monotonic clock in nanoseconds and a wall clock that can be stepped; sleeping advances both
+	def __init__(self, end_ns, wall_offset = 1.7e9):
+		self.now_ns = 0
+		self.end_ns = end_ns
+		self.wall_offset = wall_offset
+		self.sleeps = []
+
+	def monotonic_ns(self):
+		return self.now_ns
+
+	def wall_time(self):
+		return self.wall_offset + self.now_ns / NS
+
+	def advance(self, ns):
+		self.now_ns += int(ns)
+
+	def sleep(self, seconds):
+		self.sleeps.append(seconds)
+		self.advance(seconds * NS)
+		if self.now_ns >= self.end_ns:
+			raise simulation_end()
+
+class simulated_counters:
+	# interface byte counters generated from a traffic rate function rate(t) (bytes per second at monotonic
+	# time t seconds), integrated in 1 ms steps. Counters wrap at max_counter.
+	def __init__(self, clock, interfaces, rate, start_bytes = 0, max_counter = 2 ** 64 - 1):
+		self.clock = clock
+		self.interfaces = interfaces
+		self.rate = rate
+		self.max_counter = max_counter
+		self.total_bytes = start_bytes
+		self.total_ns = 0
+		self.reads = 0
+
+	def read(self):
+		while self.total_ns < self.clock.now_ns:
+			step = min(1000000, self.clock.now_ns - self.total_ns)
+			self.total_bytes += self.rate(self.total_ns / NS) * step / NS
+			self.total_ns += step
+		self.reads += 1
+		value = int(round(self.total_bytes)) % (self.max_counter + 1)
+		# the transmit counter carries half of the receive traffic
+		tx_value = int(round(self.total_bytes / 2)) % (self.max_counter + 1)
+		return dict([(i, (value, tx_value)) for i in self.interfaces])
+
+class simulated_queue:
+	# database queue: records the messages, raises BusyError like a full posix_ipc queue while full() is true
+	def __init__(self, clock, full = lambda t: False, write_delay = lambda t: 0):
+		self.clock = clock
+		self.full = full
+		self.write_delay = write_delay
+		self.messages = []
+		self.dropped = 0
+
+	def write(self, message, timeout = None):
+		t = self.clock.now_ns / NS
+		self.clock.advance(self.write_delay(t) * NS)
+		if self.full(t):
+			if timeout is None:
+				raise RuntimeError("the sampling loop blocked on a full queue")
+			self.dropped += 1
+			raise posix_ipc.BusyError("queue full")
+		self.messages.append(message)
+
+def run(seconds, rate, sample_rate = 1, interfaces = ["eth0"], start_bytes = 0, max_counter = 2 ** 64 - 1, \
+		full = lambda t: False, write_delay = lambda t: 0, processing = lambda t: 0, wall_steps = []):
+	# runs the sampling loop for <seconds> simulated seconds, returns (messages, clock, queue, scheduler)
+	clock = simulated_clock(seconds * NS)
+	counters = simulated_counters(clock, interfaces, rate, start_bytes, max_counter)
+	queue = simulated_queue(clock, full, write_delay)
+	scheduler = tick_scheduler(NS // sample_rate, clock.monotonic_ns, clock.sleep)
+	sampler = bandwidth_sampler("simulation", interfaces, sample_rate, max_counter)
+	read = counters.read
+
+	def read_counters():
+		# processing time before the counters are read, and wall clock steps
+		t = clock.now_ns / NS
+		clock.advance(processing(t) * NS)
+		for (step_time, step) in wall_steps:
+			if t <= step_time < t + 1.0 / sample_rate:
+				clock.wall_offset += step
+		return read()
+	counters.read = read_counters
+	try:
+		sampling_loop(counters, sampler, scheduler, queue, clock.wall_time)
+	except simulation_end:
+		pass
+	if VERBOSE:
+		for m in queue.messages:
+			print("    {}".format(m["data"]))
+	return (queue.messages, clock, queue, scheduler)
+
+def close(a, b, tolerance = 1e-6):
+	return abs(a - b) <= tolerance * max(abs(a), abs(b), 1.0)
+
+def scenario_constant_rate(results):
+	for sample_rate in (1, 10):
+		(messages, clock, queue, scheduler) = run(30, lambda t: 125000.0, sample_rate = sample_rate)
+		rates = [m["data"]["rx_bps"] for m in messages]
+		check(results, "constant rate, {} Hz: one reading per second".format(sample_rate), len(messages) in (29, 30), len(messages))
+		check(results, "constant rate, {} Hz: rx_bps = 1 Mbps".format(sample_rate), all([close(r, 1e6, 1e-3) for r in rates]), rates[:3])
+		check(results, "constant rate, {} Hz: tx_bps = 0.5 Mbps".format(sample_rate), \
+				all([close(m["data"]["tx_bps"], 5e5, 1e-3) for m in messages]))
+		if sample_rate > 1:
+			check(results, "constant rate, 10 Hz: 10 samples per reading", all([m["data"]["sample_count"] == 10 for m in messages]))
+
+def scenario_counter_wrap(results):
+	# 32 bit counters that wrap several times during the run (10 MB/s, about 7 minutes per wrap)
+	(messages, clock, queue, scheduler) = run(900, lambda t: 1e7, start_bytes = MAXUINT32 - 5e7, max_counter = MAXUINT32)
+	rates = [m["data"]["rx_bps"] for m in messages]
+	check(results, "32 bit counter wrap: rates unaffected", all([close(r, 8e7, 1e-3) for r in rates]), min(rates))
+	check(results, "32 bit counter wrap: bytes per reading", all([abs(m["data"]["rx_bytes"] - 1e7) <= 1 for m in messages]))
+
+def scenario_wall_clock_steps(results):
+	steps = [(10.5, -3600.0), (20.5, 7.0)]
+	(messages, clock, queue, scheduler) = run(30, lambda t: 125000.0, wall_steps = steps)
+	rates = [m["data"]["rx_bps"] for m in messages]
+	check(results, "wall clock steps: rates unaffected", all([close(r, 1e6, 1e-3) for r in rates]), rates)
+	timestamps = [m["data"]["timestamp"] for m in messages]
+	deltas = [round(b - a, 3) for (a, b) in zip(timestamps, timestamps[1:])]
+	check(results, "wall clock steps: timestamps follow the wall clock", -3599.0 in deltas and 8.0 in deltas, deltas)
+	check(results, "wall clock steps: no missed readings", len(messages) in (29, 30), len(messages))
+
+def scenario_stalled_write(results):
+	# one queue write takes 3.4 seconds
+	stalled = [False]
+
+	def write_delay(t):
+		if t >= 10 and not stalled[0]:
+			stalled[0] = True
+			return 3.4
+		return 0
+	(messages, clock, queue, scheduler) = run(30, lambda t: 125000.0, sample_rate = 10, write_delay = write_delay)
+	rates = [m["data"]["rx_bps"] for m in messages]
+	check(results, "stalled write: rates computed over the real interval", all([close(r, 1e6, 1e-3) for r in rates]), rates)
+	counts = [m["data"]["sample_count"] for m in messages]
+	check(results, "stalled write: missed ticks reduce the sample count", min(counts) < 10 and counts.count(10) >= len(counts) - 2, counts)
+	check(results, "stalled write: readings resume on schedule", len(messages) >= 26, len(messages))
+	total_bytes = sum([m["data"]["rx_bytes"] for m in messages])
+	check(results, "stalled write: no bytes lost", abs(total_bytes - 125000.0 * (messages[-1]["data"]["timestamp"] - messages[0]["data"]["timestamp"] + 1)) < 200, total_bytes)
+
+def scenario_full_queue(results):
+	(messages, clock, queue, scheduler) = run(30, lambda t: 125000.0, full = lambda t: 10 <= t < 20)
+	check(results, "full queue: readings dropped, loop not blocked", queue.dropped in (9, 10, 11) and len(messages) >= 18, \
+			"{} dropped, {} sent".format(queue.dropped, len(messages)))
+	check(results, "full queue: sampling cadence kept", all([s > 0.99 for s in clock.sleeps]), min(clock.sleeps))
+
+def scenario_burst(results):
+	# 200 ms burst at 100 Mbps on top of 1 Mbps
+	rate = lambda t: 12.5e6 if 5.2 <= t < 5.4 else 125000.0
+	(messages, clock, queue, scheduler) = run(10, rate, sample_rate = 10)
+	burst = [m["data"] for m in messages if m["data"]["rx_bps_max"] > 2e6]
+	check(results, "burst: shows up in the peak rate of one reading", len(burst) == 1 and close(burst[0]["rx_bps_max"], 1e8, 1e-2), burst)
+	if len(burst) == 1:
+		check(results, "burst: mean rate of the reading", close(burst[0]["rx_bps"], 0.8 * 1e6 + 0.2 * 1e8, 1e-2), burst[0]["rx_bps"])
+
+def scenario_drift(results):
+	# processing time of up to 300 ms per tick must not delay later ticks
+	random.seed(1)
+	(messages, clock, queue, scheduler) = run(3600, lambda t: 125000.0, processing = lambda t: random.uniform(0, 0.3))
+	deadline_error = clock.now_ns - scheduler.deadline(scheduler.tick)
+	check(results, "drift: last tick on its absolute deadline", deadline_error == 0, deadline_error)
+	check(results, "drift: one reading per second for an hour", len(messages) in (3598, 3599, 3600), len(messages))
+
+def scenario_ring(results):
+	ring_filename = os.path.join(tempfile.mkdtemp(), "ring")
+	writer = bandwidth_ring_writer(60, ring_filename)
+	reader = bandwidth_ring_reader(ring_filename)
+	for i in range(100):
+		writer.append(dict([(c, float(i)) for c in RING_COLUMNS]))
+	result = reader.read()
+	check(results, "ring: read returns the last <capacity> readings", result is not None and result[1] == 100 and \
+			result[0]["timestamp"].tolist() == [float(i) for i in range(40, 100)], None if result is None else result[1])
+	# the writer dies after making the sequence counter odd, before the reading is complete
+	RING_COUNTER.pack_into(writer.mm, RING_SEQUENCE_OFFSET, writer.sequence + 1)
+	check(results, "ring: read returns None after the writer died in append", reader.read() is None)
+	check(results, "ring: snapshot returns None after the writer died in append", reader.snapshot() is None)
+	check(results, "ring: recent returns None after the writer died in append", reader.recent(60) is None)
+	# a restarted writer replaces the ring
+	writer = bandwidth_ring_writer(60, ring_filename)
+	writer.append(dict([(c, 1.0) for c in RING_COLUMNS]))
+	result = reader.read()
+	check(results, "ring: the ring of a restarted writer is read", result is not None and result[1] == 1, None if result is None else result[1])
+	os.remove(ring_filename)
+	os.rmdir(os.path.dirname(ring_filename))
+
+def main():
+	global VERBOSE
+	try:
+		options, remainder = getopt.getopt(sys.argv[1:], "v", ["verbose"])
+	except getopt.error as err:
+		print(str(err))
+		sys.exit(2)
+	for opt, arg in options:
+		if opt in ("-v", "--verbose"):
+			VERBOSE = True
+	results = []
+	scenario_constant_rate(results)
+	scenario_counter_wrap(results)
+	scenario_wall_clock_steps(results)
+	scenario_stalled_write(results)
+	scenario_full_queue(results)
+	scenario_burst(results)
+	scenario_drift(results)
+	scenario_ring(results)
+	exit_status(results)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# Test harness for the speedtest server selection (speedtest_servers.py). A local HTTP server stands in for the
+# speedtest.net server list, and the servers of the list point to local TCP listeners:
+#	- the server list is downloaded once, then read from the cache while it is younger than the TTL
+#	- an expired cache is refreshed with a conditional request: 304 keeps the cached list, a changed list
+#	  is downloaded again
+#	- HTTP errors and lists that cannot be parsed: the cached list is used, without a cache an error is raised
+#	- a large list is parsed as it is received
+#	- ranking: servers that refuse connections, cannot be resolved or do not answer (a listener whose accept
+#	  queue stays full) are left out, the others are ordered by connect time (a listener whose full accept
+#	  queue is drained after a delay is slow), only the candidates are probed, each <attempts> times, all
+#	  servers concurrently
+#	- the shortlist file and the server id used by the speedtest (netperf_settings.get_speedtest_server_id)
+#	- the speedtest_servers.py command line (as run in another network namespace)
+#
+# usage: speedtest_server_stub.py
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import asyncio
+import tempfile
+import threading
+import subprocess
+import http.server
+from xml.sax.saxutils import quoteattr
+
+NETPERF_PATH = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(1, NETPERF_PATH)
+
+import speedtest_servers
+from netperf_settings import netperf_settings
+from harness import check, exit_status
+
+class server_list_handler(http.server.BaseHTTPRequestHandler):
+	# serves the server list of the stub at /servers.xml, /broken.xml and /error
+	def do_GET(self):
+		stub = self.server.stub
+		stub.requests += 1
+		if self.path == "/error":
+			self.send_error(500)
+			return
+		if self.path == "/broken.xml":
+			body = b"<settings><servers><server id=\"1\" host=\"a:1\"></servers>"
+		else:
+			etag = "\"v{}\"".format(stub.version)
+			if self.headers.get("If-None-Match", None) == etag:
+				stub.not_modified += 1
+				self.send_response(304)
+				self.end_headers()
+				return
+			body = stub.server_list()
+		stub.downloads += 1
+		self.send_response(200)
+		self.send_header("Content-Type", "text/xml")
+		self.send_header("Content-Length", str(len(body)))
+		if self.path != "/broken.xml":
+			self.send_header("ETag", etag)
+			self.send_header("Last-Modified", "Mon, 01 Jan 2024 00:00:00 GMT")
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+class server_list_stub:
+	def __init__(self):
+		self.servers = []
+		self.version = 1
+		self.requests = 0
+		self.downloads = 0
+		self.not_modified = 0
+		self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), server_list_handler)
+		self.httpd.stub = self
+		self.url = "http://127.0.0.1:{}".format(self.httpd.server_address[1])
+		threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+	def server_list(self):
+		lines = ["<?xml version=\"1.0\" encoding=\"UTF-8\"?>", "<settings>", "<servers>"]
+		for s in self.servers:
+			lines.append("<server {} />".format(" ".join(["{}={}".format(a, quoteattr(str(s.get(a, "")))) \
+					for a in speedtest_servers.SERVER_ATTRIBUTES])))
+		lines += ["</servers>", "</settings>"]
+		return "\n".join(lines).encode()
+
+	def close(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
+
+class tcp_listener:
+	# accepts and closes connections, counting them. A slow listener starts with a full accept queue, which is
+	# drained after <delay> seconds: connections made before then are established by a SYN retransmission.
+	def __init__(self, address, delay = 0):
+		self.sock = socket.socket()
+		self.sock.bind((address, 0))
+		self.sock.listen(0 if delay > 0 else 16)
+		self.host = "{}:{}".format(address, self.sock.getsockname()[1])
+		self.connections = 0
+		self.filler = None
+		if delay > 0:
+			self.filler = socket.create_connection(self.sock.getsockname())
+		self.delay = delay
+		threading.Thread(target=self.accept, daemon=True).start()
+
+	def accept(self):
+		time.sleep(self.delay)
+		while True:
+			try:
+				(conn, addr) = self.sock.accept()
+			except OSError:
+				return
+			if self.filler is not None and addr == self.filler.getsockname():
+				self.filler.close()
+				self.filler = None
+			else:
+				self.connections += 1
+			conn.close()
+
+	def close(self):
+		self.sock.close()
+
+def server_entry(server_id, host):
+	return { "id" : str(server_id), "name" : "City {}".format(server_id), "host" : host, "sponsor" : "Sponsor {}".format(server_id), \
+			"country" : "Country", "cc" : "CC", "url" : "http://{}/speedtest/upload.php".format(host), "lat" : "1.0", "lon" : "2.0" }
+
+def closed_port(address):
+	sock = socket.socket()
+	sock.bind((address, 0))
+	port = sock.getsockname()[1]
+	sock.close()
+	return "{}:{}".format(address, port)
+
+def check_server_list(results, stub, work_dir):
+	cache_file = os.path.join(work_dir, "speedtest_server_list.json")
+	stub.servers = [server_entry(i, "127.0.0.2:{}".format(8000 + i)) for i in range(1, 11)]
+	url = stub.url + "/servers.xml"
+
+	servers = speedtest_servers.fetch_server_list(url, cache_file, 3600)
+	check(results, "download: all servers and attributes", len(servers) == 10 and servers[0] == stub.servers[0] \
+			and stub.downloads == 1, (len(servers), servers[:1]))
+	servers = speedtest_servers.fetch_server_list(url, cache_file, 3600)
+	check(results, "cache within TTL: no request", len(servers) == 10 and stub.requests == 1, stub.requests)
+
+	fetched = speedtest_servers.read_json(cache_file)["fetched"]
+	time.sleep(0.01)
+	servers = speedtest_servers.fetch_server_list(url, cache_file, 0)
+	check(results, "expired cache, list unchanged: 304, cached list", len(servers) == 10 and stub.not_modified == 1 \
+			and stub.downloads == 1 and speedtest_servers.read_json(cache_file)["fetched"] > fetched, \
+			(stub.not_modified, stub.downloads))
+
+	stub.version = 2
+	stub.servers = stub.servers[:4]
+	servers = speedtest_servers.fetch_server_list(url, cache_file, 0)
+	check(results, "expired cache, list changed: downloaded again", len(servers) == 4 and stub.downloads == 2 \
+			and speedtest_servers.read_json(cache_file)["etag"] == "\"v2\"", (len(servers), stub.downloads))
+
+	# the cache is only used for its URL: the failing URLs get a copy of the cached list
+	shutil.copy(cache_file, cache_file + ".saved")
+	cache = speedtest_servers.read_json(cache_file)
+	cache["url"] = stub.url + "/error"
+	speedtest_servers.write_json(cache_file, cache)
+	servers = speedtest_servers.fetch_server_list(stub.url + "/error", cache_file, 0)
+	check(results, "HTTP error: stale cached list", len(servers) == 4, len(servers))
+	try:
+		speedtest_servers.fetch_server_list(stub.url + "/error", None, 0)
+		raised = False
+	except OSError:
+		raised = True
+	check(results, "HTTP error without cache: OSError", raised)
+
+	cache["url"] = stub.url + "/broken.xml"
+	speedtest_servers.write_json(cache_file, cache)
+	servers = speedtest_servers.fetch_server_list(stub.url + "/broken.xml", cache_file, 0)
+	check(results, "invalid list: stale cached list", len(servers) == 4, len(servers))
+	try:
+		speedtest_servers.fetch_server_list(stub.url + "/broken.xml", None, 0)
+		raised = False
+	except ValueError:
+		raised = True
+	check(results, "invalid list without cache: ValueError", raised)
+	shutil.move(cache_file + ".saved", cache_file)
+
+	stub.version = 3
+	stub.servers = [server_entry(i, "host{}.example.com:8080".format(i)) for i in range(20000)]
+	servers = speedtest_servers.fetch_server_list(url, None, 0)
+	check(results, "large list parsed while received", len(servers) == 20000 and servers[-1]["id"] == "19999", len(servers))
+
+async def check_ranking(results, work_dir):
+	fast = [tcp_listener("127.0.0.2"), tcp_listener("127.0.0.3")]
+	slow = tcp_listener("127.0.0.4", 0.5)
+	# the accept queue of this listener stays full: connections time out
+	stalled = tcp_listener("127.0.0.7", 3600)
+	beyond = tcp_listener("127.0.0.5")
+	servers = [server_entry(1, slow.host), server_entry(2, closed_port("127.0.0.6")), server_entry(3, fast[0].host), \
+			server_entry(4, "unresolvable.invalid:8080"), server_entry(5, stalled.host), \
+			server_entry(6, fast[1].host), server_entry(7, beyond.host)]
+	attempts = 1
+	timeout = 2.0
+	start = time.monotonic()
+	ranked = await speedtest_servers.rank_servers(servers, 6, 0, attempts, timeout)
+	elapsed = time.monotonic() - start
+	check(results, "ranking: only servers that accepted a connection", sorted([s["id"] for s in ranked]) == ["1", "3", "6"], \
+			[s["id"] for s in ranked])
+	check(results, "ranking: ordered by connect time, slow server last", len(ranked) == 3 and ranked[-1]["id"] == "1" \
+			and ranked[0]["latency_ms"] <= ranked[1]["latency_ms"] and ranked[2]["latency_ms"] > 500, \
+			[(s["id"], s["latency_ms"]) for s in ranked])
+	check(results, "ranking: servers probed concurrently", elapsed < attempts * timeout + 0.5, "{:.2f} s".format(elapsed))
+	check(results, "ranking: servers beyond the candidates not probed", beyond.connections == 0, beyond.connections)
+
+	attempts = 3
+	ranked = await speedtest_servers.rank_servers(servers[2:3] + servers[5:6], 2, 1, attempts, 1.0)
+	time.sleep(0.1)
+	check(results, "ranking: one connection per attempt, shortlist size", len(ranked) == 1 \
+			and [l.connections for l in fast] == [1 + attempts, 1 + attempts], [l.connections for l in fast])
+	for l in fast + [slow, stalled, beyond]:
+		l.close()
+
+def check_shortlist(results, work_dir):
+	data_root = os.path.join(work_dir, "data")
+	settings = netperf_settings.__new__(netperf_settings)
+	settings.settings_json = { "data_root" : data_root, "speedtest" : { "client" : "ookla" } }
+	shortlist_file = settings.get_speedtest_shortlist_filename()
+	check(results, "no shortlist: no server id", settings.get_speedtest_server_id() is None \
+			and speedtest_servers.load_shortlist(shortlist_file) == (None, []))
+	os.makedirs(os.path.dirname(shortlist_file))
+	shortlist = [dict(server_entry(9, "127.0.0.2:8080"), latency_ms=1.5), dict(server_entry(8, "127.0.0.3:8080"), latency_ms=2.5)]
+	speedtest_servers.save_shortlist(shortlist_file, shortlist, 1000.0)
+	check(results, "shortlist saved and loaded", speedtest_servers.load_shortlist(shortlist_file) == (1000.0, shortlist))
+	check(results, "ranked selection: first server of the shortlist", settings.get_speedtest_server_selection() == "ranked" \
+			and settings.get_speedtest_server_id() == "9", settings.get_speedtest_server_id())
+	settings.settings_json["speedtest"]["server_id"] = "1234"
+	check(results, "manual selection: configured server", settings.get_speedtest_server_selection() == "manual" \
+			and settings.get_speedtest_server_id() == "1234", settings.get_speedtest_server_id())
+	settings.settings_json["speedtest"] = { "client" : "speedtest-cli" }
+	check(results, "speedtest-cli: the client chooses", settings.get_speedtest_server_selection() == "client" \
+			and settings.get_speedtest_server_id() is None, settings.get_speedtest_server_id())
+
+def check_command_line(results, stub, work_dir):
+	listener = tcp_listener("127.0.0.2")
+	stub.version = 4
+	stub.servers = [server_entry(1, closed_port("127.0.0.3")), server_entry(2, listener.host)]
+	cache_file = os.path.join(work_dir, "cli_server_list.json")
+	process = subprocess.run([sys.executable, os.path.join(NETPERF_PATH, "speedtest_servers.py"), "-u", stub.url + "/servers.xml", \
+			"-c", cache_file, "-t", "3600", "-n", "5"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+	try:
+		shortlist = json.loads(process.stdout)
+	except ValueError:
+		shortlist = []
+	check(results, "command line: JSON shortlist, cache written", [s["id"] for s in shortlist] == ["2"] \
+			and os.path.exists(cache_file), process.stdout)
+	process = subprocess.run([sys.executable, os.path.join(NETPERF_PATH, "speedtest_servers.py"), "-u", stub.url + "/error"], \
+			stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+	check(results, "command line: exit code 1 without a list", process.returncode == 1 and process.stdout == b"", process.returncode)
+	listener.close()
+
+def main():
+	results = []
+	work_dir = tempfile.mkdtemp()
+	stub = server_list_stub()
+	try:
+		check_server_list(results, stub, work_dir)
+		asyncio.run(check_ranking(results, work_dir))
+		check_shortlist(results, work_dir)
+		check_command_line(results, stub, work_dir)
+	finally:
+		stub.close()
+		shutil.rmtree(work_dir)
+	exit_status(results)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
+# See the file LICENSE for full license details.
+
+# Compressed time series chunks.
+#
+# A chunk holds a block of rows, each row being a timestamp followed by a fixed number of float values.
+# Timestamps are stored in microseconds as delta-of-delta values: regularly spaced samples (e.g. the 1 Hz
+# bandwidth monitor) give small values with mostly zero high bytes. Each value column is XORed with the previous
+# value of the same column (as in Gorilla, see "Gorilla: A Fast, Scalable, In-Memory Time Series Database",
+# Pelkonen et al., VLDB 2015): repeated values give zero, slowly changing values only their changed low bits.
+# The resulting 64 bit words are stored byte plane by byte plane and compressed with zlib, so that the zero
+# bytes of each column end up next to each other. All of the fields have a fixed width, so chunks are encoded
+# and decoded with whole-array NumPy operations (cumulative sums and XORs) rather than bit by bit.
+# Values are stored losslessly, timestamps are rounded to the nearest microsecond.
+#
+# chunk layout: header (version, number of value columns, row count), followed by the zlib compressed words:
+#	for each column (the timestamp delta-of-delta, then the XOR encoded value columns) and for each byte of the
+#	little endian 64 bit words, least significant first, the byte of every row.
+# Version 1 chunks (a Gorilla style bit stream: first timestamp and row values, then for each following row
+# the timestamp delta-of-delta and the XOR encoded value of each column, with variable length bit fields) are
+# still decoded, but no longer written: they have to be decoded bit by bit in Python, which is about 25 times
+# slower.
+
+import zlib
+import struct
+import numpy as np
+
+CHUNK_VERSION = 2
+CHUNK_HEADER = struct.Struct("<BBI")
+CHUNK_COMPRESSION_LEVEL = 6
+
+# delta-of-delta encodings of version 1 chunks: (control bits, control bit count, value bit count), tried in
+# order; a delta-of-delta of zero is encoded as a single 0 bit.
+DOD_ENCODINGS = [ (0b10, 2, 7), (0b110, 3, 14), (0b1110, 4, 20), (0b11110, 5, 32), (0b11111, 5, 64) ]
+
+def encode_chunk(rows):
+	# encodes a list of rows (timestamp, value 1, ..., value n), sorted by timestamp, returns the chunk bytes
+	count = len(rows)
+	if count == 0:
+		raise ValueError("cannot encode an empty chunk")
+	ncols = len(rows[0]) - 1
+	# NULL (None) values are stored as NaN
+	table = np.array(rows, dtype=np.float64).reshape(count, ncols + 1)
+	timestamps = np.rint(table[:,0] * 1e6).astype(np.int64)
+	words = np.empty((count, ncols + 1), dtype="<u8")
+	words[:,0] = np.diff(np.diff(timestamps, prepend=0), prepend=0).view(np.uint64)
+	values = table[:,1:].view(np.uint64)
+	words[:,1:] = values
+	words[1:,1:] ^= values[:-1]
+	planes = np.ascontiguousarray(words.view(np.uint8).reshape(count, ncols + 1, 8).transpose(1, 2, 0))
+	return CHUNK_HEADER.pack(CHUNK_VERSION, ncols, count) + zlib.compress(planes.tobytes(), CHUNK_COMPRESSION_LEVEL)
+
+def decode_chunk(data):
+	# decodes a chunk, returns a tuple of NumPy arrays: (timestamps in seconds, values with one row per sample
+	# and one column per value column)
+	(version, ncols, count) = CHUNK_HEADER.unpack_from(data, 0)
+	if version == 1:
+		return decode_chunk_v1(data, ncols, count)
+	if version != CHUNK_VERSION:
+		raise ValueError("unsupported chunk version {}".format(version))
+	planes = np.frombuffer(zlib.decompress(data[CHUNK_HEADER.size:]), dtype=np.uint8)
+	if len(planes) != count * (ncols + 1) * 8:
+		raise ValueError("invalid chunk size")
+	words = np.ascontiguousarray(planes.reshape(ncols + 1, 8, count).transpose(2, 0, 1)).view("<u8").reshape(count, ncols + 1)
+	timestamps = np.cumsum(np.cumsum(words[:,0].view(np.int64)))
+	values = np.bitwise_xor.accumulate(words[:,1:], axis=0).astype(np.uint64)
+	return (timestamps / 1e6, values.view(np.float64))
+
+def decode_chunk_v1(data, ncols, count):
+	# decodes the bit stream of a version 1 chunk
+	# windows[n] holds the 64 bits starting at byte n of the bit stream, so that any field of up to 57 bits
+	# can be read with a single lookup and shift (the bit stream is padded with 8 zero bytes)
+	stream = np.frombuffer(bytes(data[CHUNK_HEADER.size:]) + bytes(8), dtype=np.uint8).astype(np.uint64)
+	nwindows = len(stream) - 7
+	windows = np.zeros(nwindows, dtype=np.uint64)
+	for k in range(8):
+		windows |= stream[k:k + nwindows] << np.uint64(56 - 8 * k)
+	windows = windows.tolist()
+	pos = 0
+
+	def read(nbits):
+		nonlocal pos
+		if nbits > 57:
+			return (read(nbits - 32) << 32) | read(32)
+		value = (windows[pos >> 3] >> (64 - (pos & 7) - nbits)) & ((1 << nbits) - 1)
+		pos += nbits
+		return value
+
+	timestamps = [0] * count
+	values = [0] * (count * ncols)
+	prev_time = read(64)
+	timestamps[0] = prev_time
+	for c in range(ncols):
+		values[c] = read(64)
+	prev_delta = 0
+	prev_leading = [0] * ncols
+	prev_trailing = [0] * ncols
+	for i in range(1, count):
+		# the control bits (at most 5) are read from the window at the current position
+		window = windows[pos >> 3] << (pos & 7)
+		if window & 0x8000000000000000 == 0:
+			dod = 0
+			pos += 1
+		else:
+			for (control, control_bits, value_bits) in DOD_ENCODINGS:
+				if (window >> (64 - control_bits)) & ((1 << control_bits) - 1) == control:
+					break
+			pos += control_bits
+			if value_bits > 57:
+				dod = read(value_bits)
+			else:
+				dod = (windows[pos >> 3] >> (64 - (pos & 7) - value_bits)) & ((1 << value_bits) - 1)
+				pos += value_bits
+			# sign extend
+			if dod >= 1 << (value_bits - 1):
+				dod -= 1 << value_bits
+		prev_delta += dod
+		prev_time += prev_delta
+		timestamps[i] = prev_time
+		base = i * ncols
+		for c in range(ncols):
+			# the control bits and the leading/length fields (at most 13 bits) fit in the window
+			window = windows[pos >> 3] << (pos & 7)
+			if window & 0x8000000000000000 == 0:
+				values[base + c] = values[base - ncols + c]
+				pos += 1
+				continue
+			if window & 0x4000000000000000 == 0:
+				trailing = prev_trailing[c]
+				meaningful = 64 - prev_leading[c] - trailing
+				pos += 2
+			else:
+				leading = (window >> 57) & 0x1f
+				meaningful = (window >> 51) & 0x3f
+				if meaningful == 0:
+					meaningful = 64
+				trailing = 64 - leading - meaningful
+				prev_leading[c] = leading
+				prev_trailing[c] = trailing
+				pos += 13
+			if meaningful > 57:
+				xor = read(meaningful)
+			else:
+				# inlined read
+				xor = (windows[pos >> 3] >> (64 - (pos & 7) - meaningful)) & ((1 << meaningful) - 1)
+				pos += meaningful
+			values[base + c] = values[base - ncols + c] ^ (xor << trailing)
+	return (np.array(timestamps, dtype=np.int64) / 1e6, \
+		np.array(values, dtype=np.uint64).view(np.float64).reshape(count, ncols))
@@ -2,24 +2,50 @@
 # This file is part of the Network Performance Monitor which is released under the GNU General Public License v3.0
 # See the file LICENSE for full license details.
 
-from subprocess import check_output,Popen,STDOUT,PIPE
-import numpy as np
+import os
 import signal
 from datetime import datetime
 
 def nz_values(arr):
 # return an array containing all non-zero values in the source array
+	import numpy as np
 	nztuples = np.nonzero(arr)
 	nzvalues = []
 	for i in nztuples[0]:
 		nzvalues.append(arr[i])
 	return nzvalues
 
+CLIENT_ID = None
+
 def get_client_id():
-	cmd = "sum /etc/machine-id | cut -f 1 -d ' '"
-	ps = Popen(cmd,shell=True,stdout=PIPE,stderr=STDOUT)
-	(sn_str,return_code) = ps.communicate()
-	return (sn_str.decode()).rstrip("\n")
+	# the client id is the BSD checksum of the machine id, as printed by 'sum /etc/machine-id'. It is computed
+	# here rather than by running sum, and only once per process.
+	global CLIENT_ID
+	if CLIENT_ID is None:
+		checksum = 0
+		try:
+			with open("/etc/machine-id", "rb") as f:
+				data = f.read()
+		except OSError:
+			return ""
+		for byte in data:
+			checksum = ((checksum >> 1) + ((checksum & 1) << 15) + byte) & 0xffff
+		CLIENT_ID = "{:05d}".format(checksum)
+	return CLIENT_ID
+
+def pidfile_running(pidfile):
+	# returns True if the process recorded in the pid file is running
+	try:
+		with open(pidfile, "r") as f:
+			pid = int(f.read().strip())
+		os.kill(pid, 0)
+	except PermissionError:
+		# the process runs as another user
+		return True
+	except (OSError, ValueError):
+		# no pid file, or no such process
+		return False
+	return True
 
 class sigterm_handler():
 	def sh(self,signalNumber, frame):